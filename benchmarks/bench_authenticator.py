@@ -0,0 +1,70 @@
+"""
+CONNECT checks per second, and how long the event loop is held up by them.
+
+A cold storm is every device connecting for the first time, each check is a
+full KDF run in the thread pool. A reconnect storm is the same devices
+coming back within cache_ttl, answered from the cache without touching the
+pool. While a storm is checked a ticker task runs on the loop, its worst
+delay shows whether checking blocks the loop.
+
+    python benchmarks/bench_authenticator.py --devices 200 --iterations 200000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from authenticator import Authenticator, hash_password  # noqa: E402
+
+
+async def ticker(stop, delays, interval=0.001):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        delays.append(time.perf_counter() - start - interval)
+
+
+async def storm(authenticator, devices):
+    stop = asyncio.Event()
+    delays = []
+    tick = asyncio.create_task(ticker(stop, delays))
+    start = time.perf_counter()
+    results = await asyncio.gather(*(
+        authenticator.authenticate(f'device-{i}', b'secret') for i in range(devices)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await tick
+    assert all(results)
+    return devices / elapsed, max(delays, default=0)
+
+
+async def run(devices, iterations, workers):
+    encoded = hash_password('secret', iterations=iterations)
+    users = {f'device-{i}': encoded for i in range(devices)}
+    authenticator = Authenticator(users=users, workers=workers)
+    try:
+        cold = await storm(authenticator, devices)
+        cached = await storm(authenticator, devices)
+    finally:
+        authenticator.close()
+    return cold, cached
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--iterations', type=int, default=200_000)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    cold, cached = asyncio.run(run(args.devices, args.iterations, args.workers))
+    print(f'{"storm":>10} {"connects/s":>12} {"max loop delay ms":>18}')
+    for name, (rate, delay) in (('cold', cold), ('reconnect', cached)):
+        print(f'{name:>10} {rate:>12.0f} {delay * 1e3:>18.2f}')
+
+
+if __name__ == '__main__':
+    main()
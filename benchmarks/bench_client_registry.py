@@ -0,0 +1,65 @@
+"""
+Cost of routing a publish as the number of connected clients grows.
+
+Every client is registered with the server but only a few subscribe to the
+topic being published. Resolving subscribers through the client registry is
+one lookup per subscriber, so the time per publish should stay flat however
+many other clients are connected.
+
+    python benchmarks/bench_client_registry.py --clients 1000 10000 100000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from mqtt_server import MQTTServer  # noqa: E402
+
+
+class Client:
+    """ Stands in for an MQTTConnection, deliveries are just counted """
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.delivered = 0
+
+    def deliver(self, frame, qos, retain=False):
+        self.delivered += 1
+
+
+def run(clients, subscribers, messages):
+    server = MQTTServer()
+    for i in range(clients):
+        client = Client(f'client-{i}')
+        server.clients.register(client)
+        if i % (clients // subscribers) == 0:
+            server.add_new_subscription('bench/topic', client.client_id)
+
+    payload = b'x' * 64
+    start = time.perf_counter()
+    for _ in range(messages):
+        server.publish('bench/topic', payload)
+    elapsed = time.perf_counter() - start
+
+    delivered = sum(client.delivered for client in server.clients)
+    return elapsed / messages, delivered
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[1_000, 10_000, 100_000])
+    parser.add_argument('--subscribers', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=10_000)
+    args = parser.parse_args()
+
+    print(f'{"clients":>10} {"us/publish":>11} {"delivered":>10}')
+    for clients in args.clients:
+        per_publish, delivered = run(clients, args.subscribers, args.messages)
+        print(f'{clients:>10} {per_publish * 1e6:>11.2f} {delivered:>10}')
+
+
+if __name__ == '__main__':
+    main()
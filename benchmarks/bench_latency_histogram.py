@@ -0,0 +1,59 @@
+"""
+Cost of recording into a LatencyHistogram, and of reading percentiles out.
+
+Recording should cost about what the clock read it goes with does, and
+reading percentiles a pass over the buckets, whatever the number of values.
+
+    python benchmarks/bench_latency_histogram.py --values 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from latency_histogram import LatencyHistogram, format_histograms  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--values', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    # mostly tens of microseconds with a long tail, like packet handling
+    values = [int(random.lognormvariate(10, 1.5)) for _ in range(args.values)]
+    histogram = LatencyHistogram()
+
+    start = time.perf_counter()
+    for value in values:
+        histogram.record(value)
+    record = (time.perf_counter() - start) / len(values)
+
+    clock = time.perf_counter_ns
+    start = time.perf_counter()
+    for _ in range(len(values)):
+        clock()
+    clock_read = (time.perf_counter() - start) / len(values)
+
+    start = time.perf_counter()
+    percentiles = histogram.percentiles()
+    read = time.perf_counter() - start
+
+    values.sort()
+    worst = max(
+        (percentiles[p] - values[max(0, int(-(-len(values) * p // 100)) - 1)]) /
+        values[max(0, int(-(-len(values) * p // 100)) - 1)]
+        for p in percentiles)
+
+    print(f'record            {record * 1e9:8.0f} ns')
+    print(f'perf_counter_ns   {clock_read * 1e9:8.0f} ns')
+    print(f'percentiles       {read * 1e6:8.0f} us for {len(histogram.counts)} buckets')
+    print(f'worst error       {worst * 100:8.2f} %')
+    print()
+    print(format_histograms({'lognormal': histogram}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Loopback clients against tcp clients of the same embedded broker.
+
+One EmbeddedBroker also listens on a tcp port, and MQTTClients attach to it
+either way. Latency is a client publishing to a topic it's subscribed to
+and waiting for the message to come back, one at a time. Throughput is qos 0
+publishes from one client to another as fast as they go.
+
+    python benchmarks/bench_loopback.py --round-trips 5000 --messages 50000
+"""
+import argparse
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from latency_histogram import LatencyHistogram  # noqa: E402
+from loopback import EmbeddedBroker  # noqa: E402
+from mqtt_client import MQTTClient  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def client(address, port, client_id):
+    mqtt_client = MQTTClient(address, port, client_id, keep_alive=0)
+    mqtt_client.connect(timeout=5)
+    assert mqtt_client.connected
+    mqtt_client.start_loop()
+    return mqtt_client
+
+
+def subscribed(broker, count):
+    deadline = time.monotonic() + 5
+    while broker.call(lambda: len(broker.server.topics)) < count:
+        if time.monotonic() > deadline:
+            raise TimeoutError('subscription never arrived')
+        time.sleep(0.001)
+
+
+def latency(broker, address, port, round_trips, payload):
+    echo = client(address, port, 'bench-echo')
+    arrived = threading.Event()
+    echo.set_on_message_callback(lambda topic, message: arrived.set())
+    echo.subscribe('bench/echo')
+    subscribed(broker, 1)
+
+    histogram = LatencyHistogram()
+    for _ in range(round_trips):
+        arrived.clear()
+        start = time.perf_counter_ns()
+        echo.publish('bench/echo', payload)
+        if not arrived.wait(5):
+            raise TimeoutError('message never came back')
+        histogram.record(time.perf_counter_ns() - start)
+    return histogram
+
+
+def throughput(broker, address, port, messages, payload):
+    received = 0
+    done = threading.Event()
+
+    def on_message(topic, message):
+        nonlocal received
+        received += 1
+        if received == messages:
+            done.set()
+
+    subscriber = client(address, port, 'bench-sub')
+    subscriber.set_on_message_callback(on_message)
+    subscriber.subscribe('bench/t')
+    # the latency run's bench/echo is still there
+    subscribed(broker, 2)
+    publisher = client(address, port, 'bench-pub')
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        publisher.publish('bench/t', payload)
+    done.wait(60)
+    elapsed = time.perf_counter() - start
+    return received / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--round-trips', type=int, default=5_000)
+    parser.add_argument('--messages', type=int, default=50_000)
+    parser.add_argument('--size', type=int, default=64, help='payload bytes')
+    args = parser.parse_args()
+    # the client logs every publish, and the disconnects at the end
+    logging.disable(logging.WARNING)
+
+    payload = 'x' * args.size
+    port = free_port()
+    print(f'{"":>9} {"p50 us":>8} {"p99 us":>8} {"p99.9 us":>9} {"msgs/s":>10}')
+    for name, address in (('tcp', '127.0.0.1'), ('loopback', 'loopback://bench')):
+        # a broker per run, stopping it disconnects the run's clients
+        with EmbeddedBroker('bench', host='127.0.0.1', port=port, sys_interval=0,
+                            track_latency=False, max_queued_messages=10**7,
+                            max_queued_bytes=1 << 30) as broker:
+            histogram = latency(broker, address, port, args.round_trips, payload)
+            rate = throughput(broker, address, port, args.messages, payload)
+        p = histogram.percentiles((50, 99, 99.9))
+        print(f'{name:>9} {p[50] / 1000:>8.1f} {p[99] / 1000:>8.1f} '
+              f'{p[99.9] / 1000:>9.1f} {rate:>10.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Cost of the MQTTPackets a client makes for the packets it receives.
+
+Received PUBLISH and PUBACK frames are validated into packets, kept alive
+the way a client holds qos 2 messages until their PUBREL, and measured with
+tracemalloc. "untouched" never reads the topic or payload, "read" reads
+both as the on_message callback does.
+
+    python benchmarks/bench_mqtt_packet.py --packets 100000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from packet_generator import PacketGenerator  # noqa: E402
+from packet_validator import PacketValidator  # noqa: E402
+
+
+def frames(kind, count, size):
+    generator = PacketGenerator(None)
+    if kind == 'puback':
+        raw = generator.create_puback_packet(1).raw_bytes
+    else:
+        raw = generator.create_publish_packet('bench/topic/1', 'x' * size, 1, False).raw_bytes
+    # as the frame decoder hands them over
+    buffer = memoryview(raw * count).toreadonly()
+    return [buffer[i * len(raw):(i + 1) * len(raw)] for i in range(count)]
+
+
+def validate(validator, packets, read):
+    received = []
+    for frame in packets:
+        packet = validator.validate_packet(frame)
+        if read:
+            packet.topic
+            packet.payload
+        packet.packet_id
+        received.append(packet)
+    return received
+
+
+def measure(kind, count, size, read):
+    validator = PacketValidator(None)
+    packets = frames(kind, count, size)
+
+    start = time.perf_counter()
+    validate(validator, packets, read)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    received = validate(validator, packets, read)
+    held = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    del received
+    return held / count, elapsed / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packets', type=int, default=100_000)
+    parser.add_argument('--size', type=int, default=64, help='payload bytes')
+    args = parser.parse_args()
+
+    print(f'{"":>18} {"bytes/packet":>13} {"us/packet":>10}')
+    for kind, read in (('publish', False), ('publish', True), ('puback', False)):
+        held, per_packet = measure(kind, args.packets, args.size, read)
+        name = f'{kind} {"read" if read else "untouched"}' if kind == 'publish' else kind
+        print(f'{name:>18} {held:>13.0f} {per_packet:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Memory and drain speed of OfflineQueue for many disconnected devices.
+
+Queues messages for a fleet of offline devices and reports how much of it
+is held in Python memory (tracemalloc) versus spilled to memory-mapped
+files, then times draining one device's queue as it would be on reconnect.
+
+    python benchmarks/bench_offline_queue.py --devices 5000 --messages 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from offline_queue import OfflineQueue  # noqa: E402
+from publish_frame import PublishFrame  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=200,
+                        help='messages queued per device')
+    parser.add_argument('--payload', type=int, default=256)
+    parser.add_argument('--memory-budget', type=int, default=16 * 1024)
+    parser.add_argument('--segment-bytes', type=int, default=256 * 1024)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        tracemalloc.start()
+        queues = [OfflineQueue(os.path.join(directory, f'device-{i}'),
+                               memory_budget=args.memory_budget,
+                               segment_bytes=args.segment_bytes)
+                  for i in range(args.devices)]
+        payload = b'x' * args.payload
+
+        start = time.perf_counter()
+        for m in range(args.messages):
+            # one fleet-wide command at a time, like a broadcast topic
+            frame = PublishFrame(f'fleet/cmd/{m}', payload)
+            for queue in queues:
+                queue.put(frame, 1)
+        elapsed = time.perf_counter() - start
+        traced, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        queued = args.devices * args.messages
+        spilled = sum(queue.spilled_bytes for queue in queues)
+        in_memory = sum(queue.memory_bytes for queue in queues)
+        print(f'queued {queued:,} messages in {elapsed:.2f}s '
+              f'({queued / elapsed:,.0f}/s)')
+        print(f'message bytes in memory {in_memory / 2**20:.1f} MiB, '
+              f'spilled {spilled / 2**20:.1f} MiB')
+        print(f'python heap {traced / 2**20:.1f} MiB '
+              f'({traced / args.devices / 1024:.1f} KiB per device)')
+
+        queue = queues[0]
+        count = len(queue)
+        start = time.perf_counter()
+        for _ in queue.drain():
+            pass
+        elapsed = time.perf_counter() - start
+        print(f'drained {count:,} messages from one device in '
+              f'{elapsed * 1000:.1f}ms ({count / elapsed:,.0f}/s)')
+
+        for queue in queues:
+            queue.clear()
+
+
+if __name__ == '__main__':
+    main()
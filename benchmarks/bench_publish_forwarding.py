@@ -0,0 +1,93 @@
+"""
+Bytes copied and time taken to turn a received PUBLISH into the buffers
+written to a subscriber.
+
+The decoded path is what the broker did before frames were forwarded from
+the receive buffer: the validator decodes topic and payload to str and
+PublishFrame encodes them again. The forwarded path wraps the received
+frame with PublishFrame.from_packet(). Copies are measured as the memory
+allocated while a message is handled, with tracemalloc, everything made
+being kept until the buffers are built as it is in the broker.
+
+The transport joining the batch it's given (Python before 3.12) is a copy
+both paths share and isn't counted.
+
+    python benchmarks/bench_publish_forwarding.py --messages 100000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from packet_generator import PacketGenerator  # noqa: E402
+from packet_validator import PacketValidator  # noqa: E402
+from publish_frame import PublishFrame  # noqa: E402
+
+
+# the broker kept one per connection
+VALIDATOR = PacketValidator(None)
+
+
+def decoded(packet, delivery_qos):
+    publish = VALIDATOR.validate_packet(packet)
+    frame = PublishFrame(publish.topic, publish.payload)
+    return publish, frame, frame.buffers(delivery_qos, False, 1 if delivery_qos else None)
+
+
+def forwarded(packet, delivery_qos):
+    frame, _, _, _ = PublishFrame.from_packet(packet)
+    return frame, frame.buffers(delivery_qos, False, 1 if delivery_qos else None)
+
+
+def received_packet(size, qos):
+    raw = PacketGenerator(None).create_publish_packet('bench/topic', 'x' * size, qos, False).raw_bytes
+    # as the frame decoder hands it over
+    return memoryview(bytearray(raw)).toreadonly()
+
+
+def copied_bytes(path, packet, delivery_qos, samples=100):
+    tracemalloc.start()
+    total = 0
+    for _ in range(samples):
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = path(packet, delivery_qos)
+        total += tracemalloc.get_traced_memory()[1] - baseline
+        del result
+    tracemalloc.stop()
+    return total / samples
+
+
+def per_message_us(path, packet, delivery_qos, messages):
+    start = time.perf_counter()
+    for _ in range(messages):
+        path(packet, delivery_qos)
+    return (time.perf_counter() - start) / messages * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 1024, 65536],
+                        help='payload bytes')
+    args = parser.parse_args()
+
+    print(f'{"payload":>8} {"qos":>7} {"decoded B":>10} {"forwarded B":>12} '
+          f'{"decoded us":>11} {"forwarded us":>13}')
+    for size in args.sizes:
+        messages = max(1000, args.messages * 64 // max(size, 64))
+        for qos, delivery_qos in ((0, 0), (1, 1), (1, 0)):
+            packet = received_packet(size, qos)
+            row = [copied_bytes(decoded, packet, delivery_qos),
+                   copied_bytes(forwarded, packet, delivery_qos),
+                   per_message_us(decoded, packet, delivery_qos, messages),
+                   per_message_us(forwarded, packet, delivery_qos, messages)]
+            print(f'{size:>8} {f"{qos}->{delivery_qos}":>7} {row[0]:>10.0f} {row[1]:>12.0f} '
+                  f'{row[2]:>11.2f} {row[3]:>13.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark for RetainedStore with a large number of retained topics.
+
+Retains one reading per sensor under 'sensors/<id>/<kind>' and times how
+long a new subscription takes to get its first and all of its matches, plus
+what the store costs in memory per message (both as the store estimates it
+and as tracemalloc measures it).
+
+    python benchmarks/bench_retained_store.py --topics 500000
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from retained_store import RetainedStore  # noqa: E402
+
+KINDS = ('temp', 'humidity', 'pressure', 'battery')
+
+
+def build(store, topics, payload):
+    for i in range(topics):
+        store.set(f'sensors/{i // len(KINDS)}/{KINDS[i % len(KINDS)]}',
+                  payload, 1)
+
+
+def time_filter(store, topic_filter, repeat):
+    return min((run_filter(store, topic_filter) for _ in range(repeat)),
+               key=lambda result: result[2])
+
+
+def run_filter(store, topic_filter):
+    start = time.perf_counter()
+    messages = store.match(topic_filter)
+    first = next(messages, None)
+    first_at = time.perf_counter() - start
+    count = 0 if first is None else 1 + sum(1 for _ in messages)
+    return count, first_at, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--topics', type=int, default=500_000)
+    parser.add_argument('--payload', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per filter, the fastest is reported')
+    args = parser.parse_args()
+
+    store = RetainedStore()
+    tracemalloc.start()
+    start = time.perf_counter()
+    build(store, args.topics, b'x' * args.payload)
+    elapsed = time.perf_counter() - start
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = store.stats()
+    print(f'retained {stats["messages"]:,} messages in {elapsed:.2f}s')
+    print(f'estimated {stats["bytes_per_message"]:.0f} bytes/message, '
+          f'traced {traced / stats["messages"]:.0f} bytes/message')
+
+    # keep a full collection of the freshly built store out of the timings
+    gc.collect()
+    gc.freeze()
+
+    print(f'{"filter":>24} {"matches":>10} {"first":>10} {"all":>10}')
+    for topic_filter in ('sensors/1234/temp', 'sensors/1234/+',
+                         'sensors/+/temp', 'sensors/#'):
+        count, first_at, total = time_filter(store, topic_filter, args.repeat)
+        print(f'{topic_filter:>24} {count:>10,} {first_at * 1e3:>8.2f}ms '
+              f'{total * 1e3:>8.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Cost of picking a shared subscription member, per strategy and group size.
+
+A group of consumers subscribes to '$share/workers/jobs/+' and messages are
+published to a spread of topics. The time to walk the groups' trie and
+choose a member is reported, along with how evenly the messages were
+spread (the busiest member's share over a fair share).
+
+    python benchmarks/bench_shared_subscriptions.py --members 2 10 100
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from shared_subscriptions import SharedSubscriptions, STRATEGIES  # noqa: E402
+
+
+class Queue:
+    depth = 0
+
+
+class Consumer:
+    """ Stands in for an MQTTConnection with a few deliveries outstanding """
+
+    def __init__(self, inflight):
+        self.inflight = dict.fromkeys(range(inflight))
+        self.queue = Queue()
+
+
+def run(strategy, members, messages, topics):
+    shared = SharedSubscriptions(strategy)
+    clients = {}
+    for i in range(members):
+        client_id = f'worker-{i}'
+        shared.subscribe('workers', 'jobs/+', client_id, 1)
+        clients[client_id] = Consumer(i % 4)
+
+    names = [f'jobs/{i}' for i in range(topics)]
+    picked = Counter()
+    start = time.perf_counter()
+    for i in range(messages):
+        for client_id, _ in shared.match(names[i % topics], clients, {}):
+            picked[client_id] += 1
+    elapsed = time.perf_counter() - start
+    return elapsed / messages, max(picked.values()) / (messages / members)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--members', type=int, nargs='+', default=[2, 10, 100])
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--topics', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f'{"strategy":>15} {"members":>8} {"us/message":>11} {"max/fair":>9}')
+    for strategy in STRATEGIES:
+        for members in args.members:
+            per_message, skew = run(strategy, members, args.messages, args.topics)
+            print(f'{strategy:>15} {members:>8} {per_message * 1e6:>11.2f} {skew:>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Cost of keep-alive tracking in TimerWheel as the connection count grows.
+
+Every connection gets a 1.5x keep alive deadline. Each simulated second a
+fraction of them send a packet (touch) and the wheel is advanced, the cost
+of both is reported per connection count. Both should stay flat: a touch is
+a store, and an advance only looks at the timers in the slot that came due.
+
+    python benchmarks/bench_timer_wheel.py --connections 1000 10000 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from timer_wheel import TimerWheel  # noqa: E402
+
+
+def run(connections, keep_alive, active, seconds):
+    wheel = TimerWheel(resolution=1.0)
+    for key in range(connections):
+        # spread connects over one keep alive period like a real fleet
+        wheel.schedule(key, keep_alive * 1.5, now=random.uniform(0, keep_alive))
+
+    touched = random.sample(range(connections), int(connections * active))
+    touch_time = advance_time = 0.0
+    expired = 0
+    for second in range(int(keep_alive), int(keep_alive) + seconds):
+        start = time.perf_counter()
+        for key in touched:
+            wheel.touch(key, second)
+        touch_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        expired += len(wheel.advance(second))
+        advance_time += time.perf_counter() - start
+
+    touches = len(touched) * seconds
+    return (touch_time / touches if touches else 0,
+            advance_time / seconds, expired)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, nargs='+',
+                        default=[1_000, 10_000, 100_000])
+    parser.add_argument('--keep-alive', type=float, default=60)
+    parser.add_argument('--active', type=float, default=0.5,
+                        help='fraction of connections sending every second')
+    parser.add_argument('--seconds', type=int, default=120)
+    args = parser.parse_args()
+
+    print(f'{"connections":>12} {"ns/touch":>10} {"us/tick":>10} '
+          f'{"ns/tick/conn":>13} {"expired":>9}')
+    for connections in args.connections:
+        touch, advance, expired = run(
+            connections, args.keep_alive, args.active, args.seconds)
+        print(f'{connections:>12,} {touch * 1e9:>10.0f} {advance * 1e6:>10.1f} '
+              f'{advance * 1e9 / connections:>13.1f} {expired:>9,}')
+
+
+if __name__ == '__main__':
+    main()
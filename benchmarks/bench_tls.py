@@ -0,0 +1,154 @@
+"""
+TLS handshake rate and throughput against plaintext.
+
+A broker is started in its own process with a self-signed certificate made
+by the openssl command, listening both plain and with TLS. Then:
+
+    connects/s   sequential connections, each a TCP connect, handshake,
+                 CONNECT and CONNACK, for plaintext, full TLS handshakes and
+                 TLS handshakes resuming the first connection's session
+    MB/s         qos 0 publishes from one client to one subscriber, both
+                 plain or both over TLS
+
+    python benchmarks/bench_tls.py --connections 500 --messages 100000
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import tls  # noqa: E402
+from mqtt_server import MQTTServer  # noqa: E402
+from packet_generator import PacketGenerator  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(port, tls_port, certfile, keyfile, ciphers):
+    MQTTServer('127.0.0.1', port, max_queued_messages=10**7,
+               max_queued_bytes=1 << 30, sys_interval=0,
+               tls_context=tls.server_context(certfile, keyfile, ciphers=ciphers),
+               tls_port=tls_port).run()
+
+
+def wait_for(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError(f'broker never listened on {port}')
+
+
+def connect(port, client_id, context=None, session=None):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if context is not None:
+        sock = context.wrap_socket(sock, server_hostname='localhost', session=session)
+    sock.sendall(PacketGenerator(None).create_connect_packet(client_id=client_id).raw_bytes)
+    assert sock.recv(4) == b'\x20\x02\x00\x00'
+    return sock
+
+
+def handshake_rate(port, connections, context=None, resume=False):
+    session = None
+    if resume:
+        first = connect(port, 'bench-first', context)
+        session = first.session
+        first.close()
+    start = time.perf_counter()
+    for i in range(connections):
+        sock = connect(port, f'bench-{i}', context, session)
+        if resume:
+            assert sock.session_reused
+        sock.close()
+    return connections / (time.perf_counter() - start)
+
+
+def throughput(port, messages, size, context=None):
+    pg = PacketGenerator(None)
+    subscriber = connect(port, 'bench-sub', context)
+    subscriber.sendall(pg.create_subscribe_packet('bench/t', 0).raw_bytes)
+    subscriber.recv(5)
+
+    packet = pg.create_publish_packet('bench/t', 'x' * size, 0, False).raw_bytes
+    expected = len(packet) * messages
+    publisher = connect(port, 'bench-pub', context)
+    chunk = packet * max(1, 65536 // len(packet))
+
+    def publish():
+        sent = 0
+        while sent < expected:
+            data = chunk[:expected - sent]
+            publisher.sendall(data)
+            sent += len(data)
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=publish)
+    thread.start()
+    received = 0
+    buffer = bytearray(256 * 1024)
+    while received < expected:
+        n = subscriber.recv_into(buffer)
+        if not n:
+            break
+        received += n
+    elapsed = time.perf_counter() - start
+    thread.join()
+    publisher.close()
+    subscriber.close()
+    return received / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--size', type=int, default=256, help='payload bytes')
+    parser.add_argument('--ciphers', default=None,
+                        help='OpenSSL cipher list for TLS 1.2')
+    parser.add_argument('--tls12', action='store_true',
+                        help='stay on TLS 1.2, resumed from the session cache')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = tls.self_signed_certificate(directory)
+        port, tls_port = free_port(), free_port()
+        broker = multiprocessing.Process(
+            target=serve, args=(port, tls_port, certfile, keyfile, args.ciphers),
+            daemon=True)
+        broker.start()
+        try:
+            wait_for(port)
+            wait_for(tls_port)
+            context = tls.client_context(cafile=certfile, ciphers=args.ciphers)
+            if args.tls12:
+                context.maximum_version = ssl.TLSVersion.TLSv1_2
+
+            print(f'{"":>12} {"connects/s":>12} {"MB/s":>8}')
+            print(f'{"plaintext":>12} {handshake_rate(port, args.connections):>12.0f} '
+                  f'{throughput(port, args.messages, args.size):>8.1f}')
+            print(f'{"tls full":>12} '
+                  f'{handshake_rate(tls_port, args.connections, context):>12.0f} '
+                  f'{throughput(tls_port, args.messages, args.size, context):>8.1f}')
+            print(f'{"tls resumed":>12} '
+                  f'{handshake_rate(tls_port, args.connections, context, True):>12.0f}')
+        finally:
+            broker.terminate()
+            broker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Cost of an ACL check as the number of rules grows.
+
+Every user gets a few rules of their own on top of a handful of patterns
+shared by everyone. Uncached is the trie walk a connection does the first
+time it publishes to a topic, cached is every publish to that topic after,
+answered from the connection's LRU.
+
+    python benchmarks/bench_topic_acl.py --users 100 1000 10000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from topic_acl import TopicAcl, READ, WRITE, READWRITE  # noqa: E402
+
+
+def build(users):
+    acl = TopicAcl()
+    acl.add_rule('$SYS/#', READ, pattern=True)
+    acl.add_rule('devices/%c/#', READWRITE, pattern=True)
+    acl.add_rule('users/%u/inbox', READ, pattern=True)
+    for i in range(users):
+        acl.add_rule(f'tenants/{i}/#', READWRITE, user=f'user-{i}')
+        acl.add_rule(f'tenants/{i}/+/config', READ, user=f'user-{i}')
+        acl.add_rule(f'shared/{i % 10}/+/telemetry', WRITE, user=f'user-{i}')
+        acl.add_rule(f'firmware/{i % 100}', READ, user=f'user-{i}')
+    return acl
+
+
+def run(users, checks):
+    acl = build(users)
+    topics = [f'devices/device-7/sensor/{i}' for i in range(50)] + \
+             [f'tenants/7/room/{i}' for i in range(50)]
+
+    start = time.perf_counter()
+    for i in range(checks):
+        # a new checker each time so nothing is cached
+        acl.checker('device-7', 'user-7').can_publish(topics[i % len(topics)])
+    uncached = (time.perf_counter() - start) / checks
+
+    checker = acl.checker('device-7', 'user-7')
+    start = time.perf_counter()
+    for i in range(checks):
+        checker.can_publish(topics[i % len(topics)])
+    cached = (time.perf_counter() - start) / checks
+    return len(acl), uncached, cached
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, nargs='+', default=[100, 1_000, 10_000])
+    parser.add_argument('--checks', type=int, default=200_000)
+    args = parser.parse_args()
+
+    print(f'{"rules":>10} {"uncached ns":>12} {"cached ns":>10}')
+    for users in args.users:
+        rules, uncached, cached = run(users, args.checks)
+        print(f'{rules:>10} {uncached * 1e9:>12.0f} {cached * 1e9:>10.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark for TopicTrie.match at a large number of subscriptions.
+
+Builds an index shaped like a device fleet (one command topic per device,
+a few per-site wildcard subscriptions and some global monitors) and times
+matching random publish topics against it.
+
+    python benchmarks/bench_topic_trie.py --subscriptions 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from topic_trie import TopicTrie  # noqa: E402
+
+
+def build(trie, subscriptions, sites):
+    devices = subscriptions - sites * 2 - 2
+    if devices <= 0:
+        raise ValueError(
+            f'{subscriptions} subscriptions leave no devices with {sites} sites')
+    for device in range(devices):
+        trie.subscribe(f'site/{device % sites}/device/{device}/cmd',
+                       f'device-{device}', 1)
+    for site in range(sites):
+        trie.subscribe(f'site/{site}/device/+/cmd', f'site-monitor-{site}', 0)
+        trie.subscribe(f'site/{site}/#', f'site-logger-{site}', 0)
+    trie.subscribe('site/+/device/+/cmd', 'fleet-monitor', 1)
+    trie.subscribe('#', 'audit', 0)
+    return devices
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subscriptions', type=int, default=1_000_000)
+    parser.add_argument('--sites', type=int, default=1000)
+    parser.add_argument('--lookups', type=int, default=200_000)
+    args = parser.parse_args()
+    if args.sites < 1 or args.lookups < 1:
+        parser.error('--sites and --lookups must be at least 1')
+    if args.subscriptions < args.sites * 2 + 3:
+        # every site has two subscriptions of its own, plus the two global
+        # ones and at least one device
+        parser.error(f'--subscriptions must be at least {args.sites * 2 + 3} '
+                     f'with --sites {args.sites}, lower --sites for fewer')
+
+    trie = TopicTrie()
+    tracemalloc.start()
+    start = time.perf_counter()
+    devices = build(trie, args.subscriptions, args.sites)
+    build_time = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rng = random.Random(1)
+    topics = []
+    for _ in range(args.lookups):
+        device = rng.randrange(devices)
+        topics.append(f'site/{device % args.sites}/device/{device}/cmd')
+
+    start = time.perf_counter()
+    matched = 0
+    for topic in topics:
+        matched += len(trie.match(topic))
+    match_time = time.perf_counter() - start
+
+    print(f'subscriptions:       {len(trie)}')
+    print(f'build:               {build_time:.2f} s '
+          f'({memory / len(trie):.0f} B/subscription)')
+    print(f'lookups:             {args.lookups}')
+    print(f'subscribers/lookup:  {matched / args.lookups:.1f}')
+    print(f'match:               {match_time / args.lookups * 1e6:.2f} us/lookup '
+          f'({args.lookups / match_time:,.0f} lookups/s)')
+
+
+if __name__ == '__main__':
+    main()
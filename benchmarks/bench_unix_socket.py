@@ -0,0 +1,143 @@
+"""
+Unix domain socket against TCP loopback for clients on the broker's host.
+
+A broker is started in its own process listening on both. Latency is a
+client publishing to a topic it's subscribed to and waiting for the message
+to come back, one at a time. Throughput is qos 0 publishes from one client
+to another as fast as they go.
+
+    python benchmarks/bench_unix_socket.py --round-trips 10000 --messages 200000
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from latency_histogram import LatencyHistogram  # noqa: E402
+from mqtt_server import MQTTServer  # noqa: E402
+from packet_generator import PacketGenerator  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(port, unix_path):
+    MQTTServer('127.0.0.1', port, max_queued_messages=10**7,
+               max_queued_bytes=1 << 30, sys_interval=0, track_latency=False,
+               unix_path=unix_path).run()
+
+
+def connect(address, client_id):
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX)
+    else:
+        sock = socket.socket()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    for _ in range(100):
+        try:
+            sock.connect(address)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            time.sleep(0.05)
+    sock.sendall(PacketGenerator(None).create_connect_packet(client_id=client_id).raw_bytes)
+    assert sock.recv(4) == b'\x20\x02\x00\x00'
+    return sock
+
+
+def subscribe(sock, topic):
+    sock.sendall(PacketGenerator(None).create_subscribe_packet(topic, 0).raw_bytes)
+    assert sock.recv(5)[0] == 0x90
+
+
+def recv_exactly(sock, size, buffer):
+    view = memoryview(buffer)[:size]
+    while view:
+        n = sock.recv_into(view)
+        if not n:
+            raise ConnectionError('broker closed the connection')
+        view = view[n:]
+
+
+def latency(address, round_trips, size):
+    sock = connect(address, 'bench-echo')
+    subscribe(sock, 'bench/echo')
+    packet = PacketGenerator(None).create_publish_packet('bench/echo', 'x' * size, 0, False).raw_bytes
+    buffer = bytearray(len(packet))
+    histogram = LatencyHistogram()
+    for _ in range(round_trips):
+        start = time.perf_counter_ns()
+        sock.sendall(packet)
+        recv_exactly(sock, len(packet), buffer)
+        histogram.record(time.perf_counter_ns() - start)
+    sock.close()
+    return histogram
+
+
+def throughput(address, messages, size):
+    subscriber = connect(address, 'bench-sub')
+    subscribe(subscriber, 'bench/t')
+    publisher = connect(address, 'bench-pub')
+    packet = PacketGenerator(None).create_publish_packet('bench/t', 'x' * size, 0, False).raw_bytes
+    chunk = packet * max(1, 65536 // len(packet))
+    expected = len(packet) * messages
+
+    def publish():
+        sent = 0
+        while sent < expected:
+            data = chunk[:expected - sent]
+            publisher.sendall(data)
+            sent += len(data)
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=publish)
+    thread.start()
+    received = 0
+    buffer = bytearray(256 * 1024)
+    while received < expected:
+        n = subscriber.recv_into(buffer)
+        if not n:
+            break
+        received += n
+    elapsed = time.perf_counter() - start
+    thread.join()
+    publisher.close()
+    subscriber.close()
+    return messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--round-trips', type=int, default=10_000)
+    parser.add_argument('--messages', type=int, default=200_000)
+    parser.add_argument('--size', type=int, default=64, help='payload bytes')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        unix_path = os.path.join(directory, 'mqtt.sock')
+        port = free_port()
+        broker = multiprocessing.Process(target=serve, args=(port, unix_path), daemon=True)
+        broker.start()
+        try:
+            print(f'{"":>6} {"p50 us":>8} {"p99 us":>8} {"p99.9 us":>9} {"msgs/s":>10}')
+            for name, address in (('tcp', ('127.0.0.1', port)), ('unix', unix_path)):
+                histogram = latency(address, args.round_trips, args.size)
+                rate = throughput(address, args.messages, args.size)
+                p = histogram.percentiles((50, 99, 99.9))
+                print(f'{name:>6} {p[50] / 1000:>8.1f} {p[99] / 1000:>8.1f} '
+                      f'{p[99.9] / 1000:>9.1f} {rate:>10.0f}')
+        finally:
+            broker.terminate()
+            broker.join()
+
+
+if __name__ == '__main__':
+    main()
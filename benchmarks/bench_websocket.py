@@ -0,0 +1,209 @@
+"""
+MQTT over WebSocket against plain TCP.
+
+First the cost of unmasking client frames, byte by byte in Python against
+unmask()'s bulk translate. Then a broker is started in its own process with
+a WebSocket listener and qos 0 publishes are sent from one client to one
+subscriber, both over TCP or both over WebSocket. The publisher's frames
+are masked up front so only the broker's side is measured.
+
+    python benchmarks/bench_websocket.py --messages 100000 --size 256
+"""
+import argparse
+import base64
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from mqtt_server import MQTTServer  # noqa: E402
+from packet_generator import PacketGenerator  # noqa: E402
+from websocket_transport import unmask, frame_header, OPCODE_BINARY  # noqa: E402
+
+
+def unmask_bytewise(data, mask):
+    for i in range(len(data)):
+        data[i] ^= mask[i & 3]
+
+
+def unmask_rates(sizes, total=8 * 1024 * 1024):
+    mask = os.urandom(4)
+    print(f'{"bytes":>8} {"bytewise MB/s":>14} {"bulk MB/s":>10}')
+    for size in sizes:
+        data = bytearray(os.urandom(size))
+        rates = []
+        for function, volume in ((unmask_bytewise, total // 16), (unmask, total)):
+            rounds = max(1, volume // size)
+            start = time.perf_counter()
+            for _ in range(rounds):
+                function(data, mask)
+            rates.append(rounds * size / (time.perf_counter() - start) / 1e6)
+        print(f'{size:>8} {rates[0]:>14.1f} {rates[1]:>10.1f}')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(port, websocket_port):
+    MQTTServer('127.0.0.1', port, max_queued_messages=10**7,
+               max_queued_bytes=1 << 30, sys_interval=0,
+               websocket_port=websocket_port).run()
+
+
+def wait_for(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError(f'broker never listened on {port}')
+
+
+def masked(data):
+    mask = os.urandom(4)
+    payload = bytearray(data)
+    unmask(payload, mask)
+    return frame_header(OPCODE_BINARY, len(payload), mask) + payload
+
+
+class Stream:
+    """ A client socket, over WebSocket when websocket is True """
+
+    def __init__(self, port, websocket):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.websocket = websocket
+        self.buffer = bytearray()
+        # payload bytes left in the frame being read
+        self.remaining = 0
+        if websocket:
+            key = base64.b64encode(os.urandom(16)).decode()
+            self.sock.sendall(
+                (f'GET /mqtt HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+                 f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n'
+                 f'Sec-WebSocket-Version: 13\r\nSec-WebSocket-Protocol: mqtt\r\n\r\n').encode())
+            response = b''
+            while b'\r\n\r\n' not in response:
+                response += self.sock.recv(4096)
+            assert response.startswith(b'HTTP/1.1 101')
+
+    def frame(self, data):
+        return masked(data) if self.websocket else data
+
+    def send(self, data):
+        self.sock.sendall(self.frame(data))
+
+    def read(self, size):
+        """ Returns at most size MQTT bytes, reading more if needed """
+        while True:
+            data = self.take(size)
+            if data:
+                return data
+            received = self.sock.recv(256 * 1024)
+            if not received:
+                return b''
+            self.buffer += received
+
+    def take(self, size):
+        if not self.websocket:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        while not self.remaining:
+            if len(self.buffer) < 2:
+                return b''
+            length, header = self.buffer[1] & 0x7F, 2
+            if length == 126:
+                if len(self.buffer) < 4:
+                    return b''
+                length, header = int.from_bytes(self.buffer[2:4], 'big'), 4
+            elif length == 127:
+                if len(self.buffer) < 10:
+                    return b''
+                length, header = int.from_bytes(self.buffer[2:10], 'big'), 10
+            del self.buffer[:header]
+            self.remaining = length
+        count = min(size, self.remaining, len(self.buffer))
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        self.remaining -= count
+        return data
+
+    def connect(self, client_id):
+        self.send(PacketGenerator(None).create_connect_packet(client_id=client_id).raw_bytes)
+        assert self.read(4) == b'\x20\x02\x00\x00'
+
+    def close(self):
+        self.sock.close()
+
+
+def throughput(port, websocket, messages, size):
+    pg = PacketGenerator(None)
+    subscriber = Stream(port, websocket)
+    subscriber.connect('bench-sub')
+    subscriber.send(pg.create_subscribe_packet('bench/t', 0).raw_bytes)
+    suback = b''
+    while len(suback) < 5:
+        suback += subscriber.read(5 - len(suback))
+
+    publisher = Stream(port, websocket)
+    publisher.connect('bench-pub')
+    packet = pg.create_publish_packet('bench/t', 'x' * size, 0, False).raw_bytes
+    per_chunk = max(1, 32768 // len(packet))
+    chunk = publisher.frame(packet * per_chunk)
+    expected = len(packet) * (messages // per_chunk) * per_chunk
+
+    def publish():
+        for _ in range(messages // per_chunk):
+            publisher.sock.sendall(chunk)
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=publish)
+    thread.start()
+    received = 0
+    while received < expected:
+        data = subscriber.read(expected - received)
+        if not data:
+            break
+        received += len(data)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    publisher.close()
+    subscriber.close()
+    return received / len(packet) / elapsed, received / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--size', type=int, default=256, help='payload bytes')
+    args = parser.parse_args()
+
+    unmask_rates([64, 1024, 16384, 65536])
+    print()
+
+    port, websocket_port = free_port(), free_port()
+    broker = multiprocessing.Process(target=serve, args=(port, websocket_port), daemon=True)
+    broker.start()
+    try:
+        wait_for(port)
+        wait_for(websocket_port)
+        print(f'{"":>10} {"msgs/s":>10} {"MB/s":>8}')
+        for name, listener, websocket in (('tcp', port, False),
+                                          ('websocket', websocket_port, True)):
+            rate, megabytes = throughput(listener, websocket, args.messages, args.size)
+            print(f'{name:>10} {rate:>10.0f} {megabytes:>8.1f}')
+    finally:
+        broker.terminate()
+        broker.join()
+
+
+if __name__ == '__main__':
+    main()
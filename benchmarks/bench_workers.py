@@ -0,0 +1,156 @@
+"""
+Throughput of the multi-process broker as the number of workers grows.
+
+For each worker count a broker is started with --workers N, then subscriber
+and publisher processes connect (SO_REUSEPORT spreads them over the
+workers, so most messages have to cross a worker link) and the rate at
+which subscribers receive messages is reported.
+
+    python benchmarks/bench_workers.py --max-workers 4 --messages 50000
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(__file__), '..', 'src')
+sys.path.insert(0, SRC)
+
+from frame_decoder import FrameDecoder  # noqa: E402
+from packet_generator import PacketGenerator  # noqa: E402
+from publish_frame import PublishFrame  # noqa: E402
+
+
+def connect(port, client_id):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(PacketGenerator(None).create_connect_packet(
+        client_id=client_id).raw_bytes)
+    assert sock.recv(4) == b'\x20\x02\x00\x00'
+    return sock
+
+
+def subscriber(port, client_id, expected, ready, results):
+    sock = connect(port, client_id)
+    sock.sendall(PacketGenerator(None).create_subscribe_packet(
+        'bench/#', 0).raw_bytes)
+    sock.recv(5)  # SUBACK
+    ready.release()
+
+    decoder = FrameDecoder()
+    received = 0
+    first = None
+    sock.settimeout(30)
+    try:
+        while received < expected:
+            n = sock.recv_into(decoder.get_buffer())
+            if not n:
+                break
+            if first is None:
+                first = time.perf_counter()
+            decoder.buffer_updated(n)
+            received += sum(1 for _ in decoder.frames())
+    except socket.timeout:
+        pass
+    results.put((received, first, time.perf_counter()))
+    sock.close()
+
+
+def publisher(port, client_id, messages, payload_size, go):
+    sock = connect(port, client_id)
+    frame = PublishFrame(f'bench/{client_id}', b'x' * payload_size).buffers()[0]
+    batch = frame * 100
+    go.wait()
+    for _ in range(messages // 100):
+        sock.sendall(batch)
+    sock.sendall(frame * (messages % 100))
+    # keep the connection open until everything has been routed
+    time.sleep(2)
+    sock.close()
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError('broker did not start')
+
+
+def run(workers, args):
+    broker = subprocess.Popen(
+        [sys.executable, os.path.join(SRC, 'mqtt_server.py'), '--host',
+         '127.0.0.1', '--port', str(args.port), '--workers', str(workers)],
+        stdout=subprocess.DEVNULL, start_new_session=True)
+    try:
+        wait_for_port(args.port)
+        # let every worker bind before clients start arriving
+        time.sleep(0.5)
+
+        ready = multiprocessing.Semaphore(0)
+        go = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        expected = args.messages * args.publishers
+
+        subs = [multiprocessing.Process(
+            target=subscriber, args=(args.port, f'sub-{i}', expected, ready, results))
+            for i in range(args.subscribers)]
+        pubs = [multiprocessing.Process(
+            target=publisher, args=(args.port, f'pub-{i}', args.messages,
+                                    args.payload, go))
+            for i in range(args.publishers)]
+
+        for process in subs:
+            process.start()
+        for _ in subs:
+            ready.acquire()
+        # interest has to reach every worker before publishing starts
+        time.sleep(0.2)
+        for process in pubs:
+            process.start()
+        go.set()
+
+        outcomes = [results.get() for _ in subs]
+        for process in subs + pubs:
+            process.join()
+    finally:
+        os.killpg(broker.pid, signal.SIGINT)
+        broker.wait()
+
+    received = sum(r[0] for r in outcomes)
+    starts = [r[1] for r in outcomes if r[1] is not None]
+    elapsed = max(r[2] for r in outcomes) - min(starts) if starts else float('inf')
+    return received, expected * len(subs), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--port', type=int, default=18830)
+    parser.add_argument('--publishers', type=int, default=4)
+    parser.add_argument('--subscribers', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=50_000,
+                        help='messages per publisher')
+    parser.add_argument('--payload', type=int, default=32)
+    args = parser.parse_args()
+
+    print(f'{"workers":>8} {"delivered":>12} {"msgs/s":>12} {"scaling":>8}')
+    baseline = None
+    workers = 1
+    while workers <= args.max_workers:
+        received, expected, elapsed = run(workers, args)
+        rate = received / elapsed
+        baseline = baseline or rate
+        print(f'{workers:>8} {received:>5}/{expected:<6} {rate:>12,.0f} '
+              f'{rate / baseline:>7.2f}x')
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Throughput of the write-ahead log with and without group commit.
+
+A number of concurrent publishers each log a QoS 1 message and wait for its
+commit before sending the next, like clients waiting for PUBACK. With one
+publisher every message pays a full fsync, with many the commits arriving
+within the window share one.
+
+    python benchmarks/bench_write_ahead_log.py --publishers 1 100 --window 0 0.002
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from publish_frame import PublishFrame  # noqa: E402
+from write_ahead_log import WriteAheadLog  # noqa: E402
+
+
+async def publisher(wal, name, messages, payload):
+    loop = asyncio.get_running_loop()
+    for i in range(messages):
+        frame = PublishFrame(f'bench/{name}', payload)
+        wal.log_message(frame, 1, False, [(f'sub-{name}', 1)])
+        committed = loop.create_future()
+        wal.commit(lambda f=committed: f.set_result(None))
+        await committed
+
+
+async def run(publishers, window, messages, payload):
+    with tempfile.TemporaryDirectory() as directory:
+        wal = WriteAheadLog(directory, commit_window=window)
+        wal.open(asyncio.get_running_loop())
+        per_publisher = max(1, messages // publishers)
+        start = time.perf_counter()
+        await asyncio.gather(*(publisher(wal, i, per_publisher, payload)
+                               for i in range(publishers)))
+        elapsed = time.perf_counter() - start
+        await wal.wait_synced()
+        wal.close()
+        return per_publisher * publishers, elapsed, wal.syncs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--publishers', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--window', type=float, nargs='+', default=[0, 0.002])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--payload', type=int, default=64)
+    args = parser.parse_args()
+
+    payload = b'x' * args.payload
+    print(f'{"publishers":>10} {"window":>8} {"msgs/s":>10} {"fsyncs":>8} '
+          f'{"msgs/fsync":>11}')
+    for publishers in args.publishers:
+        for window in args.window:
+            count, elapsed, syncs = asyncio.run(
+                run(publishers, window, args.messages, payload))
+            print(f'{publishers:>10} {window * 1000:>6.1f}ms '
+                  f'{count / elapsed:>10,.0f} {syncs:>8,} {count / syncs:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Compares one sendall() per packet with the coalescing SocketWriter when
+pushing many small frames (PUBACK sized by default) over a local socket.
+
+    python benchmarks/bench_write_coalescing.py --packets 200000 --size 4
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from socket_writer import SocketWriter  # noqa: E402
+
+
+def drain(sock, total):
+    received = 0
+    buffer = bytearray(256 * 1024)
+    while received < total:
+        n = sock.recv_into(buffer)
+        if not n:
+            break
+        received += n
+
+
+def run(packets, size, make_writer):
+    a, b = socket.socketpair()
+    frame = b'\x40' + bytes([size - 2]) + b'\x00' * (size - 2)
+    reader = threading.Thread(target=drain, args=(b, packets * size))
+    reader.start()
+
+    start = time.perf_counter()
+    write, flush = make_writer(a)
+    for _ in range(packets):
+        write(frame)
+    flush()
+    reader.join()
+    elapsed = time.perf_counter() - start
+
+    a.close()
+    b.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packets', type=int, default=200_000)
+    parser.add_argument('--size', type=int, default=4)
+    args = parser.parse_args()
+
+    def plain(sock):
+        return sock.sendall, lambda: None
+
+    def coalesced(sock):
+        writer = SocketWriter(sock)
+        return writer.write, writer.flush
+
+    results = {
+        'sendall per packet': run(args.packets, args.size, plain),
+        'SocketWriter': run(args.packets, args.size, coalesced),
+    }
+
+    for name, elapsed in results.items():
+        print(f'{name:<20} {args.packets / elapsed:>12,.0f} packets/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""
+HTTP admin endpoint, statistics for monitoring and poking around a running
+broker.
+
+    GET /metrics                 Prometheus text format
+    GET /api/stats               the $SYS statistics as JSON
+    GET /api/clients?limit=100   connected clients, deepest queues first
+    GET /api/subscriptions       subscription and shared group counts
+    GET /api/topics?limit=10     busiest topics over the last window
+    GET /api/latency             latency histogram percentiles
+
+It listens on a port of its own and is served by http.server threads, so
+slow or stuck HTTP clients never hold up the event loop. The broker's state
+belongs to the loop though, so each request hands a function to the loop
+with call_soon_threadsafe to gather the numbers and waits for the result.
+Only that gathering runs on the loop, formatting and writing the response
+happen in the request's thread.
+"""
+import concurrent.futures
+import heapq
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from logging_setup import LoggerSetup
+logger = LoggerSetup.get_logger(__name__)
+
+# seconds a request waits for the loop to gather what it asked for
+GATHER_TIMEOUT = 5
+
+PROMETHEUS_PREFIX = 'mqtt_'
+# snapshot paths that go up and down, everything else is a counter
+GAUGES = {
+    'uptime', 'clients/connected', 'clients/disconnected', 'clients/maximum',
+    'subscriptions/count', 'subscriptions/shared/groups',
+    'retained messages/count', 'store/messages/count', 'store/messages/bytes',
+    'store/offline/count', 'store/offline/bytes',
+}
+# per packet type paths, exported as one metric with a type label
+PACKET_PATHS = ('packets/received/', 'packets/sent/',
+                'packets/bytes/received/', 'packets/bytes/sent/')
+# quantiles of each latency histogram exported as a summary
+LATENCY_QUANTILES = (50, 90, 99, 99.9)
+
+
+def metric_name(path):
+    return PROMETHEUS_PREFIX + path.replace('/', '_').replace(' ', '_')
+
+
+def counter_name(name):
+    # counters end in _total, once: clients/total is mqtt_clients_total
+    if name.endswith('_total'):
+        return name
+    return name + '_total'
+
+
+def latency_summaries(metrics):
+    """ Percentiles, count and total of every latency histogram in use
+
+    Returns:
+        dict of name to ({percentile: nanoseconds}, count, total nanoseconds)
+    """
+    return {name: (histogram.percentiles(LATENCY_QUANTILES), histogram.count,
+                   histogram.total)
+            for name, histogram in metrics.latency_histograms().items()}
+
+
+def prometheus_text(stats, latency=None):
+    """ Renders a BrokerMetrics snapshot in the Prometheus text format
+
+    Args:
+        latency: latency_summaries(), exported as one summary labelled by name
+    """
+    lines = []
+    labelled = {}
+    for path, value in stats.items():
+        for prefix in PACKET_PATHS:
+            if path.startswith(prefix):
+                labelled.setdefault(prefix, []).append(
+                    (path[len(prefix):], value))
+                break
+        else:
+            kind = 'gauge' if path in GAUGES else 'counter'
+            name = metric_name(path)
+            if kind == 'counter':
+                name = counter_name(name)
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+
+    for prefix in PACKET_PATHS:
+        name = counter_name(metric_name(prefix.rstrip('/')))
+        lines.append(f'# TYPE {name} counter')
+        for packet_type, value in labelled.get(prefix, ()):
+            lines.append(f'{name}{{type="{packet_type}"}} {value}')
+
+    if latency:
+        name = PROMETHEUS_PREFIX + 'latency_seconds'
+        lines.append(f'# TYPE {name} summary')
+        for histogram, (percentiles, count, total) in latency.items():
+            for percentile, value in percentiles.items():
+                lines.append(f'{name}{{name="{histogram}",quantile="{percentile / 100:g}"}} '
+                             f'{value / 1e9:.9f}')
+            lines.append(f'{name}_sum{{name="{histogram}"}} {total / 1e9:.9f}')
+            lines.append(f'{name}_count{{name="{histogram}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+class AdminRequestHandler(BaseHTTPRequestHandler):
+    # set on the subclass made for each AdminServer
+    admin = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        route = self.admin.routes.get(url.path)
+        if route is None:
+            self.respond(404, 'text/plain', b'Not found\n')
+            return
+
+        try:
+            limit = int(query['limit'][0]) if 'limit' in query else None
+            content_type, body = route(limit)
+        except ValueError:
+            self.respond(400, 'text/plain', b'Bad limit\n')
+            return
+        except concurrent.futures.TimeoutError:
+            self.respond(503, 'text/plain', b'Broker busy\n')
+            return
+        self.respond(200, content_type, body)
+
+    def respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f'Admin {self.address_string()} {format % args}')
+
+
+class AdminServer:
+    """ Serves the admin endpoint for an MQTTServer from a thread
+
+    Args:
+        server: the MQTTServer, its loop must be running
+        host, port: where to listen, port 0 picks a free one
+    """
+
+    def __init__(self, server, host='localhost', port=8080):
+        self.server = server
+        self.host = host
+        self.port = port
+        self.httpd = None
+        self.thread = None
+        self.routes = {
+            '/metrics': self.metrics,
+            '/api/stats': self.stats,
+            '/api/clients': self.clients,
+            '/api/subscriptions': self.subscriptions,
+            '/api/topics': self.topics,
+            '/api/latency': self.latency,
+        }
+
+    def start(self):
+        handler = type('Handler', (AdminRequestHandler,), {'admin': self})
+        self.httpd = ThreadingHTTPServer((self.host, self.port), handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, name='mqtt-admin', daemon=True)
+        self.thread.start()
+        logger.info(f'Admin endpoint listening on port {self.port}')
+
+    def close(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+        self.thread = None
+
+    def gather(self, function):
+        """ Runs function on the broker's loop and returns its result, called
+        from request threads
+        """
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(function())
+            except Exception as e:
+                future.set_exception(e)
+
+        self.server.loop.call_soon_threadsafe(run)
+        return future.result(GATHER_TIMEOUT)
+
+    # routes, each returns (content type, body)
+
+    def metrics(self, limit):
+        metrics = self.server.metrics
+        stats, latency = self.gather(
+            lambda: (metrics.snapshot(self.server), latency_summaries(metrics)))
+        return ('text/plain; version=0.0.4',
+                prometheus_text(stats, latency).encode('utf-8'))
+
+    def stats(self, limit):
+        stats = self.gather(lambda: self.server.metrics.snapshot(self.server))
+        return self.json(stats)
+
+    def clients(self, limit):
+        def gather():
+            clients = heapq.nlargest(limit or 100, self.server.clients,
+                                     key=lambda client: client.queue.depth)
+            return len(self.server.clients), [
+                {
+                    'client_id': client.client_id,
+                    'peer': str(client.peername),
+                    'clean_session': client.clean_session,
+                    'keep_alive': client.keep_alive,
+                    'subscriptions': len(client.subscriptions),
+                    'inflight': len(client.inflight),
+                    'queue': client.queue.stats(),
+                }
+                for client in clients]
+
+        count, clients = self.gather(gather)
+        return self.json({'connected': count, 'clients': clients})
+
+    def subscriptions(self, limit):
+        def gather():
+            return {
+                'count': len(self.server.topics),
+                'shared_groups': self.server.shared.stats(),
+                'persistent_sessions': len(self.server.sessions),
+            }
+        return self.json(self.gather(gather))
+
+    def topics(self, limit):
+        rates = self.server.metrics.topic_rates
+
+        def gather():
+            return rates.top(limit or 10), rates.previous_untracked / rates.window
+
+        top, untracked = self.gather(gather)
+        return self.json({
+            'window': rates.window,
+            'topics': [{'topic': topic, 'rate': rate} for topic, rate in top],
+            'untracked_rate': untracked,
+        })
+
+    def latency(self, limit):
+        histograms = self.server.metrics.latency_histograms
+        return self.json(self.gather(
+            lambda: {name: histogram.stats()
+                     for name, histogram in histograms().items()}))
+
+    def json(self, data):
+        return 'application/json', json.dumps(data).encode('utf-8')
+
@@ -0,0 +1,282 @@
+"""
+Username and password authentication for CONNECT.
+
+Passwords are stored as salted hashes from a deliberately slow key
+derivation function, PBKDF2-HMAC-SHA256 or scrypt, one user per line of a
+password file:
+
+    username:pbkdf2_sha256$<iterations>$<salt>$<hash>
+    username:scrypt$<n>$<r>$<p>$<salt>$<hash>
+
+with salt and hash base64 encoded. hash_password() makes them, and running
+this module adds or replaces a user in a file:
+
+    python src/authenticator.py passwords.txt device-1
+
+Checking a password costs tens of milliseconds of CPU on purpose, so
+Authenticator never does it on the event loop. Checks run in a thread pool
+(hashlib releases the GIL while it hashes), concurrent checks of the same
+credentials share one run, and successful ones are remembered for cache_ttl
+seconds. A fleet of devices reconnecting at once then costs one KDF run per
+device rather than one per attempt. The cache holds a keyed hash of the
+password, never the password itself.
+"""
+import argparse
+import asyncio
+import base64
+import getpass
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from logging_setup import LoggerSetup
+logger = LoggerSetup.get_logger(__name__)
+
+PBKDF2_SHA256 = 'pbkdf2_sha256'
+SCRYPT = 'scrypt'
+SCHEMES = (PBKDF2_SHA256, SCRYPT)
+
+PBKDF2_ITERATIONS = 200_000
+# n=2**14, r=8 is 16MiB of memory per check
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+
+
+class AuthenticatorError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(f"Authentication error: {message}")
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def hash_password(password, scheme=PBKDF2_SHA256, salt=None, **params):
+    """ Hashes a password for the password file
+
+    Args:
+        password: str or bytes
+        scheme: one of SCHEMES
+        params: iterations for PBKDF2, n, r and p for scrypt, the defaults
+            are the module constants
+
+    Returns:
+        the encoded hash, with its scheme, parameters and salt
+    """
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    if salt is None:
+        salt = os.urandom(SALT_BYTES)
+
+    if scheme == PBKDF2_SHA256:
+        iterations = params.get('iterations', PBKDF2_ITERATIONS)
+        digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+        return f'{scheme}${iterations}${_b64encode(salt)}${_b64encode(digest)}'
+    if scheme == SCRYPT:
+        n = params.get('n', SCRYPT_N)
+        r = params.get('r', SCRYPT_R)
+        p = params.get('p', SCRYPT_P)
+        digest = hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                                maxmem=256 * n * r + 1024 * 1024)
+        return f'{scheme}${n}${r}${p}${_b64encode(salt)}${_b64encode(digest)}'
+    raise AuthenticatorError(f'Unknown password scheme {scheme}')
+
+
+def verify_password(password, encoded):
+    """ Checks a password against an encoded hash, in constant time once
+    the hash is computed
+
+    Raises:
+        AuthenticatorError: if the encoded hash can't be parsed
+    """
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    try:
+        scheme, *fields = encoded.split('$')
+        if scheme == PBKDF2_SHA256:
+            iterations, salt, expected = fields
+            digest = hashlib.pbkdf2_hmac(
+                'sha256', password, base64.b64decode(salt), int(iterations))
+        elif scheme == SCRYPT:
+            n, r, p, salt, expected = fields
+            n, r, p = int(n), int(r), int(p)
+            digest = hashlib.scrypt(password, salt=base64.b64decode(salt),
+                                    n=n, r=r, p=p,
+                                    maxmem=256 * n * r + 1024 * 1024)
+        else:
+            raise AuthenticatorError(f'Unknown password scheme {scheme}')
+        return hmac.compare_digest(digest, base64.b64decode(expected))
+    except (ValueError, TypeError) as e:
+        raise AuthenticatorError(f'Malformed password hash: {e}')
+
+
+def load_password_file(path):
+    """ Reads username:hash lines, blank lines and # comments are skipped
+
+    Returns:
+        dict of username to encoded hash
+    """
+    users = {}
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            username, separator, encoded = line.rpartition(':')
+            if not separator or not username:
+                raise AuthenticatorError(f'{path}:{number}: expected username:hash')
+            users[username] = encoded
+    return users
+
+
+def save_password_file(path, users):
+    """ Writes the users out atomically, replacing the file """
+    temporary = f'{path}.tmp'
+    fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        for username, encoded in sorted(users.items()):
+            f.write(f'{username}:{encoded}\n')
+    os.replace(temporary, path)
+
+
+class Authenticator:
+    """ Checks CONNECT credentials against a password file
+
+    Any object with a coroutine authenticate(username, password) returning
+    True or False can be given to the server instead.
+
+    Args:
+        password_file: path of the username:hash file, see the module
+            docstring
+        users: dict of username to encoded hash, instead of a file
+        workers: threads checking passwords
+        cache_ttl: seconds a successful check is remembered, 0 for never
+        cache_size: most successful checks remembered, least recently used
+            are forgotten first
+    """
+
+    def __init__(self, password_file=None, users=None, workers=None,
+                 cache_ttl=300, cache_size=100_000):
+        self.password_file = password_file
+        self.users = dict(users) if users else {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers if workers else min(4, os.cpu_count() or 1),
+            thread_name_prefix='mqtt-auth')
+
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        # username -> (keyed hash of the password, expiry)
+        self.cache = OrderedDict()
+        # so what the cache holds is useless outside this process
+        self._cache_key = os.urandom(32)
+        # (username, keyed hash) -> future of a check that's running
+        self._checking = {}
+        # checked against for unknown users so they take as long as known ones
+        self._dummy_hash = hash_password(os.urandom(16))
+        if password_file is not None:
+            self.reload()
+
+        self.verified = 0
+        self.cache_hits = 0
+        self.failures = 0
+
+    def reload(self):
+        """ Re-reads the password file, remembered checks are forgotten """
+        self.users = load_password_file(self.password_file)
+        self.cache.clear()
+        logger.info(f'Loaded {len(self.users)} users from {self.password_file}')
+
+    def invalidate(self, username=None):
+        """ Forgets remembered checks for a user, or for everyone """
+        if username is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(username, None)
+
+    def _cache_digest(self, password):
+        return hmac.new(self._cache_key, password, hashlib.sha256).digest()
+
+    async def authenticate(self, username, password):
+        """ True if the credentials are valid
+
+        Args:
+            username: str, or None if the CONNECT had none
+            password: bytes, or None
+        """
+        if username is None or password is None:
+            return False
+        if isinstance(password, str):
+            password = password.encode('utf-8')
+
+        digest = self._cache_digest(password)
+        cached = self.cache.get(username)
+        if cached is not None:
+            cached_digest, expiry = cached
+            if time.monotonic() < expiry and hmac.compare_digest(cached_digest, digest):
+                self.cache.move_to_end(username)
+                self.cache_hits += 1
+                return True
+            del self.cache[username]
+
+        key = (username, digest)
+        future = self._checking.get(key)
+        if future is None:
+            encoded = self.users.get(username)
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self.executor, self._verify, password, encoded)
+            self._checking[key] = future
+            future.add_done_callback(lambda _: self._checking.pop(key, None))
+        valid = await asyncio.shield(future)
+
+        if not valid:
+            self.failures += 1
+            return False
+        self.verified += 1
+        if self.cache_ttl:
+            self.cache[username] = (digest, time.monotonic() + self.cache_ttl)
+            self.cache.move_to_end(username)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return True
+
+    def _verify(self, password, encoded):
+        """ Runs in the thread pool """
+        if encoded is None:
+            verify_password(password, self._dummy_hash)
+            return False
+        try:
+            return verify_password(password, encoded)
+        except AuthenticatorError as e:
+            logger.error(e.message)
+            return False
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            'users': len(self.users),
+            'cached': len(self.cache),
+            'verified': self.verified,
+            'cache_hits': self.cache_hits,
+            'failures': self.failures,
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add a user to a password file')
+    parser.add_argument('password_file')
+    parser.add_argument('username')
+    parser.add_argument('--scheme', choices=SCHEMES, default=PBKDF2_SHA256)
+    args = parser.parse_args()
+
+    users = load_password_file(args.password_file) if os.path.exists(args.password_file) else {}
+    users[args.username] = hash_password(getpass.getpass(), args.scheme)
+    save_password_file(args.password_file, users)
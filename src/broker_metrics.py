@@ -0,0 +1,214 @@
+"""
+Broker statistics for the $SYS topic tree.
+
+The counters are plain ints and lists bumped inline by the code that sees
+the event. Everything for a broker runs on its one event loop so nothing
+needs a lock. Counting a packet costs one list index and add. Anything that
+can be worked out from state the broker keeps anyway, like the number of
+clients, subscriptions or queued messages, isn't counted at all: it's read
+when a snapshot is taken.
+
+snapshot() merges both into a flat dict keyed by the path under
+'$SYS/broker/', which the server publishes every sys_interval seconds. With
+several workers each one keeps, and publishes, its own.
+
+TopicRates counts publishes per topic over fixed windows for the admin
+endpoint's busiest topics.
+
+Latency histograms, in nanoseconds, are kept by name in latency:
+    handle/<packet>        handling a packet from a client, by type
+    decode/publish         pulling a PUBLISH apart
+    route                  matching and queueing a PUBLISH for delivery
+    inbound_to_outbound    from reading a PUBLISH to writing it to a
+                           subscriber, once per live delivery
+"""
+import heapq
+import time
+
+from latency_histogram import LatencyHistogram
+from packets import PACKET_NAMES
+
+
+class TopicRates:
+    """ Publishes per topic over the last complete window
+
+    Counting is a dict increment per publish. At most max_topics topics are
+    counted per window, publishes to any more are only added to untracked, so
+    a flood of distinct topics can't grow it without bound.
+
+    Args:
+        window: seconds per window, rotate() is expected to be called this
+            often
+    """
+
+    def __init__(self, window=10.0, max_topics=10000):
+        self.window = window
+        self.max_topics = max_topics
+        self.current = {}
+        self.untracked = 0
+        # counts of the last complete window
+        self.previous = {}
+        self.previous_untracked = 0
+
+    def record(self, topic):
+        current = self.current
+        count = current.get(topic)
+        if count is not None:
+            current[topic] = count + 1
+        elif len(current) < self.max_topics:
+            current[topic] = 1
+        else:
+            self.untracked += 1
+
+    def rotate(self):
+        self.previous = self.current
+        self.previous_untracked = self.untracked
+        self.current = {}
+        self.untracked = 0
+
+    def top(self, count=10):
+        """ The busiest topics of the last window
+
+        Returns:
+            list of (topic, publishes per second), busiest first
+        """
+        busiest = heapq.nlargest(count, self.previous.items(),
+                                 key=lambda item: item[1])
+        return [(topic, publishes / self.window) for topic, publishes in busiest]
+
+
+class BrokerMetrics:
+    """
+    Args:
+        track_latency: keep the latency histograms, False saves the clock
+            reads on every packet
+    """
+
+    def __init__(self, topic_rate_window=10.0, track_latency=True):
+        self.started = time.monotonic()
+
+        # sockets accepted, and connections that completed a CONNECT
+        self.sockets_opened = 0
+        self.connections_total = 0
+        self.connections_maximum = 0
+        # closed for being slow consumers or missing their keep alive
+        self.slow_consumer_disconnects = 0
+        self.keep_alive_expired = 0
+        # CONNECTs refused for bad credentials
+        self.auth_failures = 0
+        # publishes and subscriptions refused by the ACL
+        self.publish_denied = 0
+        self.subscribe_denied = 0
+
+        # by packet type, indexed by the fixed header's top four bits
+        self.packets_received = [0] * 16
+        self.packets_sent = [0] * 16
+        self.packet_bytes_received = [0] * 16
+        self.packet_bytes_sent = [0] * 16
+        # what was actually read from and handed to the sockets
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+        # deliveries discarded by a slow consumer policy or a full offline
+        # queue
+        self.messages_dropped = 0
+
+        # publishes received per topic, see TopicRates
+        self.topic_rates = TopicRates(topic_rate_window)
+
+        self.track_latency = track_latency
+        # name -> LatencyHistogram
+        self.latency = {}
+        # by packet type like the counters, only those seen are named
+        self.handle_latency = [LatencyHistogram() for _ in range(16)]
+        self.decode_latency = self.histogram('decode/publish')
+        self.route_latency = self.histogram('route')
+        self.delivery_latency = self.histogram('inbound_to_outbound')
+
+    def histogram(self, name):
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = LatencyHistogram()
+        return histogram
+
+    def latency_histograms(self):
+        """ Every histogram with something in it, by name """
+        histograms = {f'handle/{name}': self.handle_latency[index]
+                      for index, name in PACKET_NAMES.items()}
+        histograms.update(self.latency)
+        return {name: histogram for name, histogram in histograms.items()
+                if histogram.count}
+
+    def packet_received(self, command, size):
+        index = command >> 4
+        self.packets_received[index] += 1
+        self.packet_bytes_received[index] += size
+
+    def packet_sent(self, command, size):
+        index = command >> 4
+        self.packets_sent[index] += 1
+        self.packet_bytes_sent[index] += size
+
+    def client_connected(self, connected):
+        self.connections_total += 1
+        if connected > self.connections_maximum:
+            self.connections_maximum = connected
+
+    def snapshot(self, server):
+        """ The counters merged with gauges read from the server's state
+
+        Returns:
+            dict of '$SYS/broker/' relative path to number
+        """
+        stats = {
+            'uptime': int(time.monotonic() - self.started),
+            'clients/connected': len(server.clients),
+            'clients/disconnected': sum(
+                1 for session in server.sessions.values() if not session.connected),
+            'clients/total': self.connections_total,
+            'clients/maximum': self.connections_maximum,
+            'clients/expired': self.keep_alive_expired,
+            'clients/slow_consumer_disconnects': self.slow_consumer_disconnects,
+            'clients/auth_failures': self.auth_failures,
+            'sockets/opened': self.sockets_opened,
+            'bytes/received': self.bytes_received,
+            'bytes/sent': self.bytes_sent,
+            'messages/received': sum(self.packets_received),
+            'messages/sent': sum(self.packets_sent),
+            'publish/messages/received': self.packets_received[3],
+            'publish/messages/sent': self.packets_sent[3],
+            'publish/messages/dropped': self.messages_dropped,
+            'publish/messages/denied': self.publish_denied,
+            'publish/bytes/received': self.packet_bytes_received[3],
+            'publish/bytes/sent': self.packet_bytes_sent[3],
+            'subscriptions/count': len(server.topics),
+            'subscriptions/shared/groups': len(server.shared),
+            'subscriptions/denied': self.subscribe_denied,
+            'retained messages/count': len(server.retained),
+        }
+
+        queued = queued_bytes = 0
+        for client in server.clients:
+            queued += client.queue.depth
+            queued_bytes += client.queue.bytes
+        stats['store/messages/count'] = queued
+        stats['store/messages/bytes'] = queued_bytes
+
+        tls_stats = server.tls_stats()
+        if tls_stats is not None:
+            stats['tls/handshakes'] = tls_stats['handshakes']
+            stats['tls/resumed'] = tls_stats['resumed']
+
+        offline = offline_bytes = 0
+        for session in server.sessions.values():
+            offline += len(session.offline)
+            offline_bytes += session.offline.bytes
+        stats['store/offline/count'] = offline
+        stats['store/offline/bytes'] = offline_bytes
+
+        for index, name in PACKET_NAMES.items():
+            stats[f'packets/received/{name}'] = self.packets_received[index]
+            stats[f'packets/sent/{name}'] = self.packets_sent[index]
+            stats[f'packets/bytes/received/{name}'] = self.packet_bytes_received[index]
+            stats[f'packets/bytes/sent/{name}'] = self.packet_bytes_sent[index]
+        return stats
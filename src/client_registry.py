@@ -0,0 +1,64 @@
+"""
+Connected clients, keyed by client id.
+
+The broker resolves subscriber ids from the topic index to connections here,
+so routing a message costs one dict lookup per subscriber however many
+clients are connected. A client id names at most one connection
+[MQTT-3.1.4-2]: registering a second connection under an id hands back the
+first so the caller can take it over.
+"""
+import itertools
+
+
+class ClientRegistry:
+    def __init__(self, prefix='auto'):
+        # client id -> MQTTConnection
+        self.connections = {}
+        # for ids the server assigns to clients that sent none
+        self.prefix = prefix
+        self._assigned = itertools.count(1)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __iter__(self):
+        # a snapshot, connections can come and go while it's being used
+        return iter(list(self.connections.values()))
+
+    def __contains__(self, client_id):
+        return client_id in self.connections
+
+    def get(self, client_id):
+        return self.connections.get(client_id)
+
+    def register(self, connection):
+        """ Makes connection the one for its client id
+
+        Returns:
+            the connection previously registered under the id, if any, which
+            the caller is expected to close
+        """
+        previous = self.connections.get(connection.client_id)
+        self.connections[connection.client_id] = connection
+        return previous if previous is not connection else None
+
+    def unregister(self, connection):
+        """ Removes a connection, unless its id has already been taken over
+        by a newer one
+
+        Returns:
+            True if it was removed
+        """
+        if self.connections.get(connection.client_id) is connection:
+            del self.connections[connection.client_id]
+            return True
+        return False
+
+    def assign_id(self):
+        """ A client id that isn't in use, for a client that connected with
+        an empty one [MQTT-3.1.3-6]
+        """
+        while True:
+            client_id = f'{self.prefix}-{next(self._assigned)}'
+            if client_id not in self.connections:
+                return client_id
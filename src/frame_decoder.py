@@ -0,0 +1,152 @@
+"""
+Incremental MQTT frame decoder shared by the broker and the client.
+
+Bytes are received straight into the decoder's buffer (get_buffer() then
+buffer_updated(), the same shape as asyncio.BufferedProtocol and
+socket.recv_into) and complete frames come back out of frames() as
+memoryviews into that buffer, so framing is a single pass over the data with
+no per-packet copies or buffer shifting.
+
+Bytes that have been handed out as a frame are never overwritten. When the
+buffer runs out of room the unconsumed tail is moved to the front if nothing
+still references the old frames, otherwise it's copied to a fresh buffer and
+the old one lives on for as long as the frames do.
+"""
+
+# largest remaining length a 4 byte variable length integer can hold plus
+# the fixed header itself [MQTT-2.2.3]
+MAX_REMAINING_LENGTH = 268435455
+DEFAULT_MAX_PACKET_SIZE = MAX_REMAINING_LENGTH + 5
+
+
+class FrameDecoderError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(f"Error while decoding frame: {message}")
+
+
+class FrameDecoder:
+    """
+    Args:
+        max_packet_size: largest whole packet (fixed header included) that is
+            accepted, anything bigger raises FrameDecoderError
+        buffer_size: size of the receive buffer, grown for larger packets
+        min_read: smallest amount of free space handed to a read
+    """
+
+    def __init__(self, max_packet_size=DEFAULT_MAX_PACKET_SIZE,
+                 buffer_size=64 * 1024, min_read=4096):
+        self.max_packet_size = max_packet_size
+        self.buffer_size = buffer_size
+        self.min_read = min_read
+
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        # unconsumed data lives in _buffer[_start:_end]
+        self._start = 0
+        self._end = 0
+        # length of the frame at _start once its header has been decoded
+        self._needed = 0
+
+    def __len__(self):
+        """ Number of received bytes not yet returned as frames """
+        return self._end - self._start
+
+    def get_buffer(self, sizehint=-1):
+        """ Writable memoryview to receive the next chunk of data into """
+        free = len(self._buffer) - self._end
+        if free < self.min_read or free < sizehint or \
+                self._start + self._needed > len(self._buffer):
+            self._make_room(max(sizehint, self.min_read))
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """ Marks nbytes of the buffer from get_buffer() as received """
+        self._end += nbytes
+
+    def feed(self, data):
+        """ Copies data in, for callers that already have the bytes """
+        data = memoryview(data)
+        while data:
+            buffer = self.get_buffer(len(data))
+            n = min(len(buffer), len(data))
+            buffer[:n] = data[:n]
+            del buffer
+            self.buffer_updated(n)
+            data = data[n:]
+
+    def frames(self):
+        """ Yields every complete frame received so far
+
+        Yields:
+            read-only memoryview of a single packet, fixed header included
+
+        Raises:
+            FrameDecoderError: for a malformed remaining length or a packet
+                larger than max_packet_size
+        """
+        while True:
+            buffer = self._buffer
+            start = self._start
+            available = self._end - start
+            if available < 2:
+                return
+
+            if not self._needed:
+                remaining_length = 0
+                multiplier = 1
+                index = 1
+                while True:
+                    if index >= available:
+                        # header split across reads, wait for the rest
+                        return
+                    byte = buffer[start + index]
+                    remaining_length += (byte & 0x7F) * multiplier
+                    index += 1
+                    if not byte & 0x80:
+                        break
+                    if index == 5:
+                        raise FrameDecoderError(
+                            "Malformed Remaining Length field: length too long")
+                    multiplier *= 128
+
+                self._needed = index + remaining_length
+                if self._needed > self.max_packet_size:
+                    raise FrameDecoderError(
+                        f"Packet of {self._needed} bytes exceeds maximum "
+                        f"of {self.max_packet_size}")
+
+            if available < self._needed:
+                return
+
+            end = start + self._needed
+            self._start = end
+            self._needed = 0
+            yield self._view[start:end].toreadonly()
+
+    def _make_room(self, wanted):
+        tail = self._end - self._start
+        size = max(self.buffer_size, self._needed, tail + wanted)
+
+        self._view.release()
+        if size <= len(self._buffer) and self._unshared():
+            # nobody is holding on to earlier frames, reuse the buffer
+            self._buffer[:tail] = self._buffer[self._start:self._end]
+        else:
+            buffer = bytearray(size)
+            buffer[:tail] = self._buffer[self._start:self._end]
+            self._buffer = buffer
+
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = tail
+
+    def _unshared(self):
+        # a bytearray can't change size while any memoryview of it is alive,
+        # which is the cheapest way to ask whether frames are still in use
+        try:
+            self._buffer.append(0)
+        except BufferError:
+            return False
+        del self._buffer[-1]
+        return True
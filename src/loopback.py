@@ -0,0 +1,361 @@
+"""
+An in-process broker for embedding and for tests, reached without a socket.
+
+EmbeddedBroker runs an MQTTServer on an event loop in a thread of its own,
+with no listener unless it's given a port. MQTTClients in the same process
+attach to it by name:
+
+    with EmbeddedBroker('test'):
+        client = MQTTClient('loopback://test', 0)
+        client.connect()
+
+The client gets a LoopbackSocket in place of its socket and the broker's
+MQTTConnection a LoopbackTransport, so both sides run the code they always
+do. What the client sends is handed to the broker's loop as is, the PUBLISH
+packets it builds as the MQTTPacket objects themselves, which the broker
+routes from their fields without decoding them again. Everything else, and
+everything the broker sends back, is bytes copied from one side's buffer
+to the other's. There are no system calls, no kernel buffers and no ports,
+so it's also a quick stand-in for a real broker in integration tests.
+"""
+import asyncio
+import errno
+import threading
+
+from mqtt_connection import MQTTConnection
+from mqtt_server import MQTTServer
+from logging_setup import LoggerSetup
+logger = LoggerSetup.get_logger(__name__)
+
+LOOPBACK_SCHEME = 'loopback://'
+DEFAULT_WRITE_BUFFER_HIGH = 64 * 1024
+
+# name -> running EmbeddedBroker
+BROKERS = {}
+
+
+class LoopbackError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(f"Loopback error: {message}")
+
+
+class EmbeddedBroker:
+    """ An MQTTServer on an event loop in a thread of its own
+
+    Args:
+        name: clients connect to 'loopback://<name>'
+        server_options: MQTTServer arguments, it opens no tcp listener
+            unless given a port
+    """
+
+    def __init__(self, name='broker', **server_options):
+        self.name = name
+        server_options.setdefault('port', None)
+        self.server = MQTTServer(**server_options)
+        self.loop = None
+        self.thread = None
+        # LoopbackTransports of the attached clients
+        self.transports = set()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def running(self):
+        return self.loop is not None
+
+    def start(self):
+        """ Starts the broker's thread and waits for the server to start
+
+        Raises:
+            LoopbackError: if a broker with this name is already running
+        """
+        if self.name in BROKERS:
+            raise LoopbackError(f'An embedded broker named {self.name!r} is already running')
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name=f'mqtt-broker-{self.name}',
+            daemon=True)
+        self.thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result()
+        except BaseException:
+            self._stop_loop()
+            raise
+        BROKERS[self.name] = self
+        logger.info(f'Embedded broker {self.name} started')
+        return self
+
+    def stop(self):
+        """ Stops the server, disconnecting every client, and the thread """
+        if self.loop is None:
+            return
+        if BROKERS.get(self.name) is self:
+            del BROKERS[self.name]
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+        self._stop_loop()
+        logger.info(f'Embedded broker {self.name} stopped')
+
+    async def _stop(self):
+        await self.server.stop()
+        # clients that never finished their CONNECT aren't the server's yet
+        for transport in list(self.transports):
+            transport.close()
+
+    def _stop_loop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+        self.thread = None
+
+    def call(self, function, *args):
+        """ Runs function on the broker's loop and returns its result, for
+        looking at the server's state from another thread
+        """
+        async def run():
+            return function(*args)
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    def attach(self, sock):
+        """ Gives a connecting LoopbackSocket a connection of its own, called
+        from the client's thread
+        """
+        transport = LoopbackTransport(self, sock)
+        self.loop.call_soon_threadsafe(transport.open)
+        return transport
+
+
+class LoopbackTransport(asyncio.Transport):
+    """ The broker's end of a loopback connection. Its MQTTConnection
+    writes here and what the client sends arrives here, on the broker's
+    loop.
+    """
+
+    def __init__(self, broker, sock):
+        super().__init__()
+        self.broker = broker
+        self.loop = broker.loop
+        self.sock = sock
+        self.protocol = None
+        self.closing = False
+
+    def open(self):
+        self.protocol = MQTTConnection(self.broker.server)
+        self.broker.transports.add(self)
+        self.protocol.connection_made(self)
+
+    # from the client
+
+    def receive(self, data):
+        """ Bytes the client sent, through the decoder as if read from a
+        socket as they needn't be whole packets
+        """
+        protocol = self.protocol
+        data = memoryview(data)
+        while data and not self.closing:
+            buffer = protocol.get_buffer(len(data))
+            count = min(len(buffer), len(data))
+            buffer[:count] = data[:count]
+            del buffer
+            protocol.buffer_updated(count)
+            data = data[count:]
+
+    def receive_packet(self, packet):
+        if not self.closing:
+            self.protocol.handle_mqtt_packet(packet)
+
+    def client_closed(self):
+        if not self.closing:
+            self.closing = True
+            self.broker.transports.discard(self)
+            self.protocol.connection_lost(None)
+
+    def reader_drained(self):
+        if not self.closing:
+            self.protocol.resume_writing()
+
+    # asyncio.Transport
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return f'{LOOPBACK_SCHEME}{self.broker.name}'
+        return default
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.sock.set_limits(high, low)
+
+    def get_write_buffer_size(self):
+        return self.sock.buffered()
+
+    def is_closing(self):
+        return self.closing
+
+    def write(self, data):
+        self.writelines((data,))
+
+    def writelines(self, list_of_data):
+        if self.closing:
+            return
+        if self.sock.feed(b''.join(list_of_data)):
+            self.protocol.pause_writing()
+
+    def close(self):
+        if self.closing:
+            return
+        self.closing = True
+        self.broker.transports.discard(self)
+        self.sock.feed_eof()
+        self.loop.call_soon(self.protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+
+class LoopbackSocket:
+    """ The client's end of a loopback connection, standing in for its
+    socket with the methods MQTTClientConnection uses. Reads block on what
+    the broker has written, writes are handed to the broker's loop.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.timeout = None
+        self.closed = False
+        self.eof = False
+        # written by the broker, not yet read
+        self.inbound = bytearray()
+        # the broker stops writing above high bytes unread until they're
+        # read down to low
+        self.high = DEFAULT_WRITE_BUFFER_HIGH
+        self.low = self.high // 4
+        self.paused = False
+        self._lock = threading.Lock()
+        self._readable = threading.Condition(self._lock)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def connect(self, name):
+        """
+        Raises:
+            ConnectionRefusedError: if no broker of that name is running
+        """
+        if self.closed:
+            raise OSError(errno.EBADF, 'Bad file descriptor')
+        if self.transport is not None:
+            raise OSError(errno.EISCONN, 'Already connected')
+        broker = BROKERS.get(name)
+        if broker is None:
+            raise ConnectionRefusedError(
+                errno.ECONNREFUSED, f'No embedded broker named {name!r}')
+        self.transport = broker.attach(self)
+
+    def _check_connected(self):
+        if self.closed:
+            raise OSError(errno.EBADF, 'Bad file descriptor')
+        if self.transport is None:
+            raise OSError(errno.ENOTCONN, 'Not connected')
+        if self.eof:
+            raise BrokenPipeError(errno.EPIPE, 'Broken pipe')
+
+    def _call(self, function, *args):
+        self._check_connected()
+        try:
+            self.transport.loop.call_soon_threadsafe(function, *args)
+        except RuntimeError:
+            # the broker's loop has been closed
+            raise ConnectionResetError(errno.ECONNRESET, 'Connection reset by broker')
+
+    def send(self, data):
+        if data:
+            self._call(self.transport.receive, bytes(data))
+        else:
+            # sending nothing checks the connection is up, like a socket
+            self._check_connected()
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def sendmsg(self, buffers):
+        return self.send(b''.join(buffers))
+
+    def send_packet(self, packet):
+        """ Hands an MQTTPacket the client built to the broker as it is """
+        self._call(self.transport.receive_packet, packet)
+
+    def recv(self, bufsize):
+        buffer = bytearray(bufsize)
+        return bytes(buffer[:self.recv_into(buffer)])
+
+    def recv_into(self, buffer, nbytes=0):
+        """
+        Raises:
+            TimeoutError: if nothing arrived within the timeout
+        """
+        with self._lock:
+            if not self._readable.wait_for(
+                    lambda: self.inbound or self.eof or self.closed, self.timeout):
+                raise TimeoutError('timed out')
+            if self.closed:
+                raise OSError(errno.EBADF, 'Bad file descriptor')
+            count = min(nbytes if nbytes else len(buffer), len(self.inbound))
+            buffer[:count] = self.inbound[:count]
+            del self.inbound[:count]
+            drained = self.paused and len(self.inbound) <= self.low
+            if drained:
+                self.paused = False
+        if drained:
+            try:
+                self.transport.loop.call_soon_threadsafe(self.transport.reader_drained)
+            except RuntimeError:
+                pass
+        return count
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._readable.notify_all()
+        if self.transport is not None and not self.eof:
+            try:
+                self.transport.loop.call_soon_threadsafe(self.transport.client_closed)
+            except RuntimeError:
+                pass
+
+    # called by the LoopbackTransport on the broker's loop
+
+    def set_limits(self, high=None, low=None):
+        with self._lock:
+            self.high = high if high is not None else DEFAULT_WRITE_BUFFER_HIGH
+            self.low = low if low is not None else self.high // 4
+
+    def buffered(self):
+        with self._lock:
+            return len(self.inbound)
+
+    def feed(self, data):
+        """ Adds what the broker wrote
+
+        Returns:
+            True if the broker should stop writing until it's read
+        """
+        with self._lock:
+            self.inbound += data
+            self._readable.notify()
+            if not self.paused and len(self.inbound) > self.high:
+                self.paused = True
+                return True
+            return False
+
+    def feed_eof(self):
+        with self._lock:
+            self.eof = True
+            self._readable.notify_all()
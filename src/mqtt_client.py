@@ -12,10 +12,14 @@ logger.debug('MQTT Client module initialized')
 
 
 class MQTTClient:
-    def __init__(self, address, port, client_id=None, keep_alive=60, clean_session=True):
+    def __init__(self, address, port, client_id=None, keep_alive=60, clean_session=True,
+                 tls_context=None, server_hostname=None, tls_session=None,
+                 track_latency=True):
         self.keep_alive = keep_alive
         self.connection = MQTTClientConnection(
-            address, port, client_id, keep_alive, clean_session)
+            address, port, client_id, keep_alive, clean_session,
+            tls_context=tls_context, server_hostname=server_hostname,
+            tls_session=tls_session, track_latency=track_latency)
 
         # internals
         # TODO move these
@@ -52,11 +56,30 @@ class MQTTClient:
 
         self.connection.subscribe(topic, qos)
 
+    def set_credentials(self, username, password=None):
+        """ Username and password sent with the next CONNECT """
+        self.connection.username = username
+        self.connection.password = password
+
     def set_will(self, topic, payload, qos=0, retain=False):
         logging.info('Setting lwt to: %s %s %s %s',
                      topic, payload, qos, retain)
         self.connection.set_will(topic, payload, qos, retain)
 
+    def latency_stats(self):
+        """ Decode time and qos 1/2 publish round trip percentiles """
+        return self.connection.latency_stats()
+
+    def dump_latency(self):
+        return self.connection.dump_latency()
+
+    @property
+    def tls_session(self):
+        """ The TLS session once connected, pass it to the next client to
+        resume it
+        """
+        return self.connection.tls_session
+
     @property
     def connected(self):
         return self.connection.connected
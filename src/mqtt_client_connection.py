@@ -1,28 +1,68 @@
 import socket
+import ssl
+import logging
 import random
 import string
-from time import sleep
+import threading
+from time import sleep, monotonic, perf_counter_ns
 
 # packet stuff
 from packet_validator import PacketValidator, PacketValidatorError
 from packet_generator import PacketGenerator
+from frame_decoder import FrameDecoder, FrameDecoderError, DEFAULT_MAX_PACKET_SIZE
 import packets
 
 from mqtt_client_messages import MQTTClientMessages
+from socket_writer import SocketWriter
+from loopback import LoopbackSocket, LOOPBACK_SCHEME
+from latency_histogram import LatencyHistogram, format_histograms
 from logging_setup import LoggerSetup
 logger = LoggerSetup.get_logger(__name__)
 
+UNIX_SCHEME = 'unix://'
+# packets a broker sends a client, each gets a decode histogram of its own
+RECEIVED_PACKETS = (
+    packets.CONNACK_BYTE, packets.PUBLISH_BYTE, packets.PUBACK_BYTE,
+    packets.PUBREC_BYTE, packets.PUBREL_BYTE, packets.PUBCOMP_BYTE,
+    packets.SUBACK_BYTE, packets.UNSUBACK_BYTE, packets.PINGRESP_BYTE,
+)
+
 
 class MQTTClientConnection:
-    def __init__(self, address, port, client_id=None, keep_alive=60, clean_session=True):
+    def __init__(self, address, port, client_id=None, keep_alive=60, clean_session=True,
+                 max_packet_size=DEFAULT_MAX_PACKET_SIZE, tls_context=None,
+                 server_hostname=None, tls_session=None, track_latency=True):
         self.address = address
         self.port = port
+        # 'unix:///path/to/socket' connects to the broker's unix domain
+        # socket, the port is ignored
+        self.unix_path = address[len(UNIX_SCHEME):] if address.startswith(UNIX_SCHEME) else None
+        # 'loopback://name' attaches to the EmbeddedBroker of that name in
+        # this process, see loopback.py
+        self.loopback_name = (address[len(LOOPBACK_SCHEME):]
+                              if address.startswith(LOOPBACK_SCHEME) else None)
+        # with an ssl.SSLContext the socket is wrapped once connected, see
+        # tls.py. tls_session is offered to resume an earlier connection's
+        # session and replaced by this one's once connected.
+        self.tls_context = tls_context
+        self.server_hostname = server_hostname if server_hostname else address
+        self.tls_session = tls_session
+        self.tls_session_reused = False
         self.keep_alive = keep_alive
         self.clean_session = clean_session
-        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.conn = self.new_socket()
+        # packets are batched into one sendmsg per flush, see socket_writer.py.
+        # A loopback write is a function call, there's nothing to save by
+        # holding it back.
+        self.writer = SocketWriter(
+            self.conn, max_delay=None if self.loopback_name is not None else 0.001)
         self.client_id = client_id if client_id else self.generate_random_client_id()
 
         self.connected = False
+        # a PINGREQ is sent when nothing else has been for keep_alive seconds
+        self.last_sent = monotonic()
+        self.ping_thread = None
+        self._ping_stop = threading.Event()
 
         self.on_connect = lambda: None
         self.on_disconnect = lambda: None
@@ -41,10 +81,34 @@ class MQTTClientConnection:
         # send is attached to packets so we need to pass it here
         self.pg = PacketGenerator(self.send)
         self.validator = PacketValidator(self.send)
+        self.decoder = FrameDecoder(max_packet_size)
 
         # pg is used to create and resend dup packets in qos handshakes
         self.messages = MQTTClientMessages()
 
+        # name -> LatencyHistogram, decode/<packet> for decoding received
+        # packets and publish_rtt/qos<n> from sending a qos 1/2 PUBLISH to
+        # its PUBACK or PUBCOMP. Nothing is timed without track_latency.
+        self.track_latency = track_latency
+        self.latency = {}
+        # decode histograms by packet type, built up front so timing a
+        # received packet is one list index. Types a broker never sends
+        # share decode/unknown.
+        self.decode_latency = None
+        if track_latency:
+            self.decode_latency = [self.histogram('decode/unknown')] * 16
+            for command in RECEIVED_PACKETS:
+                self.decode_latency[command >> 4] = self.histogram(
+                    f'decode/{packets.PACKET_NAMES[command >> 4]}')
+        # packet id -> perf_counter_ns() the PUBLISH was sent at
+        self.publish_times = {}
+
+    def new_socket(self):
+        if self.loopback_name is not None:
+            return LoopbackSocket()
+        family = socket.AF_UNIX if self.unix_path is not None else socket.AF_INET
+        return socket.socket(family, socket.SOCK_STREAM)
+
     def generate_random_client_id(self):
         return 'PYMQTTClient-'.join(random.choices(string.ascii_letters + string.digits, k=8))
 
@@ -63,9 +127,13 @@ class MQTTClientConnection:
             return
 
         logger.info(
-            f'Client: {self.client_id} connected to {self.address}:{self.port}')
+            f'Client: {self.client_id} connected to {self.address}'
+            f'{f":{self.port}" if self.unix_path is None and self.loopback_name is None else ""}')
 
         server_response = self.negotiate_connection_to_server(timeout)
+        if server_response is None:
+            self.connected = False
+            return
 
         try:
             # TODO actually check this is a connack packet
@@ -78,17 +146,24 @@ class MQTTClientConnection:
             self.connected = False
             return
 
-        if server_response.command_byte != packet.CONNACK_BYTE:
+        if packet.command_type != packets.CONNACK_BYTE:
             logger.error('Incorrect response from server')
             return
 
         logger.info('We connected!')
         self.connected = True
+        if self.tls_context is not None:
+            # TLS 1.3 tickets come after the handshake, by the CONNACK
+            # they've arrived
+            self.tls_session = self.conn.session
+            self.tls_session_reused = self.conn.session_reused
         self.call_on_connect()
 
-        # TODO ping threading as optional start
-        # self.ping_thread = threading.Thread(target=self.ping_manager)
-        # self.ping_thread.start()
+        if self.keep_alive:
+            self._ping_stop.clear()
+            self.ping_thread = threading.Thread(
+                target=self.ping_manager, daemon=True)
+            self.ping_thread.start()
 
     def call_on_connect(self):
         self.messages.start_retry_thread()
@@ -100,6 +175,7 @@ class MQTTClientConnection:
             logger.exception(e)
 
     def call_on_disconnect(self):
+        self._ping_stop.set()
         self.messages.stop_retry_thread()
 
         try:
@@ -117,7 +193,7 @@ class MQTTClientConnection:
 
     def socket_connected(self):
         try:
-            self.send(b'')
+            self.conn.send(b'')
             return True
         except (OSError, BrokenPipeError):
             return False
@@ -129,9 +205,14 @@ class MQTTClientConnection:
                 return True
             try:
                 self.conn.settimeout(1)
-                self.conn.connect((self.address, self.port))
+                self.conn.connect(self.server_address())
+                if self.tls_context is not None:
+                    self.start_tls()
                 return True
-            except (ConnectionRefusedError, ConnectionAbortedError):
+            except ssl.SSLError as e:
+                logger.error(f'TLS handshake failed: {e}')
+                return False
+            except (ConnectionRefusedError, ConnectionAbortedError, FileNotFoundError):
                 attempts += 1
                 if attempts > timeout:
                     # TODO more information about failure here
@@ -140,6 +221,25 @@ class MQTTClientConnection:
             finally:
                 self.conn.settimeout(None)
 
+    def server_address(self):
+        if self.loopback_name is not None:
+            return self.loopback_name
+        if self.unix_path is not None:
+            return self.unix_path
+        return (self.address, self.port)
+
+    def start_tls(self):
+        try:
+            self.conn = self.tls_context.wrap_socket(
+                self.conn, server_hostname=self.server_hostname,
+                session=self.tls_session)
+        except ssl.SSLError:
+            # the plain socket was closed with the failed handshake, have a
+            # fresh one ready for another attempt
+            self.conn = self.new_socket()
+            raise
+        self.writer.attach(self.conn)
+
     def negotiate_connection_to_server(self, timeout):
         connect_packet = self.pg.create_connect_packet(
             client_id=self.client_id, will_topic=self.will_topic,
@@ -147,21 +247,34 @@ class MQTTClientConnection:
             will_retain=self.will_retain, username=self.username,
             password=self.password, keep_alive=self.keep_alive,
             clean_session=self.clean_session)
-        data = None
+        # nothing left over from an earlier connection is read as the CONNACK
+        decoder = self.decoder = FrameDecoder(self.decoder.max_packet_size)
 
         try:
             self.conn.settimeout(timeout)
             connect_packet.send()
+            self.writer.flush()
             logger.debug('Connection packet sent, waiting for response...')
-            data = self.conn.recv(4)
+            # the CONNACK can arrive over several reads, and anything the
+            # server sends straight after it stays in the decoder for loop()
+            while True:
+                frame = next(decoder.frames(), None)
+                if frame is not None:
+                    return bytes(frame)
+                received = self.conn.recv_into(decoder.get_buffer())
+                if not received:
+                    logger.warning('Server closed the connection.')
+                    return None
+                decoder.buffer_updated(received)
         except TimeoutError:
             logger.warning('No response from server.')
             return None
+        except FrameDecoderError as e:
+            logger.error(e)
+            return None
         finally:
             self.conn.settimeout(None)
 
-        return data
-
     def publish(self, topic, payload, qos, retain):
         if not self.connected:
             logger.warning(f'Cant publish to {topic}, not connected to server')
@@ -170,7 +283,14 @@ class MQTTClientConnection:
         pub_packet = self.pg.create_publish_packet(topic, payload, qos, retain)
         if qos > 0:
             self.messages.add(pub_packet)
-        pub_packet.send()
+            if self.track_latency:
+                self.publish_times[pub_packet.packet_id] = perf_counter_ns()
+        if self.loopback_name is not None:
+            # the embedded broker takes the packet itself, not its bytes
+            self.last_sent = monotonic()
+            self.conn.send_packet(pub_packet)
+        else:
+            pub_packet.send()
 
     def subscribe(self, topic, qos):
         if not self.connected:
@@ -182,62 +302,79 @@ class MQTTClientConnection:
         sub_packet.send()
 
     def loop(self):
-        # TODO break this up
         logger.info('Entering loop')
-        buffer = bytearray()
+        decoder = self.decoder
         while True:
             try:
-                data = self.conn.recv(1024)
+                # read straight into the decoder, no intermediate bytes
+                received = self.conn.recv_into(decoder.get_buffer())
             except OSError as e:
                 logger.error(f"Socket error: {e}")
                 self.connected = False
                 self.call_on_disconnect()
                 return
 
-            if not data:
+            if not received:
                 self.connected = False
                 self.call_on_disconnect()
             if not self.connected:
                 logger.info(f'{self.client_id} Disconnected')
                 return
 
-            buffer.extend(data)
+            decoder.buffer_updated(received)
 
-            while True:
-                if len(buffer) < 2:
-                    break
-
-                # Parse MQTT Remaining Length (variable-length encoding)
-                remaining_length = 0
-                multiplier = 1
-                bytes_used = 1
-                for i in range(1, min(5, len(buffer))):
-                    byte = buffer[i]
-                    bytes_used += 1
-                    remaining_length += (byte & 127) * multiplier
-                    if (byte & 128) == 0:
-                        break
-                    multiplier *= 128
-                else:
-                    break
-
-                total_packet_length = bytes_used + remaining_length
-                if len(buffer) < total_packet_length:
-                    break
-
-                packet_bytes = bytes(buffer[:total_packet_length])
-
-                try:
-                    packet = self.validator.validate_packet(packet_bytes)
-                    logger.debug(packet)
-                    self.handle_packet(packet)
-                    del buffer[:total_packet_length]
-                except PacketValidatorError as e:
-                    logger.error(e)
-                    logger.error('Offending data: %s', '\\x'.join(
-                        f"{byte:02x}" for byte in packet_bytes))
-                    # Remove the first byte and try again (skip bad data)
-                    del buffer[0]
+            try:
+                for packet_bytes in decoder.frames():
+                    self.process_frame(packet_bytes)
+            except FrameDecoderError as e:
+                # framing is lost, nothing after this can be trusted
+                logger.error(e)
+                self.conn.close()
+                self.connected = False
+                self.call_on_disconnect()
+                return
+
+    def histogram(self, name):
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = LatencyHistogram()
+        return histogram
+
+    def latency_histograms(self):
+        """ Every histogram with something in it, by name """
+        return {name: histogram for name, histogram in list(self.latency.items())
+                if histogram.count}
+
+    def latency_stats(self):
+        """ Percentiles of every latency histogram, in microseconds """
+        return {name: histogram.stats()
+                for name, histogram in self.latency_histograms().items()}
+
+    def dump_latency(self):
+        """ The latency histograms as a text table of percentiles """
+        return format_histograms(self.latency_histograms())
+
+    def record_publish_rtt(self, packet_id, qos):
+        sent = self.publish_times.pop(packet_id, None)
+        if sent is not None:
+            self.histogram(f'publish_rtt/qos{qos}').record(perf_counter_ns() - sent)
+
+    def process_frame(self, packet_bytes):
+        try:
+            decode_latency = self.decode_latency
+            if decode_latency is None:
+                packet = self.validator.validate_packet(packet_bytes)
+            else:
+                start = perf_counter_ns()
+                packet = self.validator.validate_packet(packet_bytes)
+                decode_latency[packet_bytes[0] >> 4].record(perf_counter_ns() - start)
+            logger.debug(packet)
+            self.handle_packet(packet)
+        except PacketValidatorError as e:
+            # the frame is complete so only this packet is skipped
+            logger.error(e)
+            logger.error('Offending data: %s', '\\x'.join(
+                f"{byte:02x}" for byte in packet_bytes))
 
     def handle_packet(self, packet):
         # TODO break this up
@@ -264,6 +401,7 @@ class MQTTClientConnection:
         if packet.command_type == packets.PUBACK_BYTE:
             # qos 1 acknowledgement
             self.messages.acknowledge(packet)
+            self.record_publish_rtt(packet.packet_id, 1)
 
         if packet.command_type == packets.PUBREC_BYTE:
             # qos 2 acknowledgement
@@ -281,26 +419,34 @@ class MQTTClientConnection:
             # qos 2 acknowledgement
             # nothing to send
             self.messages.acknowledge(packet)
+            self.record_publish_rtt(packet.packet_id, 2)
 
         if packet.command_type == packets.DISCONNECT_BYTE:
             self.connected = False
             self.call_on_disconnect()
 
     def send(self, data):
-        # TODO is this thread safe?
-        logger.debug('Sending %s', '\\x'.join(f"{byte:02x}" for byte in data))
-        self.conn.sendall(data)
-
-        # def ping_manager(self):
-    #     if not self.connected:
-    #         return
-    #     # TODO make this timer based which resets on every comms with server
-    #     # (publishing or acknowloging)
-    #     # TODO make this config option
-    #     while True:
-    #         self.ping_server()
-    #         sleep(self.keep_alive - 1)
-
-    # def ping_server(self):
-    #     ping_packet = b'\xc0\x00'  # MQTT PINGREQ
-    #     self.conn.sendall(ping_packet)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Sending %s', '\\x'.join(
+                f"{byte:02x}" for byte in data))
+        self.last_sent = monotonic()
+        self.writer.write(data)
+
+    def ping_manager(self):
+        """ Keeps the connection alive, the server drops clients it hasn't
+        heard from in 1.5x the keep alive. Any packet we send resets the
+        timer so a busy client never pings.
+        """
+        while self.connected:
+            idle = monotonic() - self.last_sent
+            if idle >= self.keep_alive:
+                self.ping_server()
+                idle = 0
+            if self._ping_stop.wait(self.keep_alive - idle):
+                return
+
+    def ping_server(self):
+        try:
+            self.send(bytes([packets.PINGREQ_BYTE, 0x00]))
+        except OSError as e:
+            logger.error(f'Could not send PINGREQ: {e}')
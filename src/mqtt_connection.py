@@ -1,43 +1,329 @@
-import threading
-
-
-class MQTTConnection:
-    def __init__(self, conn, on_new_subscription):
-        print('Client created')
-        self.running = False
+import asyncio
+from collections import deque
+from time import perf_counter_ns
+
+import packets
+from frame_decoder import FrameDecoder, FrameDecoderError
+from mqtt_packet import MQTTPacket
+from outbound_queue import OutboundQueue
+from packet_generator import encode_remaining_length
+from publish_frame import PublishFrame
+from packet_validator import PacketValidatorError
+from topic_trie import TopicFilterError
+from shared_subscriptions import is_shared, parse_shared
+from write_ahead_log import RECEIVED, DONE
+from write_batch import BatchedWriter
+from logging_setup import LoggerSetup
+logger = LoggerSetup.get_logger(__name__)
+
+SUBACK_FAILURE = 0x80
+CONNACK_IDENTIFIER_REJECTED = 0x02
+CONNACK_SERVER_UNAVAILABLE = 0x03
+CONNACK_BAD_CREDENTIALS = 0x04
+# packets a client may send after CONNECT before it's authenticated
+MAX_HELD_PACKETS = 100
+
+
+class MQTTConnection(BatchedWriter, asyncio.BufferedProtocol):
+    """ Broker side of a single client connection.
+
+    One of these is created by the event loop for every accepted socket. It
+    never blocks: the loop reads straight into the frame decoder's buffer,
+    packets are handled as soon as they're complete and the CONNECT handshake
+    is simply the first packet handled, so a slow client can't hold up the
+    accept loop or anyone else.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        # counters for $SYS, see broker_metrics.py
+        self.metrics = server.metrics
+        self.track_latency = server.metrics.track_latency
+        # perf_counter_ns() of the latest read, when tracking latency
+        self.read_time = None
+        self.transport = None
+        self.peername = None
         self.client_id = None
-        self.conn = conn
-        self.on_new_subscription = on_new_subscription
-
-    def validate_connection(self) -> bool:
-        data = self.conn.recv(1024)
-
-        if not data or data[0] != 0x10:
+        self.username = None
+        # AclChecker when the server has an ACL, see topic_acl.py
+        self.acl = None
+        self.connected = False
+        # while the CONNECT's credentials are being checked, anything else
+        # the client sends waits in held
+        self.authenticating = False
+        self.held = []
+        self._auth_task = None
+        # seconds, 0 turns the keep alive off
+        self.keep_alive = 0
+        self.clean_session = True
+        # the persistent Session for clean_session=False clients, which
+        # then owns the subscriptions and inflight dicts below
+        self.session = None
+        # topic filter -> granted qos, dropped with the connection
+        self.subscriptions = {}
+        # packet id -> (PublishFrame, qos) of deliveries awaiting an ack
+        self.inflight = {}
+        # packet ids of qos 2 deliveries that have had their PUBREC
+        self.released = set()
+        # packet ids of qos 2 publishes from the client not yet released by
+        # its PUBREL, a resent PUBLISH with one of these isn't routed again
+        self.unreleased = set()
+        self._last_packet_id = 0
+        # deliveries wait here while the transport is applying backpressure
+        self.queue = OutboundQueue(
+            server.max_queued_messages, server.max_queued_bytes,
+            server.slow_consumer_policy, server.slow_consumer_timeout,
+            on_drop=self.delivery_dropped)
+        self.writing_paused = False
+        # iterators of (frame, qos, retain) sent once the queue is empty,
+        # retained messages for new subscriptions and a session's offline
+        # messages, see stream()
+        self.streams = deque()
+        # frames are batched into one write per loop iteration, see
+        # write_batch.py
+        self.init_write_batch(
+            server.loop, server.write_batch_bytes, server.write_batch_delay)
+        # received bytes are read straight into the decoder's buffer
+        self.decoder = FrameDecoder(
+            server.max_packet_size, buffer_size=server.read_buffer_size,
+            min_read=server.read_buffer_size // 4)
+
+    # asyncio.BufferedProtocol callbacks
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peername = transport.get_extra_info('peername')
+        self.metrics.sockets_opened += 1
+        transport.set_write_buffer_limits(high=self.server.write_buffer_high)
+        logger.debug(f'Connection from {self.peername}')
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        self.metrics.bytes_received += nbytes
+        if self.track_latency:
+            self.read_time = perf_counter_ns()
+
+        self.handle_packets(self.decoder.frames())
+
+    def handle_packets(self, frames):
+        try:
+            for packet in frames:
+                if self.transport is None:
+                    return
+                self.handle_packet(packet)
+        except FrameDecoderError as e:
+            logger.error(f'Bad frame from {self.peername}: {e.message}')
+            self.close()
+        except (PacketValidatorError, IndexError, UnicodeDecodeError) as e:
+            logger.error(f'Malformed packet from {self.peername}: {e}')
+            self.close()
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.drain()
+
+    def connection_lost(self, exc):
+        logger.debug(f'Connection lost {self.client_id} {self.peername}')
+        self.transport = None
+        self.held = []
+        if self.session is not None:
+            self.detach_session()
+        self.queue.clear()
+        self.streams.clear()
+        self.cancel_flush()
+        if self.connected:
+            self.connected = False
+            if self.server.wal is not None and self.clean_session:
+                # the session ends with the connection [MQTT-3.1.2-6]
+                self.server.wal.discard(self.client_id)
+            self.server.remove_client(self)
+
+    def handle_packet(self, packet):
+        command = packet[0] & 0xF0
+        self.metrics.packet_received(command, len(packet))
+        if self.track_latency:
+            start = perf_counter_ns()
+            self.dispatch_packet(command, packet)
+            self.metrics.handle_latency[command >> 4].record(perf_counter_ns() - start)
+        else:
+            self.dispatch_packet(command, packet)
+
+    def handle_mqtt_packet(self, packet):
+        """ A packet from an in-process client, as the MQTTPacket it built,
+        see loopback.py. A PUBLISH skips the frame decoder and is routed
+        straight from the bytes the client encoded. Anything else, or
+        anything before the CONNECT has been accepted, goes through the
+        decoder like bytes from a socket.
+        """
+        if packet.command_type != packets.PUBLISH_BYTE or not self.connected:
+            self.handle_packets((packet.raw_bytes,))
+            return
+
+        self.metrics.packet_received(packets.PUBLISH_BYTE, len(packet.raw_bytes))
+        try:
+            if self.track_latency:
+                self.read_time = start = perf_counter_ns()
+                self.dispatch_packet(packets.PUBLISH_BYTE, packet)
+                self.metrics.handle_latency[packets.PUBLISH_BYTE >> 4].record(
+                    perf_counter_ns() - start)
+            else:
+                self.dispatch_packet(packets.PUBLISH_BYTE, packet)
+        except (PacketValidatorError, IndexError, UnicodeDecodeError) as e:
+            logger.error(f'Malformed packet from {self.client_id}: {e}')
+            self.close()
+
+    def dispatch_packet(self, command, packet):
+        if not self.connected:
+            if self.authenticating:
+                self.hold(packet)
+                return
+            # the first packet MUST be a CONNECT [MQTT-3.1.0-1]
+            if command != packets.CONNECT_BYTE or not self.validate_connection(packet):
+                self.close()
+            return
+
+        if self.keep_alive:
+            # any packet counts as activity [MQTT-3.1.2-23]
+            self.server.keep_alive_timers.touch(self, self.server.loop.time())
+
+        if command == packets.SUBSCRIBE_BYTE & 0xF0:
+            self.extract_subscription_message(packet)
+        elif command == packets.UNSUBSCRIBE_BYTE & 0xF0:
+            self.extract_unsubscription_message(packet)
+        elif command == packets.PUBLISH_BYTE:
+            self.handle_publish(packet)
+        elif command == packets.PUBREL_BYTE:
+            # qos 2 from the client, the message was routed on PUBLISH
+            self.unreleased.discard(int.from_bytes(packet[2:4], 'big'))
+            self.send(bytes([packets.PUBCOMP_BYTE, 0x02]) + packet[2:4])
+        elif command in (packets.PUBACK_BYTE, packets.PUBREC_BYTE, packets.PUBCOMP_BYTE):
+            self.handle_delivery_ack(command, int.from_bytes(packet[2:4], 'big'))
+        elif command == packets.PINGREQ_BYTE:
+            self.send(bytes([packets.PINGRESP_BYTE, 0x00]))
+        elif command == packets.DISCONNECT_BYTE:
+            self.close()
+        else:
+            logger.warning(
+                f'Unhandled packet type {hex(command)} from {self.client_id}')
+
+    def validate_connection(self, packet) -> bool:
+        if packet[0] != packets.CONNECT_BYTE:
             return False
 
-        remaining_length = data[1]
-        print(f'Header length: {remaining_length}')
-
-        if len(data) < 2 + remaining_length:
-            return False  # Incomplete packet
+        # skip the fixed header and its variable length remaining length
+        index = 1
+        while packet[index] & 0x80:
+            index += 1
+        header = packet[index + 1:]
 
-        header = data[2:2 + remaining_length]
-        username, password, LWT, clean_session, keep_alive, payload_start = self.extract_header(
-            header)
+        will_flag, username_flag, password_flag, clean_session, keep_alive, payload_start = \
+            self.extract_header(header)
 
         payload = header[payload_start:]
-        self.client_id, will_topic, will_message = self.extract_payload(
-            payload)
+        self.client_id, will_topic, will_message, username, password = self.extract_payload(
+            payload, will_flag, username_flag, password_flag)
+        if not self.client_id:
+            if not clean_session:
+                # a session needs an id to be found again [MQTT-3.1.3-8]
+                self.send(bytes([packets.CONNACK_BYTE, 0x02, 0x00,
+                                 CONNACK_IDENTIFIER_REJECTED]))
+                return False
+            self.client_id = self.server.clients.assign_id()
+        if not clean_session and not self.server.persistent_sessions:
+            logger.warning(
+                f'Refusing {self.client_id}, persistent sessions are turned off')
+            self.send(bytes([packets.CONNACK_BYTE, 0x02, 0x00,
+                             CONNACK_SERVER_UNAVAILABLE]))
+            return False
 
-        print(
-            f"Username: {username}, Password: {password}, LWT: {LWT}, Clean Session: {clean_session}, Keep Alive: {keep_alive}")
-        print(
+        logger.debug(
+            f"Username: {username}, LWT: {will_flag}, Clean Session: {clean_session}, Keep Alive: {keep_alive}")
+        logger.debug(
             f"Client ID: {self.client_id}, Will Topic: {will_topic}, Will Message: {will_message}")
 
-        self.acknowledge_connection()
+        self.username = username
+        self.clean_session = clean_session
+        self.keep_alive = keep_alive
 
+        authenticator = self.server.authenticator
+        if authenticator is None or (username is None and self.server.allow_anonymous):
+            self.accept_connection()
+            return True
+
+        # the check can take a while, the CONNACK is sent when it's done
+        self.authenticating = True
+        self._auth_task = self.server.loop.create_task(
+            self.authenticate(authenticator, username, password))
         return True
 
+    async def authenticate(self, authenticator, username, password):
+        try:
+            valid = await authenticator.authenticate(username, password)
+        except Exception as e:
+            logger.error(f'Authenticating {self.client_id} failed: {e}')
+            valid = False
+        self.authenticating = False
+        self._auth_task = None
+        if self.transport is None:
+            return
+
+        if not valid:
+            logger.warning(
+                f'Client {self.client_id} from {self.peername} failed to authenticate')
+            self.metrics.auth_failures += 1
+            self.send(bytes([packets.CONNACK_BYTE, 0x02, 0x00,
+                             CONNACK_BAD_CREDENTIALS]))
+            self.close()
+            return
+
+        self.accept_connection()
+        held = self.held
+        self.held = []
+        self.handle_packets(held)
+
+    def hold(self, packet):
+        if len(self.held) >= MAX_HELD_PACKETS:
+            logger.warning(
+                f'{self.client_id} sent too much before being authenticated')
+            self.close()
+            return
+        # the decoder reuses its buffer, the packet has to be copied
+        self.held.append(bytes(packet))
+
+    def accept_connection(self):
+        """ Registers the client and sends the CONNACK once it's allowed on,
+        attaching its persistent session if it has one
+        """
+        self.connected = True
+        if self.server.acl is not None:
+            self.acl = self.server.acl.checker(self.client_id, self.username)
+        self.server.add_client(self)
+        keep_alive = self.keep_alive
+        if keep_alive:
+            self.server.keep_alive_timers.schedule(
+                self, keep_alive * 1.5, self.server.loop.time())
+
+        if self.clean_session:
+            self.server.end_session(self.client_id)
+            if self.server.wal is not None:
+                self.server.wal.discard(self.client_id)
+            self.acknowledge_connection(False)
+            return
+
+        session, present = self.server.open_session(self.client_id)
+        # tells the client whether it has to subscribe again [MQTT-3.2.2-2]
+        self.acknowledge_connection(present)
+        self.attach_session(session)
+        if not present and self.server.wal is not None:
+            # nothing in memory, pick up what was logged before a restart
+            self.resume_deliveries()
+
     def extract_header(self, header):
         index = 0
 
@@ -46,7 +332,7 @@ class MQTTConnection:
         index += 2
 
         # Extract Protocol Name
-        proto_name = header[index:index + proto_len].decode()
+        proto_name = str(header[index:index + proto_len], 'utf-8')
         index += proto_len
 
         # Extract Protocol Level
@@ -66,23 +352,18 @@ class MQTTConnection:
         keep_alive = int.from_bytes(header[index:index + 2], 'big')
         index += 2
 
-        username = password = None
-
-        if username_flag:
-            user_len = int.from_bytes(header[index:index + 2], 'big')
-            index += 2
-            username = header[index:index + user_len].decode()
-            index += user_len
-
-        if password_flag:
-            pass_len = int.from_bytes(header[index:index + 2], 'big')
-            index += 2
-            password = header[index:index + pass_len].decode()
-            index += pass_len
+        # the will, username and password themselves are in the payload
+        return LWT_flag, username_flag, password_flag, clean_session, keep_alive, index
 
-        return username, password, LWT_flag, clean_session, keep_alive, index
+    def extract_payload(self, payload, will_flag=False, username_flag=False,
+                        password_flag=False):
+        """ Reads the CONNECT payload, its fields are present in this order
+        as the header's flags say [MQTT-3.1.3-1]
 
-    def extract_payload(self, payload):
+        Returns:
+            client id, will topic, will message, username and password,
+            the password as bytes as it needn't be text
+        """
         index = 0
 
         # Extract Client ID Length
@@ -90,60 +371,73 @@ class MQTTConnection:
         index += 2
 
         # Extract Client ID
-        client_id = payload[index:index + client_id_len].decode()
+        client_id = str(payload[index:index + client_id_len], 'utf-8')
         index += client_id_len
 
         will_topic = will_message = None
 
-        if len(payload) > index:
+        if will_flag:
             # Extract Will Topic Length
             will_topic_len = int.from_bytes(payload[index:index + 2], 'big')
             index += 2
-            will_topic = payload[index:index + will_topic_len].decode()
+            will_topic = str(payload[index:index + will_topic_len], 'utf-8')
             index += will_topic_len
 
-        if len(payload) > index:
             # Extract Will Message Length
             will_message_len = int.from_bytes(payload[index:index + 2], 'big')
             index += 2
-            will_message = payload[index:index + will_message_len].decode()
+            will_message = str(payload[index:index + will_message_len], 'utf-8')
             index += will_message_len
 
-        return client_id, will_topic, will_message
+        username = password = None
+
+        if username_flag:
+            user_len = int.from_bytes(payload[index:index + 2], 'big')
+            index += 2
+            username = str(payload[index:index + user_len], 'utf-8')
+            index += user_len
+
+        if password_flag:
+            pass_len = int.from_bytes(payload[index:index + 2], 'big')
+            index += 2
+            password = bytes(payload[index:index + pass_len])
+            index += pass_len
+
+        return client_id, will_topic, will_message, username, password
 
-    def acknowledge_connection(self):
-        data = bytearray([0x20, 0x02, 0x01, 0])
-        self.conn.send(data)
+    def acknowledge_connection(self, session_present):
+        # session present is always 0 for a clean session [MQTT-3.2.2-1]
+        self.send(bytes([packets.CONNACK_BYTE, 0x02,
+                         0x01 if session_present else 0x00, 0x00]))
 
     def acknowledge_subscription(self, packet_id, qos_to_ack):
-        # TODO failed acknowledge for qos
         packet_id_high_byte = (packet_id >> 8) & 0xFF
         packet_id_low_byte = packet_id & 0xFF
-        # 4 = command byte, packet length, high and low packet id bytes
-        packet_length = 4 + len(qos_to_ack)
-        print(f'subacking {packet_id} {qos_to_ack} length {packet_length}')
+        # remaining length = high and low packet id bytes + one per topic
+        packet_length = 2 + len(qos_to_ack)
+        logger.debug(
+            f'subacking {packet_id} {qos_to_ack} length {packet_length}')
 
-        data = bytearray(
-            [0x90, packet_length, packet_id_high_byte, packet_id_low_byte] + qos_to_ack)
-        print(f'suback packet {data}')
-        self.conn.send(data)
+        data = bytearray([packets.SUBACK_BYTE]) + encode_remaining_length(packet_length)
+        data += bytes([packet_id_high_byte, packet_id_low_byte] + qos_to_ack)
+        self.send(data)
+
+    def acknowledge_unsubscription(self, packet_id):
+        self.send(bytes([packets.UNSUBACK_BYTE, 0x02]) +
+                  packet_id.to_bytes(2, 'big'))
 
     def extract_subscription_message(self, payload):
         # Bits 3,2,1 and 0 of the fixed header of the SUBSCRIBE Control Packet are reserved and MUST be set to 0,0,1 and 0 respectively. The Server MUST treat any other value as malformed and close the Network Connection [MQTT-3.8.1-1].
-        print(f'SUB message received {payload}')
-        index = 0
+        index = 1
 
-        command_byte = payload[index]
+        # skip the remaining length, we already have the whole packet
+        while payload[index] & 0x80:
+            index += 1
         index += 1
 
         # Extract Packet Identifier
-        remaining_length = payload[index]
-        print(f'remaining length {remaining_length}')
-        index += 1
-
         packet_id = int.from_bytes(payload[index:index + 2], 'big')
         index += 2
-        print(f'packet id {packet_id}')
 
         topics = []
         qos_to_ack = []
@@ -151,44 +445,346 @@ class MQTTConnection:
         while index < len(payload):
             # Extract Topic Length
             topic_len = int.from_bytes(payload[index:index + 2], 'big')
-            print(topic_len, index)
             index += 2
 
             # Extract Topic Name
-            topic_name = payload[index:index + topic_len].decode()
+            topic_name = str(payload[index:index + topic_len], 'utf-8')
             index += topic_len
-            print(f'topic: {topic_name}')
 
             # Extract QoS Level
             qos_level = payload[index]
-            qos_to_ack.append(qos_level)
             index += 1
 
             topics.append((topic_name, qos_level))
 
+        granted = []
+        for topic_name, qos_level in topics:
+            if self.acl is not None and not self.can_subscribe(topic_name):
+                logger.warning(f'{self.client_id} may not subscribe to {topic_name}')
+                self.metrics.subscribe_denied += 1
+                qos_to_ack.append(SUBACK_FAILURE)
+                continue
+            try:
+                self.server.add_new_subscription(
+                    topic_name, self.client_id, qos_level)
+                self.subscriptions[topic_name] = qos_level
+                qos_to_ack.append(min(qos_level, 2))
+                granted.append((topic_name, min(qos_level, 2)))
+            except TopicFilterError as e:
+                logger.warning(f'{self.client_id}: {e.message}')
+                qos_to_ack.append(SUBACK_FAILURE)
+
         self.acknowledge_subscription(packet_id, qos_to_ack)
-        self.on_new_subscription(topic_name, self.client_id)
 
-        print(topics)
+        # retained messages follow the SUBACK [MQTT-3.3.1-6], a shared
+        # subscription joins a group that's already running so gets none
+        for topic_name, qos_level in granted:
+            if is_shared(topic_name):
+                continue
+            self.stream(
+                (message.frame, min(message.qos, qos_level), True)
+                for message in self.server.retained.match(topic_name))
+
+        logger.debug(f'{self.client_id} subscribed to {topics}')
+
+        return packet_id, topics
+
+    def extract_unsubscription_message(self, payload):
+        index = 1
+        while payload[index] & 0x80:
+            index += 1
+        index += 1
+
+        packet_id = int.from_bytes(payload[index:index + 2], 'big')
+        index += 2
+
+        topics = []
+        while index < len(payload):
+            topic_len = int.from_bytes(payload[index:index + 2], 'big')
+            index += 2
+            topics.append(str(payload[index:index + topic_len], 'utf-8'))
+            index += topic_len
+
+        for topic_name in topics:
+            self.subscriptions.pop(topic_name, None)
+            self.server.remove_subscription(topic_name, self.client_id)
+
+        self.acknowledge_unsubscription(packet_id)
+
+        logger.debug(f'{self.client_id} unsubscribed from {topics}')
 
         return packet_id, topics
 
-    def start(self):
-        # run thread start
-        run_thread = threading.Thread(target=self.run)
-        run_thread.start()
-
-    def run(self):
-        # threaded loop to look for incoming messages and handle keep alive etc.
-        self.running = True
-        while self.running:
-            recv = self.conn.recv(1024)
-            print(recv)
-
-            for idx, val in enumerate(recv):
-                if val == 0x82:
-                    message_length = recv[idx + 1]
-                    message_length += 2  # account for the length bytes not part of the length
-                    self.extract_subscription_message(
-                        # TODO this slicing is unpleasant
-                        recv[idx:idx + message_length])
+    def can_subscribe(self, topic_filter):
+        try:
+            shared = parse_shared(topic_filter)
+        except TopicFilterError:
+            # refused when it's subscribed
+            return True
+        # a shared subscription needs read access to its filter
+        return self.acl.can_subscribe(shared[1] if shared else topic_filter)
+
+    def handle_publish(self, packet):
+        if isinstance(packet, MQTTPacket):
+            # already built by an in-process client, see handle_mqtt_packet(),
+            # its bytes are forwarded as they are. Nothing else refers to
+            # them, the client only ever resends the whole packet.
+            frame, qos, retain, packet_id = PublishFrame.from_packet(
+                memoryview(packet.raw_bytes))
+        elif self.track_latency:
+            start = perf_counter_ns()
+            frame, qos, retain, packet_id = PublishFrame.from_packet(packet)
+            self.metrics.decode_latency.record(perf_counter_ns() - start)
+        else:
+            # the payload is forwarded as received, never copied or decoded
+            frame, qos, retain, packet_id = PublishFrame.from_packet(packet)
+
+        topic = frame.topic
+        if qos == 2 and packet_id in self.unreleased:
+            # resent before its PUBREL, it was routed the first time round
+            # so it's only acknowledged again [MQTT-4.3.3-2]
+            logger.debug(f'{self.client_id} resent qos 2 packet id {packet_id}')
+        elif self.acl is not None and not self.acl.can_publish(topic):
+            # 3.1.1 has no way to refuse a publish, it's acknowledged as
+            # usual and dropped so the client doesn't keep resending it
+            logger.debug(f'{self.client_id} may not publish to {topic}')
+            self.metrics.publish_denied += 1
+        elif self.track_latency:
+            frame.received = self.read_time
+            routing = perf_counter_ns()
+            self.server.route(frame, qos, retain)
+            self.metrics.route_latency.record(perf_counter_ns() - routing)
+            self.metrics.topic_rates.record(topic)
+        else:
+            self.server.route(frame, qos, retain)
+            self.metrics.topic_rates.record(topic)
+
+        if qos == 0:
+            return
+        if qos == 2:
+            self.unreleased.add(packet_id)
+        ack = bytes([packets.PUBACK_BYTE if qos == 1 else packets.PUBREC_BYTE,
+                     0x02]) + packet_id.to_bytes(2, 'big')
+        if self.server.wal is None:
+            self.send(ack)
+        else:
+            # only acknowledge once the deliveries are on disk, acks stay
+            # in order as commits complete in order. If they can't be the
+            # client gets no ack and will publish again once reconnected.
+            self.server.wal.commit(lambda: self.send(ack), self.close)
+
+    def attach_session(self, session):
+        """ Attaches a persistent session, its dicts are used as they are.
+        A connection that had it has already handed it back, see
+        taken_over(). Deliveries still awaiting an ack are resent and the
+        offline queue is streamed out behind them.
+        """
+        session.connection = self
+        self.session = session
+        self.subscriptions = session.subscriptions
+        self.inflight = session.inflight
+        self.released = session.released
+        self.unreleased = session.unreleased
+        self._last_packet_id = session.last_packet_id
+
+        for packet_id, (frame, qos) in sorted(session.inflight.items()):
+            if packet_id in session.released:
+                self.send(bytes([packets.PUBREL_BYTE | 0x02, 0x02]) +
+                          packet_id.to_bytes(2, 'big'))
+            else:
+                self.metrics.packet_sent(packets.PUBLISH_BYTE, frame.size(qos, False))
+                self.send_buffers(frame.buffers(qos, False, packet_id, dup=True))
+
+        if session.offline:
+            self.stream_offline()
+
+    def taken_over(self):
+        """ Closes this connection for a newer one with the same client id.
+        A persistent session is handed back to be attached by the new
+        connection, a clean one ends here [MQTT-3.1.2-6].
+        """
+        if self.session is not None:
+            self.detach_session()
+        elif self.server.wal is not None:
+            self.server.wal.discard(self.client_id)
+        self.connected = False
+        self.server.remove_client(self)
+        self.close()
+
+    def detach_session(self):
+        """ Hands the session back, with anything this connection had queued
+        but not yet written put back at the front of its offline queue
+        """
+        session = self.session
+        self.session = None
+        session.connection = None
+        session.last_packet_id = self._last_packet_id
+        session.offline.push_front(
+            [(frame, qos) for frame, qos, _, _ in self.queue.entries
+             if qos or self.server.queue_qos0_offline])
+        # unacknowledged deliveries wait for the client to come back, which
+        # can be a long time to hold on to the publishers' receive buffers
+        for frame, _ in session.inflight.values():
+            frame.own()
+        self.queue.clear()
+        self.streams.clear()
+        # nothing left here belongs to this connection any more
+        self.subscriptions = {}
+        self.inflight = {}
+        self.released = set()
+        self.unreleased = set()
+
+    def stream_offline(self):
+        offline = self.session.offline
+        self.stream((frame, qos, False) for frame, qos in offline.drain())
+
+    def resume_deliveries(self):
+        """ Picks up deliveries logged before a restart from the write-ahead
+        log
+        """
+        wal = self.server.wal
+        for frame, qos, state in wal.pending(self.client_id):
+            if state == RECEIVED:
+                # the client has the message, finish the qos 2 handshake
+                packet_id = self.next_packet_id()
+                self.inflight[packet_id] = (frame, qos)
+                self.released.add(packet_id)
+                self.send(bytes([packets.PUBREL_BYTE | 0x02, 0x02]) +
+                          packet_id.to_bytes(2, 'big'))
+            else:
+                self.deliver(frame, qos)
+
+    def delivery_dropped(self, entry):
+        frame, qos = entry[0], entry[1]
+        self.metrics.messages_dropped += 1
+        if qos and frame.message_id is not None and self.server.wal is not None:
+            self.server.wal.update(frame.message_id, self.client_id, DONE)
+
+    def next_packet_id(self):
+        # skip ids still in use, 0 is not a valid packet id
+        packet_id = self._last_packet_id
+        for _ in range(len(self.inflight) + 1):
+            packet_id = packet_id % 65535 + 1
+            if packet_id not in self.inflight:
+                break
+        self._last_packet_id = packet_id
+        return packet_id
+
+    def deliver(self, frame, qos, retain=False):
+        """ Queues a shared PublishFrame for this client at the given qos """
+        if self.transport is None:
+            return
+
+        session = self.session
+        if session is not None and session.offline:
+            # still catching up on messages from while we were away, this
+            # one has to wait its turn behind them
+            if not session.offline.put(frame, qos):
+                self.delivery_dropped((frame, qos))
+            return
+
+        dropped = self.queue.dropped
+        if not self.queue.put(frame, qos, retain, frame.size(qos, retain)):
+            self.disconnect_slow_consumer()
+            return
+        if self.queue.over_limit_since is not None:
+            # the deadline is checked on the server's timer from now on, in
+            # case nothing more is delivered
+            self.server.slow_consumers.add(self)
+        if self.queue.dropped != dropped:
+            logger.debug(
+                f'Dropped {self.queue.dropped - dropped} messages for slow consumer {self.client_id}')
+
+        if not self.writing_paused:
+            self.drain()
+
+    def disconnect_slow_consumer(self):
+        logger.warning(
+            f'Disconnecting slow consumer {self.client_id}, '
+            f'{self.queue.depth} messages queued')
+        self.metrics.slow_consumer_disconnects += 1
+        self.close()
+
+    def stream(self, messages):
+        """ Sends messages as the transport takes them, pulling them from
+        the iterator one at a time rather than queueing them all up front.
+        Used for retained messages matching a new subscription, usually a
+        generator from RetainedStore.match(), and for a session's offline
+        queue.
+
+        Args:
+            messages: iterator of (PublishFrame, qos, retain)
+        """
+        if self.transport is None:
+            return
+        self.streams.append(messages)
+        if not self.writing_paused:
+            self.drain()
+
+    def drain(self):
+        """ Writes queued deliveries until the transport pushes back, then
+        carries on with any streams still to be sent. Packet ids are only
+        allocated here so anything dropped from the queue never had one.
+        """
+        queue = self.queue
+        # one clock read covers everything written in this call
+        now = perf_counter_ns() if self.track_latency and queue.entries else None
+        while queue.entries and not self.writing_paused and self.transport is not None:
+            frame, qos, retain, _ = queue.get()
+            if now is not None and frame.received is not None:
+                self.metrics.delivery_latency.record(now - frame.received)
+            self.write_publish(frame, qos, retain)
+
+        streams = self.streams
+        while streams and not self.writing_paused and self.transport is not None:
+            entry = next(streams[0], None)
+            if entry is None:
+                streams.popleft()
+                continue
+            self.write_publish(*entry)
+
+    def write_publish(self, frame, qos, retain):
+        self.metrics.packet_sent(packets.PUBLISH_BYTE, frame.size(qos, retain))
+        if qos == 0:
+            self.send_buffers(frame.buffers(0, retain))
+            return
+
+        packet_id = self.next_packet_id()
+        self.inflight[packet_id] = (frame, qos)
+        self.send_buffers(frame.buffers(qos, retain, packet_id))
+
+    def handle_delivery_ack(self, command, packet_id):
+        if packet_id not in self.inflight:
+            logger.warning(
+                f'{self.client_id} acknowledged unknown packet id {packet_id}')
+            return
+
+        wal = self.server.wal
+        message_id = self.inflight[packet_id][0].message_id
+
+        if command == packets.PUBREC_BYTE:
+            # qos 2, keep it inflight until PUBCOMP
+            self.released.add(packet_id)
+            if wal is not None and message_id is not None:
+                wal.update(message_id, self.client_id, RECEIVED)
+            self.send(bytes([packets.PUBREL_BYTE | 0x02, 0x02]) +
+                      packet_id.to_bytes(2, 'big'))
+            return
+
+        del self.inflight[packet_id]
+        self.released.discard(packet_id)
+        if wal is not None and message_id is not None:
+            wal.update(message_id, self.client_id, DONE)
+
+    def send(self, data):
+        self.metrics.packet_sent(data[0] & 0xF0, len(data))
+        self.send_buffers((data,))
+
+    def batch_written(self, nbytes):
+        self.metrics.bytes_sent += nbytes
+
+    def close(self):
+        if self.transport is not None:
+            # anything already batched still goes out before the close
+            self.flush()
+            self.transport.close()
@@ -4,17 +4,35 @@ import packets
 class MQTTPacket:
     # this is either created from the packet generator or from a received packet
     # topic and payload are encoded as utf-8 strings
+    # PUBLISH and the acks have classes of their own below, the rest keep
+    # their fields in data
+    __slots__ = ('command_byte', 'raw_bytes', 'send_func', '_data')
+
     def __init__(self, command_byte, raw_bytes, data=None, send_func=None):
-        self.command_byte = command_byte
         # TODO check why this is necesarry
         if isinstance(command_byte, bytes):
-            self.command_byte = command_byte[0]
+            command_byte = command_byte[0]
+        self.command_byte = command_byte
         self.raw_bytes = raw_bytes
-        self.data = data if data is not None else {}
+        self._data = data
         self.send_func = send_func
 
     def __str__(self):
-        return f"MQTTPacket(command_byte={self.command_byte}, \rdata={self.data})"
+        return f"{type(self).__name__}(command_byte={self.command_byte}, \rdata={self.data})"
+
+    @property
+    def data(self):
+        # most packets never have their data looked at, it's made on demand
+        # and kept, so it can be added to like any dict
+        if self._data is None:
+            self._data = self._fields()
+        return self._data
+
+    def _fields(self):
+        """ data for a packet that wasn't given any, from the fields of the
+        packet types that have their own class
+        """
+        return {}
 
     @property
     def command_type(self):
@@ -24,23 +42,23 @@ class MQTTPacket:
     # TODO double check the default return types for these
     @property
     def packet_id(self):
-        return self.data.get('packet_id', None)
+        return self._data.get('packet_id', None) if self._data else None
 
     @property
     def qos(self):
-        return self.data.get('qos', 0)
+        return self._data.get('qos', 0) if self._data else 0
 
     @property
     def retain(self):
-        return self.data.get('retain', False)
+        return self._data.get('retain', False) if self._data else False
 
     @property
     def topic(self):
-        return self.data.get('topic', None)
+        return self._data.get('topic', None) if self._data else None
 
     @property
     def payload(self):
-        return self.data.get('payload', None)
+        return self._data.get('payload', None) if self._data else None
 
     @property
     def dup(self):
@@ -55,3 +73,91 @@ class MQTTPacket:
             return
 
         self.send_func(self.raw_bytes)
+
+
+# topic or payload not decoded from raw_bytes yet
+UNDECODED = object()
+
+
+class PublishPacket(MQTTPacket):
+    """ A PUBLISH. qos and retain are read from the command byte, and a
+    received packet's topic and payload are only decoded from raw_bytes,
+    usually a memoryview of the receive buffer, the first time they're read.
+
+    Args:
+        topic_start: offset of the topic's length prefix in raw_bytes
+        payload_start: offset of the payload in raw_bytes
+        topic, payload: for packets that are being built, as given
+    """
+    __slots__ = ('_packet_id', '_topic', '_payload', '_topic_start', '_payload_start')
+
+    def __init__(self, command_byte, raw_bytes, topic_start, payload_start,
+                 packet_id=None, send_func=None, topic=UNDECODED, payload=UNDECODED):
+        super().__init__(command_byte, raw_bytes, send_func=send_func)
+        self._packet_id = packet_id
+        self._topic = topic
+        self._payload = payload
+        self._topic_start = topic_start
+        self._payload_start = payload_start
+
+    def _fields(self):
+        return {
+            'topic': self.topic,
+            'payload': self.payload,
+            'qos': self.qos,
+            'dup': self.dup,
+            'retain': self.retain,
+            'packet_id': self._packet_id,
+        }
+
+    def set_dup_bit(self):
+        super().set_dup_bit()
+        if self._data is not None:
+            self._data['dup'] = True
+
+    @property
+    def packet_id(self):
+        return self._packet_id
+
+    @property
+    def qos(self):
+        return (self.command_byte & 0x06) >> 1
+
+    @property
+    def retain(self):
+        return bool(self.command_byte & packets.RETAIN_BIT)
+
+    @property
+    def topic(self):
+        if self._topic is UNDECODED:
+            start = self._topic_start + 2
+            length = int.from_bytes(self.raw_bytes[self._topic_start:start], 'big')
+            # str() rather than .decode() as raw_bytes can be a memoryview
+            self._topic = str(self.raw_bytes[start:start + length], 'utf-8')
+        return self._topic
+
+    @property
+    def payload(self):
+        if self._payload is UNDECODED:
+            payload = self.raw_bytes[self._payload_start:]
+            try:
+                self._payload = str(payload, 'utf-8')
+            except UnicodeDecodeError:
+                self._payload = bytes(payload)  # fallback to raw bytes if not UTF-8
+        return self._payload
+
+
+class AckPacket(MQTTPacket):
+    """ PUBACK, PUBREC, PUBREL and PUBCOMP, nothing but a packet id """
+    __slots__ = ('_packet_id',)
+
+    def __init__(self, command_byte, raw_bytes, packet_id, send_func=None):
+        super().__init__(command_byte, raw_bytes, send_func=send_func)
+        self._packet_id = packet_id
+
+    def _fields(self):
+        return {'packet_id': self._packet_id}
+
+    @property
+    def packet_id(self):
+        return self._packet_id
@@ -1,75 +1,842 @@
+import argparse
+import asyncio
+import errno
+import hashlib
+import os
+import shutil
+import signal
 import socket
+import stat
+import tempfile
 from mqtt_connection import MQTTConnection
-from time import sleep
+from broker_metrics import BrokerMetrics
+from admin_server import AdminServer
+from authenticator import Authenticator
+from topic_acl import TopicAcl
+import tls
+from websocket_transport import WebSocketProtocol
+from client_registry import ClientRegistry
+from peer_link import PeerLink, PeerRouter
+from topic_trie import TopicTrie
+from shared_subscriptions import SharedSubscriptions, parse_shared, ROUND_ROBIN, STRATEGIES
+from publish_frame import PublishFrame
+from retained_store import RetainedStore
+from timer_wheel import TimerWheel
+from write_ahead_log import WriteAheadLog, DONE
+from offline_queue import OfflineQueue, SPILL_SUFFIX
+from session import Session
+from outbound_queue import DROP_OLDEST
+from frame_decoder import DEFAULT_MAX_PACKET_SIZE
 
-clients = []
-topics = {}
+from logging_setup import LoggerSetup
+import logging  # for initial log level
+logger = LoggerSetup.get_logger(__name__)
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
 
 
 class MQTTServer:
-    def __init__(self):
-        print('Starting server...')
+    def __init__(self, host='localhost', port=1883, backlog=4096,
+                 max_queued_messages=1000, max_queued_bytes=1024 * 1024,
+                 slow_consumer_policy=DROP_OLDEST, slow_consumer_timeout=10,
+                 write_buffer_high=64 * 1024, write_batch_bytes=16 * 1024,
+                 write_batch_delay=0, max_packet_size=DEFAULT_MAX_PACKET_SIZE,
+                 read_buffer_size=4096, workers=1, node_id=None,
+                 cluster_host=None, cluster_port=None, cluster_peers=(),
+                 cluster_batch_delay=0, keep_alive_resolution=1.0,
+                 wal_dir=None, wal_commit_window=0,
+                 wal_segment_bytes=64 * 1024 * 1024, wal_fsync=True,
+                 offline_dir=None, offline_memory_budget=64 * 1024,
+                 offline_max_bytes=64 * 1024 * 1024,
+                 offline_segment_bytes=1024 * 1024, queue_qos0_offline=False,
+                 persistent_sessions=None,
+                 shared_subscription_strategy=ROUND_ROBIN, sys_interval=10,
+                 admin_host=None, admin_port=None, topic_rate_window=10.0,
+                 track_latency=True, authenticator=None, allow_anonymous=True,
+                 acl=None, tls_context=None, tls_port=8883,
+                 tls_handshake_timeout=10.0, websocket_port=None,
+                 websocket_path=None, unix_path=None, unix_mode=0o660):
+        logger.info('Starting server...')
+        self.host = host
+        # None opens no tcp listener, for a broker only reached some other
+        # way like an EmbeddedBroker's clients, see loopback.py
+        self.port = port
+        # listen backlog, large enough to absorb a reconnect storm
+        self.backlog = backlog
+
+        # per subscriber outbound queue limits, see outbound_queue.py
+        self.max_queued_messages = max_queued_messages
+        self.max_queued_bytes = max_queued_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        self.slow_consumer_timeout = slow_consumer_timeout
+        # bytes buffered in a transport before it stops taking queued messages
+        self.write_buffer_high = write_buffer_high
+        # frames to a connection are batched into one write per loop
+        # iteration, or sooner once this many bytes are pending. A delay
+        # holds batches open longer at the cost of latency.
+        self.write_batch_bytes = write_batch_bytes
+        self.write_batch_delay = write_batch_delay
+        # larger packets close the connection, see frame_decoder.py
+        self.max_packet_size = max_packet_size
+        # initial per connection receive buffer, kept small so idle clients
+        # are cheap, it grows for packets that don't fit
+        self.read_buffer_size = read_buffer_size
+
+        # with more than one worker run() forks that many processes sharing
+        # the port, each with its own clients and subscriptions
+        self.workers = workers
+        self.worker_id = None
+        self.node_id = node_id if node_id else f'{socket.gethostname()}-{os.getpid()}'
+        # this worker's ends of the socket pairs linking it to the others
+        self.link_sockets = []
+        self.router = None
+
+        # cluster mode, links to other brokers over tcp, see peer_link.py
+        self.cluster_host = cluster_host if cluster_host else host
+        self.cluster_port = cluster_port
+        # (host, port) of every other node's cluster port
+        self.cluster_peers = list(cluster_peers)
+        # holding batches of forwarded frames open trades latency for fewer,
+        # bigger writes between nodes
+        self.cluster_batch_delay = cluster_batch_delay
+        if workers > 1 and (cluster_port is not None or self.cluster_peers):
+            raise ValueError('Clustering is not supported with workers > 1')
+
+        # checks CONNECT credentials off the event loop, see
+        # authenticator.py. Clients without a username are let in only
+        # with allow_anonymous.
+        self.authenticator = authenticator
+        self.allow_anonymous = allow_anonymous
+        # TopicAcl of who may publish and subscribe to what, everything is
+        # allowed without one, see topic_acl.py
+        self.acl = acl
+
+        # with an ssl.SSLContext a TLS listener is served on tls_port as
+        # well, see tls.py
+        self.tls_context = tls_context
+        self.tls_port = tls_port
+        self.tls_handshake_timeout = tls_handshake_timeout
+
+        # MQTT over WebSocket for browsers, off unless websocket_port is
+        # set, see websocket_transport.py. A path limits the upgrade
+        # requests accepted to that one.
+        self.websocket_port = websocket_port
+        self.websocket_path = websocket_path
+
+        # a unix domain socket for clients on this host, skipping the tcp
+        # stack. With several workers it's bound before they fork and they
+        # all accept on it.
+        self.unix_path = unix_path
+        self.unix_mode = unix_mode
+        self.unix_socket = None
+        # (st_dev, st_ino) of the path once bound, so only our own socket
+        # is removed on the way out
+        self.unix_inode = None
+
+        # asyncio servers of the extra listeners, TLS, WebSocket and unix
+        self.listeners = []
+
+        # client id -> connection, see client_registry.py
+        self.clients = ClientRegistry()
+        self.topics = TopicTrie()
+        # '$share/<group>/<filter>' subscriptions, each message goes to one
+        # member of a group, see shared_subscriptions.py
+        self.shared = SharedSubscriptions(shared_subscription_strategy)
+        # last retained message for each topic, sent to new subscribers
+        self.retained = RetainedStore()
+
+        # clients are disconnected after 1.5x their keep alive without a
+        # packet [MQTT-3.1.2-24], checked every keep_alive_resolution seconds
+        self.keep_alive_resolution = keep_alive_resolution
+        self.keep_alive_timers = None
+        # connections whose outbound queue is over its limits, their
+        # slow_consumer_timeout is checked on the same tick
+        self.slow_consumers = set()
+
+        # with a directory qos 1/2 deliveries are logged so unfinished ones
+        # survive a restart, see write_ahead_log.py. Publishes are only
+        # acknowledged once logged, commits within wal_commit_window share
+        # one fsync.
+        self.wal_dir = wal_dir
+        self.wal_commit_window = wal_commit_window
+        self.wal_segment_bytes = wal_segment_bytes
+        self.wal_fsync = wal_fsync
+        self.wal = None
+
+        # persistent sessions hold messages for disconnected clients in
+        # memory up to offline_memory_budget each, then spill them to
+        # offline_max_bytes of memory-mapped files in offline_dir (a
+        # temporary directory by default), see offline_queue.py
+        self.offline_dir = offline_dir
+        self.offline_memory_budget = offline_memory_budget
+        self.offline_max_bytes = offline_max_bytes
+        self.offline_segment_bytes = offline_segment_bytes
+        self.queue_qos0_offline = queue_qos0_offline
+        self._offline_dir_is_temporary = False
+        # client id -> Session, for clean_session=False clients
+        self.sessions = {}
+        # a session lives in the worker its client connected to and the
+        # kernel spreads reconnects over workers at random, so with several
+        # workers they're off by default and clean_session=False clients are
+        # refused
+        if persistent_sessions is None:
+            persistent_sessions = workers <= 1
+        elif persistent_sessions and workers > 1:
+            raise ValueError('Persistent sessions are not supported with workers > 1')
+        self.persistent_sessions = persistent_sessions
+
+        # statistics published under $SYS/broker/ every sys_interval
+        # seconds, 0 turns publishing off
+        self.metrics = BrokerMetrics(topic_rate_window, track_latency)
+        self.sys_interval = sys_interval
+
+        # HTTP admin endpoint with Prometheus metrics and JSON introspection
+        # on a port of its own, off unless admin_port is set, see
+        # admin_server.py. With several workers each one listens on
+        # admin_port + its worker id.
+        self.admin_host = admin_host if admin_host else host
+        self.admin_port = admin_port
+        self.admin = None
+        self._topic_rates_handle = None
+
+        self.loop = None
+        self.server = None
+        # set by stop(), what serve() waits on without a tcp listener
+        self._stopped = None
+        self._sys_handle = None
+        self._keep_alive_handle = None
+
+    def add_new_subscription(self, topic, client_id, qos=0):
+        shared = parse_shared(topic)
+        if shared is not None:
+            group, shared_filter = shared
+            is_new = self.shared.subscribe(group, shared_filter, client_id, min(qos, 2))
+        else:
+            # qos 3 is reserved, grant the most we support
+            is_new = self.topics.subscribe(topic, client_id, min(qos, 2))
+        if is_new and self.router is not None:
+            # peers are told about shared subscriptions by group, so only
+            # the node a message is published on picks the member
+            self.router.local_subscribed(topic)
+
+    def remove_subscription(self, topic, client_id):
+        shared = parse_shared(topic)
+        if shared is not None:
+            group, shared_filter = shared
+            removed = self.shared.unsubscribe(group, shared_filter, client_id)
+        else:
+            removed = self.topics.unsubscribe(topic, client_id)
+        if removed and self.router is not None:
+            self.router.local_unsubscribed(topic)
+
+    def add_client(self, connection):
+        """ Registers a connection under its client id, a connection
+        already using the id is taken over and closed [MQTT-3.1.4-2],
+        whichever worker or node it's on
+        """
+        logger.info(f'Client {connection.client_id} connected')
+        previous = self.clients.register(connection)
+        self.metrics.client_connected(len(self.clients))
+        if previous is not None:
+            logger.info(f'Client {connection.client_id} taken over')
+            previous.taken_over()
+        if self.router is not None:
+            self.router.claim(connection.client_id)
+
+    def client_claimed(self, client_id, peer_id):
+        """ A client has connected to another worker or node, any
+        connection it has here is taken over
+        """
+        connection = self.clients.get(client_id)
+        if connection is not None:
+            logger.info(f'Client {client_id} taken over by {peer_id}')
+            connection.taken_over()
+
+    def remove_client(self, connection):
+        logger.info(f'Client {connection.client_id} disconnected')
+        self.keep_alive_timers.cancel(connection)
+        self.slow_consumers.discard(connection)
+        if connection.session is None:
+            for topic in connection.subscriptions:
+                self.remove_subscription(topic, connection.client_id)
+        self.clients.unregister(connection)
+
+    def _prepare_offline_dir(self):
+        if self.offline_dir is None:
+            self.offline_dir = tempfile.mkdtemp(prefix='mqtt-offline-')
+            self._offline_dir_is_temporary = True
+            return
+
+        os.makedirs(self.offline_dir, exist_ok=True)
+        # spill files are scratch space, anything left is from an old run
+        for name in os.listdir(self.offline_dir):
+            if name.endswith(SPILL_SUFFIX):
+                os.remove(os.path.join(self.offline_dir, name))
+
+    def open_session(self, client_id):
+        """ Finds or creates the persistent session for a client id
+
+        Returns:
+            (Session, True if it already existed)
+        """
+        session = self.sessions.get(client_id)
+        if session is not None:
+            return session, True
+
+        name = hashlib.sha1(client_id.encode('utf-8')).hexdigest()[:16]
+        offline = OfflineQueue(
+            os.path.join(self.offline_dir, name),
+            memory_budget=self.offline_memory_budget,
+            max_bytes=self.offline_max_bytes,
+            segment_bytes=self.offline_segment_bytes)
+        session = self.sessions[client_id] = Session(client_id, offline)
+        return session, False
+
+    def end_session(self, client_id):
+        """ Discards a persistent session, e.g. when its client reconnects
+        with clean_session=True [MQTT-3.1.2-6]
+        """
+        session = self.sessions.pop(client_id, None)
+        if session is None:
+            return
+        for topic in session.subscriptions:
+            self.remove_subscription(topic, client_id)
+        session.offline.clear()
+        if self.wal is not None:
+            self.wal.discard(client_id)
+
+    def session_stats(self):
+        return {client_id: session.stats()
+                for client_id, session in self.sessions.items()}
+
+    def tls_stats(self):
+        """ Handshakes on the TLS listener, see tls.session_stats(), None
+        when there's no TLS listener
+        """
+        if self.tls_context is None:
+            return None
+        return tls.session_stats(self.tls_context)
+
+    def reap_idle_clients(self):
+        """ Closes connections whose keep alive has run out, only the wheel
+        slots that came due since the last call are looked at. Slow
+        consumers that have been over their queue limits for too long are
+        closed too, whether or not anything is still being delivered to them.
+        """
+        for connection in self.keep_alive_timers.advance(self.loop.time()):
+            logger.info(
+                f'Client {connection.client_id} keep alive expired, disconnecting')
+            self.metrics.keep_alive_expired += 1
+            connection.close()
+
+        for connection in list(self.slow_consumers):
+            if connection.queue.over_limit_since is None or connection.transport is None:
+                self.slow_consumers.discard(connection)
+            elif connection.queue.overdue():
+                self.slow_consumers.discard(connection)
+                connection.disconnect_slow_consumer()
+        self._keep_alive_handle = self.loop.call_later(
+            self.keep_alive_resolution, self.reap_idle_clients)
+
+    def queue_stats(self):
+        """ Outbound queue depth and drop counters for every client """
+        return {client.client_id: client.queue.stats() for client in self.clients}
+
+    async def start(self):
+        """ Binds the listening socket and starts accepting connections.
+        Every connection is served by its own MQTTConnection protocol object
+        on this one event loop, so nothing here waits on a single client.
+        """
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        raise_open_file_limit()
+
+        self._prepare_offline_dir()
+
+        if self.wal_dir is not None:
+            self.wal = WriteAheadLog(
+                self.wal_dir, segment_bytes=self.wal_segment_bytes,
+                commit_window=self.wal_commit_window, fsync=self.wal_fsync)
+            self.wal.open(self.loop)
+
+        self.keep_alive_timers = TimerWheel(
+            self.keep_alive_resolution, now=self.loop.time())
+        self._keep_alive_handle = self.loop.call_later(
+            self.keep_alive_resolution, self.reap_idle_clients)
+
+        if self.port is not None:
+            self.server = await self.loop.create_server(
+                lambda: MQTTConnection(self), self.host, self.port,
+                backlog=self.backlog, reuse_address=True,
+                reuse_port=self.workers > 1)
+
+            # port 0 lets the os pick, report what we actually got
+            self.port = self.server.sockets[0].getsockname()[1]
+            logger.info(f'Server listening on port {self.port}')
+
+        if self.tls_context is not None:
+            self.tls_port = await self.listen(
+                lambda: MQTTConnection(self), self.tls_port, ssl=self.tls_context,
+                ssl_handshake_timeout=self.tls_handshake_timeout)
+            logger.info(f'Server listening for TLS on port {self.tls_port}')
+        if self.websocket_port is not None:
+            self.websocket_port = await self.listen(
+                lambda: WebSocketProtocol(MQTTConnection(self), self.websocket_path),
+                self.websocket_port)
+            logger.info(f'Server listening for WebSockets on port {self.websocket_port}')
+        if self.unix_path is not None:
+            if self.unix_socket is None:
+                self.unix_socket, self.unix_inode = bind_unix_socket(
+                    self.unix_path, self.unix_mode)
+            self.listeners.append(await self.loop.create_unix_server(
+                lambda: MQTTConnection(self), sock=self.unix_socket,
+                backlog=self.backlog))
+            logger.info(f'Server listening on {self.unix_path}')
 
-    def add_new_subscription(self, topic, client_id):
+        if self.link_sockets:
+            self.router = PeerRouter(self, f'{self.node_id}-{self.worker_id}')
+            for sock, outbound in self.link_sockets:
+                await self.loop.connect_accepted_socket(
+                    lambda: PeerLink(self.router, outbound), sock)
+
+        if self.cluster_port is not None or self.cluster_peers:
+            self.router = PeerRouter(
+                self, self.node_id, batch_delay=self.cluster_batch_delay)
+            if self.cluster_port is not None:
+                self.cluster_port = await self.router.listen(
+                    self.cluster_host, self.cluster_port)
+                logger.info(
+                    f'Node {self.node_id} accepting cluster links on port {self.cluster_port}')
+            for host, port in self.cluster_peers:
+                self.router.dial(host, port)
+
+        if self.router is not None:
+            # ids handed out here mustn't take over another worker's or node's
+            self.clients.prefix = f'auto-{self.router.node_id}'
+
+        if self.sys_interval:
+            self._sys_handle = self.loop.call_later(
+                self.sys_interval, self.publish_sys_tree)
+        self._topic_rates_handle = self.loop.call_later(
+            self.metrics.topic_rates.window, self.rotate_topic_rates)
+
+        if self.admin_port is not None:
+            self.admin = AdminServer(self, self.admin_host, self.admin_port)
+            self.admin.start()
+            self.admin_port = self.admin.port
+
+    async def listen(self, protocol_factory, port, **kwargs):
+        """ Starts an extra listener sharing everything with the main one
+
+        Returns:
+            the port it's listening on
+        """
+        listener = await self.loop.create_server(
+            protocol_factory, self.host, port, backlog=self.backlog,
+            reuse_address=True, reuse_port=self.workers > 1, **kwargs)
+        self.listeners.append(listener)
+        return listener.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+
+        if self._keep_alive_handle is not None:
+            self._keep_alive_handle.cancel()
+            self._keep_alive_handle = None
+
+        if self._sys_handle is not None:
+            self._sys_handle.cancel()
+            self._sys_handle = None
+        if self._topic_rates_handle is not None:
+            self._topic_rates_handle.cancel()
+            self._topic_rates_handle = None
+
+        if self.admin is not None:
+            # shutdown() waits for the serving thread, which can be waiting
+            # on this loop
+            await self.loop.run_in_executor(None, self.admin.close)
+            self.admin = None
+
+        if self.router is not None:
+            self.router.close()
+
+        if self.server is not None:
+            self.server.close()
+        for listener in self.listeners:
+            listener.close()
+        for connection in self.clients:
+            connection.close()
+        if self.server is not None:
+            await self.server.wait_closed()
+            self.server = None
+        for listener in self.listeners:
+            await listener.wait_closed()
+        self.listeners = []
+        if self.unix_socket is not None:
+            # the workers' parent removes the path once they've all exited
+            if self.worker_id is None:
+                remove_unix_socket(self.unix_path, self.unix_inode)
+            self.unix_socket = None
+
+        if self.wal is not None:
+            await self.wal.wait_synced()
+            self.wal.close()
+            self.wal = None
+
+        for session in self.sessions.values():
+            session.offline.clear()
+        self.sessions = {}
+        if self._offline_dir_is_temporary:
+            shutil.rmtree(self.offline_dir, ignore_errors=True)
+            self.offline_dir = None
+            self._offline_dir_is_temporary = False
+
+    async def serve(self):
+        await self.start()
         try:
-            topics[topic].append(client_id)
-        except KeyError:
-            topics[topic] = [client_id]
+            if self.server is not None:
+                await self.server.serve_forever()
+            else:
+                # only the other listeners, or none at all for a broker
+                # reached in process, they're already accepting
+                await self._stopped.wait()
+        finally:
+            await self.stop()
 
     def run(self):
-        host = 'localhost'
-        port = 1883
+        if self.workers > 1:
+            self.run_workers()
+            return
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+        logger.info('Exiting')
+
+    def run_workers(self):
+        """ Forks self.workers processes that all accept on the same port with
+        SO_REUSEPORT, so the kernel spreads connections over them and each
+        one gets a core of its own. Every pair of workers is joined by a unix
+        socket pair that carries subscription interest and the publishes
+        that need to cross between them, see peer_link.py.
+        """
+        if self.unix_path is not None:
+            self.unix_socket, self.unix_inode = bind_unix_socket(
+                self.unix_path, self.unix_mode)
 
-            server_socket.bind((host, port))
+        pairs = {}
+        for i in range(self.workers):
+            for j in range(i + 1, self.workers):
+                pairs[(i, j)] = socket.socketpair()
 
-            # queue 5 connections
-            # TODO make bigger as and when needed
-            server_socket.listen(5)
-            print(f'Server listening on port {port}')
+        children = []
+        for worker_id in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker(worker_id, pairs)
+            children.append(pid)
 
-            while True:
+        for a, b in pairs.values():
+            a.close()
+            b.close()
+        if self.unix_socket is not None:
+            self.unix_socket.close()
+
+        logger.info(f'Started {self.workers} workers on port {self.port}')
+        try:
+            for pid in children:
+                os.waitpid(pid, 0)
+        except KeyboardInterrupt:
+            for pid in children:
                 try:
-                    conn, addr = server_socket.accept()
-                    print(f'Connection from {addr}')
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in children:
+                os.waitpid(pid, 0)
 
-                    client = MQTTConnection(
-                        conn, on_new_subscription=self.add_new_subscription)
-                    if (client.validate_connection()):
-                        clients.append(client)
-                        client.start()
+        if self.unix_path is not None:
+            remove_unix_socket(self.unix_path, self.unix_inode)
+        logger.info('Exiting')
 
-                    self.publish_sys_info()
+    def _run_worker(self, worker_id, pairs):
+        self.worker_id = worker_id
+        if self.wal_dir is not None:
+            # every worker logs its own clients' deliveries
+            self.wal_dir = os.path.join(self.wal_dir, f'worker-{worker_id}')
+        if self.offline_dir is not None:
+            self.offline_dir = os.path.join(self.offline_dir, f'worker-{worker_id}')
+        if self.admin_port:
+            self.admin_port += worker_id
+        for (i, j), (a, b) in pairs.items():
+            if i == worker_id:
+                # the lower numbered worker counts as the dialling side
+                self.link_sockets.append((a, True))
+                b.close()
+            elif j == worker_id:
+                self.link_sockets.append((b, False))
+                a.close()
+            else:
+                a.close()
+                b.close()
 
-                except KeyboardInterrupt:
-                    break
+        # ctrl-c reaches every worker through the process group anyway
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        os._exit(0)
+
+    def publish_sys_tree(self):
+        """ Publishes the broker's statistics as retained messages under
+        $SYS/broker/, then schedules the next round
+        """
+        for path, value in self.metrics.snapshot(self).items():
+            # each worker and node reports on itself only
+            self.publish(f'$SYS/broker/{path}', str(value), retain=True,
+                         forward=False)
+        self._sys_handle = self.loop.call_later(
+            self.sys_interval, self.publish_sys_tree)
+
+    def rotate_topic_rates(self):
+        self.metrics.topic_rates.rotate()
+        self._topic_rates_handle = self.loop.call_later(
+            self.metrics.topic_rates.window, self.rotate_topic_rates)
+
+    def publish(self, topic, payload, qos=0, retain=False, forward=True,
+                received=None):
+        """ Routes a message to every matching subscriber, and to one member
+        of every matching shared subscription group. The frame is
+        encoded once per qos it's delivered at and shared between them.
+        Retained messages are also stored, an empty payload clears the
+        topic's retained message [MQTT-3.3.1-5].
+
+        Args:
+            forward: also send it to peers with interested subscribers, False
+                for messages that came from a peer in the first place
+            received: perf_counter_ns() when it was read from the client,
+                for the inbound to outbound latency
+        """
+        frame = PublishFrame(topic, payload)
+        frame.received = received
+        self.route(frame, qos, retain, forward)
 
-        print('Exiting')
+    def route(self, frame, qos=0, retain=False, forward=True, groups=()):
+        """ publish() for a PublishFrame, one wrapping a received PUBLISH
+        is delivered without its payload being copied, see publish_frame.py
 
-    def publish_sys_info(self):
-        while True:
-            sleep(5)
-            self.publish('$SYS/info', 'Some info')
+        Args:
+            groups: for a message from a peer, the (group, filter) keys of
+                the shared subscription groups it chose this node for
+        """
+        topic = frame.topic
+        clients = self.clients.connections
+        # one member of each matching shared subscription group, anywhere
+        # in the cluster when it's published here
+        if not forward:
+            members = self.shared.match(topic, clients, self.sessions, groups)
+        elif self.router is not None:
+            members, peers = self.shared.route(
+                topic, clients, self.sessions, self.router.links)
+            self.router.forward(frame, qos, retain, peers)
+        else:
+            members = self.shared.match(topic, clients, self.sessions)
 
-    def publish(self, topic, payload, qos=0):
-        command_byte = 0b00110000
-        topic_length = len(topic)
-        encoded_topic = topic.encode('utf-8')
-        encoded_payload = payload.encode('utf-8')
+        if retain:
+            self.retained.set(topic, None, qos, frame=frame)
 
-        # variable header length + topic length + length of topic and payload (sometimes + packet_id if qos > 0)
-        length = 1 + 2 + topic_length + len(encoded_payload)
+        subscribers = list(self.topics.match(topic).items())
+        subscribers.extend(members)
+        if not subscribers:
+            return
 
-        data = bytearray(
-            [command_byte, length, (topic_length << 8) & 0xff, topic_length & 0xff])
-        data.extend(encoded_topic)
-        data.extend(encoded_payload)
+        recipients = []
+        # persistent sessions whose client is away
+        offline = []
+        for client_id, granted_qos in subscribers:
+            delivery_qos = min(qos, granted_qos)
+            client = clients.get(client_id)
+            if client is not None:
+                recipients.append((client, delivery_qos))
+                continue
+            session = self.sessions.get(client_id)
+            if session is not None and (delivery_qos or self.queue_qos0_offline):
+                offline.append((session, delivery_qos))
 
-        print(f'publish: {data}')
+        if self.wal is not None and qos:
+            # logged before delivery so acks and drops can find the message
+            deliveries = [(client.client_id, delivery_qos)
+                          for client, delivery_qos in recipients if delivery_qos]
+            deliveries.extend((session.client_id, delivery_qos)
+                              for session, delivery_qos in offline if delivery_qos)
+            if deliveries:
+                self.wal.log_message(frame, qos, retain, deliveries)
 
-        clients[0].conn.send(data)
+        # existing subscribers get it as a normal message [MQTT-3.3.1-9]
+        for client, delivery_qos in recipients:
+            client.deliver(frame, delivery_qos)
+        for session, delivery_qos in offline:
+            if not session.offline.put(frame, delivery_qos):
+                logger.debug(f'Offline queue for {session.client_id} is full')
+                self.metrics.messages_dropped += 1
+                if frame.message_id is not None:
+                    self.wal.update(frame.message_id, session.client_id, DONE)
+
+
+def bind_unix_socket(path, mode):
+    """ Binds a unix domain socket, replacing one left behind by a broker
+    that didn't exit cleanly. A socket something is still listening on is
+    left alone.
+
+    Returns:
+        (socket, (st_dev, st_ino) of the path) for remove_unix_socket()
+
+    Raises:
+        OSError: EADDRINUSE if another process is listening on path
+    """
+    try:
+        is_socket = stat.S_ISSOCK(os.stat(path).st_mode)
+    except FileNotFoundError:
+        is_socket = False
+    if is_socket:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            # nobody's accepting on it any more
+            remove_unix_socket(path)
+        except FileNotFoundError:
+            pass
+        else:
+            raise OSError(errno.EADDRINUSE, f'Something is listening on {path}')
+        finally:
+            probe.close()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # created with the mode it's meant to have, a chmod after bind would
+    # leave it open to anyone for a moment
+    umask = os.umask(~mode & 0o777)
+    try:
+        sock.bind(path)
+        info = os.stat(path)
+    except OSError:
+        sock.close()
+        raise
+    finally:
+        os.umask(umask)
+    return sock, (info.st_dev, info.st_ino)
+
+
+def remove_unix_socket(path, inode=None):
+    """ Removes path if it's a socket, anything else is left alone. With
+    an inode from bind_unix_socket() only that socket is removed, not one
+    another broker has bound at the same path since.
+    """
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(info.st_mode):
+        return
+    if inode is not None and (info.st_dev, info.st_ino) != inode:
+        return
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def raise_open_file_limit():
+    """ Every connection is a file descriptor, the default soft limit (often
+    1024) would cap us well below the number of idle clients we want to hold.
+    """
+    if resource is None:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            logger.warning(f'Could not raise open file limit: {e}')
 
 
 if __name__ == '__main__':
-    MQTTServer().run()
+    parser = argparse.ArgumentParser(description='MQTT broker')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes sharing the port')
+    parser.add_argument('--persistent-sessions', default=None,
+                        action=argparse.BooleanOptionalAction,
+                        help='keep clean_session=False sessions, on by '
+                             'default and not supported with --workers')
+    parser.add_argument('--node-id', default=None,
+                        help='unique name of this node in a cluster')
+    parser.add_argument('--cluster-port', type=int, default=None,
+                        help='port to accept links from other nodes on')
+    parser.add_argument('--peer', action='append', default=[],
+                        metavar='HOST:PORT', help='cluster port of another node')
+    parser.add_argument('--wal-dir', default=None,
+                        help='directory for the qos 1/2 write-ahead log')
+    parser.add_argument('--wal-commit-window', type=float, default=0,
+                        help='seconds of commits gathered into one fsync')
+    parser.add_argument('--shared-strategy', default=ROUND_ROBIN,
+                        choices=STRATEGIES,
+                        help='how a shared subscription group picks a member')
+    parser.add_argument('--admin-port', type=int, default=None,
+                        help='port for the HTTP admin endpoint')
+    parser.add_argument('--password-file', default=None,
+                        help='username:hash file, clients must authenticate')
+    parser.add_argument('--allow-anonymous', action='store_true',
+                        help='with a password file, still let in clients '
+                             'that send no username')
+    parser.add_argument('--acl-file', default=None,
+                        help='topic access rules, see topic_acl.py')
+    parser.add_argument('--tls-port', type=int, default=8883)
+    parser.add_argument('--certfile', default=None,
+                        help='PEM certificate, serves TLS on --tls-port')
+    parser.add_argument('--keyfile', default=None)
+    parser.add_argument('--cafile', default=None,
+                        help='CA certificates clients must present a certificate from')
+    parser.add_argument('--ciphers', default=None,
+                        help='OpenSSL cipher list for TLS 1.2')
+    parser.add_argument('--websocket-port', type=int, default=None,
+                        help='port for MQTT over WebSocket')
+    parser.add_argument('--unix-path', default=None,
+                        help='unix domain socket to accept local clients on')
+    parser.add_argument('--sys-interval', type=float, default=10,
+                        help='seconds between $SYS statistics, 0 for none')
+    args = parser.parse_args()
+
+    peers = []
+    for peer in args.peer:
+        peer_host, peer_port = peer.rsplit(':', 1)
+        peers.append((peer_host, int(peer_port)))
+
+    LoggerSetup.setup(log_level=logging.INFO)
+    MQTTServer(args.host, args.port, workers=args.workers, node_id=args.node_id,
+               persistent_sessions=args.persistent_sessions,
+               cluster_port=args.cluster_port, cluster_peers=peers,
+               wal_dir=args.wal_dir,
+               wal_commit_window=args.wal_commit_window,
+               shared_subscription_strategy=args.shared_strategy,
+               sys_interval=args.sys_interval,
+               admin_port=args.admin_port,
+               authenticator=(Authenticator(args.password_file)
+                              if args.password_file else None),
+               allow_anonymous=args.allow_anonymous or not args.password_file,
+               acl=TopicAcl(args.acl_file) if args.acl_file else None,
+               tls_context=(tls.server_context(args.certfile, args.keyfile,
+                                               args.cafile, args.ciphers)
+                            if args.certfile else None),
+               tls_port=args.tls_port,
+               websocket_port=args.websocket_port,
+               unix_path=args.unix_path).run()
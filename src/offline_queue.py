@@ -0,0 +1,215 @@
+"""
+Queue of messages for a persistent session whose client is disconnected.
+
+The oldest messages are kept in memory up to memory_budget bytes. Once the
+budget is used up every further message is appended to memory-mapped spill
+segments on disk, until the disk part has been read back empty, so order is
+kept without ever moving messages between the two. A device that stays away
+for a long time costs its budget in RAM and the rest in page cache the
+kernel can write back and reclaim, and nothing at all past max_bytes.
+
+Spill segments are scratch space, they're deleted as they're read back and
+are not recovered after a restart (the write-ahead log is what makes
+deliveries durable).
+
+Spill record layout, big endian:
+    length u32, message id u64 (0 for none), qos u8, topic length u16,
+    topic, payload
+"""
+import mmap
+import os
+import struct
+from collections import deque
+
+from publish_frame import PublishFrame
+
+RECORD_HEADER = struct.Struct('>IQBH')
+SPILL_SUFFIX = '.spill'
+
+
+def entry_size(frame):
+    """ Bytes a queued message accounts for, in memory or on disk """
+    # the encoded topic carries a two byte length the record doesn't need
+    return RECORD_HEADER.size + len(frame._encoded_topic) - 2 + len(frame.payload)
+
+
+class SpillSegment:
+    """ One memory-mapped spill file, written and read front to back """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            # the mapping keeps the file alive on its own
+            os.close(fd)
+        self.write_offset = 0
+        self.read_offset = 0
+        self.count = 0
+
+    def append(self, frame, qos):
+        topic = frame.topic.encode('utf-8')
+        length = RECORD_HEADER.size + len(topic) + len(frame.payload)
+        if self.write_offset + length > self.size:
+            return False
+
+        offset = self.write_offset
+        RECORD_HEADER.pack_into(self.map, offset, length,
+                                frame.message_id or 0, qos, len(topic))
+        offset += RECORD_HEADER.size
+        self.map[offset:offset + len(topic)] = topic
+        offset += len(topic)
+        self.map[offset:offset + len(frame.payload)] = frame.payload
+        self.write_offset += length
+        self.count += 1
+        return True
+
+    def read(self):
+        offset = self.read_offset
+        length, message_id, qos, topic_length = RECORD_HEADER.unpack_from(
+            self.map, offset)
+        start = offset + RECORD_HEADER.size
+        topic = str(self.map[start:start + topic_length], 'utf-8')
+        frame = PublishFrame(topic, self.map[start + topic_length:offset + length])
+        frame.message_id = message_id or None
+        self.read_offset += length
+        self.count -= 1
+        return frame, qos
+
+    def close(self):
+        self.map.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class OfflineQueue:
+    """ FIFO of (PublishFrame, qos) for a disconnected persistent session
+
+    Args:
+        path_prefix: spill segments are written to path_prefix-<n>.spill,
+            the directory must exist
+        memory_budget: bytes of messages held in memory before spilling
+        max_bytes: bytes held in total, messages beyond it are dropped
+        segment_bytes: size of each spill file, a bigger message gets a
+            segment of its own
+    """
+
+    def __init__(self, path_prefix, memory_budget=64 * 1024,
+                 max_bytes=64 * 1024 * 1024, segment_bytes=1024 * 1024):
+        self.path_prefix = path_prefix
+        self.memory_budget = memory_budget
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+
+        self.memory = deque()
+        self.memory_bytes = 0
+        self.segments = deque()
+        self.spilled = 0
+        self.spilled_bytes = 0
+        self.dropped = 0
+        self._next_segment = 0
+
+    def __len__(self):
+        return len(self.memory) + self.spilled
+
+    def __bool__(self):
+        return bool(self.memory) or bool(self.spilled)
+
+    @property
+    def bytes(self):
+        return self.memory_bytes + self.spilled_bytes
+
+    def put(self, frame, qos):
+        """ Queues a message
+
+        Returns:
+            False if it was dropped because the queue is full
+        """
+        size = entry_size(frame)
+        if self.bytes + size > self.max_bytes:
+            self.dropped += 1
+            return False
+
+        # while anything is on disk newer messages have to follow it there
+        if not self.spilled and self.memory_bytes + size <= self.memory_budget:
+            # could be held a long time, don't keep the receive buffer too
+            frame.own()
+            self.memory.append((frame, qos))
+            self.memory_bytes += size
+            return True
+
+        self._spill(frame, qos)
+        self.spilled += 1
+        self.spilled_bytes += size
+        return True
+
+    def push_front(self, entries):
+        """ Puts (frame, qos) entries back at the head of the queue, used for
+        messages a connection had queued but not yet written when it closed
+        """
+        for frame, qos in reversed(entries):
+            frame.own()
+            self.memory.appendleft((frame, qos))
+            self.memory_bytes += entry_size(frame)
+
+    def get(self):
+        """ Removes and returns the oldest (frame, qos) """
+        if self.memory:
+            frame, qos = self.memory.popleft()
+            self.memory_bytes -= entry_size(frame)
+            return frame, qos
+
+        segment = self.segments[0]
+        frame, qos = segment.read()
+        self.spilled -= 1
+        self.spilled_bytes -= entry_size(frame)
+        if not segment.count:
+            # read to the end, anything later is in the next segment
+            segment.close()
+            self.segments.popleft()
+        return frame, qos
+
+    def drain(self):
+        """ Yields (frame, qos) one at a time until the queue is empty,
+        messages put while draining are yielded too
+        """
+        while self:
+            yield self.get()
+
+    def clear(self):
+        self.memory.clear()
+        self.memory_bytes = 0
+        for segment in self.segments:
+            segment.close()
+        self.segments.clear()
+        self.spilled = 0
+        self.spilled_bytes = 0
+
+    def _spill(self, frame, qos):
+        if frame.message_id is not None:
+            # the write-ahead log holds on to the frame until it's delivered
+            frame.own()
+        if self.segments and self.segments[-1].append(frame, qos):
+            return
+        size = max(self.segment_bytes, entry_size(frame))
+        path = f'{self.path_prefix}-{self._next_segment:06d}{SPILL_SUFFIX}'
+        self._next_segment += 1
+        segment = SpillSegment(path, size)
+        self.segments.append(segment)
+        segment.append(frame, qos)
+
+    def stats(self):
+        return {
+            'depth': len(self),
+            'bytes': self.bytes,
+            'memory_bytes': self.memory_bytes,
+            'spilled': self.spilled,
+            'spilled_bytes': self.spilled_bytes,
+            'segments': len(self.segments),
+            'dropped': self.dropped,
+        }
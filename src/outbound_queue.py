@@ -0,0 +1,152 @@
+"""
+Bounded per-connection queue of PUBLISH deliveries waiting to be written.
+
+Deliveries are queued here instead of being written straight to the socket,
+and only handed to the transport while it isn't applying backpressure. That
+way a subscriber that stops reading costs at most max_messages/max_bytes of
+broker memory, what happens beyond that is decided by the slow consumer
+policy.
+"""
+import time
+from collections import deque
+
+# slow consumer policies, what to do when a queue is over its limits
+DROP_OLDEST = 'drop_oldest'     # discard the oldest queued messages
+DROP_QOS0 = 'drop_qos0'         # discard QoS 0 messages, keep QoS 1/2
+DISCONNECT = 'disconnect'       # keep everything but close the connection
+                                # if it stays over the limit for too long
+POLICIES = (DROP_OLDEST, DROP_QOS0, DISCONNECT)
+
+
+class OutboundQueue:
+    """ FIFO of (frame, qos, retain, size) entries bounded by count and bytes
+
+    Args:
+        max_messages: number of entries allowed before the policy applies
+        max_bytes: encoded bytes allowed before the policy applies
+        policy: one of POLICIES
+        disconnect_after: seconds a queue may stay over its limits before
+            put() or overdue() report the consumer should be disconnected.
+            Applies to DISCONNECT and to DROP_QOS0 when only QoS 1/2
+            messages are left.
+        on_drop: called with each entry the policy drops
+    """
+
+    def __init__(self, max_messages=1000, max_bytes=1024 * 1024,
+                 policy=DROP_OLDEST, disconnect_after=10, on_drop=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown slow consumer policy: {policy}')
+
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.disconnect_after = disconnect_after
+        self.on_drop = on_drop
+
+        self.entries = deque()
+        self.bytes = 0
+        self.qos0_count = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.over_limit_since = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def depth(self):
+        return len(self.entries)
+
+    @property
+    def over_limit(self):
+        return len(self.entries) > self.max_messages or self.bytes > self.max_bytes
+
+    def put(self, frame, qos, retain, size):
+        """ Queues a delivery and applies the policy if that overflows us
+
+        Returns:
+            False if the consumer has been over its limit for longer than
+            disconnect_after and should be dropped, True otherwise
+        """
+        self.entries.append((frame, qos, retain, size))
+        self.bytes += size
+        if qos == 0:
+            self.qos0_count += 1
+
+        if not self.over_limit:
+            self.over_limit_since = None
+            return True
+
+        if self.policy == DROP_OLDEST:
+            while self.over_limit and len(self.entries) > 1:
+                self._drop(self.entries.popleft())
+            return True
+
+        if self.policy == DROP_QOS0:
+            self._drop_qos0()
+            if not self.over_limit:
+                self.over_limit_since = None
+                return True
+
+        # over the limit with nothing we're allowed to drop
+        now = time.monotonic()
+        if self.over_limit_since is None:
+            self.over_limit_since = now
+        return now - self.over_limit_since < self.disconnect_after
+
+    def overdue(self):
+        """ True once the queue has been over its limits for
+        disconnect_after seconds, for checking a consumer that has stopped
+        reading when nothing more is being put
+        """
+        return (self.over_limit_since is not None
+                and time.monotonic() - self.over_limit_since >= self.disconnect_after)
+
+    def get(self):
+        """ Removes and returns the oldest (frame, qos, retain, size) entry """
+        entry = self.entries.popleft()
+        self.bytes -= entry[3]
+        if entry[1] == 0:
+            self.qos0_count -= 1
+        if self.over_limit_since is not None and not self.over_limit:
+            self.over_limit_since = None
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+        self.qos0_count = 0
+        self.over_limit_since = None
+
+    def stats(self):
+        return {
+            'depth': len(self.entries),
+            'bytes': self.bytes,
+            'dropped': self.dropped,
+            'dropped_bytes': self.dropped_bytes,
+        }
+
+    def _drop(self, entry):
+        self.bytes -= entry[3]
+        if entry[1] == 0:
+            self.qos0_count -= 1
+        self.dropped += 1
+        self.dropped_bytes += entry[3]
+        if self.on_drop is not None:
+            self.on_drop(entry)
+
+    def _drop_qos0(self):
+        if not self.qos0_count:
+            return
+
+        # oldest QoS 0 entries go first, rebuilding is fine as this only
+        # happens once a consumer has already fallen behind
+        excess = len(self.entries) - self.max_messages
+        kept = deque()
+        for entry in self.entries:
+            if entry[1] == 0 and (excess > 0 or self.bytes > self.max_bytes):
+                self._drop(entry)
+                excess -= 1
+            else:
+                kept.append(entry)
+        self.entries = kept
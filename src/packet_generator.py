@@ -1,5 +1,5 @@
 import packets
-from mqtt_packet import MQTTPacket
+from mqtt_packet import MQTTPacket, PublishPacket, AckPacket
 from logging_setup import LoggerSetup
 logger = LoggerSetup.get_logger(__name__)
 
@@ -8,6 +8,30 @@ Handles creation of mqtt packets to be sent including
 """
 
 
+def encode_remaining_length(length):
+    """ Encodes the remaining length (normally the variable header and payload)
+    of an MQTT packet. The length is encoded into base 128 with the msb of
+    each byte being a continuation bit that there is more data to the length
+
+    Args:
+        length: number to be encoded
+
+    Returns:
+        byte array of encoded length
+    """
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        # if more data to encode then set the continuation bit
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            break
+    return encoded
+
+
 class PacketGenerator:
     def __init__(self, send_func):
         self.pid_generator = self.get_packet_id_bytes()
@@ -23,27 +47,7 @@ class PacketGenerator:
         return len(byte_string).to_bytes(2, 'big') + byte_string
 
     def _encode_remaining_length(self, length):
-        """ Encodes the remaining length (normally the variable header and payload)
-        of an MQTT packet. The length is encoded into base 128 with the msb of
-        each byte being a continuation bit that there is more data to the length
-
-        Args:
-            length: number to be encoded
-
-        Returns:
-            byte array of encoded length
-        """
-        encoded = bytearray()
-        while True:
-            byte = length % 128
-            length //= 128
-            # if more data to encode then set the continuation bit
-            if length > 0:
-                byte |= 0x80
-            encoded.append(byte)
-            if length == 0:
-                break
-        return encoded
+        return encode_remaining_length(length)
 
     def create_connect_packet(
         self,
@@ -148,7 +152,10 @@ class PacketGenerator:
         logger.debug(f'Variable header: {variable_header}')
 
         # NOTE could add config here to allow for numbers encoded as bytes?
-        encoded_payload = str(payload).encode('utf-8')
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            encoded_payload = bytes(payload)
+        else:
+            encoded_payload = str(payload).encode('utf-8')
         payload_length = len(encoded_payload)
 
         remaining_length = self._encode_remaining_length(
@@ -157,13 +164,11 @@ class PacketGenerator:
         raw_bytes = command_byte + remaining_length + \
             variable_header + encoded_payload
 
-        return MQTTPacket(command_byte, raw_bytes, data={
-            'topic': topic,
-            'payload': payload,
-            'qos': qos,
-            'retain': retain,
-            'packet_id': int.from_bytes(pid, 'big') if pid else None
-        }, send_func=self.send_func)
+        return PublishPacket(
+            command_byte, raw_bytes, 1 + len(remaining_length),
+            len(raw_bytes) - payload_length,
+            int.from_bytes(pid, 'big') if pid else None,
+            send_func=self.send_func, topic=topic, payload=payload)
 
     def create_puback_packet(self, pid, dup=False):
         command = packets.PUBACK_BYTE
@@ -173,7 +178,7 @@ class PacketGenerator:
         remaining_length = bytes([2])
         raw_bytes = command_byte + remaining_length + pid.to_bytes(2, 'big')
 
-        return MQTTPacket(command_byte, raw_bytes, data={'packet_id': pid}, send_func=self.send_func)
+        return AckPacket(command_byte, raw_bytes, pid, send_func=self.send_func)
 
     def create_pubrec_packet(self, pid, dup=False):
         command = packets.PUBREC_BYTE
@@ -183,7 +188,7 @@ class PacketGenerator:
         remaining_length = bytes([2])
         raw_bytes = command_byte + remaining_length + pid.to_bytes(2, 'big')
 
-        return MQTTPacket(command_byte, raw_bytes, data={'packet_id': pid}, send_func=self.send_func)
+        return AckPacket(command_byte, raw_bytes, pid, send_func=self.send_func)
 
     def create_pubrel_packet(self, pid, dup=False):
         command = packets.PUBREL_BYTE
@@ -194,7 +199,7 @@ class PacketGenerator:
         remaining_length = bytes([2])
         raw_bytes = command_byte + remaining_length + pid.to_bytes(2, 'big')
 
-        return MQTTPacket(command_byte, raw_bytes, data={'packet_id': pid}, send_func=self.send_func)
+        return AckPacket(command_byte, raw_bytes, pid, send_func=self.send_func)
 
     def create_pubcomp_packet(self, pid):
         # no DUP bit for PUBCOMP
@@ -202,7 +207,7 @@ class PacketGenerator:
         remaining_length = bytes([2])
         raw_bytes = command_byte + remaining_length + pid.to_bytes(2, 'big')
 
-        return MQTTPacket(command_byte, raw_bytes, data={'packet_id': pid}, send_func=self.send_func)
+        return AckPacket(command_byte, raw_bytes, pid, send_func=self.send_func)
 
     def create_subscribe_packet(self, topic, qos=0):
         logger.info(f'Subscribing to {topic} at QoS: {qos}')
@@ -1,8 +1,9 @@
 # handlers for each of the expected MQTT packets:
+import logging
 import packets
 from pprint import pformat
 
-from mqtt_packet import MQTTPacket
+from mqtt_packet import MQTTPacket, PublishPacket, AckPacket
 from logging_setup import LoggerSetup
 logger = LoggerSetup.get_logger(__name__)
 
@@ -83,13 +84,14 @@ class PacketValidator:
         self.consumed_bytes = None
 
     def validate_packet(self, packet):
-        datapr = ', '.join(f"{byte:02x}" for byte in packet)
-        logger.debug(f'recv {datapr}')
-
         self.packet = packet
         if not self.packet:
             raise PacketValidatorError("No packet to handle")
 
+        if logger.isEnabledFor(logging.DEBUG):
+            datapr = ', '.join(f"{byte:02x}" for byte in packet)
+            logger.debug(f'recv {datapr}')
+
         # masks out flags
         command = self.packet[0] & 0xf0
 
@@ -184,7 +186,7 @@ class PacketValidator:
         if index + topic_length > len(self.packet):
             raise PacketValidatorError("Incomplete topic in PUBLISH packet")
 
-        topic = self.packet[index:index + topic_length].decode('utf-8')
+        topic_start = index - 2
         index += topic_length
 
         # Packet Identifier (if QoS > 0)
@@ -197,28 +199,14 @@ class PacketValidator:
             packet_id = int.from_bytes(self.packet[index:index + 2], 'big')
             index += 2
 
-        # Remaining is payload
-        payload_bytes = self.packet[index:]
-        try:
-            payload = payload_bytes.decode('utf-8')
-        except UnicodeDecodeError:
-            payload = payload_bytes  # fallback to raw bytes if not UTF-8
-
+        # remaining is payload, topic and payload are only decoded when
+        # they're first read
         logger.debug(
-            f"PUBLISH packet: topic={topic}, qos={qos_level}, dup={dup_flag}, retain={retain}, packet_id={packet_id}")
+            "PUBLISH packet: qos=%s, dup=%s, retain=%s, packet_id=%s",
+            qos_level, dup_flag, retain, packet_id)
 
-        return MQTTPacket(
-            fixed_header,
-            self.packet,
-            data={
-                'topic': topic,
-                'payload': payload,
-                'qos': qos_level,
-                'dup': dup_flag,
-                'retain': retain,
-                'packet_id': packet_id,
-            }, send_func=self.send_func
-        )
+        return PublishPacket(fixed_header, self.packet, topic_start, index,
+                             packet_id, send_func=self.send_func)
 
     def handle_puback(self):
         if len(self.packet) != 4:
@@ -235,9 +223,9 @@ class PacketValidator:
         packet_id = (self.packet[2] << 8) | self.packet[3]
         packet_id = int.from_bytes(self.packet[2:], 'big')
 
-        logger.debug(f"Received PUBACK for Packet ID: {packet_id}")
+        logger.debug("Received PUBACK for Packet ID: %s", packet_id)
 
-        return MQTTPacket(fixed_header, self.packet, data={'packet_id': packet_id}, send_func=self.send_func)
+        return AckPacket(fixed_header, self.packet, packet_id, send_func=self.send_func)
 
     def handle_pubrec(self):
         if len(self.packet) != 4:
@@ -253,9 +241,9 @@ class PacketValidator:
 
         packet_id = int.from_bytes(self.packet[2:], 'big')
 
-        logger.debug(f"Received PUBREC for Packet ID: {packet_id}")
+        logger.debug("Received PUBREC for Packet ID: %s", packet_id)
 
-        return MQTTPacket(fixed_header, self.packet, data={'packet_id': packet_id}, send_func=self.send_func)
+        return AckPacket(fixed_header, self.packet, packet_id, send_func=self.send_func)
 
     def handle_pubrel(self):
         if len(self.packet) != 4:
@@ -271,9 +259,9 @@ class PacketValidator:
 
         packet_id = int.from_bytes(self.packet[2:], 'big')
 
-        logger.debug(f"Received PUBREL for Packet ID: {packet_id}")
+        logger.debug("Received PUBREL for Packet ID: %s", packet_id)
 
-        return MQTTPacket(fixed_header, self.packet, data={'packet_id': packet_id}, send_func=self.send_func)
+        return AckPacket(fixed_header, self.packet, packet_id, send_func=self.send_func)
 
     def handle_pubcomp(self):
         if len(self.packet) != 4:
@@ -289,9 +277,9 @@ class PacketValidator:
 
         packet_id = int.from_bytes(self.packet[2:], 'big')
 
-        logger.debug(f"Received PUBCOMP for Packet ID: {packet_id}")
+        logger.debug("Received PUBCOMP for Packet ID: %s", packet_id)
 
-        return MQTTPacket(fixed_header, self.packet, data={'packet_id': packet_id}, send_func=self.send_func)
+        return AckPacket(fixed_header, self.packet, packet_id, send_func=self.send_func)
 
     def handle_suback(self):
         if len(self.packet) < 5:
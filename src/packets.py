@@ -23,3 +23,11 @@ RETAIN_BIT = 0b00000001
 QOS_1_BITS = 0b00000010
 QOS_2_BITS = 0b00000100
 DUP_BIT = 0b00001000
+
+# packet type (the fixed header's top four bits) -> name
+PACKET_NAMES = {
+    1: 'connect', 2: 'connack', 3: 'publish', 4: 'puback', 5: 'pubrec',
+    6: 'pubrel', 7: 'pubcomp', 8: 'subscribe', 9: 'suback',
+    10: 'unsubscribe', 11: 'unsuback', 12: 'pingreq', 13: 'pingresp',
+    14: 'disconnect',
+}
@@ -0,0 +1,379 @@
+"""
+Broker to broker links, used to route between worker processes and between
+cluster nodes.
+
+Worker links are unix socket pairs created before forking. Cluster links are
+TCP: every node listens on its cluster port and dials every peer it's
+configured with, redialling when a link drops. Nodes must form a full mesh as
+nothing is relayed through an intermediate node.
+
+Links speak MQTT framing so the same FrameDecoder and PublishFrame code is
+used on both ends:
+    CONNECT      first frame each way, the client id is the sender's node id.
+                 Any later one is a client that connected to the sender,
+                 its connection here, if it has one, is taken over.
+    SUBSCRIBE    the sender now has local subscribers for these filters,
+                 '$share/<group>/<filter>' for members of a shared group
+    UNSUBSCRIBE  the sender has no local subscribers left for these filters
+    SUBACK       the next PUBLISH also goes to one member of each of these
+                 '$share/<group>/<filter>' groups, the sender picked us
+    PUBLISH      a message for the receiver's local subscribers
+
+Only interest is exchanged, never individual subscriptions, so a publish is
+forwarded to a peer only if at least one of its clients wants it, and a
+shared group's messages only to the peer picked to deliver them. Retained
+publishes are the exception, they go to every peer so each one's
+RetainedStore has them for clients that subscribe later. Messages received
+from a peer are delivered locally and never forwarded again (split
+horizon), which keeps a full mesh free of loops.
+"""
+import asyncio
+
+import packets
+from frame_decoder import FrameDecoder, FrameDecoderError
+from packet_generator import PacketGenerator, encode_remaining_length
+from packet_validator import PacketValidatorError
+from publish_frame import PublishFrame
+from shared_subscriptions import SHARE_PREFIX, is_shared, parse_shared
+from topic_trie import TopicTrie, TopicFilterError
+from write_batch import BatchedWriter
+from logging_setup import LoggerSetup
+logger = LoggerSetup.get_logger(__name__)
+
+# filters per SUBSCRIBE frame when sending a full interest summary
+FILTERS_PER_FRAME = 256
+
+
+def encode_filters(command_byte, filters, with_qos):
+    """ Builds a SUBSCRIBE/UNSUBSCRIBE style frame for a list of filters """
+    body = bytearray(b'\x00\x01')  # packet ids aren't used on links
+    for topic_filter in filters:
+        encoded = topic_filter.encode('utf-8')
+        body += len(encoded).to_bytes(2, 'big') + encoded
+        if with_qos:
+            body.append(2)
+    return bytes([command_byte]) + encode_remaining_length(len(body)) + body
+
+
+def decode_client_id(frame):
+    # protocol name, level, flags and keep alive come before the id
+    index = 1
+    while frame[index] & 0x80:
+        index += 1
+    index += 11
+    length = int.from_bytes(frame[index:index + 2], 'big')
+    return str(frame[index + 2:index + 2 + length], 'utf-8')
+
+
+def decode_filters(frame, with_qos):
+    index = 1
+    while frame[index] & 0x80:
+        index += 1
+    index += 3  # end of the remaining length plus the packet id
+
+    filters = []
+    while index < len(frame):
+        length = int.from_bytes(frame[index:index + 2], 'big')
+        index += 2
+        filters.append(str(frame[index:index + length], 'utf-8'))
+        index += length
+        if with_qos:
+            index += 1
+    return filters
+
+
+class PeerLink(BatchedWriter, asyncio.BufferedProtocol):
+    """ One end of a link to another broker """
+
+    def __init__(self, router, outbound=False):
+        self.router = router
+        # True if we dialled the peer, used to settle duplicate links
+        self.outbound = outbound
+        self.peer_id = None
+        self.transport = None
+        self.decoder = FrameDecoder()
+        # filters this peer has told us it's interested in
+        self.interest = set()
+        # shared groups named by a SUBACK, for the PUBLISH that follows it
+        self.groups = ()
+
+        # everything forwarded to this peer in one loop iteration goes out
+        # in one write, as for clients
+        loop = asyncio.get_running_loop()
+        self.init_write_batch(loop, router.batch_bytes, router.batch_delay)
+        self.closed = loop.create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        connect = PacketGenerator(None).create_connect_packet(
+            client_id=self.router.node_id, keep_alive=0)
+        self.send(connect.raw_bytes)
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        try:
+            for frame in self.decoder.frames():
+                if self.transport is None:
+                    return
+                self.handle_frame(frame)
+        except (FrameDecoderError, PacketValidatorError, TopicFilterError,
+                IndexError, UnicodeDecodeError) as e:
+            logger.error(f'Bad frame on link to {self.peer_id}: {e}')
+            self.close()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.cancel_flush()
+        self.router.link_lost(self)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def handle_frame(self, frame):
+        command = frame[0] & 0xF0
+
+        if self.peer_id is None:
+            if command != packets.CONNECT_BYTE:
+                self.close()
+                return
+            self.peer_id = decode_client_id(frame)
+            self.router.link_made(self)
+            return
+
+        if command == packets.PUBLISH_BYTE:
+            groups = self.groups
+            self.groups = ()
+            self.router.receive_publish(self, frame, groups)
+        elif command == packets.SUBACK_BYTE:
+            self.groups = [parse_shared(shared)
+                           for shared in decode_filters(frame, False)]
+        elif command == packets.SUBSCRIBE_BYTE & 0xF0:
+            self.router.add_remote_interest(self, decode_filters(frame, True))
+        elif command == packets.UNSUBSCRIBE_BYTE & 0xF0:
+            self.router.remove_remote_interest(
+                self, decode_filters(frame, False))
+        elif command == packets.CONNECT_BYTE:
+            self.router.server.client_claimed(decode_client_id(frame), self.peer_id)
+        else:
+            logger.warning(
+                f'Unexpected packet {hex(command)} on link to {self.peer_id}')
+
+    def send_interest(self, filters, interested):
+        filters = list(filters)
+        for i in range(0, len(filters), FILTERS_PER_FRAME):
+            chunk = filters[i:i + FILTERS_PER_FRAME]
+            if interested:
+                self.send(encode_filters(packets.SUBSCRIBE_BYTE, chunk, True))
+            else:
+                self.send(encode_filters(
+                    packets.UNSUBSCRIBE_BYTE, chunk, False))
+
+    def send(self, data):
+        self.send_buffers((data,))
+
+    def close(self):
+        if self.transport is not None:
+            self.flush()
+            self.transport.close()
+
+
+class PeerRouter:
+    """ Tracks which peers want which topics and forwards publishes to them
+
+    Args:
+        server: the local MQTTServer, forwarded messages are handed to its
+            publish() with forward=False
+        node_id: unique name of this broker amongst its peers
+        batch_bytes, batch_delay: write batching for links, as for clients
+    """
+
+    def __init__(self, server, node_id, batch_bytes=64 * 1024, batch_delay=0):
+        self.server = server
+        self.node_id = node_id
+        self.batch_bytes = batch_bytes
+        self.batch_delay = batch_delay
+
+        self.links = {}
+        self.listener = None
+        self._dial_tasks = []
+        # filter -> number of local subscriptions using it
+        self.local_interest = {}
+        # filters peers are interested in, the 'client id' is the peer id
+        self.remote_interest = TopicTrie()
+
+        self.forwarded = 0
+        self.received = 0
+
+    # local interest
+
+    def local_subscribed(self, topic_filter):
+        count = self.local_interest.get(topic_filter, 0)
+        self.local_interest[topic_filter] = count + 1
+        if count == 0:
+            for link in self.links.values():
+                link.send_interest((topic_filter,), True)
+
+    def local_unsubscribed(self, topic_filter):
+        count = self.local_interest.get(topic_filter, 0) - 1
+        if count > 0:
+            self.local_interest[topic_filter] = count
+            return
+
+        self.local_interest.pop(topic_filter, None)
+        for link in self.links.values():
+            link.send_interest((topic_filter,), False)
+
+    # clients
+
+    def claim(self, client_id):
+        """ Tells every peer a client has connected here, so a connection
+        it still has on one of them is taken over
+        """
+        if not self.links:
+            return
+        claim = PacketGenerator(None).create_connect_packet(
+            client_id=client_id, keep_alive=0).raw_bytes
+        for link in self.links.values():
+            link.send(claim)
+
+    # links
+
+    async def listen(self, host, port):
+        """ Accepts links from other nodes
+
+        Returns:
+            the port actually bound, useful when port is 0
+        """
+        loop = asyncio.get_running_loop()
+        self.listener = await loop.create_server(
+            lambda: PeerLink(self), host, port, reuse_address=True)
+        return self.listener.sockets[0].getsockname()[1]
+
+    def dial(self, host, port, retry_interval=1):
+        """ Keeps a link open to the node at host:port until close() """
+        task = asyncio.get_running_loop().create_task(
+            self._dial(host, port, retry_interval))
+        self._dial_tasks.append(task)
+
+    async def _dial(self, host, port, retry_interval):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                _, link = await loop.create_connection(
+                    lambda: PeerLink(self, outbound=True), host, port)
+                await link.closed
+            except OSError as e:
+                logger.debug(f'Could not reach node at {host}:{port}: {e}')
+            await asyncio.sleep(retry_interval)
+
+    def link_made(self, link):
+        if link.peer_id == self.node_id:
+            logger.warning('Closing link to ourselves')
+            link.close()
+            return
+
+        existing = self.links.get(link.peer_id)
+        if existing is not None:
+            # both ends dialled each other, keep the link the node with the
+            # lower id dialled so both sides make the same choice
+            keep_new = link.outbound == (self.node_id < link.peer_id)
+            if not keep_new:
+                logger.debug(f'Closing duplicate link to {link.peer_id}')
+                link.peer_id = None
+                link.close()
+                return
+            self._forget(existing)
+            existing.peer_id = None
+            existing.close()
+
+        logger.info(f'{self.node_id} linked to {link.peer_id}')
+        self.links[link.peer_id] = link
+        # tell the new peer everything we're currently interested in
+        link.send_interest(self.local_interest, True)
+
+    def link_lost(self, link):
+        if link.peer_id is None or self.links.get(link.peer_id) is not link:
+            return
+        logger.info(f'{self.node_id} lost link to {link.peer_id}')
+        del self.links[link.peer_id]
+        self._forget(link)
+
+    def _forget(self, link):
+        self.remove_remote_interest(link, list(link.interest))
+
+    def add_remote_interest(self, link, filters):
+        for topic_filter in filters:
+            # raises TopicFilterError for a bad filter before it's recorded
+            shared = parse_shared(topic_filter)
+            if shared is not None:
+                self.server.shared.add_peer(*shared, link.peer_id)
+            else:
+                self.remote_interest.subscribe(topic_filter, link.peer_id)
+            link.interest.add(topic_filter)
+
+    def remove_remote_interest(self, link, filters):
+        for topic_filter in filters:
+            if topic_filter not in link.interest:
+                continue
+            link.interest.discard(topic_filter)
+            if is_shared(topic_filter):
+                self.server.shared.remove_peer(*parse_shared(topic_filter), link.peer_id)
+            else:
+                self.remote_interest.unsubscribe(topic_filter, link.peer_id)
+
+    # messages
+
+    def forward(self, frame, qos=0, retain=False, groups=None):
+        """ Sends a locally published PublishFrame to every interested peer,
+        or to every peer if it's retained
+
+        Args:
+            groups: peer id -> (group, filter) keys of the shared groups the
+                peer was picked to deliver to, see SharedSubscriptions.route()
+        """
+        if not self.links:
+            return
+
+        if retain:
+            peers = self.links
+        else:
+            peers = self.remote_interest.match(frame.topic)
+        if groups:
+            peers = set(peers).union(groups)
+        if not peers:
+            return
+
+        # packet ids aren't used on links but qos > 0 frames must carry one
+        buffers = frame.buffers(qos, retain, 0 if qos else None)
+        for peer_id in peers:
+            link = self.links.get(peer_id)
+            if link is None:
+                continue
+            picked = groups.get(peer_id) if groups else None
+            if picked:
+                filters = [f'{SHARE_PREFIX}/{group}/{topic_filter}'
+                           for group, topic_filter in picked]
+                link.send_buffers(
+                    (encode_filters(packets.SUBACK_BYTE, filters, False),) + buffers)
+            else:
+                link.send_buffers(buffers)
+            self.forwarded += 1
+
+    def receive_publish(self, link, frame, groups=()):
+        self.received += 1
+        publish, qos, retain, _ = PublishFrame.from_packet(frame)
+        # split horizon, a forwarded message is only delivered locally, and
+        # only to the shared groups we were picked for
+        self.server.route(publish, qos, retain, forward=False, groups=groups)
+
+    def close(self):
+        for task in self._dial_tasks:
+            task.cancel()
+        self._dial_tasks = []
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        for link in list(self.links.values()):
+            link.close()
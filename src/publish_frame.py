@@ -0,0 +1,177 @@
+"""
+Encode-once PUBLISH frames for fanning a message out to many subscribers.
+
+A publish to a busy topic would otherwise re-encode the same topic and
+payload for every recipient. Here each (qos, retain) variant is encoded the
+first time it's needed and the resulting bytes are shared by every delivery.
+QoS 0 deliveries send the shared frame as is, QoS 1 and 2 deliveries send it
+as three buffers with only the two packet id bytes unique to the recipient.
+
+A PUBLISH received from a client is wrapped by from_packet() without being
+copied or decoded, beyond its topic which routing needs. The topic and
+payload stay memoryviews of the receive buffer, which the frame decoder
+never overwrites while they're referenced. A delivery with the flags it was
+received with sends the received bytes themselves, any other variant only
+gets a fixed header of its own in front of the received topic and payload.
+"""
+import packets
+from packet_generator import encode_remaining_length
+from packet_validator import PacketValidatorError
+
+
+class PublishFrame:
+    __slots__ = ('topic', 'payload', 'message_id', 'received',
+                 '_encoded_topic', '_variants', '_packet', '_command')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            self.payload = bytes(payload)
+        else:
+            self.payload = str(payload).encode('utf-8')
+        # set when the message is written to the write-ahead log
+        self.message_id = None
+        # perf_counter_ns() when the PUBLISH was read, for latency tracking
+        self.received = None
+
+        encoded_topic = topic.encode('utf-8')
+        self._encoded_topic = len(encoded_topic).to_bytes(2, 'big') + encoded_topic
+        # (qos, retain, dup) -> bytes, filled in lazily as subscribers need them
+        self._variants = {}
+        # the received PUBLISH and its first byte, for frames from
+        # from_packet()
+        self._packet = None
+        self._command = None
+
+    @classmethod
+    def from_packet(cls, packet):
+        """ Wraps a received PUBLISH, a whole frame as the frame decoder
+        returns it, without copying it
+
+        Returns:
+            (PublishFrame, qos, retain, packet id or None)
+
+        Raises:
+            PacketValidatorError: if the packet is malformed or its topic
+                isn't a valid topic name
+        """
+        command = packet[0]
+        qos = (command & 0x06) >> 1
+        if qos == 3:
+            raise PacketValidatorError(f"Invalid qos level: {qos}")
+
+        index = 1
+        while packet[index] & 0x80:
+            index += 1
+        index += 1
+        topic_start = index
+        index += 2 + int.from_bytes(packet[index:index + 2], 'big')
+        if index > len(packet):
+            raise PacketValidatorError("Incomplete topic in PUBLISH packet")
+        packet_id = None
+        if qos:
+            if index + 2 > len(packet):
+                raise PacketValidatorError(
+                    "Expected Packet Identifier missing for QoS > 0")
+            packet_id = int.from_bytes(packet[index:index + 2], 'big')
+            index += 2
+
+        topic = str(packet[topic_start + 2:index - 2 if qos else index], 'utf-8')
+        # a topic name can't be empty or have wildcards [MQTT-3.3.2-2] [MQTT-4.7.3-1]
+        if not topic:
+            raise PacketValidatorError("Empty topic in PUBLISH packet")
+        if '+' in topic or '#' in topic:
+            raise PacketValidatorError(f"Wildcard in PUBLISH topic: {topic}")
+
+        frame = cls.__new__(cls)
+        frame.topic = topic
+        frame.payload = packet[index:]
+        frame.message_id = None
+        frame.received = None
+        frame._encoded_topic = packet[topic_start:index - 2 if qos else index]
+        frame._variants = {}
+        frame._packet = packet
+        frame._command = command
+        return frame, qos, bool(command & packets.RETAIN_BIT), packet_id
+
+    def own(self):
+        """ Copies a received frame's topic and payload out of the receive
+        buffer, for frames that are kept long after they're delivered and
+        would otherwise hold on to all of it
+        """
+        if self._packet is None:
+            return
+        self.payload = bytes(self.payload)
+        self._encoded_topic = bytes(self._encoded_topic)
+        self._packet = None
+        self._command = None
+        self._variants = {}
+
+    def _header(self, qos, retain, dup=False):
+        """ Shared buffers of a variant, the fixed header and topic. For qos 0
+        this is the whole frame, otherwise the packet id and payload follow.
+        """
+        key = (qos, retain, dup)
+        header = self._variants.get(key)
+        if header is not None:
+            return header
+
+        command_byte = packets.PUBLISH_BYTE | (qos << 1)
+        if retain:
+            command_byte |= packets.RETAIN_BIT
+        if dup:
+            command_byte |= packets.DUP_BIT
+
+        if command_byte == self._command:
+            # delivered just as it was received
+            if qos == 0:
+                header = (self._packet,)
+            else:
+                header = (self._packet[:len(self._packet) - len(self.payload) - 2],)
+            self._variants[key] = header
+            return header
+
+        remaining_length = len(self._encoded_topic) + len(self.payload)
+        if qos > 0:
+            remaining_length += 2
+        fixed_header = bytes([command_byte]) + encode_remaining_length(remaining_length)
+
+        if self._packet is not None:
+            # a new fixed header in front of the received topic and payload
+            header = (fixed_header, self._encoded_topic)
+            if qos == 0:
+                header += (self.payload,)
+        elif qos == 0:
+            header = (fixed_header + self._encoded_topic + self.payload,)
+        else:
+            header = (fixed_header + self._encoded_topic,)
+
+        self._variants[key] = header
+        return header
+
+    def size(self, qos=0, retain=False):
+        """ Number of bytes a delivery at this qos puts on the wire """
+        size = 0
+        for buffer in self._header(qos, retain):
+            size += len(buffer)
+        if qos > 0:
+            size += 2 + len(self.payload)
+        return size
+
+    def buffers(self, qos=0, retain=False, packet_id=None, dup=False):
+        """ Buffers that make up the frame for one delivery
+
+        Args:
+            qos: qos the message is delivered at
+            retain: whether the retain flag is set for this delivery
+            packet_id: recipient's packet id, required for qos > 0
+            dup: set the DUP flag, for a qos > 0 delivery being resent
+
+        Returns:
+            tuple of buffers to write in order, all but the packet id are
+            shared
+        """
+        header = self._header(qos, retain, dup)
+        if qos == 0:
+            return header
+        return header + (packet_id.to_bytes(2, 'big'), self.payload)
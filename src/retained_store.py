@@ -0,0 +1,200 @@
+"""
+Store of retained messages, the last retained PUBLISH for each topic.
+
+Topics are kept in a trie split on '/' so a new subscription only walks the
+branches its filter can match: 'sensors/+/temp' visits each child of
+'sensors' once and goes straight to its 'temp' child, it never looks at the
+rest of the store. Matches are yielded one at a time so a subscriber can be
+fed from the generator as fast as it reads instead of from a list of every
+match built up front.
+"""
+import sys
+
+from publish_frame import PublishFrame
+from topic_trie import SEPARATOR, SINGLE_LEVEL_WILDCARD, MULTI_LEVEL_WILDCARD
+
+
+class RetainedMessage:
+    __slots__ = ('frame', 'qos', 'size')
+
+    def __init__(self, frame, qos):
+        # kept as a PublishFrame so the encoding is shared by every
+        # subscriber it's delivered to
+        self.frame = frame
+        self.qos = qos
+        self.size = 0
+
+    @property
+    def topic(self):
+        return self.frame.topic
+
+    @property
+    def payload(self):
+        return self.frame.payload
+
+
+class RetainedNode:
+    __slots__ = ('children', 'message')
+
+    def __init__(self):
+        self.children = None
+        self.message = None
+
+
+# what each stored topic costs beyond the message itself, a trie node and
+# its slot in the parent's children dict (roughly, dicts grow in steps)
+NODE_OVERHEAD = sys.getsizeof(RetainedNode()) + 3 * 8
+
+
+def message_size(message, levels):
+    """ Approximate bytes of memory used to hold a retained message
+
+    Args:
+        message: the RetainedMessage
+        levels: number of trie nodes only this message is using
+    """
+    frame = message.frame
+    return (sys.getsizeof(message) + sys.getsizeof(frame) +
+            sys.getsizeof(frame.topic) + sys.getsizeof(frame.payload) +
+            sys.getsizeof(frame._encoded_topic) + levels * NODE_OVERHEAD)
+
+
+class RetainedStore:
+    def __init__(self):
+        self.root = RetainedNode()
+        self.count = 0
+        # approximate memory used by stored messages, see message_size()
+        self.bytes = 0
+
+    def __len__(self):
+        return self.count
+
+    def set(self, topic, payload, qos=0, frame=None):
+        """ Retains a message, an empty payload removes the topic's message
+        [MQTT-3.3.1-10]
+
+        Args:
+            frame: an existing PublishFrame for the message to share
+        """
+        if frame is None:
+            frame = PublishFrame(topic, payload)
+        if not frame.payload:
+            self.remove(topic)
+            return
+        # kept for as long as the topic's retained, not the receive buffer
+        frame.own()
+
+        node = self.root
+        new_levels = 0
+        for level in topic.split(SEPARATOR):
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = RetainedNode()
+                new_levels += 1
+            node = child
+
+        message = RetainedMessage(frame, qos)
+        message.size = message_size(message, new_levels)
+        if node.message is None:
+            self.count += 1
+        else:
+            old = node.message
+            self.bytes -= old.size
+            # the old message's share of the trie nodes carries over
+            message.size += old.size - message_size(old, 0)
+        self.bytes += message.size
+        node.message = message
+
+    def get(self, topic):
+        node = self.root
+        for level in topic.split(SEPARATOR):
+            if not node.children:
+                return None
+            node = node.children.get(level)
+            if node is None:
+                return None
+        return node.message
+
+    def remove(self, topic):
+        path = []
+        node = self.root
+        for level in topic.split(SEPARATOR):
+            if not node.children or level not in node.children:
+                return False
+            path.append((node, level))
+            node = node.children[level]
+
+        if node.message is None:
+            return False
+
+        self.bytes -= node.message.size
+        self.count -= 1
+        node.message = None
+
+        for parent, level in reversed(path):
+            child = parent.children[level]
+            if child.children or child.message is not None:
+                break
+            del parent.children[level]
+        return True
+
+    def match(self, topic_filter):
+        """ Yields every retained message whose topic matches the filter
+
+        Only the child list of the level being walked by a wildcard is
+        snapshotted, so the store can change while a generator is running.
+        """
+        levels = topic_filter.split(SEPARATOR)
+        return self._match(self.root, levels, 0)
+
+    def _match(self, node, levels, depth):
+        if depth == len(levels):
+            if node.message is not None:
+                yield node.message
+            return
+
+        level = levels[depth]
+        children = node.children
+        if level == MULTI_LEVEL_WILDCARD:
+            # 'a/#' matches 'a' itself as well as everything below it
+            if depth > 0 and node.message is not None:
+                yield node.message
+            if children:
+                for child in self._wildcard_children(children, depth):
+                    yield from self._walk(child)
+            return
+
+        if not children:
+            return
+
+        if level == SINGLE_LEVEL_WILDCARD:
+            for child in self._wildcard_children(children, depth):
+                yield from self._match(child, levels, depth + 1)
+            return
+
+        child = children.get(level)
+        if child is not None:
+            yield from self._match(child, levels, depth + 1)
+
+    def _wildcard_children(self, children, depth):
+        if depth > 0:
+            return list(children.values())
+        # '$' topics aren't matched by a leading wildcard [MQTT-4.7.2-1]
+        return [child for key, child in children.items()
+                if not key.startswith('$')]
+
+    def _walk(self, node):
+        if node.message is not None:
+            yield node.message
+        if node.children:
+            for child in list(node.children.values()):
+                yield from self._walk(child)
+
+    def stats(self):
+        return {
+            'messages': self.count,
+            'bytes': self.bytes,
+            'bytes_per_message': self.bytes / self.count if self.count else 0,
+        }
@@ -0,0 +1,41 @@
+"""
+Session state for clients that connect with clean_session=False.
+
+A persistent session outlives its connections [MQTT-3.1.2-4]: its
+subscriptions stay in the topic index, QoS 1/2 deliveries still awaiting an
+ack are resent on reconnect, and messages published while the client is
+away are held in an OfflineQueue. A connection attaches to its session by
+taking references to the session's dicts, so nothing is copied on connect,
+disconnect or takeover.
+"""
+
+
+class Session:
+    def __init__(self, client_id, offline):
+        self.client_id = client_id
+        # the MQTTConnection currently attached, None while disconnected
+        self.connection = None
+        # topic filter -> granted qos
+        self.subscriptions = {}
+        # packet id -> (PublishFrame, qos) of deliveries awaiting an ack
+        self.inflight = {}
+        # packet ids of qos 2 deliveries that have had their PUBREC
+        self.released = set()
+        # packet ids of qos 2 publishes from the client not yet released
+        # by its PUBREL
+        self.unreleased = set()
+        self.last_packet_id = 0
+        # OfflineQueue of messages waiting to be sent
+        self.offline = offline
+
+    @property
+    def connected(self):
+        return self.connection is not None
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'subscriptions': len(self.subscriptions),
+            'inflight': len(self.inflight),
+            'offline': self.offline.stats(),
+        }
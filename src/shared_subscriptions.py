@@ -0,0 +1,308 @@
+"""
+Shared subscriptions, '$share/<group>/<filter>'.
+
+Every client subscribed with the same group name and filter is a member of
+one group, and each matching message goes to just one member instead of all
+of them, so consumers can be added to split the load. Groups live in their
+own TopicTrie keyed by (group, filter), a publish walks it once and picks a
+member of every group that matched.
+
+How the member is picked is the server's shared subscription strategy:
+    round_robin     each member in turn
+    least_inflight  the member with the fewest QoS 1/2 deliveries awaiting
+                    an ack plus messages queued, for consumers that go at
+                    different speeds
+    sticky          by hash of the topic, so a topic keeps going to the
+                    same member while the group doesn't change
+
+Only connected members are picked while there are any, otherwise messages
+go round the members with a persistent session to wait in its offline
+queue.
+
+With workers or a cluster a group spans every node. Peers advertise the
+groups they have members in (see peer_link.py), and only the node a message
+is published on picks who gets it: one of its own members, or a peer that
+then delivers to one of its members and nobody else. Each peer counts as a
+single member, taken in turn or by the topic's hash for sticky. Messages
+forwarded from a peer are only delivered to the groups the peer named.
+"""
+import zlib
+
+from topic_trie import TopicTrie, TopicFilterError, SEPARATOR, validate_topic_filter
+
+SHARE_PREFIX = '$share'
+
+ROUND_ROBIN = 'round_robin'
+LEAST_INFLIGHT = 'least_inflight'
+STICKY = 'sticky'
+STRATEGIES = (ROUND_ROBIN, LEAST_INFLIGHT, STICKY)
+
+
+def is_shared(topic_filter):
+    return topic_filter.startswith(SHARE_PREFIX + SEPARATOR)
+
+
+def parse_shared(topic_filter):
+    """ Splits a shared subscription into its group name and filter
+
+    Returns:
+        (group, filter), or None if it isn't a shared subscription
+
+    Raises:
+        TopicFilterError: if the group name or filter are invalid
+    """
+    if not is_shared(topic_filter):
+        return None
+
+    parts = topic_filter.split(SEPARATOR, 2)
+    if len(parts) < 3 or not parts[1]:
+        raise TopicFilterError(
+            f"Shared subscription needs a group and a filter: {topic_filter}")
+    group, shared_filter = parts[1], parts[2]
+    if '+' in group or '#' in group:
+        raise TopicFilterError(
+            f"Shared subscription group can't contain wildcards: {topic_filter}")
+    validate_topic_filter(shared_filter)
+    return group, shared_filter
+
+
+class SharedGroup:
+    def __init__(self, name, topic_filter):
+        self.name = name
+        self.filter = topic_filter
+        # client id -> granted qos, in the order they joined
+        self.members = {}
+        self.order = []
+        # (client id, encoded client id) for the sticky hash
+        self.encoded = []
+        # round robin position in order
+        self.next = 0
+        # ids of the peers with members of their own, and the round robin
+        # position over this node and them
+        self.peers = []
+        self.next_slot = 0
+
+    def add(self, client_id, qos):
+        if client_id not in self.members:
+            self.order.append(client_id)
+            self.encoded.append((client_id, client_id.encode('utf-8')))
+        self.members[client_id] = qos
+
+    def remove(self, client_id):
+        if self.members.pop(client_id, None) is None:
+            return False
+        index = self.order.index(client_id)
+        del self.order[index]
+        del self.encoded[index]
+        return True
+
+    def choose_peer(self, topic, clients, links, strategy):
+        """ Picks whether a peer delivers a message rather than this node,
+        each linked peer with members counting as one more member
+
+        Returns:
+            the peer id, or None if a member here is to be picked
+        """
+        peers = [peer_id for peer_id in self.peers if peer_id in links]
+        if not peers:
+            return None
+        local = sum(1 for client_id in self.order if client_id in clients)
+        slots = local + len(peers)
+        if strategy == STICKY:
+            slot = zlib.crc32(topic.encode('utf-8')) % slots
+        else:
+            slot = self.next_slot % slots
+            self.next_slot = slot + 1
+        if slot < local:
+            return None
+        return peers[slot - local]
+
+    def choose(self, topic, clients, sessions, strategy):
+        """ Picks the member to deliver a message on topic to
+
+        Args:
+            clients: client id -> connected MQTTConnection
+            sessions: client id -> persistent Session
+
+        Returns:
+            (client id, granted qos), or None if no member can take it
+        """
+        order = self.order
+        count = len(order)
+        if not count:
+            # only peers have members
+            return None
+        start = self.next % count
+        self.next = start + 1
+
+        if strategy == STICKY:
+            # highest random weight, only the topics of a member that comes
+            # or goes move
+            seed = zlib.crc32(topic.encode('utf-8'))
+            crc32 = zlib.crc32
+            best = None
+            best_weight = -1
+            for client_id, encoded in self.encoded:
+                if client_id in clients:
+                    weight = crc32(encoded, seed)
+                    if weight > best_weight:
+                        best, best_weight = client_id, weight
+            if best is not None:
+                return best, self.members[best]
+        elif strategy == LEAST_INFLIGHT:
+            # ties go round robin so idle members share the load
+            best = None
+            best_load = None
+            for i in range(count):
+                client_id = order[(start + i) % count]
+                connection = clients.get(client_id)
+                if connection is None:
+                    continue
+                load = len(connection.inflight) + connection.queue.depth
+                if best is None or load < best_load:
+                    best, best_load = client_id, load
+                    if not load:
+                        break
+            if best is not None:
+                return best, self.members[best]
+        else:
+            for i in range(count):
+                client_id = order[(start + i) % count]
+                if client_id in clients:
+                    self.next = start + i + 1
+                    return client_id, self.members[client_id]
+
+        # nobody connected, leave it with a session to pick up later
+        for i in range(count):
+            client_id = order[(start + i) % count]
+            if client_id in sessions:
+                self.next = start + i + 1
+                return client_id, self.members[client_id]
+        return None
+
+
+class SharedSubscriptions:
+    """ Index of shared subscription groups
+
+    Args:
+        strategy: one of STRATEGIES, how a group picks a member
+    """
+
+    def __init__(self, strategy=ROUND_ROBIN):
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Unknown shared subscription strategy: {strategy}')
+        self.strategy = strategy
+        # (group, filter) -> SharedGroup
+        self.groups = {}
+        # filters to the (group, filter) keys of their groups
+        self.topics = TopicTrie()
+
+    def __len__(self):
+        # groups with members here, not those only peers have
+        return sum(1 for shared in self.groups.values() if shared.members)
+
+    def _group(self, group, topic_filter):
+        key = (group, topic_filter)
+        shared = self.groups.get(key)
+        if shared is None:
+            shared = self.groups[key] = SharedGroup(group, topic_filter)
+            self.topics.subscribe(topic_filter, key)
+        return shared
+
+    def _release(self, shared):
+        if not shared.members and not shared.peers:
+            key = (shared.name, shared.filter)
+            del self.groups[key]
+            self.topics.unsubscribe(shared.filter, key)
+
+    def subscribe(self, group, topic_filter, client_id, qos=0):
+        """ Adds a client to a group, creating it if needed
+
+        Returns:
+            True if the client wasn't already a member
+        """
+        shared = self._group(group, topic_filter)
+        is_new = client_id not in shared.members
+        shared.add(client_id, qos)
+        return is_new
+
+    def unsubscribe(self, group, topic_filter, client_id):
+        """ Removes a client from a group, the group goes with its last member
+
+        Returns:
+            True if the client was a member
+        """
+        shared = self.groups.get((group, topic_filter))
+        if shared is None or not shared.remove(client_id):
+            return False
+        self._release(shared)
+        return True
+
+    def add_peer(self, group, topic_filter, peer_id):
+        """ A peer has members in a group """
+        shared = self._group(group, topic_filter)
+        if peer_id not in shared.peers:
+            shared.peers.append(peer_id)
+
+    def remove_peer(self, group, topic_filter, peer_id):
+        """ A peer has no members left in a group, or has gone """
+        shared = self.groups.get((group, topic_filter))
+        if shared is None or peer_id not in shared.peers:
+            return
+        shared.peers.remove(peer_id)
+        self._release(shared)
+
+    def match(self, topic, clients, sessions, keys=None):
+        """ Picks one member of every group with a filter matching topic
+
+        Args:
+            keys: only these (group, filter) groups, for a message a peer
+                chose this node to deliver
+
+        Returns:
+            list of (client id, granted qos)
+        """
+        if not self.groups:
+            return []
+        chosen = []
+        for key in self.topics.match(topic) if keys is None else keys:
+            shared = self.groups.get(key)
+            if shared is None:
+                continue
+            member = shared.choose(topic, clients, sessions, self.strategy)
+            if member is not None:
+                chosen.append(member)
+        return chosen
+
+    def route(self, topic, clients, sessions, links):
+        """ match() for a message published on this node, with peers
+        taking part in the groups they have members in
+
+        Args:
+            links: peer id -> PeerLink of the peers currently linked
+
+        Returns:
+            (list of (client id, granted qos) picked here,
+             dict of peer id -> list of (group, filter) it was picked for)
+        """
+        if not self.groups:
+            return [], {}
+        chosen = []
+        peers = {}
+        strategy = self.strategy
+        for key in self.topics.match(topic):
+            shared = self.groups[key]
+            if shared.peers:
+                peer_id = shared.choose_peer(topic, clients, links, strategy)
+                if peer_id is not None:
+                    peers.setdefault(peer_id, []).append(key)
+                    continue
+            member = shared.choose(topic, clients, sessions, strategy)
+            if member is not None:
+                chosen.append(member)
+        return chosen, peers
+
+    def stats(self):
+        return {f'{SHARE_PREFIX}/{group}/{topic_filter}': len(shared.members)
+                for (group, topic_filter), shared in self.groups.items()
+                if shared.members}
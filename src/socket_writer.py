@@ -0,0 +1,133 @@
+"""
+Coalescing writer for the client's blocking socket.
+
+Packets handed to write() are gathered and sent together with one sendmsg()
+call instead of one sendall() per packet. A batch goes out as soon as it
+reaches max_bytes, otherwise a background thread sends it max_delay seconds
+after its first packet was added, so a lone packet is never held for long.
+TLS sockets can't sendmsg(), their batches are joined and sent with one
+sendall(), which also packs them into as few TLS records as possible.
+"""
+import ssl
+import threading
+
+from logging_setup import LoggerSetup
+logger = LoggerSetup.get_logger(__name__)
+
+# most platforms cap the number of buffers in one sendmsg at 1024 (IOV_MAX)
+MAX_BUFFERS_PER_SEND = 1024
+
+
+class SocketWriter:
+    def __init__(self, sock, max_bytes=16 * 1024, max_delay=0.001):
+        self.sock = None
+        self.gather = True
+        self.attach(sock)
+        self.max_bytes = max_bytes
+        # None or 0 sends every write straight away
+        self.max_delay = max_delay
+
+        self.pending = []
+        self.pending_bytes = 0
+        self.error = None
+
+        self._lock = threading.Lock()
+        self._has_pending = threading.Condition(self._lock)
+        self._flush_thread = None
+        self._running = False
+
+    def attach(self, sock):
+        """ Sends on sock from now on, for when the socket has been wrapped
+        for TLS
+        """
+        self.sock = sock
+        self.gather = not isinstance(sock, ssl.SSLSocket)
+
+    def write(self, data):
+        """ Adds a packet to the current batch
+
+        Raises:
+            OSError: if sending a previous batch failed
+        """
+        with self._lock:
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+
+            if not self.max_delay or self.pending_bytes >= self.max_bytes:
+                self._flush_locked()
+                return
+
+            if self._flush_thread is None:
+                self._start_flush_thread()
+            if len(self.pending) == 1:
+                self._has_pending.notify()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            self._running = False
+            self.pending = []
+            self.pending_bytes = 0
+            self._has_pending.notify()
+        if self._flush_thread is not None:
+            self._flush_thread.join(timeout=1)
+            self._flush_thread = None
+
+    def _start_flush_thread(self):
+        self._running = True
+        self._flush_thread = threading.Thread(
+            target=self._flush_loop, daemon=True)
+        self._flush_thread.start()
+
+    def _flush_loop(self):
+        with self._lock:
+            while self._running:
+                if not self.pending:
+                    self._has_pending.wait()
+                    continue
+
+                # give the batch a moment to fill before sending it, write()
+                # flushes on its own if it fills up in the meantime
+                self._has_pending.wait(self.max_delay)
+                try:
+                    self._flush_locked()
+                except OSError as e:
+                    logger.error(f'Socket error while flushing: {e}')
+                    self.error = e
+
+    def _flush_locked(self):
+        if not self.pending:
+            return
+
+        buffers = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        self._send_all(buffers)
+
+    def _send_all(self, buffers):
+        if not self.gather:
+            self.sock.sendall(b''.join(buffers))
+            return
+
+        while buffers:
+            batch = buffers[:MAX_BUFFERS_PER_SEND]
+            sent = self.sock.sendmsg(batch)
+
+            # sendmsg can stop part way through, skip what made it and go again
+            consumed = 0
+            for buffer in batch:
+                if sent < len(buffer):
+                    break
+                sent -= len(buffer)
+                consumed += 1
+
+            buffers = buffers[consumed:]
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
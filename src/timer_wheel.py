@@ -0,0 +1,109 @@
+"""
+Hashed timing wheel for keep-alive deadlines.
+
+Time is split into ticks and every tick has a slot, slots are reused each
+time the wheel comes round. A timer lives in the slot of the tick its
+deadline falls in, so advancing the wheel only looks at the slots that have
+come due, never at every timer.
+
+Resetting a timer is lazy: touch() just moves the deadline, the timer stays
+where it is. When its slot comes due a timer that has been touched since is
+moved on to the slot of its new deadline instead of expiring. A busy
+connection is therefore touched on every packet for the cost of a store,
+and each timer is looked at about once per timeout whatever the number of
+connections.
+"""
+
+
+class Timer:
+    __slots__ = ('key', 'timeout', 'deadline', 'tick')
+
+    def __init__(self, key, timeout, deadline, tick):
+        self.key = key
+        self.timeout = timeout
+        self.deadline = deadline
+        # the tick whose slot the timer is in
+        self.tick = tick
+
+
+class TimerWheel:
+    """
+    Args:
+        resolution: length of a tick in seconds, timers expire up to one
+            tick late
+        slots: number of slots, timeouts longer than slots * resolution are
+            looked at once per turn of the wheel until they're due
+    """
+
+    def __init__(self, resolution=1.0, slots=1024, now=0.0):
+        self.resolution = resolution
+        self.slots = [set() for _ in range(slots)]
+        self.timers = {}
+        # last tick advance() has processed
+        self.current_tick = self._tick_of(now) - 1
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def _tick_of(self, when):
+        return int(when // self.resolution)
+
+    def schedule(self, key, timeout, now):
+        """ Starts, or restarts, a timer that expires timeout seconds after
+        now unless it's touched in the meantime
+        """
+        self.cancel(key)
+        deadline = now + timeout
+        # the slot after the deadline's so a timer never expires early
+        tick = max(self._tick_of(deadline) + 1, self.current_tick + 1)
+        timer = Timer(key, timeout, deadline, tick)
+        self.timers[key] = timer
+        self.slots[tick % len(self.slots)].add(timer)
+
+    def touch(self, key, now):
+        """ Pushes a timer's deadline back to a full timeout from now """
+        timer = self.timers.get(key)
+        if timer is not None:
+            timer.deadline = now + timer.timeout
+
+    def cancel(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            self.slots[timer.tick % len(self.slots)].discard(timer)
+
+    def advance(self, now):
+        """ Processes every tick up to now
+
+        Returns:
+            keys of the timers that expired, they're no longer scheduled
+        """
+        target = self._tick_of(now)
+        if target <= self.current_tick:
+            return []
+
+        slots = self.slots
+        # after a long stall one turn of the wheel covers every slot
+        first = max(self.current_tick + 1, target - len(slots) + 1)
+        self.current_tick = target
+
+        expired = []
+        for tick in range(first, target + 1):
+            slot = slots[tick % len(slots)]
+            if not slot:
+                continue
+            for timer in list(slot):
+                if timer.deadline <= now:
+                    slot.discard(timer)
+                    del self.timers[timer.key]
+                    expired.append(timer.key)
+                elif timer.tick <= tick:
+                    # touched since it was slotted, move it to its deadline
+                    slot.discard(timer)
+                    timer.tick = max(self._tick_of(timer.deadline) + 1,
+                                     target + 1)
+                    slots[timer.tick % len(slots)].add(timer)
+                # otherwise it's due on a later turn of the wheel
+        return expired
@@ -0,0 +1,101 @@
+"""
+TLS contexts for the broker's listener and the client.
+
+The broker takes an ssl.SSLContext and serves a second listener with it,
+8883 by default, alongside the plain one. Full handshakes are expensive,
+an RSA or ECDSA signature on the broker for every connection, so resumption
+is what keeps a reconnect storm cheap: a client that presents the session
+of its last connection skips the certificate exchange and the signature.
+OpenSSL does both kinds of resumption for a server context on its own, a
+session cache for TLS 1.2 and session tickets for TLS 1.3. The ticket keys
+belong to the context, so when it's made before the workers are forked a
+ticket issued by one worker is accepted by all of them.
+
+On the client side Python has no session cache, the client keeps the
+session of its last connection and offers it on the next, see
+MQTTClientConnection's tls_session.
+"""
+import os
+import ssl
+import subprocess
+
+from logging_setup import LoggerSetup
+logger = LoggerSetup.get_logger(__name__)
+
+# TLS 1.3 tickets the broker hands out per connection, one per reconnect a
+# client can make without a full handshake
+DEFAULT_SESSION_TICKETS = 2
+
+
+def server_context(certfile, keyfile=None, cafile=None, ciphers=None,
+                   session_tickets=DEFAULT_SESSION_TICKETS,
+                   minimum_version=ssl.TLSVersion.TLSv1_2):
+    """ Context for the broker's TLS listener
+
+    Args:
+        certfile, keyfile: PEM certificate chain and private key, keyfile
+            can be left out if the key is in certfile
+        cafile: PEM CA certificates, with it clients must present a
+            certificate signed by one of them
+        ciphers: OpenSSL cipher list for TLS 1.2, TLS 1.3 suites can't be
+            changed from Python
+        session_tickets: TLS 1.3 tickets issued per connection, 0 turns
+            resumption off
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = minimum_version
+    context.load_cert_chain(certfile, keyfile)
+    if cafile is not None:
+        context.load_verify_locations(cafile)
+        context.verify_mode = ssl.CERT_REQUIRED
+    if ciphers:
+        context.set_ciphers(ciphers)
+    context.num_tickets = session_tickets
+    return context
+
+
+def client_context(cafile=None, certfile=None, keyfile=None, ciphers=None,
+                   verify=True, minimum_version=ssl.TLSVersion.TLSv1_2):
+    """ Context for MQTTClientConnection
+
+    Args:
+        cafile: PEM CA certificates to trust, the system's without it
+        certfile, keyfile: a client certificate, for brokers that want one
+        verify: False accepts any certificate, for testing only
+    """
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
+    context.minimum_version = minimum_version
+    if certfile is not None:
+        context.load_cert_chain(certfile, keyfile)
+    if ciphers:
+        context.set_ciphers(ciphers)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def session_stats(context):
+    """ Handshakes a server context has completed and how many resumed a
+    session, the rest were full handshakes
+    """
+    stats = context.session_stats()
+    return {'handshakes': stats['accept_good'], 'resumed': stats['hits']}
+
+
+def self_signed_certificate(directory, hostname='localhost'):
+    """ Makes a self-signed EC certificate with the openssl command, for
+    tests and benchmarks
+
+    Returns:
+        (certfile, keyfile) paths
+    """
+    certfile = os.path.join(directory, f'{hostname}.crt')
+    keyfile = os.path.join(directory, f'{hostname}.key')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'ec',
+         '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+         '-keyout', keyfile, '-out', certfile, '-days', '1',
+         '-subj', f'/CN={hostname}', '-addext', f'subjectAltName=DNS:{hostname}'],
+        check=True, capture_output=True)
+    return certfile, keyfile
@@ -0,0 +1,343 @@
+"""
+Topic access control, who may publish to and subscribe to which topics.
+
+Rules come from an ACL file in the style of mosquitto's:
+
+    # anyone may read the broker's statistics
+    pattern read $SYS/#
+    # every client has a tree of its own, and so does every user
+    pattern readwrite devices/%c/#
+    pattern readwrite users/%u/#
+
+    user alice
+    topic readwrite alice/#
+    topic read public/#
+
+    client sensor-*
+    topic write sensors/+/temperature
+
+pattern rules apply to everyone, with %c replaced by the client id and %u by
+the username. topic rules apply to the user or client id (a glob) of the
+section they're in, topic rules before any section to clients without a
+username. The access is read, write or readwrite, readwrite if left out. A
+client may do only what some rule allows, everything else is denied.
+
+Rules are compiled into tries split on '/' like the subscription index, one
+for the patterns and one per user and client section, so a check walks as
+deep as the topic whatever the number of rules. A subscription is allowed if
+a single read rule covers every topic its filter can match. Each connection
+gets an AclChecker that remembers its recent publish decisions in an LRU, so
+a client publishing to the same topics again costs one dict lookup.
+"""
+import fnmatch
+from collections import OrderedDict
+
+from topic_trie import (
+    TopicFilterError, validate_topic_filter, SEPARATOR,
+    SINGLE_LEVEL_WILDCARD, MULTI_LEVEL_WILDCARD)
+from logging_setup import LoggerSetup
+logger = LoggerSetup.get_logger(__name__)
+
+READ = 1
+WRITE = 2
+READWRITE = READ | WRITE
+ACCESS = {'read': READ, 'write': WRITE, 'readwrite': READWRITE}
+
+CLIENT_ID_TEMPLATE = '%c'
+USERNAME_TEMPLATE = '%u'
+
+
+class TopicAclError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(f"ACL error: {message}")
+
+
+def substitute(template, client_id, username):
+    """ A template level with the client's values put in, None if it needs
+    a username the client doesn't have
+    """
+    if USERNAME_TEMPLATE in template:
+        if username is None:
+            return None
+        template = template.replace(USERNAME_TEMPLATE, username)
+    return template.replace(CLIENT_ID_TEMPLATE, client_id)
+
+
+class AclTrieNode:
+    __slots__ = ('children', 'templates', 'access')
+
+    def __init__(self):
+        # level -> AclTrieNode
+        self.children = None
+        # [(level with %c or %u, AclTrieNode)]
+        self.templates = None
+        # READ and WRITE bits of the rules ending here
+        self.access = 0
+
+
+class AclTrie:
+    """ Rules of one section, topic filters to the access they grant """
+
+    def __init__(self):
+        self.root = AclTrieNode()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, topic_filter, access):
+        validate_topic_filter(topic_filter)
+        node = self.root
+        for level in topic_filter.split(SEPARATOR):
+            if CLIENT_ID_TEMPLATE in level or USERNAME_TEMPLATE in level:
+                if node.templates is None:
+                    node.templates = []
+                for template, child in node.templates:
+                    if template == level:
+                        break
+                else:
+                    child = AclTrieNode()
+                    node.templates.append((level, child))
+            else:
+                if node.children is None:
+                    node.children = {}
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = AclTrieNode()
+            node = child
+        node.access |= access
+        self.count += 1
+
+    def allows(self, levels, access, client_id, username):
+        """ True if one rule grants access to every topic matching levels
+
+        Args:
+            levels: a topic, or a subscription's filter, split on '/'
+        """
+        # a leading wildcard doesn't match $ topics [MQTT-4.7.2-1]
+        system_topic = levels[0].startswith('$')
+        nodes = [self.root]
+        for depth, level in enumerate(levels):
+            # a filter's wildcards are only covered by the same wildcard or
+            # a broader one, never by a literal or a template
+            multi_level = level == MULTI_LEVEL_WILDCARD
+            wildcard = multi_level or level == SINGLE_LEVEL_WILDCARD
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if children:
+                    if depth or not system_topic:
+                        multi = children.get(MULTI_LEVEL_WILDCARD)
+                        if multi is not None and multi.access & access:
+                            return True
+                        if not multi_level:
+                            single = children.get(SINGLE_LEVEL_WILDCARD)
+                            if single is not None:
+                                next_nodes.append(single)
+                    child = children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+                if node.templates and not wildcard:
+                    for template, child in node.templates:
+                        if substitute(template, client_id, username) == level:
+                            next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                return False
+
+        for node in nodes:
+            if node.access & access:
+                return True
+            # 'a/#' also covers the parent level 'a' [MQTT-4.7.1-2]
+            if node.children:
+                multi = node.children.get(MULTI_LEVEL_WILDCARD)
+                if multi is not None and multi.access & access:
+                    return True
+        return False
+
+
+class TopicAcl:
+    """ Compiled ACL rules
+
+    Args:
+        acl_file: path of the rules, see the module docstring
+        cache_size: publish decisions each connection remembers
+    """
+
+    def __init__(self, acl_file=None, cache_size=1024):
+        self.acl_file = acl_file
+        self.cache_size = cache_size
+        self.patterns = AclTrie()
+        # topic rules before any section
+        self.anonymous = AclTrie()
+        # username -> AclTrie
+        self.users = {}
+        # client id -> AclTrie, and [(glob, AclTrie)] for ids with wildcards
+        self.clients = {}
+        self.client_globs = []
+        # bumped whenever the rules change so checkers drop what they cached
+        self.generation = 0
+        if acl_file is not None:
+            self.reload()
+
+    def __len__(self):
+        return (len(self.patterns) + len(self.anonymous) +
+                sum(len(trie) for trie in self.users.values()) +
+                sum(len(trie) for trie in self.clients.values()) +
+                sum(len(trie) for _, trie in self.client_globs))
+
+    def clear(self):
+        self.patterns = AclTrie()
+        self.anonymous = AclTrie()
+        self.users = {}
+        self.clients = {}
+        self.client_globs = []
+        self.generation += 1
+
+    def add_rule(self, topic_filter, access=READWRITE, user=None, client=None,
+                 pattern=False):
+        """ Adds a rule, for everyone with pattern, else for a user, a client
+        id glob or, with neither, clients without a username
+
+        Raises:
+            TopicFilterError: if the filter is invalid
+        """
+        if pattern:
+            trie = self.patterns
+        elif user is not None:
+            trie = self.users.get(user)
+            if trie is None:
+                trie = self.users[user] = AclTrie()
+        elif client is not None:
+            trie = self._client_trie(client)
+        else:
+            trie = self.anonymous
+        trie.add(topic_filter, access)
+        self.generation += 1
+
+    def _client_trie(self, client):
+        if not any(c in client for c in '*?['):
+            trie = self.clients.get(client)
+            if trie is None:
+                trie = self.clients[client] = AclTrie()
+            return trie
+        for glob, trie in self.client_globs:
+            if glob == client:
+                return trie
+        trie = AclTrie()
+        self.client_globs.append((client, trie))
+        return trie
+
+    def reload(self):
+        """ Re-reads the ACL file, replacing every rule. Connections pick up
+        the new rules on their next check.
+
+        Raises:
+            TopicAclError: if the file can't be parsed, the old rules are
+                kept
+        """
+        previous = (self.patterns, self.anonymous, self.users, self.clients,
+                    self.client_globs)
+        self.clear()
+        try:
+            self.load(self.acl_file)
+        except TopicAclError:
+            (self.patterns, self.anonymous, self.users, self.clients,
+             self.client_globs) = previous
+            raise
+        logger.info(f'Loaded {len(self)} ACL rules from {self.acl_file}')
+
+    def load(self, path):
+        user = client = None
+        with open(path, encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                keyword, _, rest = line.partition(' ')
+                rest = rest.strip()
+                if keyword == 'user' and rest:
+                    user, client = rest, None
+                elif keyword == 'client' and rest:
+                    user, client = None, rest
+                elif keyword in ('topic', 'pattern') and rest:
+                    access, _, topic_filter = rest.partition(' ')
+                    if access in ACCESS and topic_filter.strip():
+                        topic_filter = topic_filter.strip()
+                    else:
+                        access, topic_filter = 'readwrite', rest
+                    try:
+                        self.add_rule(topic_filter, ACCESS[access], user, client,
+                                      pattern=keyword == 'pattern')
+                    except TopicFilterError as e:
+                        raise TopicAclError(f'{path}:{number}: {e.message}')
+                else:
+                    raise TopicAclError(f'{path}:{number}: unknown rule {line!r}')
+
+    def tries(self, client_id, username):
+        """ The rule tries that apply to a client """
+        tries = [self.patterns] if self.patterns.count else []
+        if username is None:
+            if self.anonymous.count:
+                tries.append(self.anonymous)
+        elif username in self.users:
+            tries.append(self.users[username])
+        if client_id in self.clients:
+            tries.append(self.clients[client_id])
+        for glob, trie in self.client_globs:
+            if fnmatch.fnmatchcase(client_id, glob):
+                tries.append(trie)
+        return tries
+
+    def checker(self, client_id, username):
+        return AclChecker(self, client_id, username)
+
+
+class AclChecker:
+    """ A connection's view of the ACL, made when it's accepted """
+
+    def __init__(self, acl, client_id, username):
+        self.acl = acl
+        self.client_id = client_id
+        self.username = username
+        self.generation = None
+        self.tries = None
+        # topic -> may publish, least recently used first
+        self.cache = OrderedDict()
+        self.cache_size = acl.cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def _refresh(self):
+        self.generation = self.acl.generation
+        self.tries = self.acl.tries(self.client_id, self.username)
+        self.cache.clear()
+
+    def _allows(self, levels, access):
+        for trie in self.tries:
+            if trie.allows(levels, access, self.client_id, self.username):
+                return True
+        return False
+
+    def can_publish(self, topic):
+        if self.generation != self.acl.generation:
+            self._refresh()
+        cache = self.cache
+        allowed = cache.get(topic)
+        if allowed is not None:
+            cache.move_to_end(topic)
+            self.hits += 1
+            return allowed
+
+        self.misses += 1
+        allowed = cache[topic] = self._allows(topic.split(SEPARATOR), WRITE)
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return allowed
+
+    def can_subscribe(self, topic_filter):
+        """ Subscriptions are made once, these aren't cached """
+        if self.generation != self.acl.generation:
+            self._refresh()
+        return self._allows(topic_filter.split(SEPARATOR), READ)
@@ -0,0 +1,181 @@
+"""
+Subscription index for routing PUBLISH topics to subscribers.
+
+Topic filters are split on '/' and stored one level per node so a publish
+only has to walk as deep as its topic, following the literal level plus any
+'+' and '#' branches, no matter how many subscriptions exist.
+"""
+
+SEPARATOR = '/'
+SINGLE_LEVEL_WILDCARD = '+'
+MULTI_LEVEL_WILDCARD = '#'
+
+
+class TopicFilterError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(f"Invalid topic filter: {message}")
+
+
+def validate_topic_filter(topic_filter):
+    """ Checks a filter against the MQTT 3.1.1 wildcard rules [MQTT-4.7.1]
+
+    Raises:
+        TopicFilterError: if the filter is empty or has misplaced wildcards
+    """
+    if not topic_filter:
+        raise TopicFilterError("Filter must be at least one character")
+
+    levels = topic_filter.split(SEPARATOR)
+    for index, level in enumerate(levels):
+        if MULTI_LEVEL_WILDCARD in level:
+            if level != MULTI_LEVEL_WILDCARD or index != len(levels) - 1:
+                raise TopicFilterError(
+                    f"'#' must be the last level on its own: {topic_filter}")
+        elif SINGLE_LEVEL_WILDCARD in level and level != SINGLE_LEVEL_WILDCARD:
+            raise TopicFilterError(
+                f"'+' must occupy a whole level: {topic_filter}")
+
+
+class TopicTrieNode:
+    # there can be millions of these so keep them small, the dicts are only
+    # created when something is actually stored in them
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = None
+        self.subscribers = None
+
+    def is_empty(self):
+        return not self.children and not self.subscribers
+
+
+class TopicTrie:
+    """ Level tokenised trie of topic filters to {client_id: qos}.
+
+    A client has at most one subscription per filter (resubscribing replaces
+    the qos) and overlapping filters are collapsed by match() so a client is
+    only returned once per topic, at the highest granted qos.
+    """
+
+    def __init__(self):
+        self.root = TopicTrieNode()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.root = TopicTrieNode()
+        self.count = 0
+
+    def subscribe(self, topic_filter, client_id, qos=0):
+        """ Adds or updates a subscription
+
+        Returns:
+            True if this is a new subscription, False if it replaced one
+        """
+        validate_topic_filter(topic_filter)
+
+        node = self.root
+        for level in topic_filter.split(SEPARATOR):
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = TopicTrieNode()
+            node = child
+
+        if node.subscribers is None:
+            node.subscribers = {}
+        is_new = client_id not in node.subscribers
+        node.subscribers[client_id] = qos
+        if is_new:
+            self.count += 1
+        return is_new
+
+    def unsubscribe(self, topic_filter, client_id):
+        """ Removes a subscription, pruning any branches left empty
+
+        Returns:
+            True if the subscription existed
+        """
+        path = []
+        node = self.root
+        for level in topic_filter.split(SEPARATOR):
+            if not node.children or level not in node.children:
+                return False
+            path.append((node, level))
+            node = node.children[level]
+
+        if not node.subscribers or client_id not in node.subscribers:
+            return False
+
+        del node.subscribers[client_id]
+        self.count -= 1
+
+        # walk back up removing nodes with nothing left below them
+        for parent, level in reversed(path):
+            if not parent.children[level].is_empty():
+                break
+            del parent.children[level]
+
+        return True
+
+    def match(self, topic):
+        """ Finds every subscriber with a filter matching the topic
+
+        Args:
+            topic: topic name of a PUBLISH, must not contain wildcards
+
+        Returns:
+            dict of client_id to the highest qos they subscribed with
+        """
+        matches = {}
+        levels = topic.split(SEPARATOR)
+
+        # topics starting with $ are not matched by a leading wildcard
+        # [MQTT-4.7.2-1]
+        system_topic = topic.startswith('$')
+
+        nodes = [self.root]
+        for depth, level in enumerate(levels):
+            next_nodes = []
+            wildcards_allowed = depth > 0 or not system_topic
+            for node in nodes:
+                children = node.children
+                if not children:
+                    continue
+
+                if wildcards_allowed:
+                    multi = children.get(MULTI_LEVEL_WILDCARD)
+                    if multi is not None:
+                        self._collect(multi, matches)
+                    single = children.get(SINGLE_LEVEL_WILDCARD)
+                    if single is not None:
+                        next_nodes.append(single)
+
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+
+            nodes = next_nodes
+            if not nodes:
+                return matches
+
+        for node in nodes:
+            self._collect(node, matches)
+            # 'a/#' also matches the parent level 'a' [MQTT-4.7.1-2]
+            if node.children:
+                multi = node.children.get(MULTI_LEVEL_WILDCARD)
+                if multi is not None:
+                    self._collect(multi, matches)
+
+        return matches
+
+    def _collect(self, node, matches):
+        if not node.subscribers:
+            return
+        for client_id, qos in node.subscribers.items():
+            if matches.get(client_id, -1) < qos:
+                matches[client_id] = qos
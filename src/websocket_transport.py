@@ -0,0 +1,396 @@
+"""
+MQTT over WebSocket (RFC 6455) for browser clients.
+
+WebSocketProtocol sits between the event loop and an MQTTConnection. It
+answers the HTTP upgrade, agreeing the 'mqtt' subprotocol, then strips the
+WebSocket framing off what the client sends and hands the unmasked bytes to
+the connection through the same get_buffer()/buffer_updated() calls the
+loop would make, so from there on they're decoded and routed exactly as if
+they came over TCP. MQTT packets and WebSocket frames needn't line up, the
+frame decoder puts packets back together as it always does.
+
+The connection writes to a WebSocketTransport, which puts each batch the
+connection flushes in a single binary frame. Frames from the broker aren't
+masked so the batch's buffers are written as they are behind the frame
+header.
+
+Frames from clients are always masked, every payload byte XORed with a
+4 byte key. Unmasking byte by byte in Python would cost far more than the
+rest of the packet's handling, so a whole buffer is unmasked at a time:
+every fourth byte shares a key byte, so each of the four strided slices is
+run through bytes.translate() with a table for its key byte.
+"""
+import asyncio
+import base64
+import hashlib
+
+from logging_setup import LoggerSetup
+logger = LoggerSetup.get_logger(__name__)
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+# in order of preference, 'mqttv3.1' is what older clients ask for
+SUBPROTOCOLS = ('mqtt', 'mqttv3.1')
+# largest upgrade request accepted
+MAX_REQUEST_SIZE = 16 * 1024
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED_DATA = 1003
+
+# XOR_TABLES[k] maps every byte b to b ^ k, for bytes.translate()
+XOR_TABLES = [bytes(b ^ k for b in range(256)) for k in range(256)]
+# below this translating four slices costs more than going through an int
+STRIDED_MIN_BYTES = 512
+
+
+def unmask(data, mask):
+    """ XORs a bytearray in place with a repeating 4 byte mask, masking
+    and unmasking are the same thing
+    """
+    if len(data) < STRIDED_MIN_BYTES:
+        n = len(data)
+        key = (mask * (n // 4 + 1))[:n]
+        data[:] = (int.from_bytes(data, 'little') ^
+                   int.from_bytes(key, 'little')).to_bytes(n, 'little')
+        return
+    for i in range(4):
+        data[i::4] = data[i::4].translate(XOR_TABLES[mask[i]])
+
+
+def accept_key(key):
+    """ The Sec-WebSocket-Accept answer to a Sec-WebSocket-Key """
+    return base64.b64encode(hashlib.sha1(key.encode('ascii') + WEBSOCKET_GUID).digest())
+
+
+def frame_header(opcode, length, mask=None):
+    """ Header of a final frame with a payload of length bytes """
+    mask_bit = 0x80 if mask is not None else 0
+    if length < 126:
+        header = bytes([0x80 | opcode, mask_bit | length])
+    elif length < 65536:
+        header = bytes([0x80 | opcode, mask_bit | 126]) + length.to_bytes(2, 'big')
+    else:
+        header = bytes([0x80 | opcode, mask_bit | 127]) + length.to_bytes(8, 'big')
+    return header + mask if mask is not None else header
+
+
+class WebSocketTransport(asyncio.Transport):
+    """ What the MQTTConnection writes to, everything is passed on to the
+    socket's transport in binary frames
+    """
+
+    def __init__(self, protocol, transport):
+        super().__init__()
+        self.protocol = protocol
+        self.transport = transport
+        self.closing = False
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.transport.set_write_buffer_limits(high, low)
+
+    def get_write_buffer_size(self):
+        return self.transport.get_write_buffer_size()
+
+    def is_closing(self):
+        return self.closing or self.transport.is_closing()
+
+    def write(self, data):
+        self.writelines((data,))
+
+    def writelines(self, buffers):
+        if self.closing:
+            return
+        buffers = list(buffers)
+        length = sum(len(buffer) for buffer in buffers)
+        if not length:
+            return
+        buffers.insert(0, frame_header(OPCODE_BINARY, length))
+        self.transport.writelines(buffers)
+
+    def close(self):
+        self.close_with(CLOSE_NORMAL)
+
+    def close_with(self, code, reason=b''):
+        """ Sends a close frame and closes the socket once it's written """
+        if self.closing:
+            return
+        self.closing = True
+        payload = code.to_bytes(2, 'big') + reason
+        self.transport.write(frame_header(OPCODE_CLOSE, len(payload)) + payload)
+        self.transport.close()
+
+    def abort(self):
+        self.closing = True
+        self.transport.abort()
+
+
+class WebSocketProtocol(asyncio.BufferedProtocol):
+    """ WebSocket server end of one socket, feeding an inner protocol
+
+    Args:
+        connection: the BufferedProtocol the MQTT stream is for, given a
+            WebSocketTransport once the upgrade is done
+        path: only upgrade requests for this path are accepted, None for
+            any
+    """
+
+    def __init__(self, connection, path=None, buffer_size=4096):
+        self.connection = connection
+        self.path = path
+        self.transport = None
+        self.websocket = None
+
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.end = 0
+
+        # the frame being read
+        self.opcode = None
+        self.fragment_opcode = None
+        self.mask = None
+        # payload bytes of the frame still to come and already read
+        self.remaining = 0
+        self.offset = 0
+        # control frames are small and arrive whole, their payload is
+        # gathered here
+        self.control = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        if len(self.buffer) - self.end < max(sizehint, 1024):
+            grown = bytearray(max(len(self.buffer) * 2, self.end + sizehint))
+            grown[:self.end] = self.view[:self.end]
+            self.view.release()
+            self.buffer = grown
+            self.view = memoryview(grown)
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        if self.websocket is None:
+            if not self.upgrade():
+                return
+        self.read_frames()
+
+    def pause_writing(self):
+        if self.websocket is not None:
+            self.connection.pause_writing()
+
+    def resume_writing(self):
+        if self.websocket is not None:
+            self.connection.resume_writing()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.websocket is not None:
+            self.websocket.closing = True
+            self.connection.connection_lost(exc)
+
+    def consume(self, count):
+        """ Drops the first count bytes of the buffer """
+        remaining = self.end - count
+        self.buffer[:remaining] = self.view[count:self.end]
+        self.end = remaining
+
+    # the HTTP upgrade
+
+    def upgrade(self):
+        """ Answers the upgrade request once it's all arrived
+
+        Returns:
+            True if the WebSocket is open
+        """
+        headers_end = self.buffer.find(b'\r\n\r\n', 0, self.end)
+        if headers_end < 0:
+            if self.end > MAX_REQUEST_SIZE:
+                self.refuse(431, 'Request Header Fields Too Large')
+            return False
+
+        lines = bytes(self.view[:headers_end]).decode('latin-1').split('\r\n')
+        self.consume(headers_end + 4)
+        try:
+            method, target, _ = lines[0].split(' ')
+        except ValueError:
+            self.refuse(400, 'Bad Request')
+            return False
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if method != 'GET' or \
+                headers.get('upgrade', '').lower() != 'websocket' or \
+                'upgrade' not in headers.get('connection', '').lower() or \
+                headers.get('sec-websocket-version') != '13' or \
+                'sec-websocket-key' not in headers:
+            self.refuse(400, 'Bad Request')
+            return False
+        if self.path is not None and target.split('?', 1)[0] != self.path:
+            self.refuse(404, 'Not Found')
+            return False
+
+        response = [
+            'HTTP/1.1 101 Switching Protocols',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            f'Sec-WebSocket-Accept: {accept_key(headers["sec-websocket-key"]).decode()}',
+        ]
+        if 'sec-websocket-protocol' in headers:
+            offered = [protocol.strip() for protocol in
+                       headers['sec-websocket-protocol'].split(',')]
+            for protocol in SUBPROTOCOLS:
+                if protocol in offered:
+                    response.append(f'Sec-WebSocket-Protocol: {protocol}')
+                    break
+            else:
+                self.refuse(400, 'Bad Request')
+                return False
+        self.transport.write(('\r\n'.join(response) + '\r\n\r\n').encode('latin-1'))
+
+        self.websocket = WebSocketTransport(self, self.transport)
+        self.connection.connection_made(self.websocket)
+        return True
+
+    def refuse(self, status, reason):
+        logger.debug(f'Refused WebSocket upgrade: {status} {reason}')
+        self.transport.write(
+            f'HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\n'
+            f'Connection: close\r\n\r\n'.encode('latin-1'))
+        self.transport.close()
+
+    # frames
+
+    def read_frames(self):
+        buffer = self.buffer
+        position = 0
+        end = self.end
+        while position < end and not self.websocket.closing:
+            if self.opcode is None:
+                header = self.read_header(position, end)
+                if header is None:
+                    break
+                position += header
+                if self.remaining == 0:
+                    self.frame_complete()
+                continue
+
+            count = min(self.remaining, end - position)
+            payload = buffer[position:position + count]
+            position += count
+            mask = self.mask
+            if self.offset & 3:
+                shift = self.offset & 3
+                mask = mask[shift:] + mask[:shift]
+            unmask(payload, mask)
+            self.offset += count
+            self.remaining -= count
+
+            if self.opcode >= OPCODE_CLOSE:
+                self.control += payload
+            else:
+                self.deliver(payload)
+            if self.remaining == 0:
+                self.frame_complete()
+
+        if self.transport is not None:
+            self.consume(position)
+
+    def read_header(self, position, end):
+        """ Decodes the frame header at position
+
+        Returns:
+            its length, or None if it hasn't all arrived
+        """
+        buffer = self.buffer
+        if end - position < 2:
+            return None
+        first, second = buffer[position], buffer[position + 1]
+        if not second & 0x80:
+            # clients must mask every frame [RFC 6455 5.1]
+            self.fail(CLOSE_PROTOCOL_ERROR, b'unmasked frame')
+            return None
+        length = second & 0x7F
+        size = 2
+        if length == 126:
+            size = 4
+        elif length == 127:
+            size = 10
+        if end - position < size + 4:
+            return None
+        if length == 126:
+            length = int.from_bytes(buffer[position + 2:position + 4], 'big')
+        elif length == 127:
+            length = int.from_bytes(buffer[position + 2:position + 10], 'big')
+
+        opcode = first & 0x0F
+        final = first & 0x80
+        if opcode >= OPCODE_CLOSE:
+            if not final or length > 125 or opcode > OPCODE_PONG:
+                self.fail(CLOSE_PROTOCOL_ERROR, b'bad control frame')
+                return None
+        elif opcode == OPCODE_CONTINUATION:
+            if self.fragment_opcode is None:
+                self.fail(CLOSE_PROTOCOL_ERROR, b'nothing to continue')
+                return None
+        elif opcode == OPCODE_BINARY:
+            if self.fragment_opcode is not None:
+                self.fail(CLOSE_PROTOCOL_ERROR, b'expected a continuation')
+                return None
+            self.fragment_opcode = opcode
+        else:
+            # MQTT is only carried in binary frames
+            self.fail(CLOSE_UNSUPPORTED_DATA, b'binary frames only')
+            return None
+        if opcode < OPCODE_CLOSE and final:
+            self.fragment_opcode = None
+
+        self.opcode = opcode
+        self.mask = bytes(buffer[position + size:position + size + 4])
+        self.remaining = length
+        self.offset = 0
+        return size + 4
+
+    def deliver(self, payload):
+        """ Hands unmasked MQTT bytes to the connection """
+        connection = self.connection
+        while payload:
+            buffer = connection.get_buffer(len(payload))
+            count = min(len(buffer), len(payload))
+            buffer[:count] = payload[:count]
+            del buffer
+            connection.buffer_updated(count)
+            if self.transport is None or self.websocket.closing:
+                return
+            payload = payload[count:]
+
+    def frame_complete(self):
+        opcode = self.opcode
+        self.opcode = None
+        if opcode < OPCODE_CLOSE:
+            return
+
+        payload = bytes(self.control)
+        self.control = bytearray()
+        if opcode == OPCODE_PING:
+            self.transport.write(frame_header(OPCODE_PONG, len(payload)) + payload)
+        elif opcode == OPCODE_CLOSE:
+            # echo the status code back and close [RFC 6455 5.5.1]
+            code = int.from_bytes(payload[:2], 'big') if len(payload) >= 2 else CLOSE_NORMAL
+            self.websocket.close_with(code)
+
+    def fail(self, code, reason):
+        logger.warning(f'WebSocket protocol error from '
+                       f'{self.transport.get_extra_info("peername")}: {reason.decode()}')
+        self.websocket.close_with(code, reason)
@@ -0,0 +1,562 @@
+"""
+Append-only write-ahead log of QoS 1/2 messages and their delivery state.
+
+Every QoS > 0 message routed to at least one QoS > 0 subscriber is logged
+together with one delivery record per subscriber, and each delivery's
+progress (PUBREC received, finished) is logged as it happens. Replaying the
+log at startup rebuilds every delivery that hadn't finished so it can be
+sent again when its client reconnects.
+
+The log is split into numbered segment files. Records are appended to the
+newest one, and a new segment is started once it reaches segment_bytes.
+
+Group commit: appends only go to an in-memory buffer. commit() asks for a
+callback once everything appended so far is on disk. The buffer is written
+and fsynced in a worker thread commit_window seconds after the first
+commit() request (by default at the end of the current loop iteration), and
+commits that arrive while that's happening wait for the next fsync. Under
+load one fsync covers every message committed while the previous one ran
+instead of one fsync per message. A window only helps when fsync is cheaper
+than the gap between commits.
+
+A failed write or fsync leaves the log unusable: every commit waiting on it,
+and any made afterwards, has its errback called instead of its callback and
+nothing more is appended.
+
+Compaction: segments are deleted oldest first, as soon as none of the
+oldest segment's messages have unfinished deliveries. Deleting in order
+means a delivery's later state records are never lost while its message
+record survives. An oldest segment that is mostly finished has its few live
+messages copied to the newest segment so it can go too, otherwise one slow
+client could pin every segment written after it.
+
+Record layout, all integers big endian:
+    length u32, crc32 u32, type u8, body            (length and crc cover
+                                                     type and body)
+    MESSAGE   body: id u64, qos u8, retain u8, topic (u16 length + utf-8),
+              payload (u32 length + bytes)
+    DELIVERY  body: id u64, state u8, qos u8, client id (u16 length + utf-8)
+"""
+import asyncio
+import os
+import struct
+import zlib
+
+from publish_frame import PublishFrame
+from logging_setup import LoggerSetup
+logger = LoggerSetup.get_logger(__name__)
+
+MESSAGE = 1
+DELIVERY = 2
+
+# delivery states
+QUEUED = 0      # not yet acknowledged by the subscriber
+RECEIVED = 1    # qos 2, PUBREC received, PUBREL still to be completed
+DONE = 2        # finished, acknowledged or discarded
+
+RECORD_HEADER = struct.Struct('>II')
+MESSAGE_HEADER = struct.Struct('>BQBB')
+DELIVERY_HEADER = struct.Struct('>BQBB')
+
+SEGMENT_PREFIX = 'wal-'
+SEGMENT_SUFFIX = '.log'
+
+
+class WriteAheadLogError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(f"Write-ahead log error: {message}")
+
+
+class LoggedMessage:
+    __slots__ = ('frame', 'qos', 'retain', 'segment', 'deliveries')
+
+    def __init__(self, frame, qos, retain, segment):
+        self.frame = frame
+        self.qos = qos
+        self.retain = retain
+        # segment holding the most recent copy of the message record, None
+        # until the buffered record is written
+        self.segment = segment
+        # client id -> (QUEUED or RECEIVED, qos it's delivered at),
+        # finished deliveries are removed
+        self.deliveries = {}
+
+
+def encode_message(message_id, qos, retain, topic, payload):
+    topic = topic.encode('utf-8')
+    return b''.join((
+        MESSAGE_HEADER.pack(MESSAGE, message_id, qos, retain),
+        len(topic).to_bytes(2, 'big'), topic,
+        len(payload).to_bytes(4, 'big'), payload))
+
+
+def encode_delivery(message_id, client_id, state, qos):
+    client_id = client_id.encode('utf-8')
+    return b''.join((
+        DELIVERY_HEADER.pack(DELIVERY, message_id, state, qos),
+        len(client_id).to_bytes(2, 'big'), client_id))
+
+
+def frame_record(body):
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def read_records(data):
+    """ Yields (offset, body) for every intact record in data, stopping at
+    the first torn or corrupt one
+    """
+    offset = 0
+    view = memoryview(data)
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        body = view[start:start + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            return
+        yield offset, body
+        offset = start + length
+
+
+class WriteAheadLog:
+    """
+    Args:
+        directory: where segment files live, created if missing
+        segment_bytes: size a segment grows to before a new one is started
+        commit_window: seconds to gather commits before writing them out
+        compact_ratio: closed segments with fewer than this fraction of
+            their messages still live are rewritten and deleted
+        fsync: False skips fsync, data still reaches the os on every commit
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024,
+                 commit_window=0, compact_ratio=0.25, fsync=True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.commit_window = commit_window
+        self.compact_ratio = compact_ratio
+        self.fsync = fsync
+
+        # message id -> LoggedMessage with unfinished deliveries
+        self.messages = {}
+        # client id -> {message id: LoggedMessage} of unfinished deliveries
+        self.clients = {}
+        # segment number -> [messages still live, messages written]
+        self.segments = {}
+        self.last_message_id = 0
+
+        self.loop = None
+        self._file = None
+        self._segment = 0
+        self._segment_size = 0
+        # records appended since the last write, and (callback, errback)
+        # of the commits waiting for them to be synced
+        self._buffer = []
+        self._waiters = []
+        # messages whose records are in _buffer, see _take_batch()
+        self._unplaced = []
+        self._commit_handle = None
+        # the sync running in a worker thread, if any, and its waiters
+        self._sync_future = None
+        self._syncing = []
+        # the OSError a sync failed with, the log is unusable from then on
+        self.failed = None
+        # segments to delete once the copies of their messages are synced
+        self._compacted = []
+
+        self.syncs = 0
+        self.synced_bytes = 0
+
+    # startup and shutdown
+
+    def open(self, loop=None):
+        """ Replays the existing segments and starts a new one to append to
+
+        Args:
+            loop: event loop that commits are scheduled on and callbacks
+                are run on. Without one commit() writes synchronously.
+        """
+        self.loop = loop
+        os.makedirs(self.directory, exist_ok=True)
+        for number in self._segment_numbers():
+            self._replay(number)
+
+        numbers = self._segment_numbers()
+        # finished segments found during replay can go straight away
+        for number in numbers:
+            if self.segments[number][0]:
+                break
+            del self.segments[number]
+            self._remove_file(number)
+
+        self._start_segment(max(numbers, default=0) + 1)
+        logger.info(f'Recovered {len(self.messages)} messages with '
+                    f'unfinished deliveries for {len(self.clients)} clients')
+
+    async def wait_synced(self):
+        """ Waits for a sync running in the background to finish """
+        while self._sync_future is not None:
+            try:
+                await asyncio.shield(self._sync_future)
+            except OSError:
+                # already handled by _sync_done()
+                pass
+
+    def close(self):
+        """ Syncs anything still buffered, call wait_synced() first if
+        commits are being made on a loop
+        """
+        if self._commit_handle is not None:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+        if self._file is None:
+            return
+        if self.failed is None:
+            self._sync(self._take_batch())
+        if self._commit_handle is not None:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+        self._file.close()
+        self._file = None
+
+    def _segment_numbers(self):
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                numbers.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(numbers)
+
+    def _path(self, number):
+        return os.path.join(
+            self.directory, f'{SEGMENT_PREFIX}{number:08d}{SEGMENT_SUFFIX}')
+
+    def _replay(self, number):
+        path = self._path(number)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        end = 0
+        self.segments[number] = [0, 0]
+        for offset, body in read_records(data):
+            end = offset + RECORD_HEADER.size + len(body)
+            if body[0] == MESSAGE:
+                self._replay_message(number, body)
+            elif body[0] == DELIVERY:
+                _, message_id, state, qos = DELIVERY_HEADER.unpack_from(body)
+                index = DELIVERY_HEADER.size
+                length = int.from_bytes(body[index:index + 2], 'big')
+                client_id = str(body[index + 2:index + 2 + length], 'utf-8')
+                message = self.messages.get(message_id)
+                if message is not None:
+                    self._set_state(message_id, message, client_id, state, qos)
+            else:
+                raise WriteAheadLogError(
+                    f'Unknown record type {body[0]} in {path}')
+
+        if end < len(data):
+            # a crash part way through a write, nothing after it was synced
+            logger.warning(f'Truncating {len(data) - end} bytes of torn '
+                           f'records from {path}')
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+
+    def _replay_message(self, number, body):
+        _, message_id, qos, retain = MESSAGE_HEADER.unpack_from(body)
+        index = MESSAGE_HEADER.size
+        length = int.from_bytes(body[index:index + 2], 'big')
+        topic = str(body[index + 2:index + 2 + length], 'utf-8')
+        index += 2 + length
+        length = int.from_bytes(body[index:index + 4], 'big')
+        payload = body[index + 4:index + 4 + length]
+
+        self.last_message_id = max(self.last_message_id, message_id)
+        message = self.messages.get(message_id)
+        if message is not None:
+            # a copy made by compaction, the old segment is being dropped
+            self._move(message, number)
+            return
+
+        frame = PublishFrame(topic, payload)
+        frame.message_id = message_id
+        message = LoggedMessage(frame, qos, bool(retain), number)
+        self.messages[message_id] = message
+        self.segments[number][0] += 1
+        self.segments[number][1] += 1
+
+    # appending
+
+    def _append(self, body):
+        if self.failed is not None:
+            # it would never be written
+            return
+        self._buffer.append(frame_record(body))
+
+    def log_message(self, frame, qos, retain, deliveries):
+        """ Logs a message and a QUEUED delivery for each subscriber
+
+        Args:
+            deliveries: (client id, qos) for every subscriber getting the
+                message at qos > 0
+
+        The message id is stored on the frame so acknowledgements can find
+        their way back to it.
+        """
+        self.last_message_id += 1
+        message_id = self.last_message_id
+        frame.message_id = message_id
+
+        message = LoggedMessage(frame, qos, retain, None)
+        self.messages[message_id] = message
+        self._unplaced.append(message)
+
+        self._append(encode_message(
+            message_id, qos, retain, frame.topic, frame.payload))
+        for client_id, delivery_qos in deliveries:
+            self._append(encode_delivery(
+                message_id, client_id, QUEUED, delivery_qos))
+            self._set_state(message_id, message, client_id, QUEUED,
+                            delivery_qos)
+
+    def update(self, message_id, client_id, state):
+        """ Logs a delivery moving on to RECEIVED or DONE """
+        message = self.messages.get(message_id)
+        delivery = message.deliveries.get(client_id) if message else None
+        if delivery is None:
+            return
+        qos = delivery[1]
+        self._append(encode_delivery(message_id, client_id, state, qos))
+        self._set_state(message_id, message, client_id, state, qos)
+        # nobody waits on these, losing one only means a duplicate delivery
+        self.commit()
+
+    def discard(self, client_id):
+        """ Finishes every delivery to a client, e.g. when its session ends """
+        for message_id, message in list(self.clients.get(client_id, {}).items()):
+            qos = message.deliveries[client_id][1]
+            self._append(encode_delivery(message_id, client_id, DONE, qos))
+            self._set_state(message_id, message, client_id, DONE, qos)
+        self.commit()
+
+    def pending(self, client_id):
+        """ Unfinished deliveries to a client, oldest first
+
+        Returns:
+            list of (PublishFrame, qos, state), qos being the qos the
+            message is delivered to this client at
+        """
+        messages = self.clients.get(client_id)
+        if not messages:
+            return []
+        pending = []
+        for _, message in sorted(messages.items()):
+            state, qos = message.deliveries[client_id]
+            pending.append((message.frame, qos, state))
+        return pending
+
+    def _set_state(self, message_id, message, client_id, state, qos):
+        if state != DONE:
+            message.deliveries[client_id] = (state, qos)
+            self.clients.setdefault(client_id, {})[message_id] = message
+            return
+
+        if message.deliveries.pop(client_id, None) is None:
+            return
+        client = self.clients.get(client_id)
+        if client is not None:
+            client.pop(message_id, None)
+            if not client:
+                del self.clients[client_id]
+
+        if not message.deliveries:
+            del self.messages[message_id]
+            self._release(message.segment)
+
+    def _release(self, number):
+        counts = self.segments.get(number)
+        if counts is None:
+            return
+        counts[0] -= 1
+        if number == min(self.segments):
+            self._trim()
+
+    def _move(self, message, number):
+        if message.segment is not None:
+            self.segments[message.segment][0] -= 1
+        message.segment = number
+        self.segments[number][0] += 1
+        self.segments[number][1] += 1
+
+    # compaction
+
+    def _trim(self):
+        """ Drops closed segments from the oldest up while they're finished
+        or mostly finished. Their files are deleted once any live messages
+        copied out of them are synced.
+        """
+        if self._file is None:
+            return
+        trimmed = False
+        while True:
+            oldest = min(self.segments)
+            if oldest == self._segment:
+                break
+            live, written = self.segments[oldest]
+            if live and live >= written * self.compact_ratio:
+                break
+            if live:
+                self._copy_live(oldest)
+            del self.segments[oldest]
+            self._compacted.append(oldest)
+            trimmed = True
+        if trimmed:
+            self.commit()
+
+    def _copy_live(self, number):
+        for message_id, message in self.messages.items():
+            if message.segment != number:
+                continue
+            frame = message.frame
+            self._append(encode_message(
+                message_id, message.qos, message.retain, frame.topic,
+                frame.payload))
+            for client_id, (state, qos) in message.deliveries.items():
+                self._append(encode_delivery(message_id, client_id, state, qos))
+            message.segment = None
+            self._unplaced.append(message)
+
+    def _remove_file(self, number):
+        try:
+            os.remove(self._path(number))
+        except FileNotFoundError:
+            pass
+
+    # group commit
+
+    def commit(self, callback=None, errback=None):
+        """ Asks for everything appended so far to be made durable
+
+        Args:
+            callback: called, on the loop, once it has been synced
+            errback: called instead if the sync fails, or straight away if
+                one already has
+        """
+        if self.failed is not None:
+            self._fail([(callback, errback)])
+            return
+        if callback is not None or errback is not None:
+            self._waiters.append((callback, errback))
+
+        if self.loop is None:
+            self._finish(self._sync(self._take_batch()))
+            return
+
+        if self._commit_handle is None and self._sync_future is None:
+            self._commit_handle = self.loop.call_later(
+                self.commit_window, self._start_sync)
+
+    def _take_batch(self):
+        """ Hands the buffered records over to be written, only ever called
+        on the loop while no sync is running
+        """
+        if self._segment_size >= self.segment_bytes:
+            self._roll()
+
+        # messages belong to the segment their record is written to
+        for message in self._unplaced:
+            if message.segment is None and message.deliveries:
+                self._move(message, self._segment)
+        self._unplaced = []
+
+        batch = (self._buffer, self._waiters, self._compacted)
+        self._buffer = []
+        self._waiters = []
+        self._compacted = []
+        return batch
+
+    def _start_sync(self):
+        self._commit_handle = None
+        if not (self._buffer or self._waiters or self._compacted):
+            return
+        batch = self._take_batch()
+        self._syncing = batch[1]
+        self._sync_future = self.loop.run_in_executor(None, self._sync, batch)
+        self._sync_future.add_done_callback(self._sync_done)
+
+    def _sync_done(self, future):
+        syncing = self._syncing
+        self._sync_future = None
+        self._syncing = []
+        try:
+            waiters = future.result()
+        except OSError as e:
+            # without a working log nothing can be acknowledged safely,
+            # neither what was being synced nor anything since
+            logger.critical(f'Write-ahead log sync failed: {e}')
+            self.failed = e
+            waiters = syncing + self._waiters
+            self._buffer = []
+            self._waiters = []
+            self._fail(waiters)
+            return
+        self._finish(waiters)
+
+        # commits that came in while we were syncing
+        if self._buffer or self._waiters or self._compacted:
+            self._commit_handle = self.loop.call_later(
+                self.commit_window, self._start_sync)
+
+    def _finish(self, waiters):
+        for callback, _ in waiters:
+            if callback is None:
+                continue
+            try:
+                callback()
+            except Exception as e:
+                logger.exception(e)
+
+    def _fail(self, waiters):
+        for _, errback in waiters:
+            if errback is None:
+                continue
+            try:
+                errback()
+            except Exception as e:
+                logger.exception(e)
+
+    def _sync(self, batch):
+        """ Writes and fsyncs one batch, runs in a worker thread """
+        records, waiters, compacted = batch
+        if records:
+            data = b''.join(records)
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.syncs += 1
+            self.synced_bytes += len(data)
+            self._segment_size += len(data)
+
+        # the copies are durable, the old segments can go
+        for number in compacted:
+            self._remove_file(number)
+        return waiters
+
+    def _roll(self):
+        self._file.close()
+        self._start_segment(self._segment + 1)
+        self._trim()
+
+    def _start_segment(self, number):
+        self._segment = number
+        self._segment_size = 0
+        self.segments[number] = [0, 0]
+        self._file = open(self._path(number), 'ab')
+
+    def stats(self):
+        return {
+            'messages': len(self.messages),
+            'clients': len(self.clients),
+            'segments': len(self.segments),
+            'syncs': self.syncs,
+            'synced_bytes': self.synced_bytes,
+        }
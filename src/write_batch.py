@@ -0,0 +1,72 @@
+"""
+Write batching shared by the broker's asyncio protocols, client connections
+(see mqtt_connection.py) and links to other brokers (see peer_link.py).
+
+Frames sent during one event loop iteration are gathered and written with a
+single writelines() call at the end of it, so a burst of deliveries costs
+one vectored send rather than one per frame. A batch is written straight
+away once it reaches batch_bytes, and a batch_delay holds batches open for
+longer, trading latency for fewer, bigger writes.
+"""
+
+
+class BatchedWriter:
+    """ Mixin for a protocol whose transport attribute is None once the
+    connection is lost. init_write_batch() is called from __init__ and
+    cancel_flush() from connection_lost().
+    """
+
+    def init_write_batch(self, loop, batch_bytes, batch_delay=0):
+        self._batch_loop = loop
+        self.batch_bytes = batch_bytes
+        self.batch_delay = batch_delay
+        # frames gathered this loop iteration
+        self.pending = []
+        self.pending_bytes = 0
+        self._flush_handle = None
+
+    def send_buffers(self, buffers):
+        """ Adds frames to the pending batch, written at the end of the
+        current loop iteration or as soon as it reaches batch_bytes
+        """
+        if self.transport is None:
+            return
+
+        self.pending.extend(buffers)
+        for buffer in buffers:
+            self.pending_bytes += len(buffer)
+
+        if self.pending_bytes >= self.batch_bytes:
+            self.flush()
+        elif self._flush_handle is None:
+            if self.batch_delay:
+                self._flush_handle = self._batch_loop.call_later(
+                    self.batch_delay, self.flush)
+            else:
+                self._flush_handle = self._batch_loop.call_soon(self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self.pending or self.transport is None:
+            return
+
+        pending = self.pending
+        self.batch_written(self.pending_bytes)
+        self.pending = []
+        self.pending_bytes = 0
+        # one vectored send for everything gathered this tick
+        self.transport.writelines(pending)
+
+    def cancel_flush(self):
+        """ Drops the pending batch, for a connection that's gone """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.pending = []
+        self.pending_bytes = 0
+
+    def batch_written(self, nbytes):
+        """ Called with the size of every batch as it's written """
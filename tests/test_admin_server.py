@@ -0,0 +1,106 @@
+import asyncio
+import json
+import urllib.error
+import urllib.request
+
+from admin_server import prometheus_text, latency_summaries
+from mqtt_server import MQTTServer
+from packet_generator import PacketGenerator
+
+
+def fetch(port, path):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}{path}', timeout=5) as response:
+        return response.headers['Content-Type'], response.read()
+
+
+def test_prometheus_text():
+    text = prometheus_text({
+        'clients/connected': 3,
+        'bytes/received': 100,
+        'clients/total': 5,
+        'packets/received/publish': 7,
+        'packets/received/connect': 3,
+    })
+    lines = text.splitlines()
+    assert '# TYPE mqtt_clients_connected gauge' in lines
+    assert 'mqtt_clients_connected 3' in lines
+    assert 'mqtt_bytes_received_total 100' in lines
+    assert '# TYPE mqtt_clients_total counter' in lines
+    assert 'mqtt_clients_total 5' in lines
+    assert not [line for line in lines if '_total_total' in line]
+    assert 'mqtt_packets_received_total{type="publish"} 7' in lines
+    assert 'mqtt_packets_received_total{type="connect"} 3' in lines
+
+
+def test_admin_endpoint():
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0, admin_port=0)
+        await server.start()
+        loop = asyncio.get_running_loop()
+
+        async def get(path):
+            # urllib blocks, and the endpoint needs the loop to answer
+            return await loop.run_in_executor(None, fetch, server.admin_port, path)
+
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            pg = PacketGenerator(None)
+            writer.write(pg.create_connect_packet(client_id='sensor').raw_bytes)
+            await reader.readexactly(4)
+            writer.write(pg.create_subscribe_packet('$share/g/x', 0).raw_bytes)
+            await reader.readexactly(5)
+            for _ in range(3):
+                writer.write(pg.create_publish_packet('hot', b'1', 0, False).raw_bytes)
+            writer.write(pg.create_publish_packet('cold', b'1', 0, False).raw_bytes)
+            await asyncio.sleep(0.05)
+            # close the rate window now rather than waiting for it
+            server.metrics.topic_rates.rotate()
+
+            content_type, body = await get('/metrics')
+            assert content_type.startswith('text/plain')
+            lines = body.decode().splitlines()
+            assert 'mqtt_clients_connected 1' in lines
+            assert 'mqtt_clients_total 1' in lines
+            assert 'mqtt_packets_received_total{type="publish"} 4' in lines
+            assert not [line for line in lines if '_total_total' in line]
+
+            _, body = await get('/api/stats')
+            assert json.loads(body)['packets/received/publish'] == 4
+
+            _, body = await get('/api/clients?limit=5')
+            clients = json.loads(body)
+            assert clients['connected'] == 1
+            assert clients['clients'][0]['client_id'] == 'sensor'
+            assert clients['clients'][0]['subscriptions'] == 1
+
+            _, body = await get('/api/subscriptions')
+            assert json.loads(body)['shared_groups'] == {'$share/g/x': 1}
+
+            _, body = await get('/api/topics')
+            topics = json.loads(body)['topics']
+            assert [topic['topic'] for topic in topics] == ['hot', 'cold']
+
+            _, body = await get('/api/latency')
+            assert json.loads(body)['handle/publish']['count'] == 4
+
+            try:
+                await get('/nope')
+                assert False, 'expected a 404'
+            except urllib.error.HTTPError as e:
+                assert e.code == 404
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_latency_summaries_exported():
+    server = MQTTServer()
+    server.metrics.route_latency.record(2000)
+    stats = server.metrics.snapshot(server)
+    text = prometheus_text(stats, latency_summaries(server.metrics))
+    lines = text.splitlines()
+    assert '# TYPE mqtt_latency_seconds summary' in lines
+    assert 'mqtt_latency_seconds{name="route",quantile="0.99"} 0.000002000' in lines
+    assert 'mqtt_latency_seconds_count{name="route"} 1' in lines
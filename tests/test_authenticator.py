@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+from authenticator import (
+    Authenticator, AuthenticatorError, hash_password, verify_password,
+    load_password_file, save_password_file, PBKDF2_SHA256, SCRYPT)
+
+# cheap parameters, the defaults are slow on purpose
+FAST = {'iterations': 1000}
+
+
+def test_hash_and_verify_pbkdf2():
+    encoded = hash_password('secret', PBKDF2_SHA256, **FAST)
+    assert encoded.startswith('pbkdf2_sha256$1000$')
+    assert verify_password('secret', encoded)
+    assert verify_password(b'secret', encoded)
+    assert not verify_password('wrong', encoded)
+    # salted, the same password hashes differently each time
+    assert hash_password('secret', **FAST) != encoded
+
+
+def test_hash_and_verify_scrypt():
+    encoded = hash_password('secret', SCRYPT, n=2 ** 8, r=8, p=1)
+    assert encoded.startswith('scrypt$256$8$1$')
+    assert verify_password('secret', encoded)
+    assert not verify_password('wrong', encoded)
+
+
+def test_malformed_hash():
+    with pytest.raises(AuthenticatorError):
+        verify_password('secret', 'md5$abc')
+    with pytest.raises(AuthenticatorError):
+        verify_password('secret', 'pbkdf2_sha256$x$y')
+
+
+def test_password_file_round_trip(tmp_path):
+    path = str(tmp_path / 'passwords')
+    users = {'device-1': hash_password('a', **FAST), 'user:with:colons': hash_password('b', **FAST)}
+    save_password_file(path, users)
+    with open(path, 'a') as f:
+        f.write('\n# a comment\n')
+    assert load_password_file(path) == users
+
+    with open(path, 'a') as f:
+        f.write('no separator\n')
+    with pytest.raises(AuthenticatorError):
+        load_password_file(path)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_authenticate():
+    authenticator = Authenticator(users={'device': hash_password('secret', **FAST)})
+
+    async def test():
+        assert await authenticator.authenticate('device', b'secret')
+        assert not await authenticator.authenticate('device', b'wrong')
+        assert not await authenticator.authenticate('nobody', b'secret')
+        assert not await authenticator.authenticate('device', None)
+        assert not await authenticator.authenticate(None, None)
+
+    run(test())
+    assert authenticator.stats()['verified'] == 1
+    assert authenticator.stats()['failures'] == 2
+    authenticator.close()
+
+
+def test_successful_checks_cached():
+    authenticator = Authenticator(users={'device': hash_password('secret', **FAST)})
+
+    async def test():
+        assert await authenticator.authenticate('device', b'secret')
+        assert await authenticator.authenticate('device', b'secret')
+        # a cached success doesn't let a different password in
+        assert not await authenticator.authenticate('device', b'wrong')
+        assert await authenticator.authenticate('device', b'secret')
+
+    run(test())
+    stats = authenticator.stats()
+    assert stats['cache_hits'] == 1
+    assert stats['verified'] == 2
+    authenticator.close()
+
+
+def test_cache_expiry_and_size():
+    users = {f'd{i}': hash_password('secret', **FAST) for i in range(3)}
+    authenticator = Authenticator(users=users, cache_ttl=0.05, cache_size=2)
+
+    async def test():
+        for i in range(3):
+            assert await authenticator.authenticate(f'd{i}', b'secret')
+        assert list(authenticator.cache) == ['d1', 'd2']
+        await asyncio.sleep(0.1)
+        assert await authenticator.authenticate('d2', b'secret')
+
+    run(test())
+    assert authenticator.stats()['cache_hits'] == 0
+    authenticator.close()
+
+
+def test_concurrent_checks_share_one_run():
+    authenticator = Authenticator(users={'device': hash_password('secret', **FAST)})
+    runs = []
+    verify = authenticator._verify
+    authenticator._verify = lambda *args: runs.append(1) or verify(*args)
+
+    async def test():
+        results = await asyncio.gather(*(
+            authenticator.authenticate('device', b'secret') for _ in range(20)))
+        assert all(results)
+
+    run(test())
+    assert len(runs) == 1
+    authenticator.close()
+
+
+def test_reload(tmp_path):
+    path = str(tmp_path / 'passwords')
+    save_password_file(path, {'device': hash_password('old', **FAST)})
+    authenticator = Authenticator(path)
+
+    async def test():
+        assert await authenticator.authenticate('device', b'old')
+        save_password_file(path, {'device': hash_password('new', **FAST)})
+        authenticator.reload()
+        assert not await authenticator.authenticate('device', b'old')
+        assert await authenticator.authenticate('device', b'new')
+
+    run(test())
+    authenticator.close()
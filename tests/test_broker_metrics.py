@@ -0,0 +1,50 @@
+from broker_metrics import BrokerMetrics, TopicRates
+from mqtt_server import MQTTServer
+
+
+def test_packet_counters():
+    metrics = BrokerMetrics()
+    metrics.packet_received(0x30, 10)
+    metrics.packet_received(0x30, 20)
+    metrics.packet_received(0xC0, 2)
+    metrics.packet_sent(0xD0, 2)
+    snapshot = metrics.snapshot(MQTTServer())
+    assert snapshot['publish/messages/received'] == 2
+    assert snapshot['publish/bytes/received'] == 30
+    assert snapshot['messages/received'] == 3
+    assert snapshot['packets/received/pingreq'] == 1
+    assert snapshot['packets/sent/pingresp'] == 1
+    assert snapshot['packets/bytes/sent/pingresp'] == 2
+
+
+def test_gauges_read_from_server():
+    server = MQTTServer()
+    server.add_new_subscription('a/b', 'c1')
+    server.add_new_subscription('$share/g/a/+', 'c2')
+    server.retained.set('a/b', b'x')
+    snapshot = server.metrics.snapshot(server)
+    assert snapshot['clients/connected'] == 0
+    assert snapshot['subscriptions/count'] == 1
+    assert snapshot['subscriptions/shared/groups'] == 1
+    assert snapshot['retained messages/count'] == 1
+
+
+def test_maximum_connections():
+    metrics = BrokerMetrics()
+    for connected in (1, 2, 3, 2, 1):
+        metrics.client_connected(connected)
+    assert metrics.connections_total == 5
+    assert metrics.connections_maximum == 3
+
+
+def test_topic_rates():
+    rates = TopicRates(window=2, max_topics=2)
+    for topic in ['a'] * 6 + ['b'] * 2 + ['c']:
+        rates.record(topic)
+    # nothing until the window is complete
+    assert rates.top() == []
+    rates.rotate()
+    assert rates.top() == [('a', 3.0), ('b', 1.0)]
+    assert rates.top(1) == [('a', 3.0)]
+    # 'c' came after the table was full
+    assert rates.previous_untracked == 1
@@ -0,0 +1,44 @@
+from client_registry import ClientRegistry
+
+
+class Connection:
+    def __init__(self, client_id):
+        self.client_id = client_id
+
+
+def test_register_and_get():
+    registry = ClientRegistry()
+    a = Connection('a')
+    assert registry.register(a) is None
+    assert registry.get('a') is a
+    assert registry.get('b') is None
+    assert 'a' in registry
+    assert list(registry) == [a]
+
+
+def test_register_returns_connection_taken_over():
+    registry = ClientRegistry()
+    old, new = Connection('a'), Connection('a')
+    registry.register(old)
+    assert registry.register(new) is old
+    assert registry.get('a') is new
+    # registering the same connection again isn't a takeover
+    assert registry.register(new) is None
+
+
+def test_unregister_ignores_connection_taken_over():
+    registry = ClientRegistry()
+    old, new = Connection('a'), Connection('a')
+    registry.register(old)
+    registry.register(new)
+    assert not registry.unregister(old)
+    assert registry.get('a') is new
+    assert registry.unregister(new)
+    assert len(registry) == 0
+
+
+def test_assign_id_skips_ids_in_use():
+    registry = ClientRegistry(prefix='auto')
+    registry.register(Connection('auto-1'))
+    assert registry.assign_id() == 'auto-2'
+    assert registry.assign_id() == 'auto-3'
@@ -0,0 +1,86 @@
+import pytest
+
+from frame_decoder import FrameDecoder, FrameDecoderError
+from packet_generator import PacketGenerator
+
+
+def publish(topic, payload):
+    return PacketGenerator(None).create_publish_packet(topic, payload, 0, False).raw_bytes
+
+
+def receive(decoder, data):
+    buffer = decoder.get_buffer()
+    buffer[:len(data)] = data
+    del buffer
+    decoder.buffer_updated(len(data))
+    return [bytes(frame) for frame in decoder.frames()]
+
+
+def test_single_frame():
+    decoder = FrameDecoder()
+    assert receive(decoder, b'\xc0\x00') == [b'\xc0\x00']
+    assert len(decoder) == 0
+
+
+def test_several_frames_in_one_read():
+    decoder = FrameDecoder()
+    data = b'\x40\x02\x00\x01' + b'\xd0\x00' + publish('a', 'b')
+    assert receive(decoder, data) == [
+        b'\x40\x02\x00\x01', b'\xd0\x00', publish('a', 'b')]
+
+
+def test_frame_split_byte_by_byte():
+    decoder = FrameDecoder()
+    frame = publish('topic', 'x' * 300)  # two byte remaining length
+    frames = []
+    for i in range(len(frame)):
+        frames += receive(decoder, frame[i:i + 1])
+    assert frames == [frame]
+
+
+def test_frame_larger_than_buffer():
+    decoder = FrameDecoder(buffer_size=64, min_read=16)
+    frame = publish('big', 'y' * 5000)
+    decoder.feed(frame)
+    assert [bytes(f) for f in decoder.frames()] == [frame]
+
+
+def test_frames_are_read_only_memoryviews():
+    decoder = FrameDecoder()
+    decoder.feed(b'\xc0\x00')
+    frame = next(decoder.frames())
+    assert isinstance(frame, memoryview)
+    assert frame.readonly
+
+
+def test_retained_frames_are_not_overwritten():
+    decoder = FrameDecoder(buffer_size=64, min_read=32)
+    decoder.feed(publish('a', 'first'))
+    kept = next(decoder.frames())
+    for _ in range(20):
+        decoder.feed(publish('a', 'other data'))
+        list(decoder.frames())
+    assert bytes(kept) == publish('a', 'first')
+
+
+def test_buffer_reused_when_frames_released():
+    decoder = FrameDecoder(buffer_size=64, min_read=32)
+    buffer = decoder._buffer
+    for _ in range(20):
+        decoder.feed(publish('a', 'some data'))
+        assert len(list(decoder.frames())) == 1
+    assert decoder._buffer is buffer
+
+
+def test_max_packet_size():
+    decoder = FrameDecoder(max_packet_size=100)
+    decoder.feed(publish('a', 'z' * 200)[:4])
+    with pytest.raises(FrameDecoderError):
+        list(decoder.frames())
+
+
+def test_malformed_remaining_length():
+    decoder = FrameDecoder()
+    decoder.feed(b'\x30\xff\xff\xff\xff\x01')
+    with pytest.raises(FrameDecoderError):
+        list(decoder.frames())
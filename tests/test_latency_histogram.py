@@ -0,0 +1,69 @@
+import random
+
+from latency_histogram import LatencyHistogram, format_histograms
+
+
+def test_small_values_are_exact():
+    histogram = LatencyHistogram()
+    for value in range(64):
+        histogram.record(value)
+    assert histogram.percentile(50) == 31
+    assert histogram.percentile(100) == 63
+    assert histogram.min == 0 and histogram.max == 63
+
+
+def test_percentiles_within_precision():
+    histogram = LatencyHistogram()
+    values = [random.randint(1, 10**9) for _ in range(10000)]
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    for percentile in (50, 90, 99, 99.9):
+        exact = values[int(len(values) * percentile / 100) - 1]
+        reported = histogram.percentile(percentile)
+        # never under-reported, and within a bucket's width
+        assert exact <= reported <= exact * 1.04
+    assert histogram.percentiles((50, 99)) == {
+        50: histogram.percentile(50), 99: histogram.percentile(99)}
+
+
+def test_buckets_are_contiguous():
+    histogram = LatencyHistogram(max_value=10**6)
+    previous = -1
+    for value in range(10**5):
+        index = histogram._index(value)
+        assert index in (previous, previous + 1)
+        assert value <= histogram._upper(index)
+        previous = index
+
+
+def test_clamps_out_of_range_values():
+    histogram = LatencyHistogram(max_value=1000)
+    histogram.record(10**9)
+    histogram.record(-5)
+    assert histogram.max == 1000 and histogram.min == 0
+    assert histogram.count == 2
+
+
+def test_merge_and_reset():
+    a, b = LatencyHistogram(), LatencyHistogram()
+    for value in range(100):
+        a.record(value)
+        b.record(value + 1000)
+    a.merge(b)
+    assert a.count == 200 and a.min == 0 and a.max == 1099
+    assert a.percentile(50) < 1000 < a.percentile(51)
+    a.reset()
+    assert a.count == 0 and a.percentile(99) == 0
+
+
+def test_stats_and_format():
+    histogram = LatencyHistogram()
+    for value in (1000, 2000, 3000):
+        histogram.record(value)
+    stats = histogram.stats()
+    assert stats['count'] == 3
+    assert stats['mean_us'] == 2.0
+    assert stats['max_us'] == 3.0
+    table = format_histograms({'route': histogram, 'empty': LatencyHistogram()})
+    assert 'route' in table and 'empty' not in table
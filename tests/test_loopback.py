@@ -0,0 +1,126 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from loopback import EmbeddedBroker, LoopbackSocket, LoopbackError
+from mqtt_client import MQTTClient
+from packet_generator import PacketGenerator
+
+CONNACK_ACCEPTED = b'\x20\x02\x00\x00'
+
+
+@pytest.fixture
+def broker():
+    with EmbeddedBroker('test', sys_interval=0) as broker:
+        yield broker
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def connected_client(client_id):
+    client = MQTTClient('loopback://test', 0, client_id)
+    client.connect()
+    assert client.connected
+    client.start_loop()
+    return client
+
+
+def test_publish_and_subscribe(broker):
+    received = []
+    subscriber = connected_client('sub')
+    subscriber.set_on_message_callback(lambda topic, payload: received.append((topic, payload)))
+    subscriber.subscribe('sensors/#', 1)
+    assert wait_for(lambda: broker.call(lambda: len(broker.server.topics)) == 1)
+
+    publisher = connected_client('pub')
+    publisher.publish('sensors/a', 'hello', 0)
+    publisher.publish('sensors/b', 42, 1)
+    assert wait_for(lambda: len(received) == 2)
+    # payloads arrive as they would have over tcp
+    assert received == [('sensors/a', 'hello'), ('sensors/b', '42')]
+
+    # binary payloads go through untouched
+    publisher.publish('sensors/c', b'\xff\x00\x01', 1)
+    assert wait_for(lambda: len(received) == 3)
+    assert received[2] == ('sensors/c', b'\xff\x00\x01')
+
+    metrics = broker.server.metrics
+    published, decoded = broker.call(
+        lambda: (metrics.packets_received[3], metrics.decode_latency.count))
+    # the publishes were routed as MQTTPackets, never decoded
+    assert published == 3
+    assert decoded == 0
+
+
+def test_publish_to_wildcard_topic_disconnects(broker):
+    disconnected = threading.Event()
+    client = connected_client('pub')
+    client.set_on_disconnect_callback(disconnected.set)
+    client.publish('sensors/#', 'x', 0, retain=True)
+    assert disconnected.wait(2)
+    assert broker.call(lambda: len(broker.server.retained)) == 0
+
+
+def test_stop_disconnects_clients():
+    with EmbeddedBroker('test', sys_interval=0):
+        disconnected = threading.Event()
+        client = connected_client('client')
+        client.set_on_disconnect_callback(disconnected.set)
+    assert disconnected.wait(2)
+    assert not client.connected
+
+
+def test_unknown_broker_refuses():
+    client = MQTTClient('loopback://nowhere', 0)
+    client.connect(timeout=0)
+    assert not client.connected
+
+
+def test_names_are_unique(broker):
+    with pytest.raises(LoopbackError):
+        EmbeddedBroker('test').start()
+
+
+def test_socket_takes_partial_packets(broker):
+    sock = LoopbackSocket()
+    sock.settimeout(2)
+    sock.connect('test')
+    connect = PacketGenerator(None).create_connect_packet(client_id='raw').raw_bytes
+    sock.send(connect[:5])
+    sock.sendall(connect[5:])
+    assert sock.recv(4) == CONNACK_ACCEPTED
+    sock.close()
+    assert wait_for(lambda: broker.call(lambda: len(broker.server.clients)) == 0)
+
+
+def test_socket_flow_control():
+    drained = []
+    sock = LoopbackSocket()
+    sock.transport = SimpleNamespace(
+        loop=SimpleNamespace(call_soon_threadsafe=lambda function: drained.append(function)),
+        reader_drained='drained')
+    sock.set_limits(high=10, low=4)
+
+    assert not sock.feed(b'x' * 10)
+    # over the high mark the broker is told to stop, once
+    assert sock.feed(b'x' * 10)
+    assert not sock.feed(b'x')
+
+    buffer = bytearray(16)
+    assert sock.recv_into(buffer) == 16
+    assert drained == []
+    assert sock.recv_into(buffer, 1) == 1
+    assert drained == ['drained']
+
+    sock.feed_eof()
+    assert sock.recv_into(buffer) == 4
+    assert sock.recv_into(buffer) == 0
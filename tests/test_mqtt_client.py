@@ -65,3 +65,77 @@ def test_connected_property(mock_connection):
     client = MQTTClient('localhost', 1883)
     client.connection.connected = True
     assert client.connected is True
+
+
+def test_latency_stats_calls_connection(mock_connection):
+    client = MQTTClient('localhost', 1883)
+    client.connection.latency_stats = MagicMock(return_value={})
+    assert client.latency_stats() == {}
+
+
+def test_publish_round_trip_recorded():
+    from mqtt_client_connection import MQTTClientConnection
+
+    connection = MQTTClientConnection('localhost', 1883, 'rtt')
+    try:
+        connection.publish_times[1] = 0
+        connection.process_frame(b'\x40\x02\x00\x01')
+        stats = connection.latency_stats()
+        assert stats['publish_rtt/qos1']['count'] == 1
+        assert stats['decode/puback']['count'] == 1
+        assert 1 not in connection.publish_times
+        assert 'publish_rtt/qos1' in connection.dump_latency()
+        # histograms are built up front, not looked up per packet
+        assert connection.decode_latency[4] is connection.latency['decode/puback']
+        assert 'decode/publish' not in stats
+    finally:
+        connection.conn.close()
+
+
+def test_latency_not_tracked():
+    from mqtt_client_connection import MQTTClientConnection
+
+    connection = MQTTClientConnection('localhost', 1883, 'quiet', track_latency=False)
+    try:
+        connection.process_frame(b'\x40\x02\x00\x01')
+        assert connection.decode_latency is None
+        assert connection.latency_stats() == {}
+    finally:
+        connection.conn.close()
+
+
+def test_connack_split_across_reads():
+    import socket
+    import threading
+    import time
+    from mqtt_client_connection import MQTTClientConnection
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    publish = b'\x30\x05\x00\x01ahi'
+
+    def serve():
+        conn, _ = listener.accept()
+        conn.recv(1024)
+        conn.sendall(b'\x20\x02')
+        time.sleep(0.05)
+        # the rest of the CONNACK with a PUBLISH straight behind it
+        conn.sendall(b'\x00\x00' + publish)
+        time.sleep(0.1)
+        conn.close()
+
+    server = threading.Thread(target=serve)
+    server.start()
+    connection = MQTTClientConnection(
+        '127.0.0.1', listener.getsockname()[1], 'split', keep_alive=0)
+    try:
+        connection.connect(1)
+        assert connection.connected
+        # kept for the receive loop
+        assert bytes(next(connection.decoder.frames())) == publish
+    finally:
+        connection.messages.stop_retry_thread()
+        connection.conn.close()
+        server.join()
+        listener.close()
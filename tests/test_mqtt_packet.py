@@ -1,4 +1,5 @@
-from mqtt_packet import MQTTPacket
+from mqtt_packet import MQTTPacket, PublishPacket, AckPacket, UNDECODED
+from packet_validator import PacketValidator
 import packets
 import pytest
 
@@ -75,3 +76,61 @@ def test_send_no_send_func():
     pkt = MQTTPacket(0x30, b'\x30\x00')
     # Should not raise
     pkt.send()
+
+
+def received_publish(raw):
+    return PacketValidator(None).validate_packet(memoryview(raw).toreadonly())
+
+
+def test_received_publish_decoded_on_first_read():
+    # qos 1, retain, topic 'a/b', packet id 7, payload 'hi'
+    pkt = received_publish(b'\x33\x09\x00\x03a/b\x00\x07hi')
+    assert isinstance(pkt, PublishPacket)
+    assert pkt._topic is UNDECODED
+    assert pkt._payload is UNDECODED
+    assert pkt.qos == 1
+    assert pkt.retain is True
+    assert pkt.packet_id == 7
+
+    assert pkt.topic == 'a/b'
+    assert pkt.payload == 'hi'
+    assert pkt._topic == 'a/b'
+    assert pkt.data == {'topic': 'a/b', 'payload': 'hi', 'qos': 1,
+                        'dup': False, 'retain': True, 'packet_id': 7}
+
+
+def test_received_publish_binary_payload():
+    pkt = received_publish(b'\x30\x05\x00\x01t\xff\xfe')
+    assert pkt.packet_id is None
+    assert pkt.topic == 't'
+    assert pkt.payload == b'\xff\xfe'
+    assert isinstance(pkt.payload, bytes)
+
+
+def test_packets_have_no_dict():
+    publish = PublishPacket(0x30, b'\x30\x05\x00\x01tab', 2, 5)
+    ack = AckPacket(0x40, b'\x40\x02\x00\x01', 1)
+    for pkt in (MQTTPacket(0x30, b'\x30\x00'), publish, ack):
+        assert not hasattr(pkt, '__dict__')
+    assert publish.payload == 'ab'
+
+
+def test_received_ack():
+    pkt = PacketValidator(None).validate_packet(b'\x40\x02\x01\x02')
+    assert isinstance(pkt, AckPacket)
+    assert pkt.packet_id == 258
+    assert pkt.data == {'packet_id': 258}
+    assert "AckPacket" in str(pkt)
+
+
+def test_data_is_kept():
+    pkt = received_publish(b'\x32\x08\x00\x03a/b\x00\x07h')
+    assert pkt.data is pkt.data
+    pkt.data['received'] = 1
+    assert pkt.data['received'] == 1
+    pkt.set_dup_bit()
+    assert pkt.data['dup'] is True
+
+    ack = AckPacket(0x40, b'\x40\x02\x00\x01', 1)
+    ack.data['extra'] = True
+    assert ack.data == {'packet_id': 1, 'extra': True}
@@ -0,0 +1,1144 @@
+import asyncio
+import socket
+import pytest
+
+import packets
+from mqtt_server import MQTTServer
+from outbound_queue import DISCONNECT
+from peer_link import encode_filters
+from packet_generator import PacketGenerator, encode_remaining_length
+
+
+async def open_client(port, client_id):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    pg = PacketGenerator(send_func=None)
+    writer.write(pg.create_connect_packet(client_id=client_id).raw_bytes)
+    connack = await asyncio.wait_for(reader.readexactly(4), 1)
+    assert connack == b'\x20\x02\x00\x00'
+    return reader, writer, pg
+
+
+async def read_packet(reader):
+    header = await asyncio.wait_for(reader.readexactly(2), 1)
+    remaining_length = header[1]
+    return header + await reader.readexactly(remaining_length)
+
+
+def run_with_server(test):
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0)
+        await server.start()
+        try:
+            await test(server)
+        finally:
+            await server.stop()
+    asyncio.run(runner())
+
+
+def test_connect_is_acknowledged():
+    async def test(server):
+        _, writer, _ = await open_client(server.port, 'client-a')
+        await asyncio.sleep(0.01)
+        assert [c.client_id for c in server.clients] == ['client-a']
+        writer.close()
+
+    run_with_server(test)
+
+
+def test_first_packet_must_be_connect():
+    async def test(server):
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        writer.write(PacketGenerator(None).create_publish_packet(
+            'a', 'b', 0, False).raw_bytes)
+        assert await asyncio.wait_for(reader.read(), 1) == b''
+        assert len(server.clients) == 0
+
+    run_with_server(test)
+
+
+def test_connect_split_across_reads():
+    async def test(server):
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        raw = PacketGenerator(None).create_connect_packet(
+            client_id='slow').raw_bytes
+        for i in range(len(raw)):
+            writer.write(raw[i:i + 1])
+            await writer.drain()
+        assert await asyncio.wait_for(reader.readexactly(4), 1) == b'\x20\x02\x00\x00'
+        writer.close()
+
+    run_with_server(test)
+
+
+def test_publish_routed_to_subscriber():
+    async def test(server):
+        sub_reader, sub_writer, sub_pg = await open_client(server.port, 'sub')
+        sub_writer.write(sub_pg.create_subscribe_packet('a/b', 0).raw_bytes)
+        suback = await read_packet(sub_reader)
+        assert suback[0] == 0x90
+
+        _, pub_writer, pub_pg = await open_client(server.port, 'pub')
+        pub_writer.write(pub_pg.create_publish_packet(
+            'a/b', 'hello', 0, False).raw_bytes)
+
+        publish = await read_packet(sub_reader)
+        assert publish == b'\x30\x0a\x00\x03a/bhello'
+        sub_writer.close()
+        pub_writer.close()
+
+    run_with_server(test)
+
+
+def test_qos2_publish_resent_before_pubrel_routed_once():
+    async def test(server):
+        sub_reader, sub_writer, sub_pg = await open_client(server.port, 'sub')
+        sub_writer.write(sub_pg.create_subscribe_packet('a/b', 0).raw_bytes)
+        await read_packet(sub_reader)
+
+        pub_reader, pub_writer, _ = await open_client(server.port, 'pub')
+        publish = b'\x34\x0c\x00\x03a/b\x00\x07hello'
+        pub_writer.write(publish)
+        assert await read_packet(pub_reader) == b'\x50\x02\x00\x07'
+        # the PUBREC was lost, the client sends it again with dup set
+        pub_writer.write(b'\x3c' + publish[1:])
+        assert await read_packet(pub_reader) == b'\x50\x02\x00\x07'
+        pub_writer.write(b'\x62\x02\x00\x07')
+        assert await read_packet(pub_reader) == b'\x70\x02\x00\x07'
+
+        assert await read_packet(sub_reader) == b'\x30\x0a\x00\x03a/bhello'
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(sub_reader.readexactly(1), 0.1)
+
+        # released, the id can be used for a new message
+        pub_writer.write(publish)
+        assert await read_packet(pub_reader) == b'\x50\x02\x00\x07'
+        assert await read_packet(sub_reader) == b'\x30\x0a\x00\x03a/bhello'
+        sub_writer.close()
+        pub_writer.close()
+
+    run_with_server(test)
+
+
+@pytest.mark.parametrize('topic', ['a/#', '+', ''])
+def test_publish_to_invalid_topic_name_closes_connection(topic):
+    async def test(server):
+        reader, writer, pg = await open_client(server.port, 'pub')
+        writer.write(pg.create_publish_packet(topic, 'x', 0, True).raw_bytes)
+        assert await asyncio.wait_for(reader.read(), 1) == b''
+        assert len(server.retained) == 0
+        assert len(server.clients) == 0
+
+    run_with_server(test)
+
+
+def test_suback_for_many_filters():
+    async def test(server):
+        reader, writer, _ = await open_client(server.port, 'sub')
+        filters = b''.join(len(f'f/{i}').to_bytes(2, 'big') + f'f/{i}'.encode() + b'\x01'
+                           for i in range(200))
+        body = b'\x00\x05' + filters
+        writer.write(b'\x82' + encode_remaining_length(len(body)) + body)
+        # 202 needs two bytes of remaining length
+        header = await asyncio.wait_for(reader.readexactly(3), 1)
+        assert header == b'\x90\xca\x01'
+        assert await reader.readexactly(202) == b'\x00\x05' + b'\x01' * 200
+        writer.close()
+
+    run_with_server(test)
+
+
+def test_many_idle_connections():
+    async def test(server):
+        connections = [await open_client(server.port, f'idle-{i}') for i in range(200)]
+        await asyncio.sleep(0.01)
+        assert len(server.clients) == 200
+        for _, writer, _ in connections:
+            writer.close()
+
+    run_with_server(test)
+
+
+def test_wildcard_subscription_and_unsubscribe():
+    async def test(server):
+        sub_reader, sub_writer, sub_pg = await open_client(server.port, 'sub')
+        sub_writer.write(sub_pg.create_subscribe_packet('a/+', 1).raw_bytes)
+        assert (await read_packet(sub_reader))[-1] == 1
+
+        _, pub_writer, pub_pg = await open_client(server.port, 'pub')
+        pub_writer.write(pub_pg.create_publish_packet(
+            'a/b', 'x', 0, False).raw_bytes)
+        assert (await read_packet(sub_reader))[-1:] == b'x'
+
+        # UNSUBSCRIBE 'a/+' packet id 9
+        sub_writer.write(b'\xa2\x07\x00\x09\x00\x03a/+')
+        assert await read_packet(sub_reader) == b'\xb0\x02\x00\x09'
+        assert len(server.topics) == 0
+        sub_writer.close()
+        pub_writer.close()
+
+    run_with_server(test)
+
+
+def test_fan_out_at_subscriber_qos():
+    async def test(server):
+        subscribers = []
+        for i, qos in enumerate([0, 1, 1]):
+            reader, writer, pg = await open_client(server.port, f'sub-{i}')
+            writer.write(pg.create_subscribe_packet('hot', qos).raw_bytes)
+            await read_packet(reader)
+            subscribers.append((reader, writer))
+
+        _, pub_writer, pub_pg = await open_client(server.port, 'pub')
+        pub_writer.write(pub_pg.create_publish_packet(
+            'hot', 'x', 1, False).raw_bytes)
+
+        assert await read_packet(subscribers[0][0]) == b'\x30\x06\x00\x03hotx'
+        for reader, writer in subscribers[1:]:
+            assert await read_packet(reader) == b'\x32\x08\x00\x03hot\x00\x01x'
+            writer.write(b'\x40\x02\x00\x01')
+        await asyncio.sleep(0.01)
+        assert all(not c.inflight for c in server.clients)
+
+        for _, writer in subscribers:
+            writer.close()
+        pub_writer.close()
+
+    run_with_server(test)
+
+
+def test_slow_consumer_queue_is_bounded():
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0, max_queued_messages=5,
+                            write_buffer_high=1024)
+        await server.start()
+        try:
+            reader, writer, pg = await open_client(server.port, 'slow')
+            writer.write(pg.create_subscribe_packet('bulk', 0).raw_bytes)
+            await read_packet(reader)
+
+            # never read, the kernel and transport buffers fill and the
+            # rest has to be dropped from the queue
+            for _ in range(500):
+                server.publish('bulk', b'x' * 65536)
+            stats = server.queue_stats()['slow']
+            assert stats['depth'] <= 5
+            assert stats['dropped'] > 0
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_slow_consumer_disconnected_after_last_publish():
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0, max_queued_messages=5,
+                            slow_consumer_policy=DISCONNECT,
+                            slow_consumer_timeout=0.1, keep_alive_resolution=0.02,
+                            write_buffer_high=1024)
+        await server.start()
+        try:
+            reader, writer, pg = await open_client(server.port, 'stuck')
+            writer.write(pg.create_subscribe_packet('bulk', 0).raw_bytes)
+            await read_packet(reader)
+
+            # one burst and then nothing more is published
+            for _ in range(100):
+                server.publish('bulk', b'x' * 65536)
+            assert server.queue_stats()['stuck']['depth'] > 5
+            await wait_until(lambda: server.metrics.slow_consumer_disconnects == 1)
+            # what was already written drains, then the connection ends
+            while await asyncio.wait_for(reader.read(1 << 20), 1):
+                pass
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_publish_crosses_worker_links():
+    async def runner():
+        a, b = socket.socketpair()
+        servers = []
+        for worker_id, sock, outbound in ((0, a, True), (1, b, False)):
+            server = MQTTServer(host='127.0.0.1', port=0, node_id='test')
+            server.worker_id = worker_id
+            server.link_sockets = [(sock, outbound)]
+            await server.start()
+            servers.append(server)
+        try:
+            await asyncio.sleep(0.01)
+            assert list(servers[0].router.links) == ['test-1']
+
+            sub_reader, sub_writer, sub_pg = await open_client(servers[1].port, 'sub')
+            sub_writer.write(sub_pg.create_subscribe_packet('x/#', 0).raw_bytes)
+            await read_packet(sub_reader)
+            await asyncio.sleep(0.01)
+            assert servers[0].router.remote_interest.match('x/y') == {'test-1': 0}
+
+            _, pub_writer, pub_pg = await open_client(servers[0].port, 'pub')
+            pub_writer.write(pub_pg.create_publish_packet(
+                'x/y', 'hi', 0, False).raw_bytes)
+            pub_writer.write(pub_pg.create_publish_packet(
+                'nobody/cares', 'hi', 0, False).raw_bytes)
+            assert await read_packet(sub_reader) == b'\x30\x07\x00\x03x/yhi'
+            await asyncio.sleep(0.01)
+            assert servers[0].router.forwarded == 1
+
+            # the last subscriber leaving withdraws the interest
+            sub_writer.close()
+            await asyncio.sleep(0.05)
+            assert servers[0].router.remote_interest.match('x/y') == {}
+            pub_writer.close()
+        finally:
+            for server in servers:
+                await server.stop()
+
+    asyncio.run(runner())
+
+
+async def wait_until(condition, timeout=2):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    assert condition()
+
+
+def test_cluster_of_three_nodes():
+    async def runner():
+        nodes = []
+        for name in ('node-a', 'node-b', 'node-c'):
+            node = MQTTServer(host='127.0.0.1', port=0, node_id=name,
+                              cluster_port=0)
+            await node.start()
+            nodes.append(node)
+        try:
+            # every node dials every other, duplicate links get settled
+            for node in nodes:
+                for other in nodes:
+                    if other is not node:
+                        node.router.dial('127.0.0.1', other.cluster_port, 0.05)
+            await wait_until(lambda: all(len(n.router.links) == 2 for n in nodes))
+
+            sub_reader, sub_writer, sub_pg = await open_client(nodes[2].port, 'sub')
+            sub_writer.write(sub_pg.create_subscribe_packet('s/+', 0).raw_bytes)
+            await read_packet(sub_reader)
+            await wait_until(lambda: nodes[0].router.remote_interest.match('s/1'))
+            assert nodes[0].router.remote_interest.match('s/1') == {'node-c': 0}
+
+            _, pub_writer, pub_pg = await open_client(nodes[0].port, 'pub')
+            for i in range(3):
+                pub_writer.write(pub_pg.create_publish_packet(
+                    f's/{i}', 'v', 0, False).raw_bytes)
+            for i in range(3):
+                assert await read_packet(sub_reader) == f'\x30\x06\x00\x03s/{i}v'.encode()
+
+            # only the node with a subscriber was sent anything, and nothing
+            # was relayed on from there
+            await asyncio.sleep(0.05)
+            assert nodes[0].router.forwarded == 3
+            assert nodes[1].router.received == 0
+            assert nodes[2].router.forwarded == 0
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(sub_reader.read(1), 0.05)
+
+            sub_writer.close()
+            pub_writer.close()
+        finally:
+            for node in nodes:
+                await node.stop()
+
+    asyncio.run(runner())
+
+
+def test_cluster_link_redialled_after_drop():
+    async def runner():
+        a = MQTTServer(host='127.0.0.1', port=0, node_id='a', cluster_port=0)
+        b = MQTTServer(host='127.0.0.1', port=0, node_id='b', cluster_port=0)
+        await a.start()
+        await b.start()
+        try:
+            a.router.dial('127.0.0.1', b.cluster_port, 0.05)
+            await wait_until(lambda: 'b' in a.router.links)
+            a.router.links['b'].close()
+            await wait_until(lambda: 'b' not in a.router.links)
+            await wait_until(lambda: 'b' in a.router.links)
+        finally:
+            await a.stop()
+            await b.stop()
+
+    asyncio.run(runner())
+
+
+def test_cluster_link_closed_on_bad_filter():
+    async def runner():
+        a = MQTTServer(host='127.0.0.1', port=0, node_id='a', cluster_port=0)
+        b = MQTTServer(host='127.0.0.1', port=0, node_id='b', cluster_port=0)
+        await a.start()
+        await b.start()
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(
+            lambda loop, context: errors.append(context))
+        try:
+            a.router.dial('127.0.0.1', b.cluster_port, 0.05)
+            await wait_until(lambda: 'a' in b.router.links)
+            link = a.router.links['b']
+            link.send(encode_filters(packets.SUBSCRIBE_BYTE, ['ok/+', 'a/#/b'], True))
+            await asyncio.wait_for(link.closed, 1)
+            # b closed the link itself rather than the loop tearing it down
+            assert errors == []
+            assert len(b.router.remote_interest) == 0
+        finally:
+            await a.stop()
+            await b.stop()
+
+    asyncio.run(runner())
+
+
+def test_peer_publish_with_wildcard_topic_closes_link():
+    async def runner():
+        a = MQTTServer(host='127.0.0.1', port=0, node_id='a', cluster_port=0)
+        b = MQTTServer(host='127.0.0.1', port=0, node_id='b', cluster_port=0)
+        await a.start()
+        await b.start()
+        try:
+            a.router.dial('127.0.0.1', b.cluster_port, 0.05)
+            await wait_until(lambda: 'a' in b.router.links)
+            link = a.router.links['b']
+            link.send(PacketGenerator(None).create_publish_packet(
+                'a/#', 'x', 0, True).raw_bytes)
+            await asyncio.wait_for(link.closed, 1)
+            assert len(b.retained) == 0
+        finally:
+            await a.stop()
+            await b.stop()
+
+    asyncio.run(runner())
+
+
+async def linked_workers():
+    a, b = socket.socketpair()
+    servers = []
+    for worker_id, sock, outbound in ((0, a, True), (1, b, False)):
+        server = MQTTServer(host='127.0.0.1', port=0, node_id='test')
+        server.worker_id = worker_id
+        server.link_sockets = [(sock, outbound)]
+        await server.start()
+        servers.append(server)
+    await wait_until(lambda: all(server.router.links for server in servers))
+    return servers
+
+
+def test_takeover_across_workers():
+    async def runner():
+        servers = await linked_workers()
+        try:
+            first_reader, first_writer, _ = await open_client(servers[0].port, 'dev')
+            await wait_until(lambda: 'dev' in servers[0].clients)
+            _, second_writer, _ = await open_client(servers[1].port, 'dev')
+            # the older connection, on the other worker, is closed
+            assert await asyncio.wait_for(first_reader.read(), 1) == b''
+            await wait_until(lambda: 'dev' not in servers[0].clients)
+            assert 'dev' in servers[1].clients
+
+            # ids the workers assign never clash
+            reader, writer, _ = await open_client(servers[0].port, '')
+            _, other_writer, _ = await open_client(servers[1].port, '')
+            await wait_until(lambda: len(servers[1].clients) == 2)
+            assert len(servers[0].clients) == 1
+            for w in (first_writer, second_writer, writer, other_writer):
+                w.close()
+        finally:
+            for server in servers:
+                await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_persistent_sessions_refused_with_workers():
+    assert not MQTTServer(workers=2).persistent_sessions
+    assert MQTTServer().persistent_sessions
+    with pytest.raises(ValueError):
+        MQTTServer(workers=2, persistent_sessions=True)
+
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0, persistent_sessions=False)
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            writer.write(PacketGenerator(None).create_connect_packet(
+                client_id='device', clean_session=False).raw_bytes)
+            # server unavailable
+            assert await asyncio.wait_for(reader.read(), 1) == b'\x20\x02\x00\x03'
+            assert server.sessions == {}
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_retained_messages_shared_between_workers():
+    async def runner():
+        a, b = socket.socketpair()
+        servers = []
+        for worker_id, sock, outbound in ((0, a, True), (1, b, False)):
+            server = MQTTServer(host='127.0.0.1', port=0, node_id='test')
+            server.worker_id = worker_id
+            server.link_sockets = [(sock, outbound)]
+            await server.start()
+            servers.append(server)
+        try:
+            await wait_until(lambda: servers[0].router.links)
+            # nobody anywhere is subscribed yet
+            _, pub_writer, pub_pg = await open_client(servers[0].port, 'pub')
+            pub_writer.write(pub_pg.create_publish_packet(
+                'state/door', 'open', 1, True).raw_bytes)
+            await wait_until(lambda: len(servers[1].retained) == 1)
+
+            # a subscriber that lands on the other worker still gets it
+            sub_reader, sub_writer, sub_pg = await open_client(servers[1].port, 'sub')
+            sub_writer.write(sub_pg.create_subscribe_packet('state/+', 1).raw_bytes)
+            assert (await read_packet(sub_reader))[0] == 0x90
+            assert await read_packet(sub_reader) == b'\x33\x12\x00\x0astate/door\x00\x01open'
+
+            # clearing it is shared too
+            pub_writer.write(pub_pg.create_publish_packet(
+                'state/door', '', 0, True).raw_bytes)
+            await wait_until(lambda: len(servers[1].retained) == 0)
+            sub_writer.close()
+            pub_writer.close()
+        finally:
+            for server in servers:
+                await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_retained_messages_sent_on_subscribe():
+    async def test(server):
+        _, pub_writer, pub_pg = await open_client(server.port, 'pub')
+        for room in ['kitchen', 'hall']:
+            pub_writer.write(pub_pg.create_publish_packet(
+                f's/{room}/t', room, 1, True).raw_bytes)
+        pub_writer.write(pub_pg.create_publish_packet(
+            's/attic/t', 'x', 0, True).raw_bytes)
+        # an empty retained payload clears the topic
+        pub_writer.write(pub_pg.create_publish_packet(
+            's/attic/t', '', 0, True).raw_bytes)
+        await wait_until(lambda: len(server.retained) == 2)
+
+        sub_reader, sub_writer, sub_pg = await open_client(server.port, 'sub')
+        sub_writer.write(sub_pg.create_subscribe_packet('s/+/t', 0).raw_bytes)
+        assert (await read_packet(sub_reader))[0] == 0x90
+        received = {await read_packet(sub_reader), await read_packet(sub_reader)}
+        # retain flag set, delivered at the subscription's qos
+        assert received == {b'\x31\x14\x00\x0bs/kitchen/tkitchen',
+                            b'\x31\x0e\x00\x08s/hall/thall'}
+
+        # live messages to an existing subscriber have retain cleared
+        pub_writer.write(pub_pg.create_publish_packet(
+            's/hall/t', 'y', 0, True).raw_bytes)
+        assert await read_packet(sub_reader) == b'\x30\x0b\x00\x08s/hall/ty'
+        sub_writer.close()
+        pub_writer.close()
+
+    run_with_server(test)
+
+
+def test_pingreq_and_keep_alive_expiry():
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0,
+                            keep_alive_resolution=0.05)
+        await server.start()
+        try:
+            pg = PacketGenerator(None)
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', server.port)
+            writer.write(pg.create_connect_packet(
+                client_id='pinger', keep_alive=1).raw_bytes)
+            await read_packet(reader)
+
+            # pinging keeps the connection open past 1.5x keep alive
+            for _ in range(4):
+                await asyncio.sleep(0.5)
+                writer.write(b'\xc0\x00')
+                assert await read_packet(reader) == b'\xd0\x00'
+            assert [c.client_id for c in server.clients] == ['pinger']
+
+            # then silence, it's dropped after 1.5s
+            assert await asyncio.wait_for(reader.read(), 2) == b''
+            assert len(server.clients) == 0
+            assert len(server.keep_alive_timers) == 0
+        finally:
+            await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_publisher_disconnected_when_wal_sync_fails(tmp_path, monkeypatch):
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0, wal_dir=str(tmp_path))
+        await server.start()
+        try:
+            sub_reader, sub_writer, sub_pg = await open_client(server.port, 'sub')
+            sub_writer.write(sub_pg.create_subscribe_packet('jobs', 1).raw_bytes)
+            await read_packet(sub_reader)
+
+            def fsync(fd):
+                raise OSError(28, 'No space left on device')
+            monkeypatch.setattr('write_ahead_log.os.fsync', fsync)
+
+            pub_reader, pub_writer, pub_pg = await open_client(server.port, 'pub')
+            pub_writer.write(pub_pg.create_publish_packet(
+                'jobs', 'run', 1, False).raw_bytes)
+            # closed without a PUBACK rather than left waiting for one
+            assert await asyncio.wait_for(pub_reader.read(), 1) == b''
+            sub_writer.close()
+            pub_writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_unacknowledged_delivery_survives_restart(tmp_path):
+    async def runner():
+        pg = PacketGenerator(None)
+        server = MQTTServer(host='127.0.0.1', port=0, wal_dir=str(tmp_path))
+        await server.start()
+        try:
+            sub_reader, sub_writer = await asyncio.open_connection(
+                '127.0.0.1', server.port)
+            sub_writer.write(pg.create_connect_packet(
+                client_id='durable', clean_session=False).raw_bytes)
+            await read_packet(sub_reader)
+            sub_writer.write(pg.create_subscribe_packet('jobs', 1).raw_bytes)
+            await read_packet(sub_reader)
+
+            _, pub_writer, pub_pg = await open_client(server.port, 'pub')
+            pub_writer.write(pub_pg.create_publish_packet(
+                'jobs', 'run', 1, False).raw_bytes)
+            # received but never acknowledged
+            assert (await read_packet(sub_reader))[-3:] == b'run'
+            sub_writer.close()
+            pub_writer.close()
+        finally:
+            await server.stop()
+
+        server = MQTTServer(host='127.0.0.1', port=0, wal_dir=str(tmp_path))
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', server.port)
+            writer.write(pg.create_connect_packet(
+                client_id='durable', clean_session=False).raw_bytes)
+            await read_packet(reader)
+            publish = await read_packet(reader)
+            assert publish[0] == 0x32 and publish[-3:] == b'run'
+            writer.write(b'\x40\x02' + publish[-5:-3])
+            await wait_until(lambda: not server.wal.messages)
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(runner())
+
+
+async def connect_persistent(port, client_id, clean_session=False, present=False):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(PacketGenerator(None).create_connect_packet(
+        client_id=client_id, clean_session=clean_session).raw_bytes)
+    # session present is set when an earlier connection left one behind
+    assert await read_packet(reader) == bytes([0x20, 0x02, int(present), 0x00])
+    return reader, writer
+
+
+async def read_long_packet(reader):
+    header = await asyncio.wait_for(reader.readexactly(1), 1)
+    remaining_length = 0
+    multiplier = 1
+    while True:
+        byte = await reader.readexactly(1)
+        header += byte
+        remaining_length += (byte[0] & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte[0] & 0x80:
+            break
+    return header + await reader.readexactly(remaining_length)
+
+
+def test_offline_messages_delivered_on_reconnect():
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0,
+                            offline_memory_budget=1024)
+        await server.start()
+        try:
+            reader, writer = await connect_persistent(server.port, 'device')
+            writer.write(PacketGenerator(None).create_subscribe_packet(
+                'cmd/#', 1).raw_bytes)
+            await read_packet(reader)
+            writer.close()
+            await wait_until(lambda: not server.sessions['device'].connected)
+            # the subscription outlives the connection
+            assert server.topics.match('cmd/x') == {'device': 1}
+
+            for i in range(200):
+                server.publish(f'cmd/{i}', b'x' * 100, qos=1)
+            stats = server.session_stats()['device']['offline']
+            assert stats['depth'] == 200
+            assert stats['memory_bytes'] <= 1024 and stats['spilled'] > 0
+
+            reader, writer = await connect_persistent(server.port, 'device', present=True)
+            for i in range(200):
+                packet = await read_long_packet(reader)
+                assert packet[0] == 0x32
+                assert packet[4:4 + len(f'cmd/{i}')] == f'cmd/{i}'.encode()
+                writer.write(b'\x40\x02' + packet[4 + len(f'cmd/{i}'):][:2])
+            await wait_until(lambda: not server.sessions['device'].inflight)
+            assert server.session_stats()['device']['offline']['depth'] == 0
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_inflight_copied_out_of_receive_buffer_on_disconnect():
+    async def test(server):
+        reader, writer = await connect_persistent(server.port, 'device')
+        writer.write(PacketGenerator(None).create_subscribe_packet(
+            'cmd', 1).raw_bytes)
+        await read_packet(reader)
+        _, pub_writer, pub_pg = await open_client(server.port, 'pub')
+        pub_writer.write(pub_pg.create_publish_packet('cmd', 'go', 1, False).raw_bytes)
+        await read_packet(reader)
+
+        inflight = server.sessions['device'].inflight
+        [(frame, _)] = inflight.values()
+        # still a view of the publisher's receive buffer while connected
+        assert isinstance(frame.payload, memoryview)
+        writer.close()
+        await wait_until(lambda: not server.sessions['device'].connected)
+        assert isinstance(frame.payload, bytes)
+        assert frame.payload == b'go'
+        pub_writer.close()
+
+    run_with_server(test)
+
+
+def test_unacknowledged_delivery_resent_with_dup():
+    async def test(server):
+        reader, writer = await connect_persistent(server.port, 'device')
+        writer.write(PacketGenerator(None).create_subscribe_packet(
+            'cmd', 1).raw_bytes)
+        await read_packet(reader)
+        server.publish('cmd', b'go', qos=1)
+        first = await read_packet(reader)
+        assert first == b'\x32\x09\x00\x03cmd\x00\x01go'
+        writer.close()
+        await wait_until(lambda: not server.sessions['device'].connected)
+
+        reader, writer = await connect_persistent(server.port, 'device', present=True)
+        assert await read_packet(reader) == b'\x3a\x09\x00\x03cmd\x00\x01go'
+        writer.write(b'\x40\x02\x00\x01')
+        await wait_until(lambda: not server.sessions['device'].inflight)
+        writer.close()
+
+    run_with_server(test)
+
+
+def test_session_present_flag():
+    async def test(server):
+        # a new session, and a clean one, aren't present
+        _, writer = await connect_persistent(server.port, 'device')
+        writer.close()
+        await wait_until(lambda: not server.sessions['device'].connected)
+        # resumed
+        _, writer = await connect_persistent(server.port, 'device', present=True)
+        writer.close()
+        await wait_until(lambda: not server.sessions['device'].connected)
+        _, writer = await connect_persistent(server.port, 'device',
+                                             clean_session=True)
+        writer.close()
+        await asyncio.sleep(0.01)
+        _, writer = await connect_persistent(server.port, 'device')
+        writer.close()
+
+    run_with_server(test)
+
+
+def test_clean_session_discards_persistent_session():
+    async def test(server):
+        reader, writer = await connect_persistent(server.port, 'device')
+        writer.write(PacketGenerator(None).create_subscribe_packet(
+            'cmd', 1).raw_bytes)
+        await read_packet(reader)
+        writer.close()
+        await wait_until(lambda: not server.sessions['device'].connected)
+        server.publish('cmd', b'go', qos=1)
+
+        _, writer = await connect_persistent(server.port, 'device',
+                                             clean_session=True)
+        await asyncio.sleep(0.01)
+        assert 'device' not in server.sessions
+        assert len(server.topics) == 0
+        writer.close()
+
+    run_with_server(test)
+
+
+def test_persistent_session_taken_over():
+    async def test(server):
+        old_reader, old_writer = await connect_persistent(server.port, 'device')
+        old_writer.write(PacketGenerator(None).create_subscribe_packet(
+            'cmd', 0).raw_bytes)
+        await read_packet(old_reader)
+
+        reader, writer = await connect_persistent(server.port, 'device', present=True)
+        # the old connection is closed, the subscription carries over
+        assert await asyncio.wait_for(old_reader.read(), 1) == b''
+        assert [c.client_id for c in server.clients] == ['device']
+        server.publish('cmd', b'go')
+        assert await read_packet(reader) == b'\x30\x07\x00\x03cmdgo'
+        writer.close()
+
+    run_with_server(test)
+
+
+def test_duplicate_client_id_takes_over_connection():
+    async def test(server):
+        old_reader, old_writer, pg = await open_client(server.port, 'sensor')
+        old_writer.write(pg.create_subscribe_packet('cmd', 0).raw_bytes)
+        await read_packet(old_reader)
+
+        reader, writer, _ = await open_client(server.port, 'sensor')
+        assert await asyncio.wait_for(old_reader.read(), 1) == b''
+        assert len(server.clients) == 1
+        assert server.clients.get('sensor').transport is not None
+        # a clean session starts again without the old subscriptions
+        assert len(server.topics) == 0
+        writer.close()
+
+    run_with_server(test)
+
+
+def test_empty_client_id():
+    async def test(server):
+        first = await open_client(server.port, '')
+        second = await open_client(server.port, '')
+        await asyncio.sleep(0.01)
+        # each gets an id of its own instead of taking the other over
+        assert len(server.clients) == 2
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        writer.write(PacketGenerator(None).create_connect_packet(
+            client_id='', clean_session=False).raw_bytes)
+        assert await read_packet(reader) == b'\x20\x02\x00\x02'
+        assert await asyncio.wait_for(reader.read(), 1) == b''
+        for _, client_writer, _ in (first, second):
+            client_writer.close()
+
+    run_with_server(test)
+
+
+def test_shared_subscription_load_balanced():
+    async def test(server):
+        consumers = []
+        for i in range(3):
+            reader, writer, pg = await open_client(server.port, f'worker-{i}')
+            writer.write(pg.create_subscribe_packet('$share/workers/jobs/+', 0).raw_bytes)
+            assert await read_packet(reader) == b'\x90\x03\x00\x01\x00'
+            consumers.append((reader, writer))
+        plain_reader, plain_writer, pg = await open_client(server.port, 'watcher')
+        plain_writer.write(pg.create_subscribe_packet('jobs/+', 0).raw_bytes)
+        await read_packet(plain_reader)
+
+        for i in range(6):
+            server.publish(f'jobs/{i}', b'x')
+        # every worker gets two, the plain subscriber all six
+        for reader, _ in consumers:
+            for _ in range(2):
+                assert (await read_packet(reader))[0] == 0x30
+        for _ in range(6):
+            await read_packet(plain_reader)
+
+        for _, writer in consumers + [(None, plain_writer)]:
+            writer.close()
+        await wait_until(lambda: len(server.clients) == 0)
+        assert len(server.shared) == 0
+
+    run_with_server(test)
+
+
+async def read_until_quiet(reader, timeout=0.2):
+    packets = []
+    while True:
+        try:
+            packets.append(await asyncio.wait_for(read_packet(reader), timeout))
+        except asyncio.TimeoutError:
+            return packets
+
+
+def test_shared_subscription_across_workers():
+    async def runner():
+        servers = await linked_workers()
+        try:
+            # two members on the first worker, one on the second
+            members = []
+            for i, server in enumerate((servers[0], servers[0], servers[1])):
+                reader, writer, pg = await open_client(server.port, f'member-{i}')
+                writer.write(pg.create_subscribe_packet('$share/g/jobs/+', 0).raw_bytes)
+                await read_packet(reader)
+                members.append((reader, writer))
+            watcher_reader, watcher_writer, pg = await open_client(servers[1].port, 'watcher')
+            watcher_writer.write(pg.create_subscribe_packet('jobs/+', 0).raw_bytes)
+            await read_packet(watcher_reader)
+            await wait_until(lambda: servers[0].shared.groups[('g', 'jobs/+')].peers == ['test-1'])
+            await wait_until(lambda: servers[1].shared.groups[('g', 'jobs/+')].peers == ['test-0'])
+
+            publishers = []
+            for server in servers:
+                _, writer, pg = await open_client(server.port, f'pub-{server.worker_id}')
+                publishers.append(writer)
+                for i in range(30):
+                    writer.write(pg.create_publish_packet(
+                        f'jobs/{i}', 'x', 0, False).raw_bytes)
+
+            received = [await read_until_quiet(reader) for reader, _ in members]
+            # every message reached exactly one member of the group in total
+            assert sum(len(packets) for packets in received) == 60
+            assert all(received)
+            assert len(await read_until_quiet(watcher_reader)) == 60
+
+            for writer in publishers + [w for _, w in members] + [watcher_writer]:
+                writer.close()
+            await wait_until(lambda: not servers[0].shared.groups and not servers[1].shared.groups)
+        finally:
+            for server in servers:
+                await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_sys_tree_published():
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0, sys_interval=0.05)
+        await server.start()
+        try:
+            reader, writer, pg = await open_client(server.port, 'monitor')
+            await asyncio.sleep(0.1)
+            writer.write(pg.create_subscribe_packet(
+                '$SYS/broker/clients/connected', 0).raw_bytes)
+            await read_packet(reader)
+            # retained, so it arrives straight away
+            topic = b'$SYS/broker/clients/connected'
+            assert await read_packet(reader) == (
+                bytes([0x31, 2 + len(topic) + 1]) + len(topic).to_bytes(2, 'big') +
+                topic + b'1')
+
+            stats = server.metrics.snapshot(server)
+            assert stats['packets/received/connect'] == 1
+            assert stats['packets/received/subscribe'] == 1
+            assert stats['bytes/received'] > 0 and stats['bytes/sent'] > 0
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_latency_histograms():
+    async def test(server):
+        reader, writer, pg = await open_client(server.port, 'timed')
+        writer.write(pg.create_subscribe_packet('t', 0).raw_bytes)
+        await read_packet(reader)
+        writer.write(pg.create_publish_packet('t', b'x', 0, False).raw_bytes)
+        await read_packet(reader)
+
+        histograms = server.metrics.latency_histograms()
+        for name in ('handle/connect', 'handle/subscribe', 'handle/publish',
+                     'decode/publish', 'route', 'inbound_to_outbound'):
+            assert histograms[name].count == 1
+        # routing is part of handling
+        assert histograms['route'].max <= histograms['handle/publish'].max
+        writer.close()
+
+    run_with_server(test)
+
+
+def test_connect_with_credentials():
+    from authenticator import Authenticator, hash_password
+
+    async def runner():
+        authenticator = Authenticator(users={
+            'device': hash_password('secret', iterations=1000)})
+        server = MQTTServer(host='127.0.0.1', port=0,
+                            authenticator=authenticator, allow_anonymous=False)
+        await server.start()
+        try:
+            pg = PacketGenerator(None)
+
+            async def connect(**kwargs):
+                reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+                writer.write(pg.create_connect_packet(client_id='c', **kwargs).raw_bytes)
+                return reader, writer
+
+            for kwargs in ({'username': 'device', 'password': 'wrong'},
+                           {'username': 'nobody', 'password': 'secret'}, {}):
+                reader, writer = await connect(**kwargs)
+                assert await read_packet(reader) == b'\x20\x02\x00\x04'
+                assert await asyncio.wait_for(reader.read(), 1) == b''
+            assert server.metrics.auth_failures == 3
+
+            # a will ahead of the credentials, and packets sent straight after
+            # the CONNECT wait for the check
+            reader, writer = await connect(
+                username='device', password='secret',
+                will_topic='wills/c', will_message='gone')
+            writer.write(pg.create_subscribe_packet('t', 0).raw_bytes)
+            writer.write(pg.create_publish_packet('t', 'hi', 0, False).raw_bytes)
+            assert await read_packet(reader) == b'\x20\x02\x00\x00'
+            assert (await read_packet(reader))[0] == 0x90
+            assert await read_packet(reader) == b'\x30\x05\x00\x01thi'
+            assert server.clients.get('c').username == 'device'
+            writer.close()
+        finally:
+            await server.stop()
+            authenticator.close()
+
+    asyncio.run(runner())
+
+
+def test_topic_acl():
+    from topic_acl import TopicAcl, READ, READWRITE
+
+    async def runner():
+        acl = TopicAcl()
+        acl.add_rule('devices/%c/#', READWRITE, pattern=True)
+        acl.add_rule('devices/+/status', READ, user='monitor')
+        server = MQTTServer(host='127.0.0.1', port=0, acl=acl)
+        await server.start()
+        try:
+            pg = PacketGenerator(None)
+
+            async def connect(client_id, **kwargs):
+                reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+                writer.write(pg.create_connect_packet(client_id=client_id, **kwargs).raw_bytes)
+                assert await read_packet(reader) == b'\x20\x02\x00\x00'
+                return reader, writer
+
+            monitor, monitor_writer = await connect('m', username='monitor')
+            monitor_writer.write(pg.create_subscribe_packet('devices/+/status', 0).raw_bytes)
+            assert (await read_packet(monitor))[-1] == 0x00
+            monitor_writer.write(pg.create_subscribe_packet('devices/#', 0).raw_bytes)
+            assert (await read_packet(monitor))[-1] == 0x80
+
+            device, device_writer = await connect('d1')
+            # someone else's topic is acknowledged but goes nowhere
+            device_writer.write(pg.create_publish_packet('devices/d2/status', 'no', 1, False).raw_bytes)
+            assert (await read_packet(device))[0] == 0x40
+            device_writer.write(pg.create_publish_packet('devices/d1/status', 'ok', 0, False).raw_bytes)
+            assert await read_packet(monitor) == b'\x30\x15\x00\x11devices/d1/statusok'
+            assert server.metrics.publish_denied == 1
+            assert server.metrics.subscribe_denied == 1
+            monitor_writer.close()
+            device_writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(runner())
+
+
+def test_unix_socket_listener(tmp_path):
+    import os
+    from mqtt_client_connection import MQTTClientConnection
+
+    path = str(tmp_path / 'mqtt.sock')
+    # left behind by a broker that was killed
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0, unix_path=path)
+        await server.start()
+        try:
+            pg = PacketGenerator(None)
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(pg.create_connect_packet(client_id='local').raw_bytes)
+            assert await read_packet(reader) == b'\x20\x02\x00\x00'
+            writer.write(pg.create_subscribe_packet('t', 0).raw_bytes)
+            assert (await read_packet(reader))[0] == 0x90
+
+            # tcp publishers reach unix subscribers
+            _, tcp_writer, _ = await open_client(server.port, 'remote')
+            tcp_writer.write(pg.create_publish_packet('t', 'hi', 0, False).raw_bytes)
+            assert await read_packet(reader) == b'\x30\x05\x00\x01thi'
+
+            def connect():
+                connection = MQTTClientConnection(f'unix://{path}', 0, 'client', keep_alive=0)
+                connection.connect(1)
+                connection.conn.close()
+                return connection.connected
+            assert await asyncio.get_running_loop().run_in_executor(None, connect)
+            writer.close()
+            tcp_writer.close()
+        finally:
+            await server.stop()
+        assert not os.path.exists(path)
+
+    asyncio.run(runner())
+
+
+def test_unix_socket_in_use_is_left_alone(tmp_path):
+    import os
+    import stat
+
+    path = str(tmp_path / 'mqtt.sock')
+
+    async def runner():
+        first = MQTTServer(host='127.0.0.1', port=0, unix_path=path)
+        await first.start()
+        try:
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o660
+            second = MQTTServer(host='127.0.0.1', port=0, unix_path=path)
+            with pytest.raises(OSError):
+                await second.start()
+            await second.stop()
+            # the first broker still has it
+            _, writer = await asyncio.open_unix_connection(path)
+            writer.close()
+
+            # replaced behind its back, it's no longer ours to remove
+            os.unlink(path)
+            other = socket.socket(socket.AF_UNIX)
+            other.bind(path)
+        finally:
+            await first.stop()
+        assert os.path.exists(path)
+        other.close()
+
+    asyncio.run(runner())
+
+
+def test_serve_without_tcp_listener(tmp_path):
+    path = str(tmp_path / 'mqtt.sock')
+
+    async def runner():
+        server = MQTTServer(port=None, unix_path=path)
+        serving = asyncio.create_task(server.serve())
+        await wait_until(lambda: server.listeners)
+        assert not serving.done()
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(PacketGenerator(None).create_connect_packet(
+            client_id='local').raw_bytes)
+        assert await read_packet(reader) == b'\x20\x02\x00\x00'
+
+        await server.stop()
+        await asyncio.wait_for(serving, 1)
+        assert await asyncio.wait_for(reader.read(), 1) == b''
+
+    asyncio.run(runner())
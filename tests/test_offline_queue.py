@@ -0,0 +1,128 @@
+import os
+
+from offline_queue import OfflineQueue, entry_size
+from publish_frame import PublishFrame
+
+
+def make_queue(tmp_path, **kwargs):
+    return OfflineQueue(os.path.join(tmp_path, 'client'), **kwargs)
+
+
+def received_frame(topic, payload, qos=1):
+    # as the broker gets it from a client, over the receive buffer
+    frame = PublishFrame(topic, payload)
+    raw = memoryview(b''.join(frame.buffers(qos, False, 1 if qos else None)))
+    return PublishFrame.from_packet(raw)[0]
+
+
+def frames(count, size=100):
+    return [PublishFrame(f'topic/{i}', bytes([i % 256]) * size)
+            for i in range(count)]
+
+
+def spill_files(tmp_path):
+    return [name for name in os.listdir(tmp_path) if name.endswith('.spill')]
+
+
+def test_stays_in_memory_within_budget(tmp_path):
+    queue = make_queue(tmp_path, memory_budget=10_000)
+    for frame in frames(10):
+        assert queue.put(frame, 1)
+    assert queue.stats()['spilled'] == 0
+    assert spill_files(tmp_path) == []
+    assert [frame.topic for frame, _ in queue.drain()] == \
+        [f'topic/{i}' for i in range(10)]
+
+
+def test_spills_beyond_budget_in_order(tmp_path):
+    queue = make_queue(tmp_path, memory_budget=1000, segment_bytes=1024)
+    sent = frames(100)
+    for i, frame in enumerate(sent):
+        queue.put(frame, 1 + i % 2)
+
+    stats = queue.stats()
+    assert stats['memory_bytes'] <= 1000
+    assert stats['spilled'] > 90
+    assert len(spill_files(tmp_path)) == stats['segments'] > 1
+
+    received = list(queue.drain())
+    assert [(f.topic, f.payload) for f, _ in received] == \
+        [(f.topic, f.payload) for f in sent]
+    assert [qos for _, qos in received] == [1 + i % 2 for i in range(100)]
+    # segments are deleted as they're read back
+    assert spill_files(tmp_path) == []
+    assert queue.bytes == 0
+
+
+def test_back_to_memory_once_spill_is_read(tmp_path):
+    queue = make_queue(tmp_path, memory_budget=500)
+    for frame in frames(10):
+        queue.put(frame, 1)
+    list(queue.drain())
+    queue.put(PublishFrame('a', b'x'), 1)
+    assert queue.stats()['spilled'] == 0
+
+
+def test_put_while_draining(tmp_path):
+    queue = make_queue(tmp_path, memory_budget=500)
+    for frame in frames(10):
+        queue.put(frame, 1)
+    drain = queue.drain()
+    next(drain)
+    queue.put(PublishFrame('late', b'x'), 1)
+    assert [frame.topic for frame, _ in drain][-1] == 'late'
+
+
+def test_message_id_kept_through_spill(tmp_path):
+    queue = make_queue(tmp_path, memory_budget=0)
+    frame = PublishFrame('a', b'payload')
+    frame.message_id = 42
+    queue.put(frame, 2)
+    assert queue.stats()['spilled'] == 1
+    received, qos = queue.get()
+    assert (received.message_id, received.payload, qos) == (42, b'payload', 2)
+
+
+def test_full_queue_drops(tmp_path):
+    frame = PublishFrame('a', b'x' * 100)
+    queue = make_queue(tmp_path, memory_budget=0,
+                       max_bytes=entry_size(frame) * 3)
+    assert [queue.put(frame, 1) for _ in range(5)] == \
+        [True, True, True, False, False]
+    assert queue.dropped == 2
+    assert len(queue) == 3
+
+
+def test_push_front(tmp_path):
+    queue = make_queue(tmp_path)
+    a, b, c = frames(3)
+    queue.put(c, 1)
+    queue.push_front([(a, 1), (b, 2)])
+    assert [frame for frame, _ in queue.drain()] == [a, b, c]
+
+
+def test_clear_removes_spill_files(tmp_path):
+    queue = make_queue(tmp_path, memory_budget=0)
+    for frame in frames(10):
+        queue.put(frame, 1)
+    assert spill_files(tmp_path)
+    queue.clear()
+    assert spill_files(tmp_path) == []
+    assert len(queue) == 0
+
+
+def test_received_frames_copied_out_of_receive_buffer(tmp_path):
+    queue = make_queue(tmp_path, memory_budget=0)
+    pushed = received_frame('a', b'pushed')
+    queue.push_front([(pushed, 1)])
+    assert isinstance(pushed.payload, bytes)
+
+    # the write-ahead log keeps logged messages that were spilled
+    logged = received_frame('b', b'logged')
+    logged.message_id = 7
+    queue.put(logged, 1)
+    assert queue.stats()['spilled'] == 1
+    assert isinstance(logged.payload, bytes)
+
+    assert [(frame.topic, bytes(frame.payload)) for frame, _ in queue.drain()] == \
+        [('a', b'pushed'), ('b', b'logged')]
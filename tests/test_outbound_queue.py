@@ -0,0 +1,93 @@
+import pytest
+
+from outbound_queue import OutboundQueue, DROP_OLDEST, DROP_QOS0, DISCONNECT
+
+
+def fill(queue, qos_levels, size=10):
+    results = []
+    for i, qos in enumerate(qos_levels):
+        results.append(queue.put(f'frame-{i}', qos, False, size))
+    return results
+
+
+def test_fifo_and_byte_accounting():
+    queue = OutboundQueue()
+    fill(queue, [0, 1, 2])
+    assert queue.depth == 3
+    assert queue.bytes == 30
+    assert queue.get() == ('frame-0', 0, False, 10)
+    assert queue.bytes == 20
+
+
+def test_drop_oldest_by_count():
+    queue = OutboundQueue(max_messages=2, policy=DROP_OLDEST)
+    assert all(fill(queue, [0, 1, 2, 0]))
+    assert [e[0] for e in queue.entries] == ['frame-2', 'frame-3']
+    assert queue.stats() == {'depth': 2, 'bytes': 20,
+                             'dropped': 2, 'dropped_bytes': 20}
+
+
+def test_drop_oldest_by_bytes():
+    queue = OutboundQueue(max_bytes=25, policy=DROP_OLDEST)
+    fill(queue, [1, 1, 1])
+    assert queue.depth == 2
+    assert queue.bytes == 20
+
+
+def test_drop_qos0_keeps_qos1_and_2():
+    queue = OutboundQueue(max_messages=3, policy=DROP_QOS0)
+    assert all(fill(queue, [0, 1, 0, 2, 0]))
+    assert [e[1] for e in queue.entries] == [1, 2, 0]
+    assert queue.dropped == 2
+
+
+def test_drop_qos0_disconnects_when_only_qos1_left(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('outbound_queue.time.monotonic', lambda: now[0])
+    queue = OutboundQueue(max_messages=1, policy=DROP_QOS0, disconnect_after=5)
+    assert fill(queue, [1, 1]) == [True, True]
+    now[0] += 6
+    assert not queue.put('late', 1, False, 10)
+    assert queue.dropped == 0
+
+
+def test_disconnect_after_timeout(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('outbound_queue.time.monotonic', lambda: now[0])
+    queue = OutboundQueue(max_messages=1, policy=DISCONNECT, disconnect_after=5)
+    assert fill(queue, [0, 0]) == [True, True]
+    now[0] += 4
+    assert queue.put('x', 0, False, 10)
+    now[0] += 2
+    assert not queue.put('y', 0, False, 10)
+    assert queue.dropped == 0
+
+
+def test_overdue(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('outbound_queue.time.monotonic', lambda: now[0])
+    queue = OutboundQueue(max_messages=1, policy=DISCONNECT, disconnect_after=5)
+    assert not queue.overdue()
+    fill(queue, [0, 0])
+    now[0] += 4
+    assert not queue.overdue()
+    now[0] += 1
+    assert queue.overdue()
+    queue.get()
+    assert not queue.overdue()
+
+
+def test_draining_below_limit_resets_timer(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('outbound_queue.time.monotonic', lambda: now[0])
+    queue = OutboundQueue(max_messages=1, policy=DISCONNECT, disconnect_after=5)
+    fill(queue, [0, 0])
+    queue.get()
+    assert queue.over_limit_since is None
+    now[0] += 10
+    assert queue.put('x', 0, False, 10)
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        OutboundQueue(policy='nope')
@@ -48,6 +48,11 @@ def test_create_publish_packet(packet_gen):
     assert pkt.raw_bytes[0] & 0xF0 == packets.PUBLISH_BYTE
 
 
+def test_create_publish_packet_bytes_payload(packet_gen):
+    pkt = packet_gen.create_publish_packet("t", b'\xff\x00', qos=0, retain=False)
+    assert pkt.raw_bytes == b'\x30\x05\x00\x01t\xff\x00'
+
+
 def test_create_puback_packet(packet_gen):
     pkt = packet_gen.create_puback_packet(42)
     assert pkt.data['packet_id'] == 42
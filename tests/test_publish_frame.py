@@ -0,0 +1,119 @@
+import pytest
+
+from publish_frame import PublishFrame
+from packet_generator import PacketGenerator
+from packet_validator import PacketValidator, PacketValidatorError
+
+
+def test_qos0_frame_is_single_buffer():
+    frame = PublishFrame('a/b', 'hello')
+    assert frame.buffers() == (b'\x30\x0a\x00\x03a/bhello',)
+
+
+def test_qos1_frame_patches_packet_id():
+    frame = PublishFrame('a/b', b'hi')
+    buffers = frame.buffers(1, False, 258)
+    assert b''.join(buffers) == b'\x32\x09\x00\x03a/b\x01\x02hi'
+
+
+def test_retain_variant():
+    frame = PublishFrame('t', 'x')
+    assert frame.buffers(0, True)[0][0] == 0x31
+    assert frame.buffers(2, True, 1)[0][0] == 0x35
+
+
+def test_variants_encoded_once_and_shared():
+    frame = PublishFrame('a', 'payload')
+    first = frame.buffers(1, False, 1)
+    second = frame.buffers(1, False, 2)
+    assert first[0] is second[0]
+    assert first[2] is second[2]
+    assert frame.buffers()[0] is frame.buffers()[0]
+
+
+def test_large_payload_uses_multi_byte_remaining_length():
+    payload = b'x' * 20000
+    frame = b''.join(PublishFrame('big', payload).buffers(1, False, 7))
+    packet = PacketValidator(None).validate_packet(frame)
+    assert packet.topic == 'big'
+    assert packet.packet_id == 7
+    assert packet.qos == 1
+    assert packet.payload == payload.decode()
+
+
+def received(topic, payload, qos=0, retain=False, packet_id=None):
+    """ A PUBLISH as the frame decoder hands it over, a memoryview """
+    packet = PacketGenerator(None).create_publish_packet(topic, payload, qos, retain).raw_bytes
+    if packet_id is not None:
+        packet = bytearray(packet)
+        index = len(packet) - len(payload) - 2
+        packet[index:index + 2] = packet_id.to_bytes(2, 'big')
+    return memoryview(bytes(packet)).toreadonly()
+
+
+def test_from_packet_fields():
+    packet = received('a/b', 'hello', 1, True, packet_id=9)
+    frame, qos, retain, packet_id = PublishFrame.from_packet(packet)
+    assert (frame.topic, qos, retain, packet_id) == ('a/b', 1, True, 9)
+    assert frame.payload == b'hello'
+    # a view of the received packet, not a copy
+    assert frame.payload.obj is packet.obj
+
+
+def test_delivered_as_received():
+    packet = received('a/b', 'hello')
+    frame, _, _, _ = PublishFrame.from_packet(packet)
+    assert frame.buffers()[0] is packet
+
+    packet = received('a/b', 'hello', 2, packet_id=1)
+    frame, _, _, _ = PublishFrame.from_packet(packet)
+    buffers = frame.buffers(2, False, 258)
+    assert buffers[-1] is frame.payload
+    assert b''.join(buffers) == b'\x34\x0c\x00\x03a/b\x01\x02hello'
+
+
+@pytest.mark.parametrize('qos,retain', [(0, False), (1, True), (2, False)])
+@pytest.mark.parametrize('delivery_qos,delivery_retain',
+                         [(0, False), (0, True), (1, False), (2, True)])
+def test_variants_match_encoding(qos, retain, delivery_qos, delivery_retain):
+    payload = 'x' * 200
+    frame, _, _, _ = PublishFrame.from_packet(
+        received('some/topic', payload, qos, retain, packet_id=5 if qos else None))
+    expected = PublishFrame('some/topic', payload)
+    packet_id = 7 if delivery_qos else None
+    buffers = frame.buffers(delivery_qos, delivery_retain, packet_id)
+    assert b''.join(buffers) == b''.join(
+        expected.buffers(delivery_qos, delivery_retain, packet_id))
+    assert frame.size(delivery_qos, delivery_retain) == \
+        expected.size(delivery_qos, delivery_retain)
+    # only the fixed header and packet id are new, the payload is shared
+    assert any(buffer is frame.payload or buffer is frame._packet for buffer in buffers)
+
+
+def test_binary_payload_untouched():
+    payload = bytes(range(256))
+    packet = b''.join(PublishFrame('bin', payload).buffers())
+    frame, _, _, _ = PublishFrame.from_packet(memoryview(packet))
+    assert bytes(frame.payload) == payload
+
+
+def test_own_copies_out_of_receive_buffer():
+    packet = received('a/b', 'hello', 1, packet_id=3)
+    frame, _, _, _ = PublishFrame.from_packet(packet)
+    before = b''.join(frame.buffers(1, False, 3))
+    frame.own()
+    assert isinstance(frame.payload, bytes)
+    assert b''.join(frame.buffers(1, False, 3)) == before
+
+
+def test_malformed_qos():
+    packet = bytearray(received('a', 'x'))
+    packet[0] |= 0x06
+    with pytest.raises(PacketValidatorError):
+        PublishFrame.from_packet(memoryview(packet))
+
+
+@pytest.mark.parametrize('topic', ['', 'a/#', '+', 'a/+/b'])
+def test_invalid_topic_name(topic):
+    with pytest.raises(PacketValidatorError):
+        PublishFrame.from_packet(received(topic, 'x', 0))
@@ -0,0 +1,104 @@
+import pytest
+
+from publish_frame import PublishFrame
+from retained_store import RetainedStore
+
+
+@pytest.fixture
+def store():
+    store = RetainedStore()
+    for topic in ['sensors/kitchen/temp', 'sensors/kitchen/humidity',
+                  'sensors/hall/temp', 'sensors', 'other/temp', '$SYS/info']:
+        store.set(topic, topic)
+    return store
+
+
+def topics(messages):
+    return sorted(message.topic for message in messages)
+
+
+def test_set_and_get(store):
+    message = store.get('sensors/hall/temp')
+    assert message.payload == b'sensors/hall/temp'
+    assert message.qos == 0
+    assert store.get('sensors/hall') is None
+    assert store.get('missing/topic') is None
+    assert len(store) == 6
+
+
+def test_set_replaces(store):
+    size = store.bytes
+    store.set('other/temp', b'y', qos=1)
+    assert store.get('other/temp').payload == b'y'
+    assert store.get('other/temp').qos == 1
+    assert len(store) == 6
+    assert store.bytes < size
+
+
+def test_shares_existing_frame():
+    store = RetainedStore()
+    frame = PublishFrame('a/b', b'x')
+    store.set('a/b', None, 1, frame=frame)
+    assert store.get('a/b').frame is frame
+
+
+def test_received_frame_copied_out_of_receive_buffer():
+    store = RetainedStore()
+    received = memoryview(b''.join(PublishFrame('a', 'on').buffers(0, True)))
+    frame, _, _, _ = PublishFrame.from_packet(received)
+    store.set('a', None, frame=frame)
+    # a retained message mustn't keep the connection's whole buffer alive
+    assert isinstance(frame.payload, bytes)
+    assert store.get('a').payload == b'on'
+
+
+def test_empty_payload_removes(store):
+    store.set('sensors/hall/temp', b'')
+    assert store.get('sensors/hall/temp') is None
+    assert len(store) == 5
+    # the now empty 'hall' branch is pruned
+    assert 'hall' not in store.root.children['sensors'].children
+
+
+def test_exact_match(store):
+    assert topics(store.match('sensors/kitchen/temp')) == ['sensors/kitchen/temp']
+    assert topics(store.match('sensors/kitchen')) == []
+
+
+def test_single_level_wildcard(store):
+    assert topics(store.match('sensors/+/temp')) == [
+        'sensors/hall/temp', 'sensors/kitchen/temp']
+    assert topics(store.match('+/temp')) == ['other/temp']
+
+
+def test_multi_level_wildcard(store):
+    assert topics(store.match('sensors/#')) == [
+        'sensors', 'sensors/hall/temp', 'sensors/kitchen/humidity',
+        'sensors/kitchen/temp']
+    assert len(topics(store.match('#'))) == 5
+
+
+def test_system_topics_not_matched_by_leading_wildcard(store):
+    assert '$SYS/info' not in topics(store.match('#'))
+    assert topics(store.match('+/info')) == []
+    assert topics(store.match('$SYS/#')) == ['$SYS/info']
+
+
+def test_match_is_lazy(store):
+    messages = store.match('sensors/#')
+    next(messages)
+    # changing the store part way through doesn't break the walk
+    store.set('sensors/new/topic', b'x')
+    store.remove('sensors/kitchen/temp')
+    assert len(list(messages)) >= 2
+
+
+def test_memory_accounting(store):
+    stats = store.stats()
+    assert stats['messages'] == 6
+    assert stats['bytes'] > 0
+    assert stats['bytes_per_message'] == stats['bytes'] / 6
+
+    for message in list(store.match('#')) + [store.get('$SYS/info')]:
+        store.remove(message.topic)
+    assert store.stats() == {'messages': 0, 'bytes': 0, 'bytes_per_message': 0}
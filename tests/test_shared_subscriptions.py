@@ -0,0 +1,150 @@
+import pytest
+
+from shared_subscriptions import (
+    SharedSubscriptions, parse_shared, ROUND_ROBIN, LEAST_INFLIGHT, STICKY)
+from topic_trie import TopicFilterError
+
+
+class Queue:
+    depth = 0
+
+
+class Connection:
+    def __init__(self, inflight=0):
+        self.inflight = dict.fromkeys(range(inflight))
+        self.queue = Queue()
+
+
+def test_parse_shared():
+    assert parse_shared('a/b') is None
+    assert parse_shared('$share/workers/jobs/+') == ('workers', 'jobs/+')
+    for bad in ('$share/workers', '$share//jobs', '$share/w+/jobs', '$share/w/a/#/b'):
+        with pytest.raises(TopicFilterError):
+            parse_shared(bad)
+
+
+def test_round_robin():
+    shared = SharedSubscriptions(ROUND_ROBIN)
+    for client_id in ('a', 'b', 'c'):
+        shared.subscribe('workers', 'jobs/#', client_id, 1)
+    clients = {'a': Connection(), 'b': Connection(), 'c': Connection()}
+    picked = [shared.match('jobs/1', clients, {})[0] for _ in range(6)]
+    assert picked == [('a', 1), ('b', 1), ('c', 1)] * 2
+
+    # disconnected members are skipped
+    del clients['b']
+    picked = [shared.match('jobs/1', clients, {})[0][0] for _ in range(4)]
+    assert sorted(picked) == ['a', 'a', 'c', 'c']
+
+
+def test_each_group_gets_a_copy():
+    shared = SharedSubscriptions()
+    shared.subscribe('g1', 'jobs/#', 'a')
+    shared.subscribe('g2', 'jobs/+', 'b')
+    shared.subscribe('g2', 'other', 'c')
+    clients = {'a': Connection(), 'b': Connection(), 'c': Connection()}
+    assert sorted(shared.match('jobs/1', clients, {})) == [('a', 0), ('b', 0)]
+
+
+def test_least_inflight():
+    shared = SharedSubscriptions(LEAST_INFLIGHT)
+    for client_id in ('a', 'b', 'c'):
+        shared.subscribe('workers', 'jobs', client_id, 1)
+    clients = {'a': Connection(5), 'b': Connection(1), 'c': Connection(3)}
+    assert shared.match('jobs', clients, {}) == [('b', 1)]
+
+    # idle members take turns
+    clients = {'a': Connection(), 'b': Connection(), 'c': Connection()}
+    picked = {shared.match('jobs', clients, {})[0][0] for _ in range(3)}
+    assert picked == {'a', 'b', 'c'}
+
+
+def test_sticky():
+    shared = SharedSubscriptions(STICKY)
+    for client_id in ('a', 'b', 'c', 'd'):
+        shared.subscribe('workers', 'jobs/+', client_id)
+    clients = {client_id: Connection() for client_id in 'abcd'}
+    topics = [f'jobs/{i}' for i in range(100)]
+    before = {topic: shared.match(topic, clients, {})[0][0] for topic in topics}
+    assert before == {topic: shared.match(topic, clients, {})[0][0] for topic in topics}
+    assert len(set(before.values())) == 4
+
+    # only the topics of a member that leaves move
+    del clients['d']
+    after = {topic: shared.match(topic, clients, {})[0][0] for topic in topics}
+    for topic in topics:
+        if before[topic] != 'd':
+            assert after[topic] == before[topic]
+
+
+def test_offline_members_used_when_none_connected():
+    shared = SharedSubscriptions()
+    shared.subscribe('workers', 'jobs', 'a', 1)
+    shared.subscribe('workers', 'jobs', 'b', 1)
+    assert shared.match('jobs', {}, {'b': object()}) == [('b', 1)]
+    assert shared.match('jobs', {}, {}) == []
+
+
+def test_unsubscribe_removes_empty_group():
+    shared = SharedSubscriptions()
+    assert shared.subscribe('workers', 'jobs', 'a')
+    assert not shared.subscribe('workers', 'jobs', 'a', 1)
+    assert shared.subscribe('workers', 'jobs', 'b')
+    assert shared.unsubscribe('workers', 'jobs', 'a')
+    assert not shared.unsubscribe('workers', 'jobs', 'a')
+    assert len(shared) == 1
+    assert shared.unsubscribe('workers', 'jobs', 'b')
+    assert len(shared) == 0 and len(shared.topics) == 0
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        SharedSubscriptions('random')
+
+
+def test_peers_take_part_in_groups():
+    shared = SharedSubscriptions(ROUND_ROBIN)
+    shared.subscribe('workers', 'jobs/#', 'a', 1)
+    shared.subscribe('workers', 'jobs/#', 'b', 1)
+    shared.add_peer('workers', 'jobs/#', 'node-2')
+    clients = {'a': Connection(), 'b': Connection()}
+    links = {'node-2': object()}
+
+    picked = []
+    for _ in range(6):
+        members, peers = shared.route('jobs/1', clients, {}, links)
+        assert len(members) + len(peers) == 1
+        picked.extend(member for member, _ in members)
+        picked.extend(peers)
+        if peers:
+            assert peers == {'node-2': [('workers', 'jobs/#')]}
+    # a peer counts as one member whatever it has behind it
+    assert sorted(picked) == ['a', 'a', 'b', 'b', 'node-2', 'node-2']
+
+    # an unlinked peer is skipped
+    members, peers = shared.route('jobs/1', clients, {}, {})
+    assert peers == {} and len(members) == 1
+
+
+def test_group_only_peers_have():
+    shared = SharedSubscriptions(ROUND_ROBIN)
+    shared.add_peer('workers', 'jobs', 'node-2')
+    assert len(shared) == 0
+    assert shared.stats() == {}
+    assert shared.route('jobs', {}, {}, {'node-2': object()}) == \
+        ([], {'node-2': [('workers', 'jobs')]})
+    # nothing to pick here if the peer was chosen for it
+    assert shared.match('jobs', {}, {}, [('workers', 'jobs')]) == []
+
+    shared.remove_peer('workers', 'jobs', 'node-2')
+    assert shared.groups == {}
+    assert len(shared.topics) == 0
+
+
+def test_match_only_named_groups():
+    shared = SharedSubscriptions(ROUND_ROBIN)
+    shared.subscribe('g1', 'jobs', 'a', 1)
+    shared.subscribe('g2', 'jobs', 'b', 1)
+    clients = {'a': Connection(), 'b': Connection()}
+    assert shared.match('jobs', clients, {}, []) == []
+    assert shared.match('jobs', clients, {}, [('g2', 'jobs')]) == [('b', 1)]
@@ -0,0 +1,73 @@
+import socket
+
+from socket_writer import SocketWriter
+
+
+class FakeSocket:
+    """ Records sendmsg calls, optionally only accepting a few bytes each """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.calls = []
+        self.received = bytearray()
+
+    def sendmsg(self, buffers):
+        data = b''.join(bytes(b) for b in buffers)
+        if self.limit is not None:
+            data = data[:self.limit]
+        self.calls.append(len(buffers))
+        self.received.extend(data)
+        return len(data)
+
+
+def test_batch_sent_in_one_sendmsg():
+    sock = FakeSocket()
+    writer = SocketWriter(sock, max_delay=10)
+    writer.write(b'\x40\x02\x00\x01')
+    writer.write(b'\x40\x02\x00\x02')
+    assert sock.calls == []
+    writer.flush()
+    assert sock.calls == [2]
+    assert sock.received == b'\x40\x02\x00\x01\x40\x02\x00\x02'
+    writer.close()
+
+
+def test_flushes_when_max_bytes_reached():
+    sock = FakeSocket()
+    writer = SocketWriter(sock, max_bytes=8, max_delay=10)
+    writer.write(b'1234')
+    writer.write(b'5678')
+    assert sock.calls == [2]
+    writer.close()
+
+
+def test_no_delay_writes_through():
+    sock = FakeSocket()
+    writer = SocketWriter(sock, max_delay=None)
+    writer.write(b'abc')
+    assert sock.received == b'abc'
+
+
+def test_partial_sends_are_resumed():
+    sock = FakeSocket(limit=3)
+    writer = SocketWriter(sock, max_delay=10)
+    for chunk in (b'abcd', b'ef', b'ghijk'):
+        writer.write(chunk)
+    writer.flush()
+    assert sock.received == b'abcdefghijk'
+    writer.close()
+
+
+def test_background_flush_after_delay():
+    a, b = socket.socketpair()
+    writer = SocketWriter(a, max_delay=0.005)
+    writer.write(b'hello ')
+    writer.write(b'world')
+    b.settimeout(1)
+    received = b''
+    while len(received) < 11:
+        received += b.recv(64)
+    assert received == b'hello world'
+    writer.close()
+    a.close()
+    b.close()
@@ -0,0 +1,64 @@
+from timer_wheel import TimerWheel
+
+
+def test_expires_after_timeout():
+    wheel = TimerWheel(resolution=1.0, slots=8)
+    wheel.schedule('a', 3, now=0)
+    assert wheel.advance(2.5) == []
+    assert wheel.advance(4.0) == ['a']
+    assert 'a' not in wheel
+    assert wheel.advance(10) == []
+
+
+def test_never_expires_early():
+    wheel = TimerWheel(resolution=1.0, slots=8)
+    wheel.schedule('a', 1.5, now=0.9)
+    assert wheel.advance(2.0) == []
+    assert wheel.advance(3.0) == ['a']
+
+
+def test_touch_pushes_deadline_back():
+    wheel = TimerWheel(resolution=1.0, slots=8)
+    wheel.schedule('a', 3, now=0)
+    for now in range(1, 10):
+        wheel.touch('a', now)
+        assert wheel.advance(now) == []
+    assert wheel.advance(11) == []
+    assert wheel.advance(13) == ['a']
+
+
+def test_cancel():
+    wheel = TimerWheel(resolution=1.0, slots=8)
+    wheel.schedule('a', 1, now=0)
+    wheel.schedule('b', 1, now=0)
+    wheel.cancel('a')
+    wheel.cancel('missing')
+    assert wheel.advance(5) == ['b']
+    assert len(wheel) == 0
+
+
+def test_timeout_longer_than_a_turn():
+    wheel = TimerWheel(resolution=1.0, slots=4)
+    wheel.schedule('a', 10, now=0)
+    for now in range(1, 11):
+        assert wheel.advance(now) == []
+    assert wheel.advance(11) == ['a']
+
+
+def test_catches_up_after_a_stall():
+    wheel = TimerWheel(resolution=1.0, slots=4)
+    wheel.schedule('a', 2, now=0)
+    wheel.schedule('b', 7, now=0)
+    wheel.schedule('c', 100, now=0)
+    assert sorted(wheel.advance(50)) == ['a', 'b']
+    assert wheel.advance(102) == ['c']
+
+
+def test_many_timers():
+    wheel = TimerWheel(resolution=1.0, slots=1024)
+    for i in range(1000):
+        wheel.schedule(i, 90 + i % 30, now=0)
+    assert wheel.advance(60) == []
+    expired = wheel.advance(105)
+    assert sorted(expired) == [i for i in range(1000) if 90 + i % 30 < 105]
+    assert len(wheel) == 1000 - len(expired)
@@ -0,0 +1,125 @@
+import asyncio
+import shutil
+import socket
+import threading
+
+import pytest
+
+import tls
+from mqtt_client_connection import MQTTClientConnection
+from mqtt_server import MQTTServer
+from packet_generator import PacketGenerator
+from socket_writer import SocketWriter
+
+pytestmark = pytest.mark.skipif(shutil.which('openssl') is None,
+                                reason='needs the openssl command')
+
+
+@pytest.fixture
+def certificate(tmp_path):
+    return tls.self_signed_certificate(str(tmp_path))
+
+
+async def read_packet(reader):
+    header = await asyncio.wait_for(reader.readexactly(2), 1)
+    return header + await reader.readexactly(header[1])
+
+
+def run_with_tls_server(certificate, test):
+    certfile, keyfile = certificate
+
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0, tls_port=0,
+                            tls_context=tls.server_context(certfile, keyfile))
+        await server.start()
+        try:
+            await test(server, tls.client_context(cafile=certfile))
+        finally:
+            await server.stop()
+    asyncio.run(runner())
+
+
+def test_publish_over_tls(certificate):
+    async def test(server, context):
+        pg = PacketGenerator(None)
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', server.tls_port, ssl=context, server_hostname='localhost')
+        writer.write(pg.create_connect_packet(client_id='secure').raw_bytes)
+        assert await read_packet(reader) == b'\x20\x02\x00\x00'
+        writer.write(pg.create_subscribe_packet('t', 0).raw_bytes)
+        assert (await read_packet(reader))[0] == 0x90
+
+        # the plain listener still works and reaches TLS subscribers
+        plain_reader, plain_writer = await asyncio.open_connection('127.0.0.1', server.port)
+        plain_writer.write(pg.create_connect_packet(client_id='plain').raw_bytes)
+        assert await read_packet(plain_reader) == b'\x20\x02\x00\x00'
+        plain_writer.write(pg.create_publish_packet('t', 'hi', 0, False).raw_bytes)
+        assert await read_packet(reader) == b'\x30\x05\x00\x01thi'
+        writer.close()
+        plain_writer.close()
+
+    run_with_tls_server(certificate, test)
+
+
+def test_client_resumes_session(certificate):
+    async def test(server, context):
+        loop = asyncio.get_running_loop()
+
+        def connect(session):
+            connection = MQTTClientConnection(
+                '127.0.0.1', server.tls_port, keep_alive=0, tls_context=context,
+                server_hostname='localhost', tls_session=session)
+            connection.connect(1)
+            connection.conn.close()
+            return connection
+
+        first = await loop.run_in_executor(None, connect, None)
+        assert first.connected
+        assert not first.tls_session_reused
+        second = await loop.run_in_executor(None, connect, first.tls_session)
+        assert second.connected
+        assert second.tls_session_reused
+
+        stats = server.metrics.snapshot(server)
+        assert stats['tls/handshakes'] == 2
+        assert stats['tls/resumed'] == 1
+
+    run_with_tls_server(certificate, test)
+
+
+def test_untrusted_certificate_refused(certificate):
+    async def test(server, context):
+        loop = asyncio.get_running_loop()
+        connection = MQTTClientConnection(
+            '127.0.0.1', server.tls_port, keep_alive=0,
+            tls_context=tls.client_context(), server_hostname='localhost')
+        await loop.run_in_executor(None, connection.connect, 1)
+        assert not connection.connected
+        connection.conn.close()
+
+    run_with_tls_server(certificate, test)
+
+
+def test_writer_joins_batches_for_tls_sockets(certificate):
+    certfile, keyfile = certificate
+    server_context = tls.server_context(certfile, keyfile)
+    listener = socket.create_server(('127.0.0.1', 0))
+    client = socket.create_connection(listener.getsockname())
+    accepted, _ = listener.accept()
+    with server_context.wrap_socket(accepted, server_side=True,
+                                    do_handshake_on_connect=False) as server_side:
+        handshake = threading.Thread(target=server_side.do_handshake)
+        handshake.start()
+        client = tls.client_context(cafile=certfile).wrap_socket(
+            client, server_hostname='localhost')
+        handshake.join()
+
+        writer = SocketWriter(client, max_delay=10)
+        assert not writer.gather
+        writer.write(b'\x40\x02\x00\x01')
+        writer.write(b'\x40\x02\x00\x02')
+        writer.flush()
+        assert server_side.recv(8) == b'\x40\x02\x00\x01\x40\x02\x00\x02'
+        writer.close()
+        client.close()
+    listener.close()
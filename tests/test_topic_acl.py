@@ -0,0 +1,140 @@
+import pytest
+
+from topic_acl import TopicAcl, TopicAclError, READ, WRITE, READWRITE
+
+
+def test_user_rules():
+    acl = TopicAcl()
+    acl.add_rule('alice/#', READWRITE, user='alice')
+    acl.add_rule('public/+/news', READ, user='alice')
+
+    alice = acl.checker('c1', 'alice')
+    assert alice.can_publish('alice/x/y')
+    assert alice.can_publish('alice')
+    assert not alice.can_publish('public/a/news')
+    assert alice.can_subscribe('public/a/news')
+    assert alice.can_subscribe('public/+/news')
+    assert not alice.can_subscribe('public/#')
+    assert not alice.can_subscribe('public/a/+')
+
+    bob = acl.checker('c2', 'bob')
+    assert not bob.can_publish('alice/x')
+    assert not bob.can_subscribe('alice/#')
+
+
+def test_default_deny():
+    checker = TopicAcl().checker('c', 'u')
+    assert not checker.can_publish('a')
+    assert not checker.can_subscribe('#')
+
+
+def test_subscription_must_be_covered_by_one_rule():
+    acl = TopicAcl()
+    acl.add_rule('a/+/c', READ, pattern=True)
+    acl.add_rule('b/#', READ, pattern=True)
+    checker = acl.checker('c', None)
+    assert checker.can_subscribe('a/+/c')
+    assert not checker.can_subscribe('a/#')
+    assert not checker.can_subscribe('a/+/+')
+    assert checker.can_subscribe('b/#')
+    assert checker.can_subscribe('b/+/x')
+    assert checker.can_subscribe('b')
+
+
+def test_pattern_substitution():
+    acl = TopicAcl()
+    acl.add_rule('devices/%c/#', READWRITE, pattern=True)
+    acl.add_rule('users/%u/inbox', READ, pattern=True)
+    acl.add_rule('tenants/t-%u/%c', WRITE, pattern=True)
+
+    checker = acl.checker('d1', 'alice')
+    assert checker.can_publish('devices/d1/status')
+    assert not checker.can_publish('devices/d2/status')
+    assert not checker.can_subscribe('devices/+/status')
+    assert checker.can_subscribe('users/alice/inbox')
+    assert not checker.can_subscribe('users/bob/inbox')
+    assert checker.can_publish('tenants/t-alice/d1')
+    assert not checker.can_publish('tenants/t-alice/d2')
+
+    # %u never matches for a client without a username
+    anonymous = acl.checker('d1', None)
+    assert anonymous.can_publish('devices/d1/x')
+    assert not anonymous.can_subscribe('users/None/inbox')
+
+    # a client id made of wildcards doesn't widen its access
+    sneaky = acl.checker('+', None)
+    assert not sneaky.can_subscribe('devices/+/#')
+
+
+def test_client_rules():
+    acl = TopicAcl()
+    acl.add_rule('sensors/#', WRITE, client='sensor-*')
+    acl.add_rule('control/#', READ, client='controller')
+    assert acl.checker('sensor-12', None).can_publish('sensors/12/t')
+    assert not acl.checker('actuator-1', None).can_publish('sensors/12/t')
+    assert acl.checker('controller', 'x').can_subscribe('control/#')
+    assert not acl.checker('controller-2', 'x').can_subscribe('control/#')
+
+
+def test_system_topics_need_their_own_rule():
+    acl = TopicAcl()
+    acl.add_rule('#', READ, pattern=True)
+    acl.add_rule('+/stats', READ, pattern=True)
+    checker = acl.checker('c', None)
+    assert checker.can_subscribe('a/b')
+    assert not checker.can_subscribe('$SYS/broker/uptime')
+    assert not checker.can_subscribe('$SYS/stats')
+    acl.add_rule('$SYS/#', READ, pattern=True)
+    assert checker.can_subscribe('$SYS/broker/uptime')
+
+
+def test_publish_decisions_cached():
+    acl = TopicAcl(cache_size=2)
+    acl.add_rule('a/#', WRITE, pattern=True)
+    checker = acl.checker('c', None)
+    for topic in ('a/1', 'a/1', 'b', 'a/1', 'a/2'):
+        checker.can_publish(topic)
+    assert checker.hits == 2
+    assert checker.misses == 3
+    assert list(checker.cache) == ['a/1', 'a/2']
+
+    # new rules drop what was cached
+    acl.add_rule('b', WRITE, pattern=True)
+    assert checker.can_publish('b')
+    assert list(checker.cache) == ['b']
+
+
+def test_load_file(tmp_path):
+    path = tmp_path / 'acl'
+    path.write_text(
+        '# comment\n'
+        'topic read anonymous/#\n'
+        'pattern read $SYS/#\n'
+        '\n'
+        'user alice\n'
+        'topic alice/#\n'
+        'topic read public/a topic with spaces\n'
+        'client sensor-?\n'
+        'topic write sensors/+\n')
+    acl = TopicAcl(str(path))
+    assert len(acl) == 5
+
+    assert acl.checker('x', None).can_subscribe('anonymous/a')
+    assert not acl.checker('x', 'alice').can_subscribe('anonymous/a')
+    alice = acl.checker('x', 'alice')
+    assert alice.can_publish('alice/a')
+    assert alice.can_subscribe('alice/#')
+    assert alice.can_subscribe('public/a topic with spaces')
+    assert alice.can_subscribe('$SYS/broker/uptime')
+    assert acl.checker('sensor-1', None).can_publish('sensors/t')
+    assert not acl.checker('sensor-10', None).can_publish('sensors/t')
+
+    # a bad file keeps the rules already loaded
+    path.write_text('user bob\ntopic read a/#/b\n')
+    with pytest.raises(TopicAclError):
+        acl.reload()
+    assert alice.can_publish('alice/a')
+
+    path.write_text('bogus line\n')
+    with pytest.raises(TopicAclError):
+        acl.reload()
@@ -0,0 +1,87 @@
+import pytest
+
+from topic_trie import TopicTrie, TopicFilterError, validate_topic_filter
+
+
+@pytest.fixture
+def trie():
+    return TopicTrie()
+
+
+def test_exact_match(trie):
+    trie.subscribe('a/b/c', 'c1', 1)
+    assert trie.match('a/b/c') == {'c1': 1}
+    assert trie.match('a/b') == {}
+    assert trie.match('a/b/c/d') == {}
+
+
+def test_single_level_wildcard(trie):
+    trie.subscribe('sensors/+/temp', 'c1')
+    assert trie.match('sensors/kitchen/temp') == {'c1': 0}
+    assert trie.match('sensors/kitchen/humidity') == {}
+    assert trie.match('sensors/temp') == {}
+    assert trie.match('sensors//temp') == {'c1': 0}
+
+
+def test_multi_level_wildcard(trie):
+    trie.subscribe('sensors/#', 'c1')
+    assert trie.match('sensors') == {'c1': 0}
+    assert trie.match('sensors/a') == {'c1': 0}
+    assert trie.match('sensors/a/b/c') == {'c1': 0}
+    assert trie.match('other') == {}
+
+
+def test_hash_matches_everything(trie):
+    trie.subscribe('#', 'c1')
+    assert trie.match('a') == {'c1': 0}
+    assert trie.match('a/b') == {'c1': 0}
+
+
+def test_system_topics_not_matched_by_leading_wildcard(trie):
+    trie.subscribe('#', 'c1')
+    trie.subscribe('+/broker', 'c2')
+    trie.subscribe('$SYS/#', 'c3')
+    assert trie.match('$SYS/broker') == {'c3': 0}
+
+
+def test_overlapping_subscriptions_deduplicated_at_highest_qos(trie):
+    trie.subscribe('a/#', 'c1', 0)
+    trie.subscribe('a/+', 'c1', 2)
+    trie.subscribe('a/b', 'c1', 1)
+    trie.subscribe('a/b', 'c2', 1)
+    assert trie.match('a/b') == {'c1': 2, 'c2': 1}
+
+
+def test_resubscribe_replaces_qos(trie):
+    assert trie.subscribe('a', 'c1', 0)
+    assert not trie.subscribe('a', 'c1', 2)
+    assert len(trie) == 1
+    assert trie.match('a') == {'c1': 2}
+
+
+def test_unsubscribe_prunes_nodes(trie):
+    trie.subscribe('a/b/c', 'c1')
+    trie.subscribe('a/b/c', 'c2')
+    assert trie.unsubscribe('a/b/c', 'c1')
+    assert trie.match('a/b/c') == {'c2': 0}
+    assert trie.unsubscribe('a/b/c', 'c2')
+    assert not trie.unsubscribe('a/b/c', 'c2')
+    assert len(trie) == 0
+    assert trie.root.is_empty()
+
+
+def test_unsubscribe_unknown_filter(trie):
+    trie.subscribe('a/b', 'c1')
+    assert not trie.unsubscribe('a/x', 'c1')
+    assert not trie.unsubscribe('a/b/c', 'c1')
+
+
+@pytest.mark.parametrize('topic_filter', ['', 'a/#/b', 'a/b#', 'a+/b', 'a/+b'])
+def test_invalid_filters(trie, topic_filter):
+    with pytest.raises(TopicFilterError):
+        trie.subscribe(topic_filter, 'c1')
+
+
+@pytest.mark.parametrize('topic_filter', ['a', '/', '+', '#', 'a/+/#', '+/+'])
+def test_valid_filters(topic_filter):
+    validate_topic_filter(topic_filter)
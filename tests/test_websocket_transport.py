@@ -0,0 +1,172 @@
+import asyncio
+import base64
+import os
+
+import pytest
+
+from mqtt_server import MQTTServer
+from packet_generator import PacketGenerator
+from websocket_transport import (
+    unmask, accept_key, frame_header, STRIDED_MIN_BYTES,
+    OPCODE_BINARY, OPCODE_TEXT, OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG,
+    OPCODE_CONTINUATION)
+
+
+def xor(data, mask):
+    return bytes(byte ^ mask[i % 4] for i, byte in enumerate(data))
+
+
+@pytest.mark.parametrize('size', [0, 1, 7, STRIDED_MIN_BYTES - 1, STRIDED_MIN_BYTES, 10001])
+def test_unmask(size):
+    data = os.urandom(size)
+    mask = os.urandom(4)
+    masked = bytearray(data)
+    unmask(masked, mask)
+    assert masked == xor(data, mask)
+    unmask(masked, mask)
+    assert masked == data
+
+
+def test_accept_key():
+    # the example from RFC 6455 1.3
+    assert accept_key('dGhlIHNhbXBsZSBub25jZQ==') == b's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+
+
+def masked_frame(opcode, payload, final=True):
+    mask = os.urandom(4)
+    header = bytearray(frame_header(opcode, len(payload), mask))
+    if not final:
+        header[0] &= 0x7F
+    return bytes(header) + xor(payload, mask)
+
+
+async def open_websocket(port, path='/mqtt', protocol='mqtt'):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    request = (f'GET {path} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+               f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n'
+               f'Sec-WebSocket-Version: 13\r\n')
+    if protocol:
+        request += f'Sec-WebSocket-Protocol: {protocol}\r\n'
+    writer.write((request + '\r\n').encode())
+    response = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 1)
+    return reader, writer, key, response.decode()
+
+
+async def read_frame(reader):
+    first, second = await asyncio.wait_for(reader.readexactly(2), 1)
+    length = second & 0x7F
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), 'big')
+    elif length == 127:
+        length = int.from_bytes(await reader.readexactly(8), 'big')
+    return first & 0x0F, await reader.readexactly(length)
+
+
+async def read_stream(reader, size):
+    """ The payloads of binary frames up to size bytes """
+    stream = b''
+    while len(stream) < size:
+        opcode, payload = await read_frame(reader)
+        assert opcode == OPCODE_BINARY
+        stream += payload
+    return stream
+
+
+def run_with_websocket_server(test, path='/mqtt'):
+    async def runner():
+        server = MQTTServer(host='127.0.0.1', port=0, websocket_port=0,
+                            websocket_path=path)
+        await server.start()
+        try:
+            await test(server)
+        finally:
+            await server.stop()
+    asyncio.run(runner())
+
+
+def test_mqtt_over_websocket():
+    async def test(server):
+        reader, writer, key, response = await open_websocket(server.websocket_port)
+        assert response.startswith('HTTP/1.1 101')
+        assert f'Sec-WebSocket-Accept: {accept_key(key).decode()}' in response
+        assert 'Sec-WebSocket-Protocol: mqtt\r\n' in response
+
+        pg = PacketGenerator(None)
+        connect = pg.create_connect_packet(client_id='browser').raw_bytes
+        # packets split over fragmented frames, and frames split over writes
+        frames = masked_frame(OPCODE_BINARY, connect[:5], final=False) + \
+            masked_frame(OPCODE_CONTINUATION, connect[5:])
+        for i in range(0, len(frames), 3):
+            writer.write(frames[i:i + 3])
+            await writer.drain()
+        assert await read_frame(reader) == (OPCODE_BINARY, b'\x20\x02\x00\x00')
+
+        # two packets in one frame
+        writer.write(masked_frame(
+            OPCODE_BINARY, pg.create_subscribe_packet('t', 0).raw_bytes +
+            pg.create_publish_packet('t', 'x' * 1000, 0, False).raw_bytes))
+        # the replies may share a frame, what matters is the stream
+        stream = await read_stream(reader, 5 + 1006)
+        assert stream[0] == 0x90
+        assert stream[5:] == pg.create_publish_packet('t', 'x' * 1000, 0, False).raw_bytes
+
+        # plain tcp publishers reach websocket subscribers
+        tcp_reader, tcp_writer = await asyncio.open_connection('127.0.0.1', server.port)
+        tcp_writer.write(pg.create_connect_packet(client_id='tcp').raw_bytes)
+        await asyncio.wait_for(tcp_reader.readexactly(4), 1)
+        tcp_writer.write(pg.create_publish_packet('t', 'hi', 0, False).raw_bytes)
+        assert await read_frame(reader) == (OPCODE_BINARY, b'\x30\x05\x00\x01thi')
+        assert server.clients.get('browser') is not None
+
+        writer.write(masked_frame(OPCODE_PING, b'ping'))
+        assert await read_frame(reader) == (OPCODE_PONG, b'ping')
+
+        writer.write(masked_frame(OPCODE_CLOSE, (1000).to_bytes(2, 'big')))
+        assert await read_frame(reader) == (OPCODE_CLOSE, (1000).to_bytes(2, 'big'))
+        assert await asyncio.wait_for(reader.read(), 1) == b''
+        await asyncio.sleep(0.01)
+        assert server.clients.get('browser') is None
+        tcp_writer.close()
+
+    run_with_websocket_server(test)
+
+
+def test_broker_closing_sends_close_frame():
+    async def test(server):
+        reader, writer, _, _ = await open_websocket(server.websocket_port)
+        # anything but a CONNECT first closes the connection
+        writer.write(masked_frame(OPCODE_BINARY, b'\xc0\x00'))
+        assert await read_frame(reader) == (OPCODE_CLOSE, (1000).to_bytes(2, 'big'))
+        assert await asyncio.wait_for(reader.read(), 1) == b''
+
+    run_with_websocket_server(test)
+
+
+def test_protocol_errors_close():
+    async def test(server):
+        reader, writer, _, _ = await open_websocket(server.websocket_port)
+        writer.write(masked_frame(OPCODE_TEXT, b'hello'))
+        opcode, payload = await read_frame(reader)
+        assert opcode == OPCODE_CLOSE and payload[:2] == (1003).to_bytes(2, 'big')
+
+        reader, writer, _, _ = await open_websocket(server.websocket_port)
+        # unmasked
+        writer.write(frame_header(OPCODE_BINARY, 2) + b'\xc0\x00')
+        opcode, payload = await read_frame(reader)
+        assert opcode == OPCODE_CLOSE and payload[:2] == (1002).to_bytes(2, 'big')
+
+    run_with_websocket_server(test)
+
+
+def test_bad_upgrades_refused():
+    async def test(server):
+        _, _, _, response = await open_websocket(server.websocket_port, path='/other')
+        assert response.startswith('HTTP/1.1 404')
+        _, _, _, response = await open_websocket(server.websocket_port, protocol='chat')
+        assert response.startswith('HTTP/1.1 400')
+        _, _, _, response = await open_websocket(server.websocket_port, protocol=None)
+        assert response.startswith('HTTP/1.1 101')
+        assert 'Sec-WebSocket-Protocol' not in response
+
+    run_with_websocket_server(test)
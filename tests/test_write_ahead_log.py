@@ -0,0 +1,166 @@
+import asyncio
+import os
+
+from publish_frame import PublishFrame
+from write_ahead_log import WriteAheadLog, QUEUED, RECEIVED, DONE
+
+
+def open_log(path, **kwargs):
+    wal = WriteAheadLog(str(path), fsync=False, **kwargs)
+    wal.open()
+    return wal
+
+
+def log(wal, topic, deliveries, qos=1):
+    frame = PublishFrame(topic, topic.encode())
+    wal.log_message(frame, qos, False, deliveries)
+    wal.commit()
+    return frame.message_id
+
+
+def segment_files(path):
+    return sorted(name for name in os.listdir(path) if name.endswith('.log'))
+
+
+def test_unfinished_deliveries_survive_reopen(tmp_path):
+    wal = open_log(tmp_path)
+    first = log(wal, 'a', [('c1', 1), ('c2', 1)])
+    log(wal, 'b', [('c1', 2)], qos=2)
+    wal.update(first, 'c1', DONE)
+    wal.close()
+
+    wal = open_log(tmp_path)
+    assert [(f.topic, qos, state) for f, qos, state in wal.pending('c1')] == \
+        [('b', 2, QUEUED)]
+    frame, qos, state = wal.pending('c2')[0]
+    assert (frame.topic, frame.payload, frame.message_id) == ('a', b'a', first)
+    # new messages carry on from the recovered ids
+    assert log(wal, 'c', [('c3', 1)]) > first
+    wal.close()
+
+
+def test_delivery_state_is_logged(tmp_path):
+    wal = open_log(tmp_path)
+    message_id = log(wal, 'a', [('c1', 2)], qos=2)
+    wal.update(message_id, 'c1', RECEIVED)
+    wal.close()
+
+    wal = open_log(tmp_path)
+    assert wal.pending('c1')[0][2] == RECEIVED
+    wal.update(message_id, 'c1', DONE)
+    wal.close()
+
+    wal = open_log(tmp_path)
+    assert wal.pending('c1') == []
+    assert wal.stats()['messages'] == 0
+
+
+def test_discard(tmp_path):
+    wal = open_log(tmp_path)
+    log(wal, 'a', [('c1', 1), ('c2', 1)])
+    log(wal, 'b', [('c1', 1)])
+    wal.discard('c1')
+    wal.close()
+
+    wal = open_log(tmp_path)
+    assert wal.pending('c1') == []
+    assert len(wal.pending('c2')) == 1
+    wal.close()
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    wal = open_log(tmp_path)
+    log(wal, 'a', [('c1', 1)])
+    log(wal, 'b', [('c1', 1)])
+    wal.close()
+
+    path = os.path.join(tmp_path, segment_files(tmp_path)[-1])
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        f.truncate(size - 3)
+
+    wal = open_log(tmp_path)
+    assert [f.topic for f, _, _ in wal.pending('c1')] == ['a']
+    wal.close()
+
+
+def test_finished_segments_are_deleted(tmp_path):
+    wal = open_log(tmp_path, segment_bytes=200)
+    ids = [log(wal, f'topic/{i}', [('c1', 1)]) for i in range(20)]
+    assert len(segment_files(tmp_path)) > 3
+    for message_id in ids:
+        wal.update(message_id, 'c1', DONE)
+    wal.commit()
+    assert len(segment_files(tmp_path)) == 1
+    wal.close()
+
+
+def test_mostly_finished_segment_is_compacted(tmp_path):
+    wal = open_log(tmp_path, segment_bytes=200, compact_ratio=0.5)
+    # one slow client holds on to the very first message
+    ids = [log(wal, f'topic/{i}', [('slow' if i == 0 else 'fast', 1)])
+           for i in range(20)]
+    before = segment_files(tmp_path)
+    for message_id in ids[1:]:
+        wal.update(message_id, 'fast', DONE)
+    wal.commit()
+
+    # its message was copied forward and the old segments are gone
+    after = segment_files(tmp_path)
+    assert before[0] not in after
+    assert len(after) < len(before)
+    wal.close()
+    wal = open_log(tmp_path)
+    assert [f.topic for f, _, _ in wal.pending('slow')] == ['topic/0']
+    wal.close()
+
+
+def test_group_commit(tmp_path):
+    async def test():
+        wal = WriteAheadLog(str(tmp_path), commit_window=0.01, fsync=True)
+        wal.open(asyncio.get_running_loop())
+        done = []
+        for i in range(100):
+            frame = PublishFrame('a', b'x')
+            wal.log_message(frame, 1, False, [('c1', 1)])
+            wal.commit(lambda i=i: done.append(i))
+        assert done == []
+        while len(done) < 100:
+            await asyncio.sleep(0.005)
+        assert done == list(range(100))
+        assert wal.syncs == 1
+        await wal.wait_synced()
+        wal.close()
+
+    asyncio.run(test())
+
+
+def test_failed_sync_fails_waiters(tmp_path, monkeypatch):
+    async def test():
+        wal = WriteAheadLog(str(tmp_path), fsync=True)
+        wal.open(asyncio.get_running_loop())
+
+        def fsync(fd):
+            raise OSError(5, 'Input/output error')
+        monkeypatch.setattr('write_ahead_log.os.fsync', fsync)
+
+        done, failed = [], []
+        for i in range(3):
+            wal.log_message(PublishFrame('a', b'x'), 1, False, [('c1', 1)])
+            wal.commit(lambda i=i: done.append(i), lambda i=i: failed.append(i))
+        await asyncio.sleep(0.01)
+        await wal.wait_synced()
+        assert done == []
+        assert failed == [0, 1, 2]
+        assert isinstance(wal.failed, OSError)
+
+        # nothing more is taken once the log has failed
+        wal.log_message(PublishFrame('a', b'x'), 1, False, [('c1', 1)])
+        wal.commit(lambda: done.append(3), lambda: failed.append(3))
+        assert failed == [0, 1, 2, 3]
+        assert wal._buffer == []
+        await asyncio.sleep(0.01)
+        assert done == []
+        wal.close()
+
+    asyncio.run(test())
@@ -0,0 +1,71 @@
+import asyncio
+
+from write_batch import BatchedWriter
+
+
+class FakeTransport:
+    def __init__(self):
+        self.writes = []
+
+    def writelines(self, buffers):
+        self.writes.append(b''.join(buffers))
+
+
+class Writer(BatchedWriter):
+    def __init__(self, loop, batch_bytes, batch_delay=0):
+        self.transport = FakeTransport()
+        self.written = 0
+        self.init_write_batch(loop, batch_bytes, batch_delay)
+
+    def batch_written(self, nbytes):
+        self.written += nbytes
+
+
+def test_one_write_per_loop_iteration():
+    async def runner():
+        writer = Writer(asyncio.get_running_loop(), 1024)
+        writer.send_buffers((b'ab', b'cd'))
+        writer.send_buffers((b'ef',))
+        assert writer.transport.writes == []
+        await asyncio.sleep(0)
+        assert writer.transport.writes == [b'abcdef']
+        assert writer.written == 6
+
+    asyncio.run(runner())
+
+
+def test_full_batch_written_straight_away():
+    async def runner():
+        writer = Writer(asyncio.get_running_loop(), 4)
+        writer.send_buffers((b'abc',))
+        writer.send_buffers((b'de',))
+        assert writer.transport.writes == [b'abcde']
+        await asyncio.sleep(0)
+        assert writer.transport.writes == [b'abcde']
+
+    asyncio.run(runner())
+
+
+def test_batch_delay():
+    async def runner():
+        writer = Writer(asyncio.get_running_loop(), 1024, batch_delay=0.02)
+        writer.send_buffers((b'a',))
+        await asyncio.sleep(0)
+        assert writer.transport.writes == []
+        await asyncio.sleep(0.05)
+        assert writer.transport.writes == [b'a']
+
+    asyncio.run(runner())
+
+
+def test_cancel_flush_drops_batch():
+    async def runner():
+        writer = Writer(asyncio.get_running_loop(), 1024)
+        writer.send_buffers((b'a',))
+        writer.cancel_flush()
+        writer.transport = None
+        writer.send_buffers((b'b',))
+        await asyncio.sleep(0)
+        assert writer.pending == [] and writer.written == 0
+
+    asyncio.run(runner())